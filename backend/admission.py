@@ -0,0 +1,327 @@
+"""
+Admission control and statement timeouts for API queries.
+
+Each API endpoint has a limiter: at most `concurrent` requests run at once,
+up to `queue` more wait for a slot, and anything beyond is turned away at
+once with 429 rather than piling up threads and connections. A queued
+request that gets no slot within ADMISSION_QUEUE_TIMEOUT seconds fails with
+503. Limits default to ADMISSION_MAX_CONCURRENT / ADMISSION_MAX_QUEUE and
+are overridden per endpoint with ADMISSION_LIMITS, e.g.
+
+    ADMISSION_LIMITS=summary=2/8,trips=32/128
+
+Limiters count requests per process, so a gunicorn or uvicorn deployment
+admits `concurrent` requests per endpoint in each worker.
+
+Read sessions (routing.get_read_session, the ASGI session) carry a
+statement_timeout_ms execution option of STATEMENT_TIMEOUT_MS. On
+PostgreSQL it is applied with SET statement_timeout; on SQLite a progress
+handler interrupts the statement once it has run that long. Either way the
+query fails with StatementTimeout (503). Writes and ingest run without the
+option and are never interrupted. aiosqlite connections cannot take a
+progress handler from the event loop's thread, so ASGI on SQLite has
+admission control but no statement timeout.
+
+Rejections are counted in metrics.py by endpoint and reason.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from sqlalchemy import event
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_MAX_CONCURRENT = int(os.getenv('ADMISSION_MAX_CONCURRENT', '16'))
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', '64'))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '10'))
+ADMISSION_LIMITS = os.getenv('ADMISSION_LIMITS', '')
+ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', '1'))
+STATEMENT_TIMEOUT_MS = int(os.getenv('STATEMENT_TIMEOUT_MS', '60000'))
+
+# SQLite virtual machine instructions between two deadline checks
+PROGRESS_HANDLER_STEPS = 10000
+
+# SQLSTATE of a statement cancelled by statement_timeout
+PG_QUERY_CANCELED = '57014'
+
+
+class Rejected(Exception):
+    """A request refused or cut short to protect the server; status is the HTTP code."""
+    status = 503
+    reason = 'rejected'
+    retry_after = None
+
+
+class QueueFull(Rejected):
+    """Every slot of the endpoint is busy and its wait queue is full."""
+    status = 429
+    reason = 'queue_full'
+    retry_after = ADMISSION_RETRY_AFTER
+
+
+class QueueTimeout(Rejected):
+    """The request waited ADMISSION_QUEUE_TIMEOUT seconds without getting a slot."""
+    reason = 'queue_timeout'
+
+
+class StatementTimeout(Rejected):
+    """A statement ran past its statement timeout and was interrupted."""
+    reason = 'statement_timeout'
+
+
+REJECTED = metrics.Counter(
+    'api_requests_rejected_total',
+    'API requests refused by admission control or cut short by a statement timeout'
+)
+STATEMENT_TIMEOUTS = metrics.Counter(
+    'db_statement_timeouts_total',
+    'Statements interrupted by the statement timeout, including batch sub-queries'
+)
+
+
+def record_rejection(endpoint, error):
+    """Count a rejected request for /metrics."""
+    REJECTED.inc(endpoint=endpoint, reason=error.reason)
+
+
+def parse_limits(value):
+    """
+    Per-endpoint overrides from ADMISSION_LIMITS.
+
+    Returns:
+        Dict endpoint name -> (concurrent, queue)
+    """
+    limits = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        name, _, spec = item.partition('=')
+        concurrent, _, queue = spec.partition('/')
+        limits[name.strip()] = (
+            int(concurrent),
+            int(queue) if queue.strip() else ADMISSION_MAX_QUEUE,
+        )
+    return limits
+
+
+class Limiter:
+    """
+    Concurrency limit with a bounded wait queue, for threaded servers.
+
+    Args:
+        name: Endpoint name, used in error messages and metrics
+        concurrent: Requests running at once
+        queue: Requests waiting at once; more are refused with QueueFull
+        timeout: Seconds a request waits before QueueTimeout
+    """
+
+    def __init__(self, name, concurrent, queue, timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.name = name
+        self.concurrent = concurrent
+        self.queue = queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def _acquire(self):
+        with self._condition:
+            if self.active < self.concurrent and not self.waiting:
+                self.active += 1
+                return
+            if self.waiting >= self.queue:
+                raise QueueFull(f'Too many concurrent {self.name} requests, retry shortly')
+            self.waiting += 1
+            try:
+                admitted = self._condition.wait_for(
+                    lambda: self.active < self.concurrent, self.timeout
+                )
+            finally:
+                self.waiting -= 1
+            if not admitted:
+                raise QueueTimeout(f'No {self.name} slot became free within {self.timeout:g}s')
+            self.active += 1
+
+    def _release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    @contextmanager
+    def slot(self):
+        """Hold one of the endpoint's slots, waiting in its queue if needed."""
+        self._acquire()
+        try:
+            yield
+        finally:
+            self._release()
+
+
+class AsyncLimiter(Limiter):
+    """Limiter for the ASGI app; waits on the event loop instead of a thread."""
+
+    def __init__(self, name, concurrent, queue, timeout=ADMISSION_QUEUE_TIMEOUT):
+        super().__init__(name, concurrent, queue, timeout)
+        self._condition = asyncio.Condition()
+
+    async def _acquire(self):
+        async with self._condition:
+            if self.active < self.concurrent and not self.waiting:
+                self.active += 1
+                return
+            if self.waiting >= self.queue:
+                raise QueueFull(f'Too many concurrent {self.name} requests, retry shortly')
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(
+                    self._condition.wait_for(lambda: self.active < self.concurrent), self.timeout
+                )
+            except asyncio.TimeoutError:
+                raise QueueTimeout(f'No {self.name} slot became free within {self.timeout:g}s')
+            finally:
+                self.waiting -= 1
+            self.active += 1
+
+    async def _release(self):
+        async with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    @asynccontextmanager
+    async def slot(self):
+        await self._acquire()
+        try:
+            yield
+        finally:
+            await self._release()
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter(name, limiter_class=Limiter):
+    """The shared limiter of endpoint `name`."""
+    key = (name, limiter_class)
+    found = _limiters.get(key)
+    if found is None:
+        with _limiters_lock:
+            found = _limiters.get(key)
+            if found is None:
+                concurrent, queue = parse_limits(ADMISSION_LIMITS).get(
+                    name, (ADMISSION_MAX_CONCURRENT, ADMISSION_MAX_QUEUE)
+                )
+                found = _limiters[key] = limiter_class(name, concurrent, queue)
+    return found
+
+
+def _limiter_gauge(attribute):
+    def collect():
+        return {
+            (('endpoint', found.name),): getattr(found, attribute)
+            for found in list(_limiters.values())
+        }
+    return collect
+
+
+metrics.Gauge('api_requests_in_flight', 'API requests holding an admission slot',
+              _limiter_gauge('active'))
+metrics.Gauge('api_requests_queued', 'API requests waiting for an admission slot',
+              _limiter_gauge('waiting'))
+
+
+def install_statement_timeouts(engine):
+    """
+    Honour the statement_timeout_ms execution option on `engine`'s
+    connections (see the module docstring). Idempotent.
+
+    Returns:
+        The engine
+    """
+    if engine.dialect.name not in ('sqlite', 'postgresql'):
+        return engine
+    if getattr(engine, '_statement_timeouts', False):
+        return engine
+    engine._statement_timeouts = True
+    sqlite = engine.dialect.name == 'sqlite'
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def apply_timeout(conn, cursor, statement, parameters, context, executemany):
+        timeout_ms = context.execution_options.get('statement_timeout_ms') if context else None
+        info = conn.connection.info
+        if sqlite:
+            if timeout_ms and 'statement_deadline' not in info:
+                _install_progress_handler(conn.connection.dbapi_connection, info)
+            if 'statement_deadline' in info:
+                info['statement_deadline'][0] = (
+                    time.monotonic() + timeout_ms / 1000 if timeout_ms else None
+                )
+        elif info.get('statement_timeout_ms', 0) != (timeout_ms or 0):
+            # Session setting, kept until changed; 0 turns the timeout off
+            cursor.execute(f'SET statement_timeout = {int(timeout_ms or 0)}')
+            info['statement_timeout_ms'] = timeout_ms or 0
+
+    @event.listens_for(engine, 'rollback')
+    def forget_timeout(conn):
+        # A rolled-back SET is undone, so issue it again next time
+        conn.connection.info.pop('statement_timeout_ms', None)
+
+    @event.listens_for(engine, 'checkin')
+    def clear_timeout(dbapi_connection, connection_record):
+        if connection_record is None:
+            return
+        connection_record.info.pop('statement_timeout_ms', None)
+        deadline = connection_record.info.get('statement_deadline')
+        if deadline is not None:
+            deadline[0] = None
+
+    @event.listens_for(engine, 'handle_error')
+    def raise_statement_timeout(context):
+        original = context.original_exception
+        timed_out = False
+        if sqlite and context.connection is not None and not context.connection.invalidated:
+            deadline = context.connection.connection.info.get('statement_deadline')
+            timed_out = deadline is not None and deadline[1]
+            if timed_out:
+                deadline[1] = False
+        elif not sqlite:
+            code = getattr(original, 'pgcode', None) or getattr(original, 'sqlstate', None)
+            timed_out = code == PG_QUERY_CANCELED
+        if timed_out:
+            STATEMENT_TIMEOUTS.inc()
+            timeout_ms = (context.execution_context.execution_options.get('statement_timeout_ms')
+                          if context.execution_context else None)
+            limit = f' of {timeout_ms} ms' if timeout_ms else ''
+            raise StatementTimeout(f'Query cancelled by the statement timeout{limit}') from original
+
+    return engine
+
+
+def _install_progress_handler(dbapi_connection, info):
+    """Interrupt the connection's statements once the deadline in info has passed."""
+    # [deadline (monotonic seconds) or None, whether the handler interrupted]
+    deadline = [None, False]
+    info['statement_deadline'] = deadline
+    if not hasattr(dbapi_connection, 'set_progress_handler'):
+        logger.debug('SQLite driver has no progress handler; statement timeouts disabled')
+        return
+
+    def check_deadline():
+        if deadline[0] is not None and time.monotonic() > deadline[0]:
+            deadline[1] = True
+            return 1
+        return 0
+
+    dbapi_connection.set_progress_handler(check_deadline, PROGRESS_HANDLER_STEPS)
+
+
+def read_options():
+    """Execution options for API read engines."""
+    return {'statement_timeout_ms': STATEMENT_TIMEOUT_MS} if STATEMENT_TIMEOUT_MS > 0 else {}
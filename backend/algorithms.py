@@ -3,8 +3,9 @@ Custom Algorithm Implementations (Manual - No Library Functions)
 Implements multi-criteria filtering and sorting for trip data analysis
 """
 
-from typing import List, Dict, Any, Callable
+from typing import List, Dict, Any, Callable, Tuple
 import logging
+import random
 
 logger = logging.getLogger(__name__)
 
@@ -60,39 +61,60 @@ class TripComparator:
 class QuickSort:
     """
     Manual QuickSort implementation for multi-criteria sorting.
+    Uses random pivots and three-way partitioning so that sorted,
+    reverse-sorted and duplicate-heavy inputs stay O(n log n).
     """
     
     @staticmethod
-    def partition(arr: List[Dict], low: int, high: int, criteria: List[Dict]) -> int:
+    def partition(arr: List[Dict], low: int, high: int, criteria: List[Dict]) -> Tuple[int, int]:
         """
-        Partition function for QuickSort.
+        Three-way (Dutch national flag) partition for QuickSort.
+        
+        Returns:
+            (lt, gt) such that arr[low:lt] < pivot, arr[lt:gt + 1] == pivot
+            and arr[gt + 1:high + 1] > pivot
         
         Time Complexity: O(n) where n is the size of partition
         Space Complexity: O(1)
         """
-        pivot = arr[high]
-        i = low - 1
-        
-        for j in range(low, high):
-            if TripComparator.compare_trips(arr[j], pivot, criteria) <= 0:
+        pivot = arr[random.randint(low, high)]
+        lt = low
+        i = low
+        gt = high
+        
+        while i <= gt:
+            cmp = TripComparator.compare_trips(arr[i], pivot, criteria)
+            if cmp < 0:
+                arr[lt], arr[i] = arr[i], arr[lt]
+                lt += 1
+                i += 1
+            elif cmp > 0:
+                arr[i], arr[gt] = arr[gt], arr[i]
+                gt -= 1
+            else:
                 i += 1
-                arr[i], arr[j] = arr[j], arr[i]
         
-        arr[i + 1], arr[high] = arr[high], arr[i + 1]
-        return i + 1
+        return lt, gt
     
     @staticmethod
     def quicksort(arr: List[Dict], low: int, high: int, criteria: List[Dict]) -> None:
         """
-        Recursive QuickSort implementation.
+        QuickSort that recurses into the smaller partition and loops on the
+        larger one, bounding the stack depth.
         
-        Time Complexity: O(n log n) average, O(n^2) worst case
+        Time Complexity: O(n log n) expected for any input order, including
+            sorted, reverse-sorted and duplicate-heavy inputs
         Space Complexity: O(log n) for recursion stack
         """
-        if low < high:
-            pi = QuickSort.partition(arr, low, high, criteria)
-            QuickSort.quicksort(arr, low, pi - 1, criteria)
-            QuickSort.quicksort(arr, pi + 1, high, criteria)
+        while low < high:
+            lt, gt = QuickSort.partition(arr, low, high, criteria)
+            
+            if lt - low < high - gt:
+                QuickSort.quicksort(arr, low, lt - 1, criteria)
+                low = gt + 1
+            else:
+                QuickSort.quicksort(arr, gt + 1, high, criteria)
+                high = lt - 1
     
     @staticmethod
     def sort(trips: List[Dict], criteria: List[Dict]) -> List[Dict]:
@@ -106,7 +128,7 @@ class QuickSort:
         Returns:
             Sorted list of trips
         
-        Time Complexity: O(n log n) average
+        Time Complexity: O(n log n) expected
         Space Complexity: O(n) for the copy + O(log n) for recursion
         """
         # Create a copy to avoid modifying original
@@ -267,6 +289,68 @@ class TripGrouper:
             groups[window_key].append(trip)
         
         return groups
+    
+    @staticmethod
+    def rolling_window(buckets: List[Dict], window: int, sum_fields: Dict[str, str],
+                       mean_fields: Dict[str, Tuple[str, str]] = None) -> List[Dict]:
+        """
+        Rolling sums and means over consecutive buckets of a series.
+        
+        The window of bucket i covers buckets i-window+1..i (fewer at the
+        start of the series). One running total per field is updated as a
+        bucket enters and another leaves the window, instead of re-adding
+        every window.
+        
+        Args:
+            buckets: Consecutive buckets (gaps already filled) in order
+            window: Number of buckets per window
+            sum_fields: Additive metric -> the bucket field it is summed
+                from; each gets '<metric>_rolling_sum' and
+                '<metric>_rolling_mean' (sum per bucket)
+            mean_fields: Averaged metric -> the bucket fields (sum, count)
+                it averages; each gets '<metric>_rolling_mean', the window's
+                sum over its count
+        
+        Returns:
+            Copies of the buckets with the rolling fields and
+            'rolling_buckets' (buckets in the window) added
+        
+        Time Complexity: O(n * f) for n buckets and f fields, whatever the window
+        Space Complexity: O(n) for the result
+        """
+        mean_fields = mean_fields or {}
+        sources = set(sum_fields.values()) | {field for pair in mean_fields.values() for field in pair}
+        totals = {field: 0 for field in sources}
+        # Buckets in the window with a non-zero count, so that a window of
+        # empty buckets has mean 0 rather than float residue over residue
+        counted = {count_field: 0 for _, count_field in mean_fields.values()}
+        result = []
+        
+        for i, bucket in enumerate(buckets):
+            leaving = buckets[i - window] if i >= window else None
+            
+            for field in sources:
+                totals[field] += bucket.get(field) or 0
+                if leaving is not None:
+                    totals[field] -= leaving.get(field) or 0
+            for field in counted:
+                counted[field] += bool(bucket.get(field))
+                if leaving is not None:
+                    counted[field] -= bool(leaving.get(field))
+            
+            size = min(i + 1, window)
+            row = dict(bucket)
+            for metric, field in sum_fields.items():
+                row[f'{metric}_rolling_sum'] = totals[field]
+                row[f'{metric}_rolling_mean'] = totals[field] / size
+            for metric, (sum_field, count_field) in mean_fields.items():
+                row[f'{metric}_rolling_mean'] = (
+                    totals[sum_field] / totals[count_field] if counted[count_field] else 0.0
+                )
+            row['rolling_buckets'] = size
+            result.append(row)
+        
+        return result
 
 
 class AnomalyDetector:
@@ -375,38 +459,46 @@ class AnomalyDetector:
 class TopKSelector:
     """
     Manual implementation of finding top K trips by a specific metric.
-    Uses a min-heap approach without heapq library.
+    Uses a bounded heap approach without heapq library: a min-heap of the
+    k largest values for 'desc', a max-heap of the k smallest for 'asc'.
     """
     
     @staticmethod
     def heapify_down(heap: List[Dict], index: int, criteria: Dict) -> None:
         """
-        Maintain min-heap property by moving element down.
+        Maintain the heap property by moving element down.
+        
+        The root holds the element that would be evicted first: the smallest
+        value for 'desc' order, the largest for 'asc' order.
         
         Time Complexity: O(log k)
         Space Complexity: O(1)
         """
         size = len(heap)
-        smallest = index
-        left = 2 * index + 1
-        right = 2 * index + 2
-        
         field = criteria['field']
+        sign = 1 if criteria.get('order', 'desc') == 'desc' else -1
         
-        if left < size and heap[left].get(field, float('inf')) < heap[smallest].get(field, float('inf')):
-            smallest = left
-        
-        if right < size and heap[right].get(field, float('inf')) < heap[smallest].get(field, float('inf')):
-            smallest = right
-        
-        if smallest != index:
-            heap[index], heap[smallest] = heap[smallest], heap[index]
-            TopKSelector.heapify_down(heap, smallest, criteria)
+        while True:
+            root = index
+            left = 2 * index + 1
+            right = 2 * index + 2
+            
+            if left < size and sign * heap[left][field] < sign * heap[root][field]:
+                root = left
+            
+            if right < size and sign * heap[right][field] < sign * heap[root][field]:
+                root = right
+            
+            if root == index:
+                return
+            
+            heap[index], heap[root] = heap[root], heap[index]
+            index = root
     
     @staticmethod
     def select_top_k(trips: List[Dict], k: int, criteria: Dict) -> List[Dict]:
         """
-        Select top K trips based on a criterion using min-heap.
+        Select top K trips based on a criterion using a bounded heap.
         
         Args:
             trips: List of trip dictionaries
@@ -417,36 +509,43 @@ class TopKSelector:
             Top K trips
         
         Time Complexity: O(n log k) where n is number of trips
+            (the heap is built once in O(k), then each of the remaining
+            trips costs at most one O(log k) sift)
         Space Complexity: O(k) for the heap
         """
+        if k <= 0:
+            return []
+        
         if k >= len(trips):
             return QuickSort.sort(trips, [criteria])
         
         field = criteria['field']
         order = criteria.get('order', 'desc')
         
-        # Build min-heap of size k
+        # Fill the heap with the first k trips that have a value
         heap = []
+        position = 0
+        while position < len(trips) and len(heap) < k:
+            if trips[position].get(field) is not None:
+                heap.append(trips[position])
+            position += 1
         
-        for trip in trips:
+        # Build the heap bottom-up, once
+        for i in range(len(heap) // 2 - 1, -1, -1):
+            TopKSelector.heapify_down(heap, i, criteria)
+        
+        for trip in trips[position:]:
             value = trip.get(field)
             if value is None:
                 continue
             
-            if len(heap) < k:
-                heap.append(trip)
-                # Heapify from bottom up
-                if len(heap) == k:
-                    for i in range(k // 2 - 1, -1, -1):
-                        TopKSelector.heapify_down(heap, i, criteria)
-            else:
-                # If current trip is larger than min, replace
-                if order == 'desc' and value > heap[0].get(field, float('-inf')):
-                    heap[0] = trip
-                    TopKSelector.heapify_down(heap, 0, criteria)
-                elif order == 'asc' and value < heap[0].get(field, float('inf')):
-                    heap[0] = trip
-                    TopKSelector.heapify_down(heap, 0, criteria)
+            # Replace the root if the current trip ranks above it
+            if order == 'desc' and value > heap[0][field]:
+                heap[0] = trip
+                TopKSelector.heapify_down(heap, 0, criteria)
+            elif order == 'asc' and value < heap[0][field]:
+                heap[0] = trip
+                TopKSelector.heapify_down(heap, 0, criteria)
         
         # Sort the heap
         return QuickSort.sort(heap, [criteria])
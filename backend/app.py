@@ -3,17 +3,27 @@ Flask REST API for NYC Taxi Trip Data
 Provides endpoints for querying, filtering, and aggregating trip data
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, g, request, jsonify
 from flask_cors import CORS
-from sqlalchemy import func, and_, or_, extract, desc
-from datetime import datetime, timedelta
-from models import get_session, Trip, Zone, PaymentType, RateCode
-from algorithms import (
-    QuickSort, MultiCriteriaFilter, TripGrouper, 
-    AnomalyDetector, TopKSelector
-)
+from models import get_engine, get_session
+from routing import get_read_session, get_router
+from dimensions import get_dimensions
+from queries import InvalidQuery, build_trip_filters
+import admission
+import batch
+import coalesce
+import histograms
+import index_advisor
+import metrics
+import profiling
+import queries
+import result_cache
+import summary
+import functools
 import logging
 import os
+import threading
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -30,97 +40,164 @@ app.config['JSON_SORT_KEYS'] = False
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-key')
 
 
-def build_trip_filters(args):
-    filters = []
+def load_dimension_cache():
+    """Load the lookup tables at startup so the first request does not pay for it."""
+    try:
+        session = get_read_session()
+        get_dimensions(session)
+        session.close()
+    except Exception as e:
+        logger.warning(f"Dimension cache not loaded at startup: {e}")
 
-    value = args.get('start_date')
-    if value:
-        try:
-            start_date = datetime.strptime(value, '%Y-%m-%d')
-            filters.append(Trip.pickup_datetime >= start_date)
-        except ValueError:
-            pass
 
-    value = args.get('end_date')
-    if value:
-        try:
-            end_date = datetime.strptime(value, '%Y-%m-%d')
-            end_date = end_date.replace(hour=23, minute=59, second=59)
-            filters.append(Trip.pickup_datetime <= end_date)
-        except ValueError:
-            pass
-
-    value = args.get('min_fare')
-    if value not in (None, ''):
-        try:
-            filters.append(Trip.fare_amount >= float(value))
-        except ValueError:
-            pass
+load_dimension_cache()
 
-    value = args.get('max_fare')
-    if value not in (None, ''):
-        try:
-            filters.append(Trip.fare_amount <= float(value))
-        except ValueError:
-            pass
 
-    value = args.get('min_distance')
-    if value not in (None, ''):
-        try:
-            filters.append(Trip.trip_distance >= float(value))
-        except ValueError:
-            pass
+# Requests are appended here for replay by index_advisor.py
+WORKLOAD_LOG_PATH = os.getenv('WORKLOAD_LOG_PATH')
 
-    value = args.get('max_distance')
-    if value not in (None, ''):
-        try:
-            filters.append(Trip.trip_distance <= float(value))
-        except ValueError:
-            pass
+if WORKLOAD_LOG_PATH:
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
 
-    value = args.get('pickup_zone_id')
-    if value not in (None, ''):
-        try:
-            filters.append(Trip.pickup_zone_id == int(value))
-        except ValueError:
-            pass
-
-    value = args.get('dropoff_zone_id')
-    if value not in (None, ''):
-        try:
-            filters.append(Trip.dropoff_zone_id == int(value))
-        except ValueError:
-            pass
-
-    value = args.get('passenger_count')
-    if value not in (None, ''):
-        try:
-            filters.append(Trip.passenger_count == int(value))
-        except ValueError:
-            pass
+    @app.after_request
+    def log_workload(response):
+        if request.path.startswith('/api/'):
+            index_advisor.record_request(
+                WORKLOAD_LOG_PATH,
+                request.method,
+                request.path,
+                request.args,
+                request.get_json(silent=True) if request.method == 'POST' else None,
+                response.status_code,
+                (time.perf_counter() - g.request_started) * 1000
+            )
+        return response
+
+
+if profiling.PROFILE_ENABLED:
+    @app.before_request
+    def start_profile():
+        g.profile = profiling.begin(
+            request.method,
+            request.path,
+            request.query_string.decode(),
+            request.headers.get(profiling.HEADER),
+            request.headers.get(profiling.MODE_HEADER)
+        )
 
-    return filters
+    @app.after_request
+    def finish_profile(response):
+        profile = g.pop('profile', None)
+        if profile is not None:
+            response.headers[profiling.ID_HEADER] = profile.id
+            profile.finish(response.status_code)
+        return response
+
+    @app.teardown_request
+    def abandon_profile(exc):
+        profile = g.pop('profile', None)
+        if profile is not None:
+            profile.finish(None)
+
+    @app.route('/debug/profiles', methods=['GET'])
+    def list_profiles():
+        """Retained request profiles of this worker, newest first (see profiling.py)."""
+        if not profiling.can_read(request.headers.get(profiling.HEADER)):
+            return jsonify({'error': f'{profiling.HEADER} header required'}), 403
+        return jsonify({'profiles': profiling.list_profiles(), 'retention': profiling.PROFILE_RETENTION})
+
+    @app.route('/debug/profiles/<profile_id>', methods=['GET'])
+    def get_profile(profile_id):
+        """One profile as collapsed stacks, for flamegraph.pl or speedscope."""
+        if not profiling.can_read(request.headers.get(profiling.HEADER)):
+            return jsonify({'error': f'{profiling.HEADER} header required'}), 403
+        profile = profiling.get_profile(profile_id)
+        if profile is None:
+            return jsonify({'error': f'No profile {profile_id}'}), 404
+        return app.response_class(profile['stacks'], content_type='text/plain; charset=utf-8')
+
+
+def rejected(e):
+    """Response for a request turned away by admission control or a statement timeout."""
+    admission.record_rejection(request.path, e)
+    response = jsonify({'error': str(e)})
+    response.status_code = e.status
+    if e.retry_after:
+        response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+def admitted(name):
+    """Run the view in one of the admission slots of endpoint `name`."""
+    def decorate(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                with admission.limiter(name).slot():
+                    return view(*args, **kwargs)
+            except admission.Rejected as e:
+                return rejected(e)
+        return wrapper
+    return decorate
+
+
+# Headers a coalesced follower copies from the leader's response
+SHARED_HEADERS = ('Content-Type', 'Retry-After')
+
+
+def coalesced(name):
+    """Answer identical concurrent requests to endpoint `name` with one response (see coalesce.py)."""
+    def decorate(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            def compute():
+                response = app.make_response(view(*args, **kwargs))
+                headers = [(h, v) for h, v in response.headers.items() if h in SHARED_HEADERS]
+                return response.get_data(), response.status_code, headers
+            body, status, headers = coalesce.run(name, coalesce.request_key(name, request.args), compute)
+            return app.response_class(body, status=status, headers=headers)
+        return wrapper
+    return decorate
+
+
+def cached(name):
+    """Answer endpoint `name` from the shared result cache when it holds the response (see result_cache.py)."""
+    def decorate(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            session = get_read_session()
+            try:
+                cache = result_cache.get_cache(session)
+                version = get_dimensions(session).version if cache else None
+            finally:
+                session.close()
+            if cache is None:
+                return view(*args, **kwargs)
+
+            key = coalesce.request_key(name, request.args)
+            entry = result_cache.lookup(cache, name, key, version)
+            if entry is not None:
+                body, headers = entry.encoded('gzip' in request.headers.get('Accept-Encoding', ''))
+                return app.response_class(body, headers=headers)
+
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                cache.put(key, version, response.get_data(), response.content_type)
+            return response
+        return wrapper
+    return decorate
 
 
 @app.route('/')
 def index():
     """API information endpoint."""
-    return jsonify({
-        'name': 'NYC Taxi Mobility Analytics API',
-        'version': '1.0.0',
-        'endpoints': {
-            'trips': '/api/trips',
-            'statistics': '/api/statistics',
-            'zones': '/api/zones',
-            'time_series': '/api/time-series',
-            'heatmap': '/api/heatmap',
-            'anomalies': '/api/anomalies',
-            'top_routes': '/api/top-routes'
-        }
-    })
+    return jsonify(queries.api_index())
 
 
 @app.route('/api/trips', methods=['GET'])
+@admitted('trips')
 def get_trips():
     """
     Retrieve trips with optional filters.
@@ -141,56 +218,25 @@ def get_trips():
     - sort_order: 'asc' or 'desc'
     """
     try:
-        session = get_session()
-        
-        query = session.query(Trip).join(Trip.pickup_zone).join(
-            Trip.dropoff_zone,
-            Trip.dropoff_zone_id == Zone.zone_id
-        )
-
-        filters = build_trip_filters(request.args)
-
-        if filters:
-            query = query.filter(and_(*filters))
-        
-        # Get total count
-        total_count = query.count()
-        
-        # Sorting
-        sort_by = request.args.get('sort_by', 'pickup_datetime')
-        sort_order = request.args.get('sort_order', 'desc')
-        
-        if hasattr(Trip, sort_by):
-            order_column = getattr(Trip, sort_by)
-            if sort_order == 'desc':
-                query = query.order_by(desc(order_column))
-            else:
-                query = query.order_by(order_column)
-        
-        # Pagination
-        limit = int(request.args.get('limit', 100))
-        offset = int(request.args.get('offset', 0))
-        
-        trips = query.limit(limit).offset(offset).all()
-        
-        # Convert to dict
-        trips_data = [trip.to_dict() for trip in trips]
-        
+        session = get_read_session()
+        result = queries.query_trips(session, request.args, build_trip_filters(request.args))
         session.close()
         
-        return jsonify({
-            'trips': trips_data,
-            'total_count': total_count,
-            'limit': limit,
-            'offset': offset
-        })
+        return jsonify(result)
     
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except admission.Rejected as e:
+        return rejected(e)
     except Exception as e:
         logger.error(f"Error fetching trips: {e}")
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/api/statistics', methods=['GET'])
+@cached('statistics')
+@coalesced('statistics')
+@admitted('statistics')
 def get_statistics():
     """
     Get aggregate statistics.
@@ -199,135 +245,46 @@ def get_statistics():
     - start_date: Start date for statistics
     - end_date: End date for statistics
     - group_by: Group by 'hour', 'day', 'zone', or 'payment_type'
+    - approx: 'true' to estimate from the stratified sample, with 95%
+      confidence intervals; exact with 'approximate': null when the
+      sample holds too few trips of the selected dates
     """
     try:
-        session = get_session()
-
-        filters = build_trip_filters(request.args)
-
-        overall_query = session.query(
-            func.count(Trip.trip_id).label('total_trips'),
-            func.avg(Trip.fare_amount).label('avg_fare'),
-            func.avg(Trip.trip_distance).label('avg_distance'),
-            func.avg(Trip.trip_duration).label('avg_duration'),
-            func.avg(Trip.trip_speed).label('avg_speed'),
-            func.sum(Trip.total_amount).label('total_revenue')
-        )
-
-        if filters:
-            overall_query = overall_query.filter(and_(*filters))
-
-        overall_stats = overall_query.first()
-        
-        stats = {
-            'total_trips': overall_stats.total_trips or 0,
-            'avg_fare': round(float(overall_stats.avg_fare or 0), 2),
-            'avg_distance': round(float(overall_stats.avg_distance or 0), 2),
-            'avg_duration': round(float(overall_stats.avg_duration or 0), 2),
-            'avg_speed': round(float(overall_stats.avg_speed or 0), 2),
-            'total_revenue': round(float(overall_stats.total_revenue or 0), 2)
-        }
-        
-        # Group by statistics
-        group_by = request.args.get('group_by')
-        grouped_stats = []
-        
-        if group_by == 'hour':
-            group_query = session.query(
-                extract('hour', Trip.pickup_datetime).label('hour'),
-                func.count(Trip.trip_id).label('trip_count'),
-                func.avg(Trip.fare_amount).label('avg_fare'),
-                func.avg(Trip.trip_speed).label('avg_speed')
-            )
-
-            if filters:
-                group_query = group_query.filter(and_(*filters))
-
-            results = group_query.group_by('hour').order_by('hour').all()
-            
-            grouped_stats = [{
-                'hour': int(r.hour),
-                'trip_count': r.trip_count,
-                'avg_fare': round(float(r.avg_fare or 0), 2),
-                'avg_speed': round(float(r.avg_speed or 0), 2)
-            } for r in results]
-        
-        elif group_by == 'zone':
-            group_query = session.query(
-                Zone.zone_name,
-                Zone.borough,
-                func.count(Trip.trip_id).label('trip_count'),
-                func.avg(Trip.fare_amount).label('avg_fare')
-            ).join(Trip.pickup_zone)
-
-            if filters:
-                group_query = group_query.filter(and_(*filters))
-
-            results = group_query.group_by(Zone.zone_name, Zone.borough).order_by(
-                desc('trip_count')
-            ).limit(20).all()
-            
-            grouped_stats = [{
-                'zone_name': r.zone_name,
-                'borough': r.borough,
-                'trip_count': r.trip_count,
-                'avg_fare': round(float(r.avg_fare or 0), 2)
-            } for r in results]
-        
-        elif group_by == 'payment_type':
-            group_query = session.query(
-                PaymentType.payment_name,
-                func.count(Trip.trip_id).label('trip_count'),
-                func.avg(Trip.fare_amount).label('avg_fare')
-            ).join(Trip.payment_type)
-
-            if filters:
-                group_query = group_query.filter(and_(*filters))
-
-            results = group_query.group_by(PaymentType.payment_name).all()
-            
-            grouped_stats = [{
-                'payment_type': r.payment_name,
-                'trip_count': r.trip_count,
-                'avg_fare': round(float(r.avg_fare or 0), 2)
-            } for r in results]
-        
+        session = get_read_session()
+        result = queries.query_statistics(session, request.args, build_trip_filters(request.args))
         session.close()
         
-        return jsonify({
-            'overall': stats,
-            'grouped': grouped_stats
-        })
+        return jsonify(result)
     
+    except admission.Rejected as e:
+        return rejected(e)
     except Exception as e:
         logger.error(f"Error calculating statistics: {e}")
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/api/zones', methods=['GET'])
+@admitted('zones')
 def get_zones():
-    """Get list of all taxi zones."""
+    """Get list of all taxi zones (pre-encoded from the dimension cache)."""
     try:
-        session = get_session()
-        zones = session.query(Zone).order_by(Zone.borough, Zone.zone_name).all()
-        
-        zones_data = [{
-            'zone_id': z.zone_id,
-            'zone_name': z.zone_name,
-            'borough': z.borough,
-            'service_zone': z.service_zone
-        } for z in zones]
-        
+        session = get_read_session()
+        dimensions = get_dimensions(session)
         session.close()
         
-        return jsonify({'zones': zones_data})
+        return app.response_class(dimensions.zones_json, mimetype='application/json')
     
+    except admission.Rejected as e:
+        return rejected(e)
     except Exception as e:
         logger.error(f"Error fetching zones: {e}")
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/api/time-series', methods=['GET'])
+@cached('time-series')
+@coalesced('time-series')
+@admitted('time-series')
 def get_time_series():
     """
     Get time series data for visualizations.
@@ -335,133 +292,57 @@ def get_time_series():
     Query Parameters:
     - start_date: Start date
     - end_date: End date
-    - interval: 'hour', 'day', or 'week'
-    - metric: 'trip_count', 'avg_fare', 'avg_speed', 'total_revenue'
+    - interval: 'hour' or 'day'
+    - approx: 'true' to estimate from the stratified sample, with 95%
+      confidence intervals; exact with 'approximate': null when the
+      sample holds too few trips of the selected dates
+    - window: Buckets per rolling window (e.g. 7 with interval=day); gaps
+      in the series are filled with empty buckets
+    - rolling: Comma-separated metrics to roll (trip_count, total_revenue,
+      avg_fare, avg_speed; default all)
+    - max_points: Largest number of buckets returned, chosen by
+      Largest-Triangle-Three-Buckets so peaks survive
+    - downsample_by: Metric whose shape max_points preserves (default
+      trip_count)
     """
     try:
-        session = get_session()
-        
-        # Parse parameters
-        interval = request.args.get('interval', 'hour')
-        metric = request.args.get('metric', 'trip_count')
-        
-        filters = build_trip_filters(request.args)
-
-        # Build query based on interval
-        if interval == 'hour':
-            query = session.query(
-                extract('hour', Trip.pickup_datetime).label('time_unit'),
-                func.count(Trip.trip_id).label('trip_count'),
-                func.avg(Trip.fare_amount).label('avg_fare'),
-                func.avg(Trip.trip_speed).label('avg_speed'),
-                func.sum(Trip.total_amount).label('total_revenue')
-            )
-
-            if filters:
-                query = query.filter(and_(*filters))
-
-            results = query.group_by('time_unit').order_by('time_unit').all()
-            
-            time_series = [{
-                'hour': int(r.time_unit),
-                'trip_count': r.trip_count,
-                'avg_fare': round(float(r.avg_fare or 0), 2),
-                'avg_speed': round(float(r.avg_speed or 0), 2),
-                'total_revenue': round(float(r.total_revenue or 0), 2)
-            } for r in results]
-        
-        elif interval == 'day':
-            query = session.query(
-                func.date(Trip.pickup_datetime).label('date'),
-                func.count(Trip.trip_id).label('trip_count'),
-                func.avg(Trip.fare_amount).label('avg_fare'),
-                func.avg(Trip.trip_speed).label('avg_speed'),
-                func.sum(Trip.total_amount).label('total_revenue')
-            )
-
-            if filters:
-                query = query.filter(and_(*filters))
-
-            results = query.group_by('date').order_by('date').all()
-
-            time_series = [{
-                'date': str(r.date),
-                'trip_count': r.trip_count,
-                'avg_fare': round(float(r.avg_fare or 0), 2),
-                'avg_speed': round(float(r.avg_speed or 0), 2),
-                'total_revenue': round(float(r.total_revenue or 0), 2)
-            } for r in results]
-        
+        session = get_read_session()
+        result = queries.query_time_series(session, request.args, build_trip_filters(request.args))
         session.close()
         
-        return jsonify({'time_series': time_series})
+        return jsonify(result)
     
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except admission.Rejected as e:
+        return rejected(e)
     except Exception as e:
         logger.error(f"Error generating time series: {e}")
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/api/heatmap', methods=['GET'])
+@cached('heatmap')
+@coalesced('heatmap')
+@admitted('heatmap')
 def get_heatmap():
     """Get heatmap data for pickup/dropoff locations."""
     try:
-        session = get_session()
-        
-        filters = build_trip_filters(request.args)
-        
-        # Pickup heatmap
-        pickup_query = session.query(
-            Zone.zone_id,
-            Zone.zone_name,
-            Zone.borough,
-            func.count(Trip.trip_id).label('pickup_count')
-        ).join(Trip.pickup_zone)
-
-        if filters:
-            pickup_query = pickup_query.filter(and_(*filters))
-
-        pickup_data = pickup_query.group_by(Zone.zone_id, Zone.zone_name, Zone.borough).order_by(
-            desc('pickup_count')
-        ).limit(50).all()
-        
-        # Dropoff heatmap
-        dropoff_query = session.query(
-            Zone.zone_id,
-            Zone.zone_name,
-            Zone.borough,
-            func.count(Trip.trip_id).label('dropoff_count')
-        ).join(Trip.dropoff_zone)
-
-        if filters:
-            dropoff_query = dropoff_query.filter(and_(*filters))
-
-        dropoff_data = dropoff_query.group_by(Zone.zone_id, Zone.zone_name, Zone.borough).order_by(
-            desc('dropoff_count')
-        ).limit(50).all()
-        
+        session = get_read_session()
+        result = queries.query_heatmap(session, request.args, build_trip_filters(request.args))
         session.close()
         
-        return jsonify({
-            'pickup': [{
-                'zone_id': r.zone_id,
-                'zone_name': r.zone_name,
-                'borough': r.borough,
-                'count': r.pickup_count
-            } for r in pickup_data],
-            'dropoff': [{
-                'zone_id': r.zone_id,
-                'zone_name': r.zone_name,
-                'borough': r.borough,
-                'count': r.dropoff_count
-            } for r in dropoff_data]
-        })
+        return jsonify(result)
     
+    except admission.Rejected as e:
+        return rejected(e)
     except Exception as e:
         logger.error(f"Error generating heatmap: {e}")
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/api/anomalies', methods=['GET'])
+@admitted('anomalies')
 def get_anomalies():
     """
     Detect anomalies using custom algorithm.
@@ -472,81 +353,236 @@ def get_anomalies():
     - limit: Number of results (default 100)
     """
     try:
-        session = get_session()
-        
-        field = request.args.get('field', 'fare_amount')
-        threshold = float(request.args.get('threshold', 3.0))
-        limit = int(request.args.get('limit', 100))
-        
-        # Fetch sample of trips
-        trips = session.query(Trip).limit(10000).all()
-        trips_data = [trip.to_dict() for trip in trips]
-        
-        # Use custom anomaly detection algorithm
-        anomalies = AnomalyDetector.detect_outliers(trips_data, field, threshold)
-        
+        session = get_read_session()
+        result = queries.query_anomalies(session, request.args)
         session.close()
         
-        return jsonify({
-            'anomalies': anomalies[:limit],
-            'total_anomalies': len(anomalies),
-            'field': field,
-            'threshold': threshold
-        })
+        return jsonify(result)
     
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except admission.Rejected as e:
+        return rejected(e)
     except Exception as e:
         logger.error(f"Error detecting anomalies: {e}")
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/api/top-routes', methods=['GET'])
+@cached('top-routes')
+@coalesced('top-routes')
+@admitted('top-routes')
 def get_top_routes():
     """Get top routes by trip count."""
     try:
-        session = get_session()
-        
-        limit = int(request.args.get('limit', 20))
+        session = get_read_session()
+        result = queries.query_top_routes(session, request.args)
+        session.close()
         
-        results = session.query(
-            Zone.zone_name.label('pickup_zone'),
-            Zone.zone_id.label('pickup_zone_id'),
-            func.count(Trip.trip_id).label('trip_count'),
-            func.avg(Trip.fare_amount).label('avg_fare'),
-            func.avg(Trip.trip_distance).label('avg_distance')
-        ).join(Trip.pickup_zone).group_by(
-            Zone.zone_name, Zone.zone_id
-        ).order_by(desc('trip_count')).limit(limit).all()
+        return jsonify(result)
+    
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except admission.Rejected as e:
+        return rejected(e)
+    except Exception as e:
+        logger.error(f"Error fetching top routes: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/percentiles', methods=['GET'])
+@cached('percentiles')
+@coalesced('percentiles')
+@admitted('percentiles')
+def get_percentiles():
+    """
+    Get percentiles of trip metrics.
+    
+    Query Parameters:
+    - Standard trip filters (start_date, end_date, min_fare, ...)
+    - metrics: Comma-separated subset of fare_amount, trip_duration,
+      trip_speed, fare_per_km (default all)
+    - percentiles: Comma-separated percentiles (default 50,90,99)
+    
+    Date and pickup zone filters are answered by merging the stored
+    t-digest sketches; other filters fall back to an exact computation.
+    """
+    try:
+        session = get_read_session()
+        try:
+            result = queries.query_percentiles(
+                session, request.args, build_trip_filters(request.args)
+            )
+        finally:
+            session.close()
         
-        routes = [{
-            'pickup_zone': r.pickup_zone,
-            'pickup_zone_id': r.pickup_zone_id,
-            'trip_count': r.trip_count,
-            'avg_fare': round(float(r.avg_fare or 0), 2),
-            'avg_distance': round(float(r.avg_distance or 0), 2)
-        } for r in results]
+        return jsonify(result)
+    
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except admission.Rejected as e:
+        return rejected(e)
+    except Exception as e:
+        logger.error(f"Error computing percentiles: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/histogram2d', methods=['GET'])
+@cached('histogram2d')
+@coalesced('histogram2d')
+@admitted('histogram2d')
+def get_histogram2d():
+    """
+    Get trip counts binned on two columns (e.g. fare vs distance).
+    
+    Query Parameters:
+    - Standard trip filters (start_date, end_date, min_fare, ...)
+    - x, y: trip_distance, trip_duration, fare_amount, tip_amount,
+      total_amount, trip_speed, fare_per_km or fare_per_minute (default
+      trip_distance and fare_amount)
+    - bins: Bins per axis (default 50, at most 200)
+    - x_min, x_max, y_min, y_max: Axis range (default: the filtered trips'
+      values); trips outside it are left out
+    """
+    try:
+        session = get_read_session()
+        try:
+            result = histograms.query_histogram2d(
+                session, request.args, build_trip_filters(request.args)
+            )
+        finally:
+            session.close()
         
+        return jsonify(result)
+    
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except admission.Rejected as e:
+        return rejected(e)
+    except Exception as e:
+        logger.error(f"Error computing 2D histogram: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/summary', methods=['GET'])
+@cached('summary')
+@coalesced('summary')
+@admitted('summary')
+def get_summary():
+    """
+    Every dashboard aggregate from a single pass over the filtered trips.
+    
+    Query Parameters:
+    - Standard trip filters (start_date, end_date, min_fare, ...)
+    - limit: Number of top pickup zones (default 10)
+    
+    Returns overall, hourly, daily, payment_types, heatmap and top_routes
+    sections shaped like the corresponding endpoints; top_routes is
+    computed over the filtered trips.
+    """
+    try:
+        session = get_read_session()
+        result = summary.query_summary(session, request.args, build_trip_filters(request.args))
         session.close()
         
-        return jsonify({'routes': routes})
+        return jsonify(result)
     
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except admission.Rejected as e:
+        return rejected(e)
     except Exception as e:
-        logger.error(f"Error fetching top routes: {e}")
+        logger.error(f"Error building summary: {e}")
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/counts', methods=['GET'])
+@cached('counts')
+@coalesced('counts')
+@admitted('counts')
+def get_counts():
+    """
+    Trip counts per value of one low-cardinality dimension.
+    
+    Query Parameters:
+    - group_by: pickup_zone_id, dropoff_zone_id, passenger_count,
+      payment_type_id, rate_code_id, hour or weekday (0 = Sunday)
+    - Any of those dimensions as filters, comma-separated values ORed
+    - Standard trip filters (start_date, end_date, min_fare, ...)
+    
+    Answered from the bitmap index when every filter is a dimension.
+    """
+    try:
+        session = get_read_session()
+        try:
+            result = queries.query_counts(session, request.args, build_trip_filters(request.args))
+        finally:
+            session.close()
+        
+        return jsonify(result)
+    
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except admission.Rejected as e:
+        return rejected(e)
+    except Exception as e:
+        logger.error(f"Error counting trips: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/batch', methods=['POST'])
+@admitted('batch')
+def run_batch():
+    """
+    Run several queries sharing one filter set in a single request.
+    
+    JSON Body:
+    - filters: Standard trip filters, parsed once for every sub-query
+    - queries: List of {id, query, params}; query is one of trips,
+      statistics, time-series, heatmap, percentiles, histogram2d, summary, counts,
+      top-routes, anomalies, zones
+    
+    Returns each sub-query's result and timing keyed by id.
+    """
+    try:
+        _, filters, sub_queries = batch.parse_batch(request.get_json(silent=True))
+        result = batch.run_batch(
+            get_read_session,
+            sub_queries,
+            filters,
+            parallel=batch.supports_parallel(get_engine())
+        )
+        
+        return jsonify(result)
+    
+    except InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    except admission.Rejected as e:
+        return rejected(e)
+    except Exception as e:
+        logger.error(f"Error running batch: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Admission and timeout counters in the Prometheus text format."""
+    return app.response_class(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint."""
     try:
         session = get_session()
-        trip_count = session.query(func.count(Trip.trip_id)).scalar()
+        result = queries.query_health(session)
         session.close()
+
+        router = get_router()
+        if router.replicas:
+            result['replicas'] = router.status()
         
-        return jsonify({
-            'status': 'healthy',
-            'database': 'connected',
-            'trip_count': trip_count
-        })
+        return jsonify(result)
     except Exception as e:
         return jsonify({
             'status': 'unhealthy',
@@ -554,5 +590,33 @@ def health_check():
         }), 500
 
 
+def warm_result_cache():
+    """Store the default-filter responses of the frontend pages in the result cache."""
+    try:
+        session = get_read_session()
+        try:
+            cache = result_cache.get_cache(session)
+            version = get_dimensions(session).version if cache else None
+        finally:
+            session.close()
+        if cache is not None:
+            client = app.test_client()
+            result_cache.warm(cache, version, lambda path, args: client.get(path, query_string=args))
+    except Exception as e:
+        logger.warning(f"Result cache not warmed: {e}")
+
+
+def start_result_cache_warmup():
+    """
+    Warm the result cache on a background thread, when enabled.
+
+    Called by the servers (below and gunicorn.conf.py), not on import, so
+    tools and tests importing the app do not warm.
+    """
+    if result_cache.RESULT_CACHE and result_cache.RESULT_CACHE_WARM:
+        threading.Thread(target=warm_result_cache, name='result-cache-warmup', daemon=True).start()
+
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    start_result_cache_warmup()
+    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
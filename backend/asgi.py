@@ -0,0 +1,575 @@
+"""
+ASGI entry point for the NYC Taxi Trip API.
+
+Serves the same routes and JSON as app.py, backed by SQLAlchemy's async
+engine (aiosqlite for SQLite, asyncpg for PostgreSQL). Query logic is shared
+with the Flask app through queries.py and runs on the async session via
+run_sync; independent queries within a request (heatmap pickup/dropoff,
+statistics overall/grouped) run concurrently on separate connections.
+Requests are admitted per endpoint as in app.py (see admission.py).
+
+Usage:
+    uvicorn asgi:app --host 0.0.0.0 --port 8000 --workers 4
+"""
+
+import asyncio
+import functools
+import logging
+import time
+from contextlib import asynccontextmanager
+
+from dotenv import load_dotenv
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from starlette.applications import Starlette
+from starlette.datastructures import Headers
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+from dimensions import encode_json, get_dimensions
+from models import (
+    DATASET_CHECK_INTERVAL, create_async_db_engine, dataset_switched, get_database_url,
+)
+from queries import InvalidQuery, build_trip_filters
+import admission
+import batch
+import coalesce
+import histograms
+import metrics
+import parallel
+import profiling
+import queries
+import result_cache
+import summary
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def open_engine(db_url):
+    """Async engine of `db_url` and a session factory carrying the read options."""
+    engine = create_async_db_engine(db_url)
+    admission.install_statement_timeouts(engine.sync_engine)
+    return engine, async_sessionmaker(
+        engine.execution_options(**admission.read_options()), expire_on_commit=False
+    )
+
+
+engine_url = get_database_url()
+engine, AsyncSession = open_engine(engine_url)
+engine_checked_at = time.monotonic()
+
+
+async def follow_dataset_switch():
+    """
+    Move to another dataset generation once datasets.py switched to it
+    (checked at most every DATASET_CHECK_INTERVAL seconds). Requests still
+    running keep their connections of the previous engine, which close as
+    they are returned.
+    """
+    global engine, engine_url, AsyncSession, engine_checked_at
+    if time.monotonic() - engine_checked_at < DATASET_CHECK_INTERVAL:
+        return
+    engine_checked_at = time.monotonic()
+    db_url = await asyncio.to_thread(get_database_url)
+    if db_url == engine_url:
+        return
+    previous = engine
+    engine_url = db_url
+    engine, AsyncSession = open_engine(db_url)
+    dataset_switched()
+    logger.info(f"Serving dataset generation {engine.url.render_as_string(hide_password=True)}")
+    await previous.dispose()
+
+
+class FlaskJSONResponse(JSONResponse):
+    """
+    JSON response rendered byte-for-byte like Flask's jsonify: sorted keys,
+    compact separators and a trailing newline.
+    """
+
+    def render(self, content):
+        return encode_json(content)
+
+
+async def run_query(fn, *args):
+    """Run a synchronous query function from queries.py on its own async session."""
+    await follow_dataset_switch()
+    async with AsyncSession() as session:
+        return await session.run_sync(fn, *args)
+
+
+async def run_parallel(endpoint, args):
+    """Date-sharded statistics or time series; the event loop awaits the pool."""
+    request_plan = await run_query(parallel.plan, endpoint, args)
+    partials = await asyncio.gather(*[asyncio.wrap_future(f) for f in parallel.submit(request_plan)])
+    return parallel.finish(request_plan, partials)
+
+
+def rejected(request, e):
+    """Response for a request turned away by admission control or a statement timeout."""
+    admission.record_rejection(request.url.path, e)
+    headers = {'Retry-After': str(e.retry_after)} if e.retry_after else None
+    return FlaskJSONResponse({'error': str(e)}, status_code=e.status, headers=headers)
+
+
+def admitted(name):
+    """Run the handler in one of the admission slots of endpoint `name`."""
+    def decorate(handler):
+        @functools.wraps(handler)
+        async def wrapper(request):
+            try:
+                async with admission.limiter(name, admission.AsyncLimiter).slot():
+                    return await handler(request)
+            except admission.Rejected as e:
+                return rejected(request, e)
+        return wrapper
+    return decorate
+
+
+# Headers a coalesced follower copies from the leader's response
+SHARED_HEADERS = ('content-type', 'retry-after')
+
+
+def coalesced(name):
+    """Answer identical concurrent requests to endpoint `name` with one response (see coalesce.py)."""
+    def decorate(handler):
+        @functools.wraps(handler)
+        async def wrapper(request):
+            async def compute():
+                response = await handler(request)
+                headers = [(h, v) for h, v in response.headers.items() if h in SHARED_HEADERS]
+                return response.body, response.status_code, headers
+            body, status, headers = await coalesce.run_async(
+                name, coalesce.request_key(name, request.query_params), compute
+            )
+            return Response(body, status_code=status, headers=dict(headers))
+        return wrapper
+    return decorate
+
+
+def _cache_and_version(session):
+    cache = result_cache.get_cache(session)
+    return cache, get_dimensions(session).version if cache else None
+
+
+def cached(name):
+    """Answer endpoint `name` from the shared result cache when it holds the response (see result_cache.py)."""
+    def decorate(handler):
+        @functools.wraps(handler)
+        async def wrapper(request):
+            cache, version = await run_query(_cache_and_version)
+            if cache is None:
+                return await handler(request)
+
+            key = coalesce.request_key(name, request.query_params)
+            entry = await asyncio.to_thread(result_cache.lookup, cache, name, key, version)
+            if entry is not None:
+                body, headers = entry.encoded('gzip' in request.headers.get('accept-encoding', ''))
+                return Response(body, headers=headers)
+
+            response = await handler(request)
+            if response.status_code == 200:
+                await asyncio.to_thread(
+                    cache.put, key, version, response.body, response.headers['content-type']
+                )
+            return response
+        return wrapper
+    return decorate
+
+
+async def index(request):
+    """API information endpoint."""
+    return FlaskJSONResponse(queries.api_index())
+
+
+@admitted('trips')
+async def get_trips(request):
+    """Retrieve trips with optional filters (see app.get_trips)."""
+    try:
+        args = request.query_params
+        result = await run_query(queries.query_trips, args, build_trip_filters(args))
+        return FlaskJSONResponse(result)
+    except InvalidQuery as e:
+        return FlaskJSONResponse({'error': str(e)}, status_code=400)
+    except admission.Rejected as e:
+        return rejected(request, e)
+    except Exception as e:
+        logger.error(f"Error fetching trips: {e}")
+        return FlaskJSONResponse({'error': str(e)}, status_code=500)
+
+
+@cached('statistics')
+@coalesced('statistics')
+@admitted('statistics')
+async def get_statistics(request):
+    """Aggregate statistics; overall and grouped parts run concurrently."""
+    try:
+        args = request.query_params
+
+        if queries.is_approx(args):
+            result = await run_query(queries.query_approximate_statistics, args)
+            if result is not None:
+                return FlaskJSONResponse(result)
+        if queries.is_parallel(args, 'statistics'):
+            result = await run_parallel('statistics', args)
+        else:
+            filters = build_trip_filters(args)
+            overall, grouped = await asyncio.gather(
+                run_query(queries.query_overall_statistics, filters),
+                run_query(queries.query_grouped_statistics, filters, args.get('group_by')),
+            )
+            result = {'overall': overall, 'grouped': grouped}
+        if queries.is_approx(args):
+            # No sample of these dates: the answer is exact, and says so
+            result['approximate'] = None
+        return FlaskJSONResponse(result)
+    except admission.Rejected as e:
+        return rejected(request, e)
+    except Exception as e:
+        logger.error(f"Error calculating statistics: {e}")
+        return FlaskJSONResponse({'error': str(e)}, status_code=500)
+
+
+@admitted('zones')
+async def get_zones(request):
+    """Get list of all taxi zones (pre-encoded from the dimension cache)."""
+    try:
+        dimensions = await run_query(get_dimensions)
+        return Response(dimensions.zones_json, media_type='application/json')
+    except admission.Rejected as e:
+        return rejected(request, e)
+    except Exception as e:
+        logger.error(f"Error fetching zones: {e}")
+        return FlaskJSONResponse({'error': str(e)}, status_code=500)
+
+
+@cached('time-series')
+@coalesced('time-series')
+@admitted('time-series')
+async def get_time_series(request):
+    """Time series data for visualizations."""
+    try:
+        args = request.query_params
+        if queries.is_parallel(args, 'time-series') and not queries.is_approx(args):
+            params = queries.time_series_params(args)
+            return FlaskJSONResponse(queries.finish_time_series(
+                await run_parallel('time-series', args), args.get('interval', 'hour'), params
+            ))
+        result = await run_query(queries.query_time_series, args, build_trip_filters(args))
+        return FlaskJSONResponse(result)
+    except InvalidQuery as e:
+        return FlaskJSONResponse({'error': str(e)}, status_code=400)
+    except admission.Rejected as e:
+        return rejected(request, e)
+    except Exception as e:
+        logger.error(f"Error generating time series: {e}")
+        return FlaskJSONResponse({'error': str(e)}, status_code=500)
+
+
+@cached('heatmap')
+@coalesced('heatmap')
+@admitted('heatmap')
+async def get_heatmap(request):
+    """Heatmap data; pickup and dropoff halves run concurrently."""
+    try:
+        args = request.query_params
+        filters = build_trip_filters(args)
+        pickup, dropoff = await asyncio.gather(
+            run_query(queries.query_heatmap_side, filters, 'pickup', args),
+            run_query(queries.query_heatmap_side, filters, 'dropoff', args),
+        )
+        return FlaskJSONResponse({'pickup': pickup, 'dropoff': dropoff})
+    except admission.Rejected as e:
+        return rejected(request, e)
+    except Exception as e:
+        logger.error(f"Error generating heatmap: {e}")
+        return FlaskJSONResponse({'error': str(e)}, status_code=500)
+
+
+@admitted('anomalies')
+async def get_anomalies(request):
+    """Detect anomalies using custom algorithm."""
+    try:
+        return FlaskJSONResponse(await run_query(queries.query_anomalies, request.query_params))
+    except InvalidQuery as e:
+        return FlaskJSONResponse({'error': str(e)}, status_code=400)
+    except admission.Rejected as e:
+        return rejected(request, e)
+    except Exception as e:
+        logger.error(f"Error detecting anomalies: {e}")
+        return FlaskJSONResponse({'error': str(e)}, status_code=500)
+
+
+@cached('top-routes')
+@coalesced('top-routes')
+@admitted('top-routes')
+async def get_top_routes(request):
+    """Get top routes by trip count."""
+    try:
+        return FlaskJSONResponse(await run_query(queries.query_top_routes, request.query_params))
+    except InvalidQuery as e:
+        return FlaskJSONResponse({'error': str(e)}, status_code=400)
+    except admission.Rejected as e:
+        return rejected(request, e)
+    except Exception as e:
+        logger.error(f"Error fetching top routes: {e}")
+        return FlaskJSONResponse({'error': str(e)}, status_code=500)
+
+
+@cached('percentiles')
+@coalesced('percentiles')
+@admitted('percentiles')
+async def get_percentiles(request):
+    """Percentiles of trip metrics from sketches or raw rows."""
+    try:
+        args = request.query_params
+        result = await run_query(queries.query_percentiles, args, build_trip_filters(args))
+        return FlaskJSONResponse(result)
+    except InvalidQuery as e:
+        return FlaskJSONResponse({'error': str(e)}, status_code=400)
+    except admission.Rejected as e:
+        return rejected(request, e)
+    except Exception as e:
+        logger.error(f"Error computing percentiles: {e}")
+        return FlaskJSONResponse({'error': str(e)}, status_code=500)
+
+
+@cached('histogram2d')
+@coalesced('histogram2d')
+@admitted('histogram2d')
+async def get_histogram2d(request):
+    """Trip counts binned on two columns."""
+    try:
+        args = request.query_params
+        result = await run_query(histograms.query_histogram2d, args, build_trip_filters(args))
+        return FlaskJSONResponse(result)
+    except InvalidQuery as e:
+        return FlaskJSONResponse({'error': str(e)}, status_code=400)
+    except admission.Rejected as e:
+        return rejected(request, e)
+    except Exception as e:
+        logger.error(f"Error computing 2D histogram: {e}")
+        return FlaskJSONResponse({'error': str(e)}, status_code=500)
+
+
+@cached('summary')
+@coalesced('summary')
+@admitted('summary')
+async def get_summary(request):
+    """Every dashboard aggregate from a single pass over the filtered trips."""
+    try:
+        args = request.query_params
+        result = await run_query(summary.query_summary, args, build_trip_filters(args))
+        return FlaskJSONResponse(result)
+    except InvalidQuery as e:
+        return FlaskJSONResponse({'error': str(e)}, status_code=400)
+    except admission.Rejected as e:
+        return rejected(request, e)
+    except Exception as e:
+        logger.error(f"Error building summary: {e}")
+        return FlaskJSONResponse({'error': str(e)}, status_code=500)
+
+
+@cached('counts')
+@coalesced('counts')
+@admitted('counts')
+async def get_counts(request):
+    """Trip counts per value of a bitmap-indexed dimension."""
+    try:
+        args = request.query_params
+        result = await run_query(queries.query_counts, args, build_trip_filters(args))
+        return FlaskJSONResponse(result)
+    except InvalidQuery as e:
+        return FlaskJSONResponse({'error': str(e)}, status_code=400)
+    except admission.Rejected as e:
+        return rejected(request, e)
+    except Exception as e:
+        logger.error(f"Error counting trips: {e}")
+        return FlaskJSONResponse({'error': str(e)}, status_code=500)
+
+
+@admitted('batch')
+async def run_batch(request):
+    """Several queries sharing one filter set; sub-queries run concurrently."""
+    try:
+        try:
+            body = await request.json()
+        except ValueError:
+            body = None
+        _, filters, sub_queries = batch.parse_batch(body)
+        fused, tasks = batch.plan_batch(sub_queries)
+
+        async def timed(fn, args):
+            started = time.perf_counter()
+            try:
+                result = await run_query(fn, args, filters)
+            except Exception as e:
+                result = {'error': str(e)}
+            return result, round((time.perf_counter() - started) * 1000, 3)
+
+        started = time.perf_counter()
+        outcomes = await asyncio.gather(*[timed(fn, args) for _, fn, args in tasks])
+        results, timings = batch.collect_results(
+            fused, {task_id: outcome for (task_id, _, _), outcome in zip(tasks, outcomes)}
+        )
+        return FlaskJSONResponse({
+            'results': results,
+            'timings_ms': timings,
+            'total_ms': round((time.perf_counter() - started) * 1000, 3),
+            'mode': 'parallel',
+            'fused': [q[0] for q in fused],
+        })
+    except InvalidQuery as e:
+        return FlaskJSONResponse({'error': str(e)}, status_code=400)
+    except admission.Rejected as e:
+        return rejected(request, e)
+    except Exception as e:
+        logger.error(f"Error running batch: {e}")
+        return FlaskJSONResponse({'error': str(e)}, status_code=500)
+
+
+async def get_metrics(request):
+    """Admission and timeout counters in the Prometheus text format."""
+    return Response(metrics.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+# cProfile takes run_sync's greenlet switches for calls (see profiling.py)
+ASYNC_PROFILE_MODES = ('sample',)
+
+
+class ProfileMiddleware:
+    """Profile the requests profiling.begin() selects (registered only when profiling is enabled)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        profile = None
+        if scope['type'] == 'http':
+            headers = Headers(scope=scope)
+            profile = profiling.begin(
+                scope['method'],
+                scope['path'],
+                scope['query_string'].decode(),
+                headers.get(profiling.HEADER),
+                headers.get(profiling.MODE_HEADER),
+                modes=ASYNC_PROFILE_MODES
+            )
+        if profile is None:
+            return await self.app(scope, receive, send)
+
+        status = None
+
+        async def send_with_id(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                message['headers'] = list(message.get('headers', [])) + [
+                    (profiling.ID_HEADER.lower().encode(), profile.id.encode())
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            profile.finish(status)
+
+
+async def list_profiles(request):
+    """Retained request profiles of this worker, newest first (see profiling.py)."""
+    if not profiling.can_read(request.headers.get(profiling.HEADER)):
+        return FlaskJSONResponse({'error': f'{profiling.HEADER} header required'}, status_code=403)
+    return FlaskJSONResponse({'profiles': profiling.list_profiles(), 'retention': profiling.PROFILE_RETENTION})
+
+
+async def get_profile(request):
+    """One profile as collapsed stacks, for flamegraph.pl or speedscope."""
+    if not profiling.can_read(request.headers.get(profiling.HEADER)):
+        return FlaskJSONResponse({'error': f'{profiling.HEADER} header required'}, status_code=403)
+    profile_id = request.path_params['profile_id']
+    profile = profiling.get_profile(profile_id)
+    if profile is None:
+        return FlaskJSONResponse({'error': f'No profile {profile_id}'}, status_code=404)
+    return Response(profile['stacks'], headers={'Content-Type': 'text/plain; charset=utf-8'})
+
+
+async def health_check(request):
+    """Health check endpoint."""
+    try:
+        return FlaskJSONResponse(await run_query(queries.query_health))
+    except Exception as e:
+        return FlaskJSONResponse({
+            'status': 'unhealthy',
+            'error': str(e)
+        }, status_code=500)
+
+
+async def warm_result_cache():
+    """Store the default-filter responses of the frontend pages in the result cache."""
+    handlers = {route.path: route.endpoint for route in routes}
+
+    def fetch(path, args):
+        query_string = '&'.join(f'{k}={v}' for k, v in args.items()).encode()
+        request = Request({'type': 'http', 'method': 'GET', 'path': path,
+                           'query_string': query_string, 'headers': []})
+        return asyncio.run_coroutine_threadsafe(handlers[path](request), loop).result()
+
+    try:
+        loop = asyncio.get_running_loop()
+        cache, version = await run_query(_cache_and_version)
+        if cache is not None:
+            # warm() blocks on the cross-worker file lock, so it runs on a thread
+            await asyncio.to_thread(result_cache.warm, cache, version, fetch)
+    except Exception as e:
+        logger.warning(f"Result cache not warmed: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    try:
+        await run_query(get_dimensions)
+    except Exception as e:
+        logger.warning(f"Dimension cache not loaded at startup: {e}")
+    if result_cache.RESULT_CACHE and result_cache.RESULT_CACHE_WARM:
+        # Kept on the app so the task is not garbage-collected while it runs
+        app.state.result_cache_warmup = asyncio.create_task(warm_result_cache())
+    yield
+    await engine.dispose()
+
+
+routes = [
+    Route('/', index),
+    Route('/api/trips', get_trips, methods=['GET']),
+    Route('/api/statistics', get_statistics, methods=['GET']),
+    Route('/api/zones', get_zones, methods=['GET']),
+    Route('/api/time-series', get_time_series, methods=['GET']),
+    Route('/api/heatmap', get_heatmap, methods=['GET']),
+    Route('/api/anomalies', get_anomalies, methods=['GET']),
+    Route('/api/top-routes', get_top_routes, methods=['GET']),
+    Route('/api/percentiles', get_percentiles, methods=['GET']),
+    Route('/api/histogram2d', get_histogram2d, methods=['GET']),
+    Route('/api/summary', get_summary, methods=['GET']),
+    Route('/api/counts', get_counts, methods=['GET']),
+    Route('/api/batch', run_batch, methods=['POST']),
+    Route('/metrics', get_metrics, methods=['GET']),
+    Route('/health', health_check, methods=['GET']),
+]
+
+middleware = [Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])]
+if profiling.PROFILE_ENABLED:
+    routes += [
+        Route('/debug/profiles', list_profiles, methods=['GET']),
+        Route('/debug/profiles/{profile_id}', get_profile, methods=['GET']),
+    ]
+    middleware.append(Middleware(ProfileMiddleware))
+
+app = Starlette(
+    routes=routes,
+    middleware=middleware,
+    lifespan=lifespan,
+)
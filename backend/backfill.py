@@ -0,0 +1,240 @@
+"""
+Chunked parallel backfill of the derived trip features.
+
+In the standard layout trip_speed (mph), fare_per_km and fare_per_minute
+are stored columns, so a change to their formula
+(synthetic.compute_derived_features) has to be written to every trip; the
+compact layout computes them in SQL and needs no backfill.
+
+The job walks `trips` in trip_id ranges of BACKFILL_CHUNK_SIZE. Pool
+processes each read a range, recompute the features with numpy and write
+back only the rows whose stored values differ, in one bulk UPDATE per
+range. Progress is checkpointed in `backfill_checkpoints` as the trip_id
+below which every range is done, so a restarted job resumes there (ranges
+finished past it are recomputed, which is harmless). Ranges are submitted
+at most BACKFILL_MAX_ROWS_PER_SECOND trip_ids per second and each write is
+a short transaction, so API reads keep getting the database between them.
+
+When every range is done, the derived structures are rebuilt and the
+dataset version bumped (ingest.refresh_all), so caches pick up the new
+values.
+
+Usage:
+    python backfill.py --db bench_1m.db
+    python backfill.py --workers 4 --max-rows-per-second 0   # unthrottled
+    python backfill.py --restart                             # run a completed job again
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime, timezone
+
+import numpy as np
+from sqlalchemy import event, func, select, update
+from sqlalchemy.orm import sessionmaker
+
+from models import (
+    COMPACT_STORAGE, BackfillCheckpoint, Trip, create_db_engine, get_session,
+)
+from synthetic import compute_derived_features
+import ingest
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_CHUNK_SIZE = int(os.getenv('BACKFILL_CHUNK_SIZE', '20000'))
+BACKFILL_WORKERS = int(os.getenv('BACKFILL_WORKERS', '2'))
+BACKFILL_MAX_ROWS_PER_SECOND = float(os.getenv('BACKFILL_MAX_ROWS_PER_SECOND', '100000'))
+# How long a SQLite writer waits for another one to commit
+BUSY_TIMEOUT_MS = 30000
+
+JOB = 'derived_features'
+DERIVED_COLUMNS = ('trip_speed', 'fare_per_km', 'fare_per_minute')
+
+
+# Per worker process: sessionmaker of the database being backfilled
+_Session = None
+
+
+def _init_worker(db_url):
+    global _Session
+    engine = create_db_engine(db_url)
+    if engine.dialect.name == 'sqlite':
+        @event.listens_for(engine, 'connect')
+        def busy_timeout(dbapi_connection, connection_record):
+            dbapi_connection.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+    _Session = sessionmaker(bind=engine)
+
+
+def recompute(distance, duration, fare):
+    """
+    Derived features of one chunk, NaN where an input is NULL and the
+    feature is not 0 (storage.derived_values semantics).
+
+    Returns:
+        Array of shape (rows, 3) in DERIVED_COLUMNS order
+    """
+    return np.column_stack(compute_derived_features(distance, duration, fare))
+
+
+def backfill_chunk(lower, upper):
+    """
+    Recompute the derived features of trips with lower <= trip_id < upper.
+
+    Runs in a pool worker.
+
+    Returns:
+        (trips read, trips updated)
+    """
+    session = _Session()
+    try:
+        rows = session.execute(
+            select(
+                Trip.trip_id, Trip.trip_distance, Trip.trip_duration, Trip.fare_amount,
+                *[getattr(Trip, name) for name in DERIVED_COLUMNS]
+            ).where(Trip.trip_id >= lower, Trip.trip_id < upper)
+        ).all()
+        if not rows:
+            return 0, 0
+
+        # None becomes NaN in a float array
+        block = np.array(rows, dtype=np.float64)
+        new = recompute(block[:, 1], block[:, 2], block[:, 3])
+        old = block[:, 4:]
+        same = (new == old) | (np.isnan(new) & np.isnan(old))
+        changed = np.flatnonzero(~same.all(axis=1))
+        if changed.size:
+            values = new[changed].astype(object)
+            values[np.isnan(new[changed])] = None
+            session.execute(update(Trip), [
+                {'trip_id': int(block[i, 0]), **dict(zip(DERIVED_COLUMNS, row))}
+                for i, row in zip(changed, values.tolist())
+            ])
+            session.commit()
+        return len(rows), int(changed.size)
+    finally:
+        session.close()
+
+
+def _utcnow():
+    # The checkpoint columns are naive DateTime, holding UTC
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def load_checkpoint(session, restart=False):
+    """The job's checkpoint, created (or reset with `restart`) at the lowest trip_id."""
+    BackfillCheckpoint.__table__.create(session.get_bind(), checkfirst=True)
+    checkpoint = session.get(BackfillCheckpoint, JOB)
+    if checkpoint is None or restart:
+        first_trip_id = session.query(func.min(Trip.trip_id)).scalar() or 0
+        if checkpoint is None:
+            checkpoint = BackfillCheckpoint(job=JOB)
+            session.add(checkpoint)
+        checkpoint.next_trip_id = first_trip_id
+        checkpoint.rows_updated = 0
+        checkpoint.completed_at = None
+    checkpoint.updated_at = _utcnow()
+    session.commit()
+    return checkpoint
+
+
+def _save(session, checkpoint, rows_updated):
+    checkpoint.rows_updated = rows_updated
+    checkpoint.updated_at = _utcnow()
+    session.commit()
+
+
+def backfill(session, chunk_size=BACKFILL_CHUNK_SIZE, workers=BACKFILL_WORKERS,
+             max_rows_per_second=BACKFILL_MAX_ROWS_PER_SECOND, restart=False):
+    """
+    Run (or resume) the derived feature backfill and refresh derived structures.
+
+    Args:
+        session: Session of the database to backfill
+        chunk_size: trip_ids per range
+        workers: Pool processes
+        max_rows_per_second: Largest rate of trip_ids submitted; 0 for no limit
+        restart: Start over even if a previous run completed
+
+    Returns:
+        Number of trips updated by this run
+    """
+    if COMPACT_STORAGE:
+        logger.info("The compact layout computes derived features in SQL; nothing to backfill")
+        return 0
+
+    checkpoint = load_checkpoint(session, restart)
+    if checkpoint.completed_at is not None:
+        logger.info(f"Backfill completed at {checkpoint.completed_at:%Y-%m-%d %H:%M}; use --restart to run it again")
+        return 0
+    max_trip_id = session.query(func.max(Trip.trip_id)).scalar() or 0
+    starts = list(range(checkpoint.next_trip_id, max_trip_id + 1, chunk_size))
+    logger.info(f"Backfilling trip_id {checkpoint.next_trip_id:,}..{max_trip_id:,} in {len(starts):,} ranges")
+
+    db_url = session.get_bind().url.render_as_string(hide_password=False)
+    pool = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker,
+        initargs=(db_url,),
+    )
+    started = time.monotonic()
+    previously_updated = checkpoint.rows_updated
+    updated = submitted = 0
+    finished = set()
+    pending = {}
+    try:
+        for lower in starts + [None]:
+            # Keep every worker busy with one range queued behind it
+            while pending and (lower is None or len(pending) >= 2 * workers):
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finished.add(pending.pop(future))
+                    updated += future.result()[1]
+                while checkpoint.next_trip_id in finished:
+                    finished.remove(checkpoint.next_trip_id)
+                    checkpoint.next_trip_id += chunk_size
+                _save(session, checkpoint, previously_updated + updated)
+            if lower is None:
+                break
+            if max_rows_per_second:
+                delay = submitted / max_rows_per_second - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            pending[pool.submit(backfill_chunk, lower, lower + chunk_size)] = lower
+            submitted += chunk_size
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+    checkpoint.completed_at = _utcnow()
+    _save(session, checkpoint, previously_updated + updated)
+    logger.info(f"Updated {updated:,} trips in {time.monotonic() - started:.1f}s")
+
+    ingest.refresh_all(session)
+    return updated
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Recompute the stored derived trip features')
+    parser.add_argument('--db', help='SQLite database (default: configured database)')
+    parser.add_argument('--chunk-size', type=int, default=BACKFILL_CHUNK_SIZE, help='trip_ids per range')
+    parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS, help='Pool processes')
+    parser.add_argument('--max-rows-per-second', type=float, default=BACKFILL_MAX_ROWS_PER_SECOND,
+                        help='Throttle; 0 for no limit')
+    parser.add_argument('--restart', action='store_true', help='Start over from the lowest trip_id')
+    args = parser.parse_args()
+
+    if args.db:
+        os.environ['USE_SQLITE'] = 'true'
+        os.environ['SQLITE_DB_PATH'] = os.path.abspath(args.db)
+
+    session = get_session()
+    try:
+        backfill(session, args.chunk_size, args.workers, args.max_rows_per_second, args.restart)
+    finally:
+        session.close()
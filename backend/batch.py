@@ -0,0 +1,397 @@
+"""
+Batched execution of several API queries that share one filter set.
+
+The dashboard needs five aggregates for every filter change. Sent as one
+/api/batch request, the filters are parsed once and the sub-queries run on
+one pooled connection (SQLite) or in parallel on a thread pool, one
+connection each (PostgreSQL), instead of five requests each opening a
+session and re-parsing the same parameters.
+
+Sub-queries that are all rollups of the same (date, hour) grid, i.e.
+hourly/daily time series and overall/hourly statistics, are answered from
+one fused scan of the filtered trips instead of one scan each. Their
+averages and totals are then rolled up from per-bucket sums in Python, adding
+the trips in a different order than the standalone endpoint's SQL SUM/AVG.
+The float results differ by ~1e-13, so a value that lies that close to a
+rounding boundary can come out 0.01 apart from the standalone endpoint.
+
+Request body:
+    {
+        "filters": {"start_date": "2023-01-01", "min_fare": 5},
+        "queries": [
+            {"id": "daily", "query": "time-series", "params": {"interval": "day"}},
+            {"id": "heatmap", "query": "heatmap"}
+        ]
+    }
+"""
+
+import os
+import time
+from collections import defaultdict
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import func, and_, literal_column
+
+from models import Trip
+from queries import InvalidQuery, TRIP_FILTER_PARAMS, build_trip_filters
+import histograms
+import queries
+import storage
+import summary
+
+MAX_BATCH_QUERIES = 20
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', 5))
+
+# Query name -> function(session, args, filters)
+BATCH_QUERIES = {
+    'trips': queries.query_trips,
+    'statistics': queries.query_statistics,
+    'time-series': queries.query_time_series,
+    'heatmap': queries.query_heatmap,
+    'percentiles': queries.query_percentiles,
+    'histogram2d': histograms.query_histogram2d,
+    'summary': summary.query_summary,
+    'counts': queries.query_counts,
+    'top-routes': lambda session, args, filters: queries.query_top_routes(session, args),
+    'anomalies': lambda session, args, filters: queries.query_anomalies(session, args),
+    'zones': lambda session, args, filters: queries.query_zones(session),
+}
+
+
+def _as_args(values):
+    """Normalize JSON values to the strings a query string would carry."""
+    args = {}
+    for key, value in (values or {}).items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            value = 'true' if value else 'false'
+        args[key] = str(value)
+    return args
+
+
+def parse_batch(body):
+    """
+    Validate a batch request body.
+
+    Returns:
+        Tuple of (shared filter args, built filters, list of
+        (id, function, args) sub-queries)
+
+    Raises:
+        InvalidQuery: For malformed bodies, unknown queries, duplicate IDs
+            or sub-queries that try to override the shared filters
+    """
+    if not isinstance(body, dict) or not isinstance(body.get('queries'), list):
+        raise InvalidQuery("Body must be an object with a 'queries' list")
+    if not body['queries'] or len(body['queries']) > MAX_BATCH_QUERIES:
+        raise InvalidQuery(f'A batch holds between 1 and {MAX_BATCH_QUERIES} queries')
+    if not isinstance(body.get('filters', {}), dict):
+        raise InvalidQuery("'filters' must be an object")
+
+    filter_args = _as_args(body.get('filters'))
+    filters = build_trip_filters(filter_args)
+
+    sub_queries = []
+    seen = set()
+    for position, entry in enumerate(body['queries']):
+        if not isinstance(entry, dict) or entry.get('query') not in BATCH_QUERIES:
+            raise InvalidQuery(f'Unknown query at position {position}')
+        query_id = str(entry.get('id', position))
+        if query_id in seen:
+            raise InvalidQuery(f'Duplicate query id: {query_id}')
+        seen.add(query_id)
+
+        params = _as_args(entry.get('params'))
+        overridden = set(params) & set(TRIP_FILTER_PARAMS)
+        if overridden:
+            raise InvalidQuery(
+                f"Query '{query_id}' sets shared filters: {', '.join(sorted(overridden))}"
+            )
+        sub_queries.append((query_id, BATCH_QUERIES[entry['query']], {**filter_args, **params}))
+
+    return filter_args, filters, sub_queries
+
+
+# Metrics summed per (date, hour) bucket by the fused scan
+BUCKET_METRICS = {
+    'fare': Trip.fare_amount,
+    'speed': Trip.trip_speed,
+    'distance': Trip.trip_distance,
+    'duration': Trip.trip_duration,
+    'revenue': Trip.total_amount,
+}
+
+
+def is_bucketable(fn, args):
+    """True if a sub-query can be derived from the (date, hour) buckets."""
+    if queries.is_approx(args):
+        return False
+    if fn is queries.query_time_series:
+        if queries.is_parallel(args, 'time-series'):
+            return False
+        return args.get('interval', 'hour') in ('hour', 'day')
+    if fn is queries.query_statistics:
+        if queries.is_parallel(args, 'statistics'):
+            return False
+        return args.get('group_by') in (None, 'hour')
+    return False
+
+
+def _hour_bucket(session):
+    """
+    'YYYY-MM-DD HH' pickup bucket, or the epoch hour in the compact storage
+    layout; one expression is cheaper to group by than two.
+    """
+    if storage.is_compact(Trip.pickup_datetime):
+        return storage.epoch_seconds(session, Trip.pickup_datetime) // 3600
+    # SQLite stores datetimes as ISO text, so the prefix is the bucket and
+    # no per-row date parsing is needed
+    if session.get_bind().dialect.name == 'sqlite':
+        return func.substr(Trip.pickup_datetime, literal_column('1'), literal_column('13'))
+    return func.to_char(Trip.pickup_datetime, literal_column("'YYYY-MM-DD HH24'"))
+
+
+def query_time_buckets(session, filters, metrics=tuple(BUCKET_METRICS)):
+    """
+    One scan of the filtered trips grouped by (date, hour).
+
+    Returns:
+        List of dicts with 'date', 'hour', 'count' and, per requested
+        metric, its sum and non-null count ('<metric>_sum', '<metric>_n')
+        so that averages can be rolled up exactly
+    """
+    bucket = _hour_bucket(session).label('bucket')
+    columns = [bucket, func.count(Trip.trip_id).label('count')]
+    for name in metrics:
+        columns.append(func.sum(BUCKET_METRICS[name]).label(f'{name}_sum'))
+        columns.append(func.count(BUCKET_METRICS[name]).label(f'{name}_n'))
+
+    query = session.query(*columns)
+    if filters:
+        query = query.filter(and_(*filters))
+
+    buckets = []
+    for row in query.group_by('bucket').all():
+        values = row._asdict()
+        key = values.pop('bucket')
+        if isinstance(key, int):
+            values.update({'date': (storage.EPOCH + timedelta(hours=key)).strftime('%Y-%m-%d'), 'hour': key % 24})
+        else:
+            values.update({'date': key[:10], 'hour': int(key[11:13])})
+        buckets.append(values)
+    return buckets
+
+
+def _rollup(buckets, key):
+    """Sum bucket rows by `key` (None rolls everything into one row)."""
+    totals = defaultdict(lambda: defaultdict(float))
+    for bucket in buckets:
+        group = totals[key(bucket) if key else None]
+        for field, value in bucket.items():
+            if field not in ('date', 'hour'):
+                group[field] += value or 0
+    return totals
+
+
+def _avg(group, metric):
+    n = group[f'{metric}_n']
+    return round(float(group[f'{metric}_sum'] / n), 2) if n else 0.0
+
+
+def time_series_from_buckets(buckets, interval):
+    """/api/time-series body derived from (date, hour) buckets."""
+    if interval == 'hour':
+        groups = _rollup(buckets, lambda b: b['hour'])
+        label = 'hour'
+    else:
+        groups = _rollup(buckets, lambda b: b['date'])
+        label = 'date'
+
+    return {'time_series': [{
+        label: unit,
+        'trip_count': int(group['count']),
+        'avg_fare': _avg(group, 'fare'),
+        'avg_speed': _avg(group, 'speed'),
+        'total_revenue': round(float(group['revenue_sum']), 2),
+        # Unrounded, for rolling metrics (queries.SERIES_SUMS)
+        'revenue_sum': float(group['revenue_sum']),
+        'fare_sum': float(group['fare_sum']),
+        'fare_n': int(group['fare_n']),
+        'speed_sum': float(group['speed_sum']),
+        'speed_n': int(group['speed_n'])
+    } for unit, group in sorted(groups.items())]}
+
+
+def statistics_from_buckets(buckets, group_by):
+    """/api/statistics body derived from (date, hour) buckets."""
+    overall = _rollup(buckets, None)[None]
+    grouped = []
+    if group_by == 'hour':
+        grouped = [{
+            'hour': hour,
+            'trip_count': int(group['count']),
+            'avg_fare': _avg(group, 'fare'),
+            'avg_speed': _avg(group, 'speed')
+        } for hour, group in sorted(_rollup(buckets, lambda b: b['hour']).items())]
+
+    return {
+        'overall': {
+            'total_trips': int(overall['count']),
+            'avg_fare': _avg(overall, 'fare'),
+            'avg_distance': _avg(overall, 'distance'),
+            'avg_duration': _avg(overall, 'duration'),
+            'avg_speed': _avg(overall, 'speed'),
+            'total_revenue': round(float(overall['revenue_sum']), 2)
+        },
+        'grouped': grouped
+    }
+
+
+def _from_buckets(buckets, fn, args):
+    if fn is queries.query_time_series:
+        interval = args.get('interval', 'hour')
+        return queries.finish_time_series(
+            time_series_from_buckets(buckets, interval), interval, queries.time_series_params(args)
+        )
+    return statistics_from_buckets(buckets, args.get('group_by'))
+
+
+FUSED_SCAN = '_fused_scan'
+
+
+def plan_batch(sub_queries):
+    """
+    Replace sub-queries that share the (date, hour) grid with one scan.
+
+    Returns:
+        Tuple of (fused sub-queries, tasks to execute), where tasks are
+        (id, function, args) like sub-queries and include the FUSED_SCAN
+        task when two or more sub-queries were fused
+    """
+    fused = [q for q in sub_queries if is_bucketable(q[1], q[2])]
+    if len(fused) < 2:
+        return [], list(sub_queries)
+
+    # Distance and duration only feed the overall statistics
+    metrics = ['fare', 'speed', 'revenue']
+    if any(q[1] is queries.query_statistics for q in fused):
+        metrics += ['distance', 'duration']
+
+    tasks = [(
+        FUSED_SCAN,
+        lambda session, args, filters: query_time_buckets(session, filters, metrics),
+        {}
+    )]
+    tasks.extend(q for q in sub_queries if q not in fused)
+    return fused, tasks
+
+
+def collect_results(fused, outcomes):
+    """
+    Per-sub-query results and timings from executed tasks.
+
+    Args:
+        fused: Fused sub-queries from plan_batch
+        outcomes: Dict mapping task ID to (result, elapsed ms)
+
+    Returns:
+        Tuple of (results, timings) keyed by sub-query ID; fused
+        sub-queries are timed as the shared scan plus their own rollup
+    """
+    results = {}
+    timings = {}
+    for task_id, (result, elapsed_ms) in outcomes.items():
+        if task_id != FUSED_SCAN:
+            results[task_id] = result
+            timings[task_id] = elapsed_ms
+
+    if fused:
+        buckets, scan_ms = outcomes[FUSED_SCAN]
+        for query_id, fn, args in fused:
+            started = time.perf_counter()
+            try:
+                results[query_id] = buckets if isinstance(buckets, dict) else _from_buckets(buckets, fn, args)
+            except InvalidQuery as e:
+                # Reported like a failing unfused sub-query
+                results[query_id] = {'error': str(e)}
+            timings[query_id] = round(scan_ms + (time.perf_counter() - started) * 1000, 3)
+    return results, timings
+
+
+def _run_one(session, fn, args, filters):
+    """Run one task, returning (result, elapsed ms)."""
+    started = time.perf_counter()
+    try:
+        result = fn(session, args, filters)
+    except InvalidQuery as e:
+        result = {'error': str(e)}
+    except Exception as e:
+        session.rollback()
+        result = {'error': str(e)}
+    return result, round((time.perf_counter() - started) * 1000, 3)
+
+
+def run_batch(session_factory, sub_queries, filters, parallel=False):
+    """
+    Execute parsed sub-queries.
+
+    Args:
+        session_factory: Callable returning a new database session
+        sub_queries: List of (id, function, args) from parse_batch
+        filters: Filters built once from the shared filter args
+        parallel: Run on a thread pool with a session per task instead of
+            sequentially on one session
+
+    Returns:
+        Dict with 'results' and 'timings_ms' keyed by sub-query ID, plus
+        the batch's total time, execution mode and the IDs answered from
+        the fused (date, hour) scan. A failing sub-query reports
+        {'error': ...} without failing the batch.
+    """
+    started = time.perf_counter()
+    fused, tasks = plan_batch(sub_queries)
+    outcomes = {}
+
+    if parallel:
+        def run_isolated(fn, args):
+            session = session_factory()
+            try:
+                return _run_one(session, fn, args, filters)
+            finally:
+                session.close()
+
+        with ThreadPoolExecutor(max_workers=min(BATCH_WORKERS, len(tasks))) as pool:
+            futures = [
+                (task_id, pool.submit(run_isolated, fn, args))
+                for task_id, fn, args in tasks
+            ]
+            for task_id, future in futures:
+                outcomes[task_id] = future.result()
+    else:
+        session = session_factory()
+        try:
+            for task_id, fn, args in tasks:
+                outcomes[task_id] = _run_one(session, fn, args, filters)
+        finally:
+            session.close()
+
+    results, timings = collect_results(fused, outcomes)
+    return {
+        'results': results,
+        'timings_ms': timings,
+        'total_ms': round((time.perf_counter() - started) * 1000, 3),
+        'mode': 'parallel' if parallel else 'sequential',
+        'fused': [q[0] for q in fused],
+    }
+
+
+def supports_parallel(engine):
+    """
+    True if sub-queries should run on separate connections in parallel.
+
+    SQLite serializes work inside one process, so extra connections only
+    add overhead; client/server databases run the queries concurrently.
+    """
+    return engine.dialect.name != 'sqlite'
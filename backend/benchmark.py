@@ -0,0 +1,797 @@
+"""
+Endpoint benchmark harness.
+
+Calls every API endpoint through the Flask test client against a given
+database and reports p50/p95/p99 latency, SQL statements per request and
+peak RSS as JSON, so runs from different commits can be compared.
+
+Usage:
+    python synthetic.py --rows 1000000 --output bench_1m.db
+    python benchmark.py --db bench_1m.db --output results.json
+    python benchmark.py --db bench_1m.db --compare results.json
+    python benchmark.py --db bench_1m.db --approx-report
+    python benchmark.py --db bench_1m.db --dashboard-report
+    python benchmark.py --db bench_1m.db --summary-report
+    python benchmark.py --db bench_1m.db --parallel-report --max-workers 8
+    python benchmark.py --db bench_1m.db --downsample-report
+    python benchmark.py --db bench_1m.db --statement-report
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Time the queries, not hits of the shared result cache (see result_cache.py)
+os.environ.setdefault('RESULT_CACHE', 'false')
+
+# (name, path, query params)
+BENCHMARK_CASES = [
+    ('trips_offset_0', '/api/trips', {'offset': 0}),
+    ('trips_offset_1k', '/api/trips', {'offset': 1000}),
+    ('trips_offset_10k', '/api/trips', {'offset': 10000}),
+    ('trips_offset_100k', '/api/trips', {'offset': 100000}),
+    ('trips_filtered', '/api/trips', {'min_fare': 20, 'max_distance': 10, 'passenger_count': 1}),
+    ('statistics', '/api/statistics', {}),
+    ('statistics_hour', '/api/statistics', {'group_by': 'hour'}),
+    ('statistics_zone', '/api/statistics', {'group_by': 'zone'}),
+    ('statistics_payment_type', '/api/statistics', {'group_by': 'payment_type'}),
+    ('time_series_hour', '/api/time-series', {'interval': 'hour'}),
+    ('time_series_day', '/api/time-series', {'interval': 'day'}),
+    ('heatmap', '/api/heatmap', {}),
+    ('histogram2d', '/api/histogram2d', {}),
+    ('histogram2d_range', '/api/histogram2d', {'y_min': 20, 'y_max': 60, 'x_max': 20}),
+    ('anomalies', '/api/anomalies', {}),
+    ('top_routes', '/api/top-routes', {'limit': 10}),
+    ('zones', '/api/zones', {}),
+    ('health', '/health', {}),
+]
+
+
+class SQLCounter:
+    """Counts statements executed on any SQLAlchemy engine."""
+
+    def __init__(self):
+        self.count = 0
+        event.listen(Engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+    def reset(self):
+        self.count = 0
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS, kilobytes on Linux
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def percentile_summary(latencies_ms):
+    """p50/p95/p99/mean/min/max of a list of latencies in milliseconds."""
+    values = np.array(latencies_ms)
+    return {
+        'p50_ms': round(float(np.percentile(values, 50)), 3),
+        'p95_ms': round(float(np.percentile(values, 95)), 3),
+        'p99_ms': round(float(np.percentile(values, 99)), 3),
+        'mean_ms': round(float(values.mean()), 3),
+        'min_ms': round(float(values.min()), 3),
+        'max_ms': round(float(values.max()), 3),
+    }
+
+
+def git_commit():
+    """Current git commit hash, or None outside a checkout."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_case(client, counter, path, params, iterations, warmup):
+    """
+    Run one endpoint `iterations` times after `warmup` untimed calls.
+
+    Returns:
+        Dict with latency percentiles, SQL statements per request and status
+    """
+    for _ in range(warmup):
+        client.get(path, query_string=params)
+
+    latencies = []
+    sql_counts = []
+    statuses = set()
+    response_bytes = 0
+
+    for _ in range(iterations):
+        counter.reset()
+        started = time.perf_counter()
+        response = client.get(path, query_string=params)
+        latencies.append((time.perf_counter() - started) * 1000)
+        sql_counts.append(counter.count)
+        statuses.add(response.status_code)
+        response_bytes = len(response.get_data())
+
+    result = percentile_summary(latencies)
+    result.update({
+        'iterations': iterations,
+        'sql_per_request': round(sum(sql_counts) / len(sql_counts), 2),
+        'response_bytes': response_bytes,
+        'status_codes': sorted(statuses),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    })
+    return result
+
+
+def run_benchmark(db_path, iterations=20, warmup=2, cases=None):
+    """
+    Benchmark every endpoint against `db_path`.
+
+    The database path is injected through the environment before the app
+    is imported, so the harness exercises exactly the production code path.
+    """
+    os.environ['USE_SQLITE'] = 'true'
+    os.environ['SQLITE_DB_PATH'] = os.path.abspath(db_path)
+
+    from app import app
+
+    counter = SQLCounter()
+    client = app.test_client()
+
+    trip_count = client.get('/health').get_json().get('trip_count')
+    results = {}
+
+    for name, path, params in cases or BENCHMARK_CASES:
+        results[name] = run_case(client, counter, path, params, iterations, warmup)
+        print(
+            f"{name:28s} p50={results[name]['p50_ms']:9.2f}ms "
+            f"p95={results[name]['p95_ms']:9.2f}ms "
+            f"p99={results[name]['p99_ms']:9.2f}ms "
+            f"sql={results[name]['sql_per_request']:5.1f}",
+            file=sys.stderr,
+        )
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'database': os.path.abspath(db_path),
+            'trip_count': trip_count,
+            'iterations': iterations,
+            'warmup': warmup,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+        },
+        'results': results,
+    }
+
+
+# (name, path, query params) compared between exact and approx=true
+APPROX_CASES = [
+    ('statistics', '/api/statistics', {}),
+    ('statistics_hour', '/api/statistics', {'group_by': 'hour'}),
+    ('statistics_zone', '/api/statistics', {'group_by': 'zone'}),
+    ('statistics_payment_type', '/api/statistics', {'group_by': 'payment_type'}),
+    ('statistics_filtered', '/api/statistics', {'min_fare': 20, 'passenger_count': 1}),
+    ('time_series_hour', '/api/time-series', {'interval': 'hour'}),
+    ('time_series_day', '/api/time-series', {'interval': 'day'}),
+]
+
+GROUP_KEYS = ('hour', 'date', 'zone_name', 'payment_type')
+
+# A case fails --approx-report when 95% intervals would cover as few of its
+# exact values less often than this. Cases with fewer values are reported but
+# not judged: their values share one sample, so a single unlucky draw moves
+# several averages at once
+MIN_COVERAGE_P_VALUE = 0.001
+MIN_COVERAGE_VALUES = 20
+
+
+def _approx_rows(body):
+    """Flatten a statistics/time-series body into {row key: row}."""
+    rows = {('overall',): body['overall']} if 'overall' in body else {}
+    for row in body.get('grouped', []) + body.get('time_series', []):
+        rows[tuple(row[k] for k in GROUP_KEYS if k in row)] = row
+    return rows
+
+
+def approx_accuracy(exact_body, approx_body):
+    """
+    Relative error and confidence-interval coverage of an approximate body.
+
+    Returns:
+        Dict with mean/max relative error and the fraction of exact values
+        that fall inside the reported 95% interval
+    """
+    exact_rows = _approx_rows(exact_body)
+    errors = []
+    covered = 0
+    checked = 0
+
+    for key, row in _approx_rows(approx_body).items():
+        exact = exact_rows.get(key)
+        if not exact:
+            continue
+        for metric, (low, high) in row.get('ci', {}).items():
+            truth = exact.get(metric)
+            if truth is None:
+                continue
+            checked += 1
+            covered += int(low <= truth <= high)
+            if truth:
+                errors.append(abs(row[metric] - truth) / abs(truth))
+
+    return {
+        'mean_relative_error': round(float(np.mean(errors)), 4) if errors else None,
+        'max_relative_error': round(float(np.max(errors)), 4) if errors else None,
+        'ci_coverage': round(covered / checked, 3) if checked else None,
+        'values_checked': checked,
+        'coverage_p_value': round(coverage_p_value(covered, checked), 6),
+    }
+
+
+def coverage_p_value(covered, checked, confidence=0.95):
+    """Probability that intervals at `confidence` cover at most `covered` of `checked` values."""
+    def log_pmf(k):
+        return (
+            math.lgamma(checked + 1) - math.lgamma(k + 1) - math.lgamma(checked - k + 1)
+            + k * math.log(confidence) + (checked - k) * math.log(1 - confidence)
+        )
+
+    return min(sum(math.exp(log_pmf(k)) for k in range(covered + 1)), 1.0)
+
+
+def find_coverage_failures(report):
+    """List of (case, coverage, values checked) whose intervals cover implausibly few exact values."""
+    return [
+        (name, entry['ci_coverage'], entry['values_checked'])
+        for name, entry in report.items()
+        if entry['values_checked'] >= MIN_COVERAGE_VALUES and entry['coverage_p_value'] < MIN_COVERAGE_P_VALUE
+    ]
+
+
+def run_approx_report(db_path, iterations=10, warmup=1):
+    """
+    Accuracy-vs-latency report for approx=true on `db_path`.
+
+    The database needs a populated sample (synthetic.py builds one; run
+    `python ingest.py --refresh` for other databases).
+    """
+    os.environ['USE_SQLITE'] = 'true'
+    os.environ['SQLITE_DB_PATH'] = os.path.abspath(db_path)
+
+    from app import app
+
+    counter = SQLCounter()
+    client = app.test_client()
+    report = {}
+
+    for name, path, params in APPROX_CASES:
+        approx_params = dict(params, approx='true')
+        exact = run_case(client, counter, path, params, iterations, warmup)
+        approx = run_case(client, counter, path, approx_params, iterations, warmup)
+        accuracy = approx_accuracy(
+            client.get(path, query_string=params).get_json(),
+            client.get(path, query_string=approx_params).get_json(),
+        )
+        report[name] = {
+            'exact_p50_ms': exact['p50_ms'],
+            'approx_p50_ms': approx['p50_ms'],
+            'speedup': round(exact['p50_ms'] / approx['p50_ms'], 2) if approx['p50_ms'] else None,
+            **accuracy,
+        }
+        print(
+            f"{name:28s} exact={exact['p50_ms']:9.2f}ms approx={approx['p50_ms']:9.2f}ms "
+            f"err={accuracy['mean_relative_error']} coverage={accuracy['ci_coverage']}",
+            file=sys.stderr,
+        )
+
+    return report
+
+
+# The dashboard's five requests per filter change, as (batch id, path, params)
+DASHBOARD_REQUESTS = [
+    ('daily', '/api/time-series', {'interval': 'day'}),
+    ('heatmap', '/api/heatmap', {}),
+    ('routes', '/api/top-routes', {'limit': 10}),
+    ('hourly', '/api/time-series', {'interval': 'hour'}),
+    ('statistics', '/api/statistics', {}),
+]
+
+
+def run_dashboard_report(db_path, iterations=10, warmup=1, filters=None):
+    """
+    Latency of the dashboard's five separate requests vs one /api/batch.
+
+    Returns:
+        Dict with latency summaries for both and the batch's per-sub-query
+        timings from its last run
+    """
+    os.environ['USE_SQLITE'] = 'true'
+    os.environ['SQLITE_DB_PATH'] = os.path.abspath(db_path)
+
+    from app import app
+
+    filters = filters or {}
+    client = app.test_client()
+    body = {
+        'filters': filters,
+        'queries': [
+            {'id': query_id, 'query': path.rsplit('/', 1)[-1], 'params': params}
+            for query_id, path, params in DASHBOARD_REQUESTS
+        ],
+    }
+
+    def separate():
+        for _, path, params in DASHBOARD_REQUESTS:
+            client.get(path, query_string=dict(filters, **params))
+
+    def batched():
+        return client.post('/api/batch', json=body)
+
+    separate_ms = []
+    batch_ms = []
+    for run in range(warmup + iterations):
+        started = time.perf_counter()
+        separate()
+        elapsed_separate = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        response = batched()
+        elapsed_batch = (time.perf_counter() - started) * 1000
+        if run >= warmup:
+            separate_ms.append(elapsed_separate)
+            batch_ms.append(elapsed_batch)
+
+    report = {
+        'separate': percentile_summary(separate_ms),
+        'batch': percentile_summary(batch_ms),
+        'batch_timings_ms': response.get_json().get('timings_ms'),
+    }
+    report['speedup'] = round(report['separate']['p50_ms'] / report['batch']['p50_ms'], 2)
+    print(
+        f"five requests p50={report['separate']['p50_ms']:9.2f}ms "
+        f"batch p50={report['batch']['p50_ms']:9.2f}ms speedup={report['speedup']}",
+        file=sys.stderr,
+    )
+    return report
+
+
+# Endpoint calls whose results /api/summary returns as sections
+SUMMARY_EQUIVALENT = [
+    ('/api/statistics', {}),
+    ('/api/statistics', {'group_by': 'payment_type'}),
+    ('/api/time-series', {'interval': 'hour'}),
+    ('/api/time-series', {'interval': 'day'}),
+    ('/api/heatmap', {}),
+    ('/api/top-routes', {'limit': 10}),
+]
+
+SUMMARY_FILTERS = [
+    ('unfiltered', {}),
+    ('fare_passenger', {'min_fare': 20, 'passenger_count': 1}),
+    ('one_month', {'start_date': '2024-03-01', 'end_date': '2024-03-31'}),
+]
+
+
+def run_summary_report(db_path, iterations=5, warmup=1):
+    """
+    Latency of /api/summary vs the sum of the endpoint calls it replaces.
+
+    Returns:
+        Dict mapping filter case name to both latency summaries and the
+        speedup of the p50s
+    """
+    os.environ['USE_SQLITE'] = 'true'
+    os.environ['SQLITE_DB_PATH'] = os.path.abspath(db_path)
+
+    from app import app
+
+    client = app.test_client()
+    report = {}
+
+    for name, filters in SUMMARY_FILTERS:
+        separate_ms = []
+        summary_ms = []
+        for run in range(warmup + iterations):
+            started = time.perf_counter()
+            for path, params in SUMMARY_EQUIVALENT:
+                client.get(path, query_string=dict(filters, **params))
+            elapsed_separate = (time.perf_counter() - started) * 1000
+            started = time.perf_counter()
+            client.get('/api/summary', query_string=filters)
+            elapsed_summary = (time.perf_counter() - started) * 1000
+            if run >= warmup:
+                separate_ms.append(elapsed_separate)
+                summary_ms.append(elapsed_summary)
+
+        report[name] = {
+            'separate': percentile_summary(separate_ms),
+            'summary': percentile_summary(summary_ms),
+        }
+        report[name]['speedup'] = round(
+            report[name]['separate']['p50_ms'] / report[name]['summary']['p50_ms'], 2
+        )
+        print(
+            f"{name:16s} separate p50={report[name]['separate']['p50_ms']:9.2f}ms "
+            f"summary p50={report[name]['summary']['p50_ms']:9.2f}ms "
+            f"speedup={report[name]['speedup']}",
+            file=sys.stderr,
+        )
+
+    report['peak_rss_mb'] = round(peak_rss_mb(), 1)
+    return report
+
+
+# Year-long aggregates run serially and with parallel=true on 1..N workers
+PARALLEL_CASES = [
+    ('statistics_zone', '/api/statistics', {'group_by': 'zone'}),
+    ('time_series_day', '/api/time-series', {'interval': 'day'}),
+]
+PARALLEL_RANGE = {'start_date': '2024-01-01', 'end_date': '2024-12-31'}
+CHART_WIDTH = 40
+
+
+def run_parallel_report(db_path, max_workers, iterations=5, warmup=1):
+    """
+    Scaling of parallel=true from 1 to `max_workers` pool processes.
+
+    Each pool size is warmed first, so process start-up is not timed.
+
+    Returns:
+        Dict mapping case name to the serial p50, and per worker count the
+        p50, speedup over serial and whether the JSON matched the serial one
+    """
+    os.environ['USE_SQLITE'] = 'true'
+    os.environ['SQLITE_DB_PATH'] = os.path.abspath(db_path)
+
+    from app import app
+    import parallel
+
+    counter = SQLCounter()
+    client = app.test_client()
+    report = {}
+
+    for name, path, params in PARALLEL_CASES:
+        params = dict(PARALLEL_RANGE, **params)
+        serial = run_case(client, counter, path, params, iterations, warmup)
+        expected = client.get(path, query_string=params).get_json()
+        scaling = []
+        for workers in range(1, max_workers + 1):
+            parallel.PARALLEL_WORKERS = workers
+            result = run_case(client, counter, path, dict(params, parallel='true'), iterations, warmup)
+            actual = client.get(path, query_string=dict(params, parallel='true')).get_json()
+            scaling.append({
+                'workers': workers,
+                'p50_ms': result['p50_ms'],
+                'speedup': round(serial['p50_ms'] / result['p50_ms'], 2) if result['p50_ms'] else None,
+                'matches_serial': actual == expected,
+            })
+        report[name] = {'serial_p50_ms': serial['p50_ms'], 'scaling': scaling}
+
+        slowest = max([serial['p50_ms']] + [row['p50_ms'] for row in scaling])
+        print(f"{name}", file=sys.stderr)
+        for label, p50, note in [('serial', serial['p50_ms'], '')] + [
+            (f"{row['workers']} workers", row['p50_ms'],
+             f"{row['speedup']}x{'' if row['matches_serial'] else ' MISMATCH'}")
+            for row in scaling
+        ]:
+            bar = '#' * max(1, round(CHART_WIDTH * p50 / slowest))
+            print(f"  {label:>10s} {p50:9.1f}ms {bar:{CHART_WIDTH}s} {note}", file=sys.stderr)
+
+    report['cpu_count'] = os.cpu_count()
+    return report
+
+
+# max_points values compared against the full daily series (None)
+DOWNSAMPLE_POINTS = [None, 200, 100, 50]
+# Lengths of synthetic high-resolution series: a week, a month and a year of minutes
+DOWNSAMPLE_SERIES = [10080, 43200, 525600]
+DOWNSAMPLE_TARGET = 1000
+
+
+def _synthetic_series(n, seed=0):
+    """Minute-resolution trip counts with a daily cycle, noise and rare spikes."""
+    rng = np.random.default_rng(seed)
+    minutes = np.arange(n)
+    counts = 40 + 30 * np.sin(2 * np.pi * minutes / 1440) + rng.normal(0, 5, n)
+    spikes = rng.random(n) < 0.0005
+    counts[spikes] += rng.uniform(100, 300, spikes.sum())
+    return minutes, np.maximum(counts, 0).round()
+
+
+def run_downsample_report(db_path, iterations=10, warmup=1):
+    """
+    Payload size and latency of /api/time-series with max_points, and of
+    LTTB on synthetic minute-resolution series.
+
+    For the synthetic series, "render data" is the JSON the chart receives:
+    its size and the time to downsample and serialize it, against
+    serializing every point. Peak retention compares the largest kept value
+    with the true maximum, for LTTB and for plain striding.
+
+    Returns:
+        Dict with an 'endpoint' entry per max_points and a 'synthetic'
+        entry per series length
+    """
+    os.environ['USE_SQLITE'] = 'true'
+    os.environ['SQLITE_DB_PATH'] = os.path.abspath(db_path)
+
+    from app import app
+    from downsampling import lttb
+
+    counter = SQLCounter()
+    client = app.test_client()
+    report = {'endpoint': {}, 'synthetic': {}}
+
+    for max_points in DOWNSAMPLE_POINTS:
+        params = {'interval': 'day'}
+        if max_points:
+            params['max_points'] = max_points
+        result = run_case(client, counter, '/api/time-series', params, iterations, warmup)
+        points = len(client.get('/api/time-series', query_string=params).get_json()['time_series'])
+        name = f"max_points_{max_points or 'all'}"
+        report['endpoint'][name] = {
+            'points': points, 'response_bytes': result['response_bytes'], 'p50_ms': result['p50_ms'],
+        }
+        print(f"{name:18s} points={points:6d} bytes={result['response_bytes']:9,d} "
+              f"p50={result['p50_ms']:8.2f}ms", file=sys.stderr)
+
+    for n in DOWNSAMPLE_SERIES:
+        x, y = _synthetic_series(n)
+        full_ms, sampled_ms = [], []
+        for run in range(warmup + iterations):
+            started = time.perf_counter()
+            full = json.dumps([{'minute': int(a), 'trip_count': b} for a, b in zip(x, y.tolist())])
+            elapsed_full = (time.perf_counter() - started) * 1000
+            started = time.perf_counter()
+            keep = lttb(x, y, DOWNSAMPLE_TARGET)
+            sampled = json.dumps([{'minute': int(x[i]), 'trip_count': float(y[i])} for i in keep])
+            elapsed_sampled = (time.perf_counter() - started) * 1000
+            if run >= warmup:
+                full_ms.append(elapsed_full)
+                sampled_ms.append(elapsed_sampled)
+        strided = y[::int(np.ceil(n / DOWNSAMPLE_TARGET))]
+        name = f"minutes_{n}"
+        report['synthetic'][name] = {
+            'points': n,
+            'kept': len(keep),
+            'full_bytes': len(full),
+            'downsampled_bytes': len(sampled),
+            'full': percentile_summary(full_ms),
+            'downsampled': percentile_summary(sampled_ms),
+            'peak_retained_lttb': round(float(y[keep].max() / y.max()), 3),
+            'peak_retained_stride': round(float(strided.max() / y.max()), 3),
+        }
+        row = report['synthetic'][name]
+        print(f"{name:18s} bytes {row['full_bytes']:11,d} -> {row['downsampled_bytes']:8,d} "
+              f"p50 {row['full']['p50_ms']:8.2f}ms -> {row['downsampled']['p50_ms']:6.2f}ms "
+              f"peak lttb={row['peak_retained_lttb']} stride={row['peak_retained_stride']}",
+              file=sys.stderr)
+
+    return report
+
+
+# Requests whose SQL is cheap (one day, one zone), so building the statement
+# is a visible share of the CPU; pickup_zone_id varies per request
+STATEMENT_DAY = {'start_date': '2024-03-01', 'end_date': '2024-03-01'}
+STATEMENT_CASES = [
+    ('statistics', '/api/statistics', dict(STATEMENT_DAY, min_fare=5)),
+    ('statistics_hour', '/api/statistics', dict(STATEMENT_DAY, group_by='hour')),
+    ('time_series_hour', '/api/time-series', dict(STATEMENT_DAY, interval='hour')),
+    ('heatmap', '/api/heatmap', dict(STATEMENT_DAY, min_fare=5)),
+    ('trips', '/api/trips', dict(STATEMENT_DAY, min_fare=5, limit=20)),
+]
+STATEMENT_ZONES = 200
+
+
+def _cache_results(counter):
+    """Totals of a cache counter by its 'result' label."""
+    totals = {}
+    for labels, value in counter.samples():
+        result = dict(labels)['result']
+        totals[result] = totals.get(result, 0) + value
+    return totals
+
+
+def _hit_rate(counts):
+    lookups = sum(counts.values())
+    return {
+        'lookups': lookups,
+        'hits': counts.get('hit', 0),
+        'hit_rate': round(counts.get('hit', 0) / lookups, 4) if lookups else None,
+    }
+
+
+def run_statement_report(db_path, iterations=100, warmup=20, rounds=5):
+    """
+    CPU time per request with statements built per request and cached per
+    filter shape (statements.py), and the hit rates of both caches.
+
+    Each case alternates `rounds` runs of `iterations` requests per mode and
+    keeps each mode's fastest run. Every request asks for a different pickup
+    zone, so it has new filter values and the same filter shape.
+
+    Returns:
+        Dict with per case the CPU and wall ms per request of both modes and
+        the CPU saved, and the statement and compiled cache hit rates over
+        the cached runs
+    """
+    os.environ['USE_SQLITE'] = 'true'
+    os.environ['SQLITE_DB_PATH'] = os.path.abspath(db_path)
+
+    from app import app
+    import statements
+
+    client = app.test_client()
+    report = {'cases': {}}
+    # Lookups of the timed cached runs, by cache and result
+    lookups = {'statement_cache': {}, 'compiled_cache': {}}
+    counters = {'statement_cache': statements.STATEMENT_LOOKUPS, 'compiled_cache': statements.COMPILED_CACHE}
+
+    def run(path, params, count):
+        for i in range(count):
+            client.get(path, query_string=dict(params, pickup_zone_id=i % STATEMENT_ZONES + 1))
+
+    for name, path, params in STATEMENT_CASES:
+        runs = {'per_request': [], 'cached': []}
+        for _ in range(rounds):
+            for mode in runs:
+                statements.STATEMENT_CACHE = mode == 'cached'
+                statements.clear()
+                run(path, params, warmup)
+                before = {cache: _cache_results(counter) for cache, counter in counters.items()}
+                cpu_started, started = time.process_time(), time.perf_counter()
+                run(path, params, iterations)
+                runs[mode].append({
+                    'cpu_ms': round((time.process_time() - cpu_started) * 1000 / iterations, 3),
+                    'wall_ms': round((time.perf_counter() - started) * 1000 / iterations, 3),
+                })
+                if mode == 'cached':
+                    for cache, counter in counters.items():
+                        counts = lookups[cache]
+                        for result, value in _cache_results(counter).items():
+                            counts[result] = counts.get(result, 0) + value - before[cache].get(result, 0)
+        row = {mode: min(results, key=lambda r: r['cpu_ms']) for mode, results in runs.items()}
+        saved = row['per_request']['cpu_ms'] - row['cached']['cpu_ms']
+        row['cpu_saved_ms'] = round(saved, 3)
+        row['cpu_saved_pct'] = round(100 * saved / row['per_request']['cpu_ms'], 1)
+        report['cases'][name] = row
+        print(
+            f"{name:18s} cpu/request {row['per_request']['cpu_ms']:7.3f}ms -> {row['cached']['cpu_ms']:7.3f}ms "
+            f"saved {row['cpu_saved_ms']:6.3f}ms ({row['cpu_saved_pct']}%)",
+            file=sys.stderr,
+        )
+
+    statements.STATEMENT_CACHE = True
+    for cache, counts in lookups.items():
+        report[cache] = _hit_rate(counts)
+    print(
+        f"statement cache hit rate {report['statement_cache']['hit_rate']}, "
+        f"compiled cache hit rate {report['compiled_cache']['hit_rate']}",
+        file=sys.stderr,
+    )
+    return report
+
+
+def compare(current, baseline):
+    """
+    Compare two benchmark reports case by case.
+
+    Returns:
+        Dict mapping case name to p50/p95 ratios (current / baseline)
+    """
+    comparison = {}
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if not base:
+            continue
+        comparison[name] = {
+            'p50_ratio': round(result['p50_ms'] / base['p50_ms'], 3) if base['p50_ms'] else None,
+            'p95_ratio': round(result['p95_ms'] / base['p95_ms'], 3) if base['p95_ms'] else None,
+            'sql_delta': round(result['sql_per_request'] - base['sql_per_request'], 2),
+        }
+    return comparison
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark API endpoints through the Flask test client')
+    parser.add_argument('--db', required=True, help='SQLite database to benchmark against')
+    parser.add_argument('--iterations', type=int, default=20, help='Timed requests per endpoint')
+    parser.add_argument('--warmup', type=int, default=2, help='Untimed requests per endpoint')
+    parser.add_argument('--cases', help='Comma-separated subset of case names to run')
+    parser.add_argument('--output', help='Write the JSON report to this file (default: stdout)')
+    parser.add_argument('--compare', help='Baseline JSON report to compare against')
+    parser.add_argument('--approx-report', action='store_true',
+                        help='Report accuracy vs latency of approx=true instead of the endpoint suite')
+    parser.add_argument('--dashboard-report', action='store_true',
+                        help="Compare the dashboard's five requests against one /api/batch call")
+    parser.add_argument('--summary-report', action='store_true',
+                        help='Compare /api/summary against the endpoint calls it replaces')
+    parser.add_argument('--parallel-report', action='store_true',
+                        help='Chart parallel=true latency from 1 to --max-workers pool processes')
+    parser.add_argument('--downsample-report', action='store_true',
+                        help='Report payload size and latency of max_points downsampling')
+    parser.add_argument('--statement-report', action='store_true',
+                        help='Report CPU per request with and without statements cached per filter shape')
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1,
+                        help='Largest pool size for --parallel-report')
+    args = parser.parse_args()
+
+    if (args.dashboard_report or args.summary_report or args.parallel_report or args.downsample_report
+            or args.statement_report):
+        report = {'meta': {'commit': git_commit(), 'database': os.path.abspath(args.db)}}
+        if args.dashboard_report:
+            report['dashboard'] = run_dashboard_report(args.db, iterations=args.iterations, warmup=args.warmup)
+        if args.summary_report:
+            report['summary'] = run_summary_report(args.db, iterations=args.iterations, warmup=args.warmup)
+        if args.parallel_report:
+            report['parallel'] = run_parallel_report(
+                args.db, args.max_workers, iterations=args.iterations, warmup=args.warmup
+            )
+        if args.downsample_report:
+            report['downsample'] = run_downsample_report(args.db, iterations=args.iterations, warmup=args.warmup)
+        if args.statement_report:
+            report['statements'] = run_statement_report(args.db)
+        output = json.dumps(report, indent=2)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(output + '\n')
+        else:
+            print(output)
+        sys.exit(0)
+
+    if args.approx_report:
+        report = {
+            'meta': {'commit': git_commit(), 'database': os.path.abspath(args.db)},
+            'approx': run_approx_report(args.db, iterations=args.iterations, warmup=args.warmup),
+        }
+        output = json.dumps(report, indent=2)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(output + '\n')
+        else:
+            print(output)
+        failures = find_coverage_failures(report['approx'])
+        for name, coverage, checked in failures:
+            print(
+                f"COVERAGE: {name} intervals cover {coverage} of {checked} exact values (nominal 0.95)",
+                file=sys.stderr,
+            )
+        sys.exit(1 if failures else 0)
+
+    cases = BENCHMARK_CASES
+    if args.cases:
+        wanted = set(args.cases.split(','))
+        cases = [case for case in BENCHMARK_CASES if case[0] in wanted]
+
+    report = run_benchmark(args.db, iterations=args.iterations, warmup=args.warmup, cases=cases)
+
+    if args.compare:
+        with open(args.compare) as f:
+            report['comparison'] = compare(report, json.load(f))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
@@ -0,0 +1,247 @@
+"""
+Micro-benchmarks and complexity regression checks for algorithms.py.
+
+Runs each custom algorithm over random, sorted, reverse-sorted and
+duplicate-heavy inputs at growing sizes, fits the empirical scaling
+exponent (slope of log time vs log n) and compares wall time against the
+standard library / NumPy equivalents. Exits non-zero when an algorithm
+scales worse than its documented complexity allows.
+
+Usage:
+    python benchmark_algorithms.py                       # 1k .. 1M rows
+    python benchmark_algorithms.py --sizes 1000,10000,100000 --output algo.json
+"""
+
+import argparse
+import heapq
+import json
+import sys
+import time
+
+import numpy as np
+
+from algorithms import (
+    QuickSort, MultiCriteriaFilter, TripGrouper,
+    AnomalyDetector, TopKSelector
+)
+from downsampling import lttb
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+DISTRIBUTIONS = ['random', 'sorted', 'reverse', 'duplicates']
+
+# Maximum accepted scaling exponent per algorithm. O(n) algorithms should
+# fit close to 1.0 and O(n log n) slightly above; anything approaching 2.0
+# means a quadratic regression.
+MAX_EXPONENT = {
+    'quicksort': 1.3,
+    'filter': 1.2,
+    'group_by_field': 1.2,
+    'group_by_time_window': 1.2,
+    'detect_outliers': 1.2,
+    'top_k': 1.2,
+    'lttb': 1.2,
+}
+
+SORT_CRITERIA = [
+    {'field': 'pickup_zone_id', 'order': 'asc'},
+    {'field': 'fare_amount', 'order': 'desc'},
+]
+FILTERS = [
+    {'field': 'fare_amount', 'min': 10.0, 'max': 30.0},
+    {'field': 'trip_speed', 'min': 10.0},
+]
+TOP_K = 100
+LTTB_POINTS = 500
+
+
+def make_trips(n, distribution, seed=0):
+    """
+    Build n trip dicts whose fare_amount / pickup_zone_id follow `distribution`.
+
+    Returns:
+        Tuple of (trips, column arrays for the NumPy baselines)
+    """
+    rng = np.random.default_rng(seed)
+
+    if distribution == 'duplicates':
+        fares = rng.choice([8.0, 12.5, 15.0, 20.0, 52.0], size=n)
+        zones = rng.choice([161, 162, 230], size=n)
+    else:
+        fares = np.round(rng.lognormal(2.7, 0.6, size=n), 2)
+        zones = rng.integers(1, 266, size=n)
+
+    if distribution in ('sorted', 'reverse'):
+        order = np.lexsort((-fares, zones))
+        if distribution == 'reverse':
+            order = order[::-1]
+        fares, zones = fares[order], zones[order]
+
+    speeds = np.round(rng.lognormal(2.5, 0.4, size=n), 2)
+    hours = rng.integers(0, 24, size=n)
+
+    trips = [{
+        'trip_id': i,
+        'fare_amount': float(fares[i]),
+        'trip_speed': float(speeds[i]),
+        'pickup_zone_id': int(zones[i]),
+        'pickup_datetime': f"2024-01-01T{int(hours[i]):02d}:15:00",
+    } for i in range(n)]
+
+    columns = {'fare_amount': fares, 'trip_speed': speeds, 'pickup_zone_id': zones, 'hour': hours}
+    return trips, columns
+
+
+def time_call(fn, repeat):
+    """Best wall time over `repeat` runs, in seconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def algorithm_cases(trips, columns):
+    """
+    (name, custom implementation, baseline implementation) triples.
+    """
+    sort_key = lambda t: (t['pickup_zone_id'], -t['fare_amount'])
+
+    def numpy_outliers():
+        values = columns['fare_amount']
+        z = np.abs(values - values.mean()) / values.std()
+        return np.nonzero(z > 3.0)[0]
+
+    return [
+        ('quicksort',
+         lambda: QuickSort.sort(trips, SORT_CRITERIA),
+         lambda: sorted(trips, key=sort_key)),
+        ('filter',
+         lambda: MultiCriteriaFilter.filter_trips(trips, FILTERS),
+         lambda: np.nonzero(
+             (columns['fare_amount'] >= 10.0) & (columns['fare_amount'] <= 30.0)
+             & (columns['trip_speed'] >= 10.0)
+         )[0]),
+        ('group_by_field',
+         lambda: TripGrouper.group_by_field(trips, 'pickup_zone_id'),
+         lambda: np.unique(columns['pickup_zone_id'], return_inverse=True)),
+        ('group_by_time_window',
+         lambda: TripGrouper.group_by_time_window(trips, window_hours=3),
+         lambda: np.bincount(columns['hour'] // 3)),
+        ('detect_outliers',
+         lambda: AnomalyDetector.detect_outliers(trips, 'fare_amount', 3.0),
+         numpy_outliers),
+        ('top_k',
+         lambda: TopKSelector.select_top_k(trips, TOP_K, {'field': 'fare_amount', 'order': 'desc'}),
+         lambda: heapq.nlargest(TOP_K, trips, key=lambda t: t['fare_amount'])),
+        ('lttb',
+         lambda: lttb(np.arange(len(trips)), columns['fare_amount'], LTTB_POINTS),
+         lambda: columns['fare_amount'][::max(1, len(trips) // LTTB_POINTS)]),
+    ]
+
+
+def fit_exponent(sizes, times):
+    """
+    Least-squares slope of log(time) against log(n).
+
+    Returns:
+        Scaling exponent (1.0 = linear, 2.0 = quadratic)
+    """
+    if len(sizes) < 2:
+        return None
+    slope, _ = np.polyfit(np.log(sizes), np.log(np.maximum(times, 1e-9)), 1)
+    return float(slope)
+
+
+def run_suite(sizes, distributions=DISTRIBUTIONS, repeat=3):
+    """
+    Time every algorithm/distribution/size combination.
+
+    Returns:
+        Nested dict: results[algorithm][distribution] with per-size timings,
+        baseline ratios and the fitted exponent
+    """
+    results = {}
+
+    for distribution in distributions:
+        for n in sizes:
+            trips, columns = make_trips(n, distribution)
+            # Large inputs are slow in pure Python; one run is enough there
+            runs = repeat if n <= 100000 else 1
+
+            for name, custom, baseline in algorithm_cases(trips, columns):
+                custom_time = time_call(custom, runs)
+                baseline_time = time_call(baseline, runs)
+
+                entry = results.setdefault(name, {}).setdefault(distribution, {'sizes': []})
+                entry['sizes'].append({
+                    'n': n,
+                    'seconds': round(custom_time, 6),
+                    'baseline_seconds': round(baseline_time, 6),
+                    'slowdown_vs_baseline': round(custom_time / baseline_time, 1) if baseline_time else None,
+                })
+                print(
+                    f"{name:22s} {distribution:10s} n={n:>8,} "
+                    f"{custom_time * 1000:10.2f}ms (baseline {baseline_time * 1000:8.2f}ms)",
+                    file=sys.stderr,
+                )
+
+    for name, by_distribution in results.items():
+        for distribution, entry in by_distribution.items():
+            ns = [row['n'] for row in entry['sizes']]
+            ts = [row['seconds'] for row in entry['sizes']]
+            exponent = fit_exponent(ns, ts)
+            entry['exponent'] = round(exponent, 3) if exponent is not None else None
+            entry['max_exponent'] = MAX_EXPONENT[name]
+            entry['regression'] = exponent is not None and exponent > MAX_EXPONENT[name]
+
+    return results
+
+
+def find_regressions(results):
+    """List of (algorithm, distribution, exponent) that exceed their bound."""
+    return [
+        (name, distribution, entry['exponent'])
+        for name, by_distribution in results.items()
+        for distribution, entry in by_distribution.items()
+        if entry['regression']
+    ]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark algorithms.py and check complexity bounds')
+    parser.add_argument('--sizes', help='Comma-separated input sizes (default 1000,10000,100000,1000000)')
+    parser.add_argument('--distributions', help='Comma-separated subset of: ' + ', '.join(DISTRIBUTIONS))
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per case (best is kept)')
+    parser.add_argument('--output', help='Write the JSON report to this file (default: stdout)')
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(',')] if args.sizes else DEFAULT_SIZES
+    distributions = args.distributions.split(',') if args.distributions else DISTRIBUTIONS
+
+    results = run_suite(sizes, distributions, repeat=args.repeat)
+    regressions = find_regressions(results)
+
+    report = {
+        'sizes': sizes,
+        'results': results,
+        'regressions': [
+            {'algorithm': name, 'distribution': distribution, 'exponent': exponent}
+            for name, distribution, exponent in regressions
+        ],
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    for name, distribution, exponent in regressions:
+        print(
+            f"REGRESSION: {name} on {distribution} input scales as n^{exponent:.2f} "
+            f"(limit n^{MAX_EXPONENT[name]})",
+            file=sys.stderr,
+        )
+    sys.exit(1 if regressions else 0)
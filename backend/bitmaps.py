@@ -0,0 +1,705 @@
+"""
+Compressed bitmap indexes over low-cardinality trip dimensions.
+
+For every value of pickup/dropoff zone, passenger count, payment type, rate
+code, pickup hour and pickup weekday, the set of trip_ids with that value is
+kept as a roaring-style bitmap: trip_ids are split into 2^16-wide chunks and
+each non-empty chunk is stored either as a sorted uint16 array (up to 4096
+members) or as a 1024-word uint64 bitmap (denser chunks). Multi-predicate
+filters become container-wise AND/OR and the counts become popcounts, so
+total and per-value counts are answered from the index without reading
+`trips`.
+
+The index is built at ingest (see ingest.after_ingest), written to one file
+per dimension and opened with np.memmap, so processes share the page cache
+instead of each loading a copy. It is only used while its recorded dataset
+version matches the database's; otherwise callers fall back to SQL.
+
+File layout (<dimension>.rbm, little-endian):
+    header      magic, value count, container count, bitmap count, array length
+    values      VALUE_DTYPE per value, sorted by value
+    containers  CONTAINER_DTYPE per container, grouped by value, sorted by key
+    bitmaps     (bitmap count, 1024) uint64, every bitmap container
+    arrays      uint16, every array container back to back
+"""
+
+import json
+import logging
+import os
+import shutil
+import threading
+
+import numpy as np
+from sqlalchemy import select, cast, func, literal_column, Integer
+
+from models import Trip, generation_name, on_dataset_switch
+from dimensions import get_dimensions
+import storage
+
+logger = logging.getLogger(__name__)
+
+BITMAP_INDEX_DIR = os.getenv('BITMAP_INDEX_DIR')
+FETCH_BATCH_SIZE = 100000
+
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+WORDS = CHUNK_SIZE // 64
+# Above this many members a bitmap container is smaller than an array
+ARRAY_MAX = 4096
+ARRAY, BITMAP = 0, 1
+
+# Stored for trips where the dimension is NULL
+NULL_VALUE = -1
+
+DIMENSIONS = (
+    'pickup_zone_id', 'dropoff_zone_id', 'passenger_count',
+    'payment_type_id', 'rate_code_id', 'hour', 'weekday',
+)
+
+MAGIC = b'RBM1'
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S4'), ('values', '<u4'), ('containers', '<u8'),
+    ('bitmaps', '<u8'), ('array_length', '<u8'),
+])
+VALUE_DTYPE = np.dtype([
+    ('value', '<i8'), ('first', '<u8'), ('count', '<u8'), ('cardinality', '<u8'),
+])
+# start: row in the bitmap block, or element offset in the array block
+CONTAINER_DTYPE = np.dtype([
+    ('key', '<u4'), ('kind', '<u4'), ('cardinality', '<u4'), ('pad', '<u4'), ('start', '<u8'),
+])
+MANIFEST = 'manifest.json'
+
+
+if hasattr(np, 'bitwise_count'):
+    def _popcount_rows(words):
+        """Set bits per row of a 2-D uint64 array."""
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+else:
+    def _popcount_rows(words):
+        """Set bits per row of a 2-D uint64 array."""
+        words = np.ascontiguousarray(words)
+        return np.unpackbits(words.view(np.uint8), axis=-1).sum(axis=-1, dtype=np.int64)
+
+
+def _popcount(words):
+    return int(_popcount_rows(words))
+
+
+def _bits(container):
+    """Container as a 1024-word bitmap."""
+    if container.dtype == np.uint64:
+        return container
+    words = np.zeros(WORDS, dtype=np.uint64)
+    np.bitwise_or.at(
+        words, container >> 6, np.left_shift(np.uint64(1), (container & 63).astype(np.uint64))
+    )
+    return words
+
+
+def _members(words):
+    """Sorted uint16 members of a bitmap container."""
+    return np.flatnonzero(np.unpackbits(words.view(np.uint8), bitorder='little')).astype(np.uint16)
+
+
+def _contains(words, members):
+    """Boolean mask of `members` set in the bitmap `words`."""
+    shifts = (members & 63).astype(np.uint64)
+    return ((words[members >> 6] >> shifts) & np.uint64(1)).astype(bool)
+
+
+def _cardinality(container):
+    return container.size if container.dtype == np.uint16 else _popcount(container)
+
+
+def _normalize(container):
+    """Pick the cheaper representation; None for an empty container."""
+    if container.dtype == np.uint64:
+        count = _popcount(container)
+        if count == 0:
+            return None
+        return _members(container) if count <= ARRAY_MAX else container
+    if container.size == 0:
+        return None
+    return _bits(container) if container.size > ARRAY_MAX else container
+
+
+def make_container(members):
+    """Container for sorted, unique uint16 members."""
+    return _normalize(np.asarray(members, dtype=np.uint16))
+
+
+def _and(a, b):
+    if a.dtype == np.uint16 and b.dtype == np.uint16:
+        return _normalize(np.intersect1d(a, b, assume_unique=True))
+    if a.dtype == np.uint16:
+        return _normalize(a[_contains(b, a)])
+    if b.dtype == np.uint16:
+        return _normalize(b[_contains(a, b)])
+    return _normalize(a & b)
+
+
+def _or(a, b):
+    if a.dtype == np.uint16 and b.dtype == np.uint16 and a.size + b.size <= ARRAY_MAX:
+        return _normalize(np.union1d(a, b))
+    return _normalize(_bits(a) | _bits(b))
+
+
+def _andnot(a, b):
+    if a.dtype == np.uint16 and b.dtype == np.uint16:
+        return _normalize(np.setdiff1d(a, b, assume_unique=True))
+    if a.dtype == np.uint16:
+        return _normalize(a[~_contains(b, a)])
+    return _normalize(a & ~_bits(b))
+
+
+class RoaringBitmap:
+    """
+    Set of non-negative integers as chunk key -> container.
+
+    Containers are uint16 arrays or 1024-word uint64 bitmaps and may be
+    read-only views into a memory-mapped index file; operations always
+    return new containers.
+    """
+
+    __slots__ = ('containers',)
+
+    def __init__(self, containers=None):
+        self.containers = containers if containers is not None else {}
+
+    @classmethod
+    def from_ids(cls, ids):
+        """
+        Build from integer IDs.
+
+        Time Complexity: O(n log n) for the sort
+        """
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        keys = ids >> CHUNK_BITS
+        bounds = np.flatnonzero(np.diff(keys)) + 1
+        containers = {}
+        for part in np.split(ids, bounds):
+            if part.size:
+                containers[int(part[0] >> CHUNK_BITS)] = make_container(part & (CHUNK_SIZE - 1))
+        return cls(containers)
+
+    def to_ids(self):
+        """Sorted int64 array of the members."""
+        parts = []
+        for key in sorted(self.containers):
+            container = self.containers[key]
+            members = container if container.dtype == np.uint16 else _members(container)
+            parts.append((np.int64(key) << CHUNK_BITS) + members.astype(np.int64))
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+    def cardinality(self):
+        """Number of members (popcount of every container)."""
+        return sum(_cardinality(c) for c in self.containers.values())
+
+    def __len__(self):
+        return self.cardinality()
+
+    def __and__(self, other):
+        result = {}
+        for key in self.containers.keys() & other.containers.keys():
+            container = _and(self.containers[key], other.containers[key])
+            if container is not None:
+                result[key] = container
+        return RoaringBitmap(result)
+
+    def __or__(self, other):
+        result = dict(self.containers)
+        for key, container in other.containers.items():
+            result[key] = _or(result[key], container) if key in result else container
+        return RoaringBitmap(result)
+
+    def __sub__(self, other):
+        result = {}
+        for key, container in self.containers.items():
+            if key in other.containers:
+                container = _andnot(container, other.containers[key])
+            if container is not None:
+                result[key] = container
+        return RoaringBitmap(result)
+
+    @classmethod
+    def union(cls, bitmaps):
+        """
+        OR of any number of bitmaps, accumulating each chunk once.
+
+        Time Complexity: O(c) container operations for c input containers
+        """
+        by_key = {}
+        for bitmap in bitmaps:
+            for key, container in bitmap.containers.items():
+                by_key.setdefault(key, []).append(container)
+
+        result = {}
+        for key, containers in by_key.items():
+            if len(containers) == 1:
+                result[key] = containers[0]
+                continue
+            words = np.zeros(WORDS, dtype=np.uint64)
+            for container in containers:
+                if container.dtype == np.uint64:
+                    words |= container
+                else:
+                    words |= _bits(container)
+            result[key] = _normalize(words)
+        return cls(result)
+
+    def dense_words(self, n_keys):
+        """Flat uint64 bitmap of the first `n_keys` chunks (chunk k at words k*1024)."""
+        words = np.zeros(n_keys * WORDS, dtype=np.uint64)
+        for key, container in self.containers.items():
+            if key < n_keys:
+                words[key * WORDS:(key + 1) * WORDS] = _bits(container)
+        return words
+
+
+class DimensionIndex:
+    """Memory-mapped bitmaps of every value of one dimension."""
+
+    def __init__(self, path):
+        data = np.memmap(path, dtype=np.uint8, mode='r')
+        header = data[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)[0]
+        if header['magic'] != MAGIC:
+            raise ValueError(f'{path} is not a bitmap index file')
+
+        offset = HEADER_DTYPE.itemsize
+        size = int(header['values']) * VALUE_DTYPE.itemsize
+        self.values = data[offset:offset + size].view(VALUE_DTYPE)
+        offset += size
+        size = int(header['containers']) * CONTAINER_DTYPE.itemsize
+        self.containers = data[offset:offset + size].view(CONTAINER_DTYPE)
+        offset += size
+        size = int(header['bitmaps']) * WORDS * 8
+        self.bitmaps = data[offset:offset + size].view(np.uint64).reshape(-1, WORDS)
+        offset += size
+        self.arrays = data[offset:offset + int(header['array_length']) * 2].view(np.uint16)
+        self._positions = {int(v): i for i, v in enumerate(self.values['value'])}
+
+    def __contains__(self, value):
+        return value in self._positions
+
+    def bitmap(self, value):
+        """RoaringBitmap of trips with `value` (empty for unseen values)."""
+        position = self._positions.get(value)
+        if position is None:
+            return RoaringBitmap()
+        entry = self.values[position]
+        first = int(entry['first'])
+        result = {}
+        for container in self.containers[first:first + int(entry['count'])]:
+            start = int(container['start'])
+            if container['kind'] == BITMAP:
+                result[int(container['key'])] = self.bitmaps[start]
+            else:
+                result[int(container['key'])] = self.arrays[start:start + int(container['cardinality'])]
+        return RoaringBitmap(result)
+
+    def counts(self):
+        """Dict value -> trip count, straight from the value directory."""
+        return {
+            int(v): int(c) for v, c in zip(self.values['value'], self.values['cardinality'])
+            if v != NULL_VALUE
+        }
+
+    def counts_within(self, words):
+        """
+        Dict value -> number of its trips that are set in the dense bitmap
+        `words` (see RoaringBitmap.dense_words).
+
+        All containers of the dimension are intersected in two vectorized
+        passes over the mapped blocks instead of one call per container.
+        """
+        n_values = self.values.size
+        labels = np.repeat(np.arange(n_values), self.values['count'].astype(np.int64))
+        keys = self.containers['key'].astype(np.int64)
+        kinds = self.containers['kind']
+        hits = np.zeros(n_values)
+
+        is_bitmap = kinds == BITMAP
+        if is_bitmap.any():
+            rows = self.containers['start'][is_bitmap].astype(np.int64)
+            window = words.reshape(-1, WORDS)[keys[is_bitmap]]
+            per_container = _popcount_rows(self.bitmaps[rows] & window)
+            hits += np.bincount(labels[is_bitmap], weights=per_container, minlength=n_values)
+
+        is_array = kinds == ARRAY
+        if is_array.any():
+            # Array containers are stored back to back in directory order, so
+            # one gather over a byte-per-trip mask tests every member
+            cards = self.containers['cardinality'][is_array].astype(np.int64)
+            selected = np.unpackbits(words.view(np.uint8), bitorder='little').view(bool)
+            positions = np.repeat(keys[is_array] << CHUNK_BITS, cards)
+            positions |= self.arrays
+            per_container = np.add.reduceat(selected[positions], np.cumsum(cards) - cards, dtype=np.int64)
+            hits += np.bincount(labels[is_array], weights=per_container, minlength=n_values)
+
+        return {
+            int(v): int(h) for v, h in zip(self.values['value'], hits)
+            if v != NULL_VALUE and h
+        }
+
+
+class BitmapIndex:
+    """
+    The bitmap indexes of one dataset version.
+
+    Attributes:
+        version: Dataset version the index was built for
+        max_trip_id: Highest trip_id covered
+        dimensions: Dict dimension name -> DimensionIndex
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+        self.path = path
+        self.version = manifest['version']
+        self.max_trip_id = manifest['max_trip_id']
+        self.n_keys = (self.max_trip_id >> CHUNK_BITS) + 1
+        self.dimensions = {
+            name: DimensionIndex(os.path.join(path, f'{name}.rbm'))
+            for name in manifest['dimensions']
+        }
+        self._rows = None
+
+    def rows(self):
+        """Every indexed trip: the union of all values of one dimension."""
+        if self._rows is None:
+            weekday = self.dimensions['weekday']
+            self._rows = RoaringBitmap.union(
+                weekday.bitmap(int(v)) for v in weekday.values['value']
+            )
+        return self._rows
+
+    def select(self, predicates, not_null=()):
+        """
+        Trips matching every predicate.
+
+        Args:
+            predicates: Dict dimension -> list of accepted values (ORed)
+            not_null: Dimensions whose NULL trips are excluded
+
+        Returns:
+            RoaringBitmap of trip_ids
+        """
+        selected = None
+        # Most selective predicates first keeps the intermediate sets small
+        for name, values in sorted(predicates.items(), key=lambda p: self._estimate(*p)):
+            dimension = self.dimensions[name]
+            bitmap = RoaringBitmap.union(dimension.bitmap(v) for v in values)
+            selected = bitmap if selected is None else selected & bitmap
+        if selected is None:
+            selected = self.rows()
+        for name in not_null:
+            selected = selected - self.dimensions[name].bitmap(NULL_VALUE)
+        return selected
+
+    def _estimate(self, name, values):
+        dimension = self.dimensions[name]
+        return sum(
+            int(dimension.values['cardinality'][dimension._positions[v]])
+            for v in values if v in dimension
+        )
+
+    def count(self, predicates, not_null=()):
+        """Number of trips matching the predicates."""
+        return self.select(predicates, not_null).cardinality()
+
+    def group_counts(self, name, predicates):
+        """
+        Dict value -> trip count of dimension `name` over the trips matching
+        `predicates`; trips where the dimension is NULL are left out.
+        """
+        dimension = self.dimensions[name]
+        if not predicates:
+            return dimension.counts()
+        selected = self.select(predicates)
+        return dimension.counts_within(selected.dense_words(self.n_keys))
+
+
+def dimension_columns(session):
+    """Dimension name -> integer SQL expression, in DIMENSIONS order."""
+    if session.get_bind().dialect.name == 'sqlite' and not storage.is_compact(Trip.pickup_datetime):
+        # Inline formats: SQLite re-parses a bound format string on every row
+        hour = cast(func.strftime(literal_column("'%H'"), Trip.pickup_datetime), Integer)
+        weekday = cast(func.strftime(literal_column("'%w'"), Trip.pickup_datetime), Integer)
+    else:
+        hour = cast(storage.hour_of(session, Trip.pickup_datetime), Integer)
+        weekday = cast(storage.weekday_of(session, Trip.pickup_datetime), Integer)
+    return {
+        'pickup_zone_id': Trip.pickup_zone_id,
+        'dropoff_zone_id': Trip.dropoff_zone_id,
+        'passenger_count': Trip.passenger_count,
+        'payment_type_id': Trip.payment_type_id,
+        'rate_code_id': Trip.rate_code_id,
+        'hour': hour,
+        'weekday': weekday,
+    }
+
+
+def index_dir(session):
+    """Directory holding the index for the session's database."""
+    if BITMAP_INDEX_DIR:
+        return BITMAP_INDEX_DIR
+    url = session.get_bind().url
+    if url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:'):
+        return os.path.abspath(url.database) + '.bitmaps'
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), generation_name('bitmap_index', url))
+
+
+class _Builder:
+    """Accumulates containers chunk by chunk from trip_id-ordered rows."""
+
+    def __init__(self):
+        # dimension -> value -> list of (key, container)
+        self.values = {name: {} for name in DIMENSIONS}
+        self.carry = None
+        self.max_trip_id = 0
+
+    def add(self, block):
+        """Add rows (trip_id, *DIMENSIONS) in trip_id order."""
+        if self.carry is not None:
+            block = np.vstack((self.carry, block))
+        keys = block[:, 0] >> CHUNK_BITS
+        # The last chunk may continue in the next batch
+        complete = keys < keys[-1]
+        self._flush(block[complete])
+        self.carry = block[~complete]
+
+    def finish(self):
+        if self.carry is not None:
+            self._flush(self.carry)
+            self.carry = None
+
+    def _flush(self, block):
+        if block.shape[0] == 0:
+            return
+        ids = block[:, 0]
+        self.max_trip_id = max(self.max_trip_id, int(ids[-1]))
+        keys = ids >> CHUNK_BITS
+        members = (ids & (CHUNK_SIZE - 1)).astype(np.uint16)
+
+        for column, name in enumerate(DIMENSIONS, start=1):
+            values = block[:, column]
+            # Stable: members stay sorted inside each (value, key) group
+            order = np.lexsort((keys, values))
+            group_values, group_keys = values[order], keys[order]
+            bounds = np.flatnonzero(
+                (np.diff(group_values) != 0) | (np.diff(group_keys) != 0)
+            ) + 1
+            starts = np.concatenate(([0], bounds))
+            ends = np.concatenate((bounds, [order.size]))
+            target = self.values[name]
+            for start, end in zip(starts, ends):
+                container = make_container(members[order[start:end]])
+                target.setdefault(int(group_values[start]), []).append(
+                    (int(group_keys[start]), container)
+                )
+
+
+def _scan(session, since_trip_id, batch_size):
+    """Yield int64 blocks of (trip_id, *DIMENSIONS) in trip_id order; NULL becomes NULL_VALUE."""
+    columns = dimension_columns(session)
+    stmt = select(
+        Trip.trip_id, *[func.coalesce(columns[name], NULL_VALUE) for name in DIMENSIONS]
+    ).where(Trip.trip_id >= since_trip_id).order_by(Trip.trip_id)
+
+    result = session.connection().execute(stmt)
+    cursor = result.cursor
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield np.array(rows, dtype=np.int64)
+    result.close()
+
+
+def _write_dimension(path, values):
+    """Write one dimension's value -> [(key, container)] map to `path`."""
+    value_rows = []
+    container_rows = []
+    bitmaps = []
+    arrays = []
+    array_length = 0
+    for value in sorted(values):
+        first = len(container_rows)
+        cardinality = 0
+        for key, container in values[value]:
+            if container.dtype == np.uint64:
+                kind, start, count = BITMAP, len(bitmaps), _popcount(container)
+                bitmaps.append(container)
+            else:
+                kind, start, count = ARRAY, array_length, container.size
+                arrays.append(container)
+                array_length += container.size
+            container_rows.append((key, kind, count, 0, start))
+            cardinality += count
+        value_rows.append((value, first, len(container_rows) - first, cardinality))
+
+    header = np.array(
+        [(MAGIC, len(value_rows), len(container_rows), len(bitmaps), array_length)],
+        dtype=HEADER_DTYPE
+    )
+    with open(path, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(np.array(value_rows, dtype=VALUE_DTYPE).tobytes())
+        f.write(np.array(container_rows, dtype=CONTAINER_DTYPE).tobytes())
+        for words in bitmaps:
+            f.write(np.asarray(words, dtype='<u8').tobytes())
+        for members in arrays:
+            f.write(np.asarray(members, dtype='<u2').tobytes())
+
+
+def _kept_containers(index, below_key):
+    """Containers of an existing index for chunks before `below_key`."""
+    kept = {}
+    for name in DIMENSIONS:
+        dimension = index.dimensions[name]
+        kept[name] = {}
+        for value in dimension.values['value']:
+            containers = [
+                (key, np.array(container))
+                for key, container in sorted(dimension.bitmap(int(value)).containers.items())
+                if key < below_key
+            ]
+            if containers:
+                kept[name][int(value)] = containers
+    return kept
+
+
+def build_index(session, version, since_trip_id=0, batch_size=FETCH_BATCH_SIZE):
+    """
+    Build or extend the bitmap index and publish it for `version`.
+
+    With since_trip_id > 0 the chunks before the one holding since_trip_id
+    are copied from the current index and only the rest is rebuilt from
+    `trips`; without a usable current index everything is rebuilt.
+
+    Returns:
+        Number of trips scanned
+    """
+    path = index_dir(session)
+    first_key = since_trip_id >> CHUNK_BITS
+    kept = {name: {} for name in DIMENSIONS}
+    kept_max_trip_id = 0
+    previous = _open(path)
+    if first_key and previous is not None and previous.max_trip_id >= since_trip_id - 1:
+        kept = _kept_containers(previous, first_key)
+        kept_max_trip_id = min(previous.max_trip_id, (first_key << CHUNK_BITS) - 1)
+    else:
+        first_key = 0
+    previous = None
+
+    builder = _Builder()
+    scanned = 0
+    for block in _scan(session, first_key << CHUNK_BITS, batch_size):
+        builder.add(block)
+        scanned += block.shape[0]
+    builder.finish()
+
+    staging = f'{path}.tmp-{os.getpid()}'
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    for name in DIMENSIONS:
+        values = kept[name]
+        for value, containers in builder.values[name].items():
+            values.setdefault(value, []).extend(containers)
+        _write_dimension(os.path.join(staging, f'{name}.rbm'), values)
+
+    with open(os.path.join(staging, MANIFEST), 'w') as f:
+        json.dump({
+            'version': version,
+            'max_trip_id': max(builder.max_trip_id, kept_max_trip_id),
+            'dimensions': list(DIMENSIONS),
+        }, f)
+
+    # Swap directories; readers keep their mappings of the old files
+    retired = f'{path}.old-{os.getpid()}'
+    if os.path.exists(path):
+        os.rename(path, retired)
+    os.rename(staging, path)
+    shutil.rmtree(retired, ignore_errors=True)
+    invalidate()
+    return scanned
+
+
+def _open(path):
+    try:
+        return BitmapIndex(path)
+    except (OSError, ValueError, KeyError) as e:
+        logger.debug(f"No bitmap index at {path}: {e}")
+        return None
+
+
+# index directory -> (dataset version, BitmapIndex or None)
+_cache = {}
+_lock = threading.Lock()
+
+
+def get_bitmap_index(session):
+    """
+    The bitmap index of the session's database, or None when it is missing
+    or was built for another dataset version.
+    """
+    version = get_dimensions(session).version
+    path = index_dir(session)
+    cached = _cache.get(path)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    with _lock:
+        cached = _cache.get(path)
+        if cached and cached[0] == version:
+            return cached[1]
+        index = _open(path)
+        if index is not None and index.version != version:
+            index = None
+        _cache[path] = (version, index)
+        return index
+
+
+@on_dataset_switch
+def invalidate():
+    """Drop opened indexes so the next request maps the current files."""
+    with _lock:
+        _cache.clear()
+
+
+def parse_predicates(args, params=DIMENSIONS, multi=False):
+    """
+    Bitmap predicates from request arguments.
+
+    Args:
+        args: Request arguments
+        params: Dimensions to read from `args`
+        multi: Accept comma-separated values (ORed); otherwise a value must
+            be a single integer
+
+    Returns:
+        Dict dimension -> list of values. Values that do not parse are
+        ignored, as build_trip_filters ignores them.
+    """
+    predicates = {}
+    for name in params:
+        value = args.get(name)
+        if value in (None, ''):
+            continue
+        parts = value.split(',') if multi else [value]
+        try:
+            predicates[name] = sorted({int(part) for part in parts})
+        except ValueError:
+            pass
+    return predicates
+
+
+def covers(args, filter_params, params=DIMENSIONS):
+    """True if every filter present in `args` is one of the bitmap dimensions."""
+    return all(
+        args.get(param) in (None, '')
+        for param in filter_params
+        if param not in params
+    )
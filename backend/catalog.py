@@ -0,0 +1,398 @@
+"""
+Statistics catalog of the trips table, maintained at ingest.
+
+Two tables summarize `trips` so that cheap questions are not answered by
+scanning it:
+
+- `trip_count_stats`: trips per (pickup date, pickup zone), with NULL
+  zones under UNKNOWN_ZONE. Their sum is the exact trip count.
+- `column_stats`: per numeric trip column the non-NULL and NULL counts,
+  min and max, plus for HISTOGRAM_COLUMNS an equi-depth histogram
+  (HISTOGRAM_BUCKETS + 1 bucket bounds).
+
+Counts and ranges are folded in incrementally from the new trips after
+each ingest. Histograms are rebuilt each time from the approximate-query
+sample (sampling.py), which is refreshed first; while the sample holds
+fewer than HISTOGRAM_MIN_SAMPLE values they are built from at most
+HISTOGRAM_MAX_VALUES trips spread evenly over trip_id.
+
+The catalog answers /health's trip count, counts /api/trips' total_count
+by date and pickup zone where the bitmap index cannot, and gives
+selectivity estimates to code that orders predicates (the snapshot scan
+in snapshots.py evaluates the most selective filter first). Estimates
+assume the filtered columns are independent of each other, except date
+and pickup zone, which are counted together.
+"""
+
+import bisect
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import func, cast, inspect, insert, select, update, Column, String
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, Null
+
+from models import Trip, TripSample, TripCountStat, ColumnStat, on_dataset_switch
+from dimensions import get_dimensions
+import storage
+
+UNKNOWN_ZONE = 0
+
+# Numeric trip columns with a range and NULL count in column_stats
+CATALOG_COLUMNS = (
+    'pickup_zone_id', 'dropoff_zone_id', 'payment_type_id', 'rate_code_id',
+    'passenger_count', 'trip_distance', 'trip_duration', 'fare_amount', 'extra',
+    'mta_tax', 'tip_amount', 'tolls_amount', 'improvement_surcharge',
+    'total_amount', 'trip_speed', 'fare_per_km', 'fare_per_minute',
+)
+HISTOGRAM_COLUMNS = ('fare_amount', 'trip_distance', 'trip_duration')
+HISTOGRAM_BUCKETS = 64
+HISTOGRAM_MIN_SAMPLE = 10000
+# Values read from `trips` for a histogram when the sample is smaller
+HISTOGRAM_MAX_VALUES = 100000
+
+SECONDS_PER_DAY = 86400
+
+ColumnStats = namedtuple('ColumnStats', ['row_count', 'null_count', 'min_value', 'max_value', 'bounds'])
+
+
+def _merge_range(stored, new, pick):
+    values = [v for v in (stored, new) if v is not None]
+    return pick(values) if values else None
+
+
+def _store_counts(session, counts):
+    """Add (date, zone) -> trips to trip_count_stats."""
+    existing = {}
+    days = sorted({day for day, _ in counts})
+    for start in range(0, len(days), 500):
+        existing.update({
+            (s.stat_date, s.pickup_zone_id): s.trip_count
+            for s in session.query(TripCountStat).filter(
+                TripCountStat.stat_date.in_(days[start:start + 500])
+            )
+        })
+
+    inserts, updates = [], []
+    for (day, zone), count in counts.items():
+        row = {'stat_date': day, 'pickup_zone_id': zone, 'trip_count': existing.get((day, zone), 0) + count}
+        (updates if (day, zone) in existing else inserts).append(row)
+    session.expunge_all()
+    if inserts:
+        session.execute(insert(TripCountStat), inserts)
+    if updates:
+        session.execute(update(TripCountStat), updates)
+
+
+def _values(session, statement):
+    return np.fromiter((v for (v,) in session.execute(statement)), dtype=np.float64)
+
+
+def _histogram_values(session, name, row_count):
+    """
+    Non-NULL values of a histogram column: the sample's when it is large
+    enough, else those of every step-th trip_id, at most HISTOGRAM_MAX_VALUES.
+
+    Args:
+        row_count: Non-NULL values of the column in `trips`
+    """
+    if inspect(session.get_bind()).has_table(TripSample.__tablename__):
+        column = getattr(TripSample, name)
+        values = _values(session, select(column).where(column.isnot(None)))
+        if values.size >= HISTOGRAM_MIN_SAMPLE:
+            return values
+    column = getattr(Trip, name)
+    statement = select(column).where(column.isnot(None))
+    step = -(-row_count // HISTOGRAM_MAX_VALUES)
+    if step > 1:
+        statement = statement.where(Trip.trip_id % step == 0)
+    return _values(session, statement.limit(HISTOGRAM_MAX_VALUES))
+
+
+def equi_depth_bounds(values, buckets=HISTOGRAM_BUCKETS):
+    """Bounds of `buckets` buckets holding equal shares of `values`."""
+    if values.size == 0:
+        return None
+    return np.quantile(values, np.linspace(0.0, 1.0, buckets + 1))
+
+
+def refresh_catalog(session, since_trip_id=0):
+    """
+    Fold trips with trip_id >= since_trip_id into the catalog and rebuild
+    the histograms.
+
+    Returns:
+        Number of trips counted
+    """
+    bind = session.get_bind()
+    TripCountStat.__table__.create(bind, checkfirst=True)
+    ColumnStat.__table__.create(bind, checkfirst=True)
+    new_trips = Trip.trip_id >= since_trip_id
+
+    stat_date = cast(storage.date_of(session, Trip.pickup_datetime), String)
+    zone = func.coalesce(Trip.pickup_zone_id, UNKNOWN_ZONE)
+    counts = {
+        (day, int(zone_id)): count
+        for day, zone_id, count in session.query(
+            stat_date, zone, func.count(Trip.trip_id)
+        ).filter(new_trips, Trip.pickup_datetime.isnot(None)).group_by(stat_date, zone)
+    }
+    if counts:
+        _store_counts(session, counts)
+
+    aggregates = [func.count(Trip.trip_id)]
+    for name in CATALOG_COLUMNS:
+        column = getattr(Trip, name)
+        aggregates += [func.count(column), func.min(column), func.max(column)]
+    row = session.query(*aggregates).filter(new_trips).one()
+    total, values = row[0], row[1:]
+
+    stored = {s.column_name: s for s in session.query(ColumnStat)}
+    for position, name in enumerate(CATALOG_COLUMNS):
+        count, low, high = values[3 * position:3 * position + 3]
+        stat = stored.get(name)
+        if stat is None:
+            stat = ColumnStat(column_name=name, row_count=0, null_count=0)
+            session.add(stat)
+        stat.row_count += count
+        stat.null_count += total - count
+        stat.min_value = _merge_range(stat.min_value, low, min)
+        stat.max_value = _merge_range(stat.max_value, high, max)
+        if name in HISTOGRAM_COLUMNS:
+            bounds = equi_depth_bounds(_histogram_values(session, name, stat.row_count))
+            stat.histogram = None if bounds is None else bounds.astype('<f8').tobytes()
+
+    session.commit()
+    return sum(counts.values())
+
+
+def rebuild_catalog(session):
+    """Drop and rebuild the catalog from `trips`."""
+    bind = session.get_bind()
+    TripCountStat.__table__.create(bind, checkfirst=True)
+    ColumnStat.__table__.create(bind, checkfirst=True)
+    session.query(TripCountStat).delete()
+    session.query(ColumnStat).delete()
+    session.commit()
+    return refresh_catalog(session, since_trip_id=0)
+
+
+def _parse(condition):
+    """(column name, operator, value) of a trip filter, or None when not a simple comparison."""
+    if not isinstance(condition, BinaryExpression):
+        return None
+    column, value = condition.left, condition.right
+    if not isinstance(column, Column) or column.table is not Trip.__table__:
+        return None
+    if isinstance(value, Null):
+        return column.name, condition.operator, None
+    if not isinstance(value, BindParameter) or value.effective_value is None:
+        return None
+    return column.name, condition.operator, value.effective_value
+
+
+class Catalog:
+    """
+    Loaded statistics of one dataset version.
+
+    Attributes:
+        version: Dataset version the catalog was loaded at
+        trip_count: Number of trips
+        days: Sorted pickup dates ('YYYY-MM-DD')
+        counts: Trips per (day index, pickup zone ID), column UNKNOWN_ZONE for NULL zones
+        columns: Dict column name -> ColumnStats
+    """
+
+    def __init__(self, version, counts, columns):
+        self.version = version
+        self.days = sorted({day for day, _, _ in counts})
+        day_index = {day: i for i, day in enumerate(self.days)}
+        width = max((zone for _, zone, _ in counts), default=0) + 1
+        self.counts = np.zeros((len(self.days), max(width, UNKNOWN_ZONE + 1)), dtype=np.int64)
+        for day, zone, count in counts:
+            self.counts[day_index[day], zone] += count
+        self.trip_count = int(self.counts.sum())
+        self.columns = columns
+
+    def non_null_fraction(self, name):
+        stats = self.columns.get(name)
+        if stats is None:
+            return None
+        total = stats.row_count + stats.null_count
+        return stats.row_count / total if total else 0.0
+
+    def cdf(self, name, value):
+        """Estimated share of the non-NULL values of column `name` that are <= value."""
+        stats = self.columns.get(name)
+        if stats is None or stats.min_value is None:
+            return None
+        if stats.bounds is not None:
+            return float(np.interp(value, stats.bounds, np.linspace(0.0, 1.0, stats.bounds.size)))
+        if value < stats.min_value:
+            return 0.0
+        if value >= stats.max_value:
+            return 1.0
+        return (value - stats.min_value) / (stats.max_value - stats.min_value)
+
+    def _day_series(self, zone_id=None, known_zone=False):
+        """Trips per day, for one pickup zone or all (known) zones."""
+        if zone_id is not None:
+            if zone_id < 0 or zone_id >= self.counts.shape[1]:
+                return np.zeros(len(self.days), dtype=np.int64)
+            return self.counts[:, zone_id]
+        if known_zone:
+            return self.counts[:, UNKNOWN_ZONE + 1:].sum(axis=1)
+        return self.counts.sum(axis=1)
+
+    def _before(self, series, moment):
+        """Estimated trips of a day series picked up before `moment` (uniform within a day)."""
+        day = moment.strftime('%Y-%m-%d')
+        index = bisect.bisect_left(self.days, day)
+        before = float(series[:index].sum())
+        if index < len(self.days) and self.days[index] == day:
+            midnight = datetime(moment.year, moment.month, moment.day)
+            before += series[index] * (moment - midnight).total_seconds() / SECONDS_PER_DAY
+        return before
+
+    def _count_between(self, series, lower, upper):
+        total = float(series.sum())
+        low = self._before(series, lower) if lower is not None else 0.0
+        high = self._before(series, upper) if upper is not None else total
+        return max(high - low, 0.0)
+
+    def selectivity(self, condition):
+        """
+        Estimated share of all trips matching one filter, or None when the
+        catalog cannot tell.
+        """
+        parsed = _parse(condition)
+        if parsed is None or not self.trip_count:
+            return None
+        name, op, value = parsed
+
+        if value is None:
+            if op is not operators.is_not:
+                return None
+            if name == 'pickup_zone_id':
+                return float(self._day_series(known_zone=True).sum()) / self.trip_count
+            return self.non_null_fraction(name)
+
+        if name == 'pickup_datetime' and isinstance(value, datetime):
+            series = self._day_series()
+            if op in (operators.ge, operators.gt):
+                return self._count_between(series, value, None) / self.trip_count
+            if op in (operators.le, operators.lt):
+                if op is operators.le:
+                    value += timedelta(seconds=1)
+                return self._count_between(series, None, value) / self.trip_count
+            return None
+
+        if name == 'pickup_zone_id' and op is operators.eq:
+            return float(self._day_series(int(value)).sum()) / self.trip_count
+
+        if op in (operators.ge, operators.gt, operators.le, operators.lt):
+            below = self.cdf(name, float(value))
+            present = self.non_null_fraction(name)
+            if below is None or present is None:
+                return None
+            share = 1.0 - below if op in (operators.ge, operators.gt) else below
+            return share * present
+        return None
+
+    def estimate_count(self, filters):
+        """
+        Estimated number of trips matching every filter, or None when some
+        filter is not covered by the catalog.
+
+        Date and pickup zone filters are counted from trip_count_stats; the
+        other filters scale that count by their selectivity.
+        """
+        lower = upper = zone_id = None
+        known_zone = False
+        factor = 1.0
+        for condition in filters:
+            parsed = _parse(condition)
+            if parsed is None:
+                return None
+            name, op, value = parsed
+            if name == 'pickup_datetime' and isinstance(value, datetime):
+                if op in (operators.ge, operators.gt):
+                    lower = value if lower is None else max(lower, value)
+                    continue
+                if op in (operators.le, operators.lt):
+                    value = value + timedelta(seconds=1) if op is operators.le else value
+                    upper = value if upper is None else min(upper, value)
+                    continue
+            if name == 'pickup_zone_id':
+                if op is operators.eq and value is not None:
+                    zone_id = int(value)
+                    continue
+                if op is operators.is_not and value is None:
+                    known_zone = True
+                    continue
+            share = self.selectivity(condition)
+            if share is None:
+                return None
+            factor *= share
+
+        series = self._day_series(zone_id, known_zone)
+        if lower is not None and upper is not None and upper <= lower:
+            return 0
+        return int(round(self._count_between(series, lower, upper) * factor))
+
+
+def load_catalog(session, version):
+    """Read the catalog tables into a Catalog, or None when they were never built."""
+    bind = session.get_bind()
+    if not inspect(bind).has_table(ColumnStat.__tablename__):
+        return None
+    columns = {
+        s.column_name: ColumnStats(
+            s.row_count, s.null_count, s.min_value, s.max_value,
+            np.frombuffer(s.histogram, dtype='<f8') if s.histogram else None,
+        )
+        for s in session.query(ColumnStat)
+    }
+    if not columns:
+        return None
+    counts = session.execute(
+        select(TripCountStat.stat_date, TripCountStat.pickup_zone_id, TripCountStat.trip_count)
+    ).all()
+    return Catalog(version, counts, columns)
+
+
+# database URL -> Catalog or None, for the version it was loaded at
+_cache = {}
+_lock = threading.Lock()
+
+
+def get_catalog(session, version=None):
+    """
+    Cached Catalog of the session's database, or None without one.
+
+    Args:
+        version: Current dataset version, when the caller already read it
+            (default: from the dimension cache)
+    """
+    version = version if version is not None else get_dimensions(session).version
+    key = str(session.get_bind().url)
+    cached = _cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    with _lock:
+        cached = _cache.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        catalog = load_catalog(session, version)
+        _cache[key] = (version, catalog)
+        return catalog
+
+
+@on_dataset_switch
+def invalidate():
+    """Drop loaded catalogs so the next request reads the current tables."""
+    with _lock:
+        _cache.clear()
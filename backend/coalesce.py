@@ -0,0 +1,228 @@
+"""
+Single-flight coalescing of identical concurrent API requests.
+
+After an ingest the dashboard of every open browser asks for the same
+statistics and time series at once. Requests are keyed on the endpoint and
+its normalized arguments (see request_key); while one request with a key
+is running, identical requests wait for it and are answered with the same
+encoded response body instead of running the same scan again.
+
+Within a worker, followers wait on the leader's thread (or, under ASGI, its
+task). With COALESCE_LOCK_DIR set, Flask workers also coalesce with each
+other: the leading request of each worker takes an exclusive file lock per
+key there, so only one worker computes while the others block on the lock
+and then read the response it left next to the lock file. A response file
+is only reused by requests that started waiting before it was written, so
+it never serves a result computed before they arrived.
+
+Whatever the leader returns is shared, including error responses; if the
+leader raises, each follower computes its own response.
+
+Coalesced requests are counted in metrics.py by endpoint and scope
+('worker' when the leader ran in the same worker, 'cross_worker' when the
+response came through COALESCE_LOCK_DIR).
+"""
+
+import asyncio
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+COALESCE_REQUESTS = os.getenv('COALESCE_REQUESTS', 'true').lower() == 'true'
+COALESCE_LOCK_DIR = os.getenv('COALESCE_LOCK_DIR')
+
+# Response files older than this are removed by the next leader
+RESPONSE_FILE_TTL = 60
+
+COALESCED = metrics.Counter(
+    'api_requests_coalesced_total',
+    'API requests answered with the response of an identical concurrent request'
+)
+
+
+def request_key(endpoint, args):
+    """
+    Key of a request: the endpoint and its non-empty arguments, sorted, so
+    that the same filters in another order or with blank fields coalesce.
+
+    Args:
+        endpoint: Endpoint name
+        args: Request arguments (a MultiDict, QueryParams or dict)
+    """
+    if hasattr(args, 'multi_items'):
+        items = args.multi_items()
+    elif hasattr(args, 'getlist'):
+        items = args.items(multi=True)
+    else:
+        items = args.items()
+    return json.dumps([endpoint, sorted((k, v) for k, v in items if v not in (None, ''))])
+
+
+class Flight:
+    """
+    One request being computed; followers wait for `response`.
+
+    Attributes:
+        response: (body bytes, status, headers list) once the leader is done,
+            None if it raised
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def run(endpoint, key, compute):
+    """
+    Compute a response once for all concurrent requests with `key`.
+
+    Args:
+        endpoint: Endpoint name for metrics
+        key: request_key of the request
+        compute: Callable returning (body bytes, status, headers list)
+
+    Returns:
+        (body bytes, status, headers list)
+    """
+    if not COALESCE_REQUESTS:
+        return compute()
+
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = Flight()
+
+    if not leader:
+        flight.done.wait()
+        if flight.response is not None:
+            COALESCED.inc(endpoint=endpoint, scope='worker')
+            return flight.response
+        return compute()
+
+    try:
+        if COALESCE_LOCK_DIR:
+            flight.response = _run_across_workers(endpoint, key, compute)
+        else:
+            flight.response = compute()
+        return flight.response
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
+
+
+def _run_across_workers(endpoint, key, compute):
+    """Compute under the key's file lock, or reuse the response another worker just wrote."""
+    os.makedirs(COALESCE_LOCK_DIR, exist_ok=True)
+    path = os.path.join(COALESCE_LOCK_DIR, hashlib.sha1(key.encode()).hexdigest())
+    started = time.time()
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            shared = _read_response(path + '.response', started)
+            if shared is not None:
+                COALESCED.inc(endpoint=endpoint, scope='cross_worker')
+                return shared
+            response = compute()
+            _write_response(path + '.response', response)
+            return response
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _read_response(path, since):
+    """The response stored at `path` if it was written after `since`."""
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_mtime < since:
+                return None
+            header = json.loads(f.readline())
+            return f.read(), header['status'], [tuple(h) for h in header['headers']]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _write_response(path, response):
+    body, status, headers = response
+    staging = f'{path}.tmp-{os.getpid()}'
+    try:
+        with open(staging, 'wb') as f:
+            f.write(json.dumps({'status': status, 'headers': headers}).encode() + b'\n')
+            f.write(body)
+        os.replace(staging, path)
+    except OSError as e:
+        logger.warning(f"Could not share response at {path}: {e}")
+    _remove_expired()
+
+
+_swept_at = 0.0
+
+
+def _remove_expired():
+    """Delete response files nobody can reuse any more, at most once per TTL."""
+    global _swept_at
+    now = time.time()
+    if now - _swept_at < RESPONSE_FILE_TTL:
+        return
+    _swept_at = now
+    for name in os.listdir(COALESCE_LOCK_DIR):
+        if not name.endswith('.response'):
+            continue
+        path = os.path.join(COALESCE_LOCK_DIR, name)
+        try:
+            if now - os.stat(path).st_mtime > RESPONSE_FILE_TTL:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+# Per event loop: key -> asyncio.Future of the response
+_async_flights = {}
+
+
+async def run_async(endpoint, key, compute):
+    """run() for the ASGI app; `compute` is a coroutine function. Coalesces within the worker."""
+    if not COALESCE_REQUESTS:
+        return await compute()
+
+    flight = _async_flights.get(key)
+    if flight is not None:
+        try:
+            response = await asyncio.shield(flight)
+        except asyncio.CancelledError:
+            if not flight.cancelled():
+                raise
+            return await compute()
+        except Exception:
+            return await compute()
+        COALESCED.inc(endpoint=endpoint, scope='worker')
+        return response
+
+    flight = _async_flights[key] = asyncio.get_running_loop().create_future()
+    try:
+        response = await compute()
+        flight.set_result(response)
+        return response
+    except asyncio.CancelledError:
+        flight.cancel()
+        raise
+    except Exception as e:
+        flight.set_exception(e)
+        # Retrieved here so an unawaited failure is not logged by asyncio
+        flight.exception()
+        raise
+    finally:
+        del _async_flights[key]
@@ -0,0 +1,417 @@
+"""
+Blue/green dataset generations: reload or recompute the data without
+writing into the database the API is serving.
+
+A new generation is built beside the active one, in a fresh SQLite file
+(<stem>.g<N><ext> next to SQLITE_DB_PATH) or PostgreSQL schema
+(trips_g<N>), together with every derived structure (ingest.refresh_all).
+Its dataset version is set above the active generation's, so each
+version-keyed cache reloads exactly once. It is then validated and made
+active in one atomic step: <SQLITE_DB_PATH>.current is written aside and
+renamed over, or the 'active' row of public.dataset_generation is replaced
+in one transaction. The API never sees a half-loaded dataset.
+
+Processes follow the pointer through models.get_database_url: Flask
+workers on their next request (PostgreSQL: within DATASET_CHECK_INTERVAL
+seconds), ASGI workers and pool processes within DATASET_CHECK_INTERVAL.
+Moving disposes the previous generation's engine, so its idle connections
+close at once and those of running requests when they are returned, and
+runs the dataset switch callbacks that drop in-process caches (dimensions,
+bitmap indexes, snapshots, catalog, result caches, replica routers).
+
+The KEEP_GENERATIONS generations before the active one are kept, so
+requests still reading them can finish and --rollback can return to them;
+older ones are removed after each switch. The original SQLITE_DB_PATH file
+or public schema is generation 0 and never removed.
+
+Usage:
+    python datasets.py --status
+    python datasets.py --load bench_1m.db     # serve a database built elsewhere, e.g. by synthetic.py
+    python datasets.py --refresh              # recompute derived data on a copy of the active generation
+    python datasets.py --rollback             # back to the previous generation
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import time
+
+from sqlalchemy import func, inspect, text
+from sqlalchemy.orm import sessionmaker
+
+from models import (
+    COMPACT_STORAGE, GENERATION_POINTER_SUFFIX, GENERATION_TABLE, Base, DatasetMeta, Trip, Zone,
+    active_schema, active_sqlite_path, configured_database_url, create_db_engine, schema_url,
+)
+from dimensions import VERSION_KEY, dataset_version
+import bitmaps
+import catalog
+import ingest
+import snapshots
+import storage
+
+logger = logging.getLogger(__name__)
+
+KEEP_GENERATIONS = int(os.getenv('DATASET_KEEP_GENERATIONS', '2'))
+SCHEMA_PREFIX = 'trips_g'
+
+# Files and directories derived from a SQLite generation, removed with it
+DERIVED_SUFFIXES = ('.bitmaps', '.snapshot', '.results', '.results-wal', '.results-shm', '.results.warm.lock')
+# Tables holding loaded data, copied into a new PostgreSQL generation;
+# the others are derived and rebuilt by ingest.refresh_all
+DATA_TABLES = ('zones', 'payment_types', 'rate_codes', 'trips')
+
+
+class InvalidGeneration(ValueError):
+    """A newly built generation failed validation and was not switched to."""
+
+
+class SqliteGenerations:
+    """
+    Generations of a SQLite database: files next to it, named <stem>.g<N><ext>.
+
+    Args:
+        db_path: The configured SQLITE_DB_PATH (generation 0)
+    """
+
+    def __init__(self, db_path):
+        self.db_path = os.path.abspath(db_path)
+        self.pointer = self.db_path + GENERATION_POINTER_SUFFIX
+
+    def path(self, number):
+        if number == 0:
+            return self.db_path
+        stem, ext = os.path.splitext(self.db_path)
+        return f'{stem}.g{number}{ext}'
+
+    def url(self, number):
+        return f'sqlite:///{self.path(number)}'
+
+    def numbers(self):
+        """Generation numbers with a database file, ascending."""
+        stem, ext = os.path.splitext(os.path.basename(self.db_path))
+        pattern = re.compile(re.escape(stem) + r'\.g(\d+)' + re.escape(ext) + '$')
+        found = [
+            int(match.group(1))
+            for match in map(pattern.match, os.listdir(os.path.dirname(self.db_path))) if match
+        ]
+        return ([0] if os.path.exists(self.db_path) else []) + sorted(found)
+
+    def active(self):
+        """Number of the active generation."""
+        active = os.path.abspath(active_sqlite_path(self.db_path))
+        for number in self.numbers():
+            if self.path(number) == active:
+                return number
+        raise InvalidGeneration(f'{self.pointer} names a missing database: {active}')
+
+    def source(self, number):
+        return self.path(number)
+
+    def create(self, number, source):
+        """Copy the SQLite file `source` into generation `number`."""
+        self.drop(number)
+        source = sqlite3.connect(source)
+        target = sqlite3.connect(self.path(number))
+        try:
+            # The online backup does not block the API reading the source
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+
+    def switch(self, number):
+        """Point the database at generation `number` in one rename."""
+        staging = f'{self.pointer}.tmp-{os.getpid()}'
+        with open(staging, 'w') as f:
+            f.write(os.path.basename(self.path(number)) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(staging, self.pointer)
+
+    def drop(self, number):
+        """Remove generation `number` and the files derived from it."""
+        if number == 0:
+            return
+        path = self.path(number)
+        for target in [path] + glob.glob(glob.escape(path) + '-*') + [path + s for s in DERIVED_SUFFIXES]:
+            if os.path.isdir(target):
+                shutil.rmtree(target, ignore_errors=True)
+            elif os.path.exists(target):
+                os.remove(target)
+
+
+class PostgresGenerations:
+    """
+    Generations of a PostgreSQL database: schemas named trips_g<N>, with the
+    public schema as generation 0.
+
+    Args:
+        db_url: The configured database URL
+    """
+
+    def __init__(self, db_url):
+        self.db_url = db_url
+        self.engine = create_db_engine(db_url)
+
+    def schema(self, number):
+        return f'{SCHEMA_PREFIX}{number}' if number else 'public'
+
+    def url(self, number):
+        return schema_url(self.db_url, self.schema(number)) if number else self.db_url
+
+    def numbers(self):
+        with self.engine.connect() as conn:
+            schemas = conn.execute(text(
+                "SELECT schema_name FROM information_schema.schemata WHERE schema_name LIKE :prefix"
+            ), {'prefix': SCHEMA_PREFIX + '%'}).scalars()
+            found = [int(s[len(SCHEMA_PREFIX):]) for s in schemas if s[len(SCHEMA_PREFIX):].isdigit()]
+        return [0] + sorted(found)
+
+    def active(self):
+        schema = active_schema(self.db_url)
+        return int(schema[len(SCHEMA_PREFIX):]) if schema else 0
+
+    def source(self, number):
+        return self.schema(number)
+
+    def create(self, number, source):
+        """Create generation `number` with the loaded data of the schema `source`."""
+        self.drop(number)
+        schema = self.schema(number)
+        with self.engine.begin() as conn:
+            conn.execute(text(f'CREATE SCHEMA {schema}'))
+        engine = create_db_engine(self.url(number))
+        try:
+            Base.metadata.create_all(engine)
+            with engine.begin() as conn:
+                for table in DATA_TABLES:
+                    conn.execute(text(
+                        f'INSERT INTO {schema}.{table} SELECT * FROM {source}.{table}'
+                    ))
+        finally:
+            engine.dispose()
+
+    def switch(self, number):
+        """Point the database at generation `number` in one transaction."""
+        with self.engine.begin() as conn:
+            conn.execute(text(
+                f'CREATE TABLE IF NOT EXISTS public.{GENERATION_TABLE} '
+                '(name VARCHAR(50) PRIMARY KEY, target VARCHAR(200) NOT NULL)'
+            ))
+            conn.execute(text(f"DELETE FROM public.{GENERATION_TABLE} WHERE name = 'active'"))
+            conn.execute(text(
+                f"INSERT INTO public.{GENERATION_TABLE} (name, target) VALUES ('active', :schema)"
+            ), {'schema': self.schema(number)})
+
+    def drop(self, number):
+        if number == 0:
+            return
+        with self.engine.begin() as conn:
+            conn.execute(text(f'DROP SCHEMA IF EXISTS {self.schema(number)} CASCADE'))
+        backend = os.path.dirname(os.path.abspath(__file__))
+        for name in ('bitmap_index', 'snapshot'):
+            shutil.rmtree(os.path.join(backend, f'{name}.{self.schema(number)}'), ignore_errors=True)
+        for path in glob.glob(os.path.join(backend, f'result_cache.{self.schema(number)}.db*')):
+            os.remove(path)
+
+
+def get_generations():
+    """Generations of the configured database."""
+    db_url = configured_database_url()
+    if db_url.startswith('sqlite'):
+        return SqliteGenerations(db_url[len('sqlite:///'):])
+    return PostgresGenerations(db_url)
+
+
+def prepare(engine, base_version):
+    """
+    Rebuild every derived structure of a new generation and number it one
+    above `base_version`.
+
+    Returns:
+        The generation's dataset version
+    """
+    session = sessionmaker(bind=engine)()
+    try:
+        DatasetMeta.__table__.create(engine, checkfirst=True)
+        own_version = int(dataset_version(session))
+        meta = session.get(DatasetMeta, VERSION_KEY)
+        if meta is None:
+            meta = DatasetMeta(key=VERSION_KEY)
+            session.add(meta)
+        meta.value = str(max(int(base_version), own_version))
+        session.commit()
+        ingest.refresh_all(session)
+        return dataset_version(session)
+    finally:
+        session.close()
+
+
+def layout_problems(engine):
+    """Why the trips table of a generation cannot be served with the configured layout, if it cannot."""
+    if not inspect(engine).has_table('trips'):
+        return ['no trips table']
+    expected = 'compact' if COMPACT_STORAGE else 'standard'
+    actual = storage.layout(engine)
+    if actual != expected:
+        return [f'trips uses the {actual} layout, COMPACT_STORAGE selects {expected}']
+    return []
+
+
+def validate(engine, expected_version):
+    """
+    Check a built generation before it is switched to.
+
+    Raises:
+        InvalidGeneration: Listing every problem found
+
+    Returns:
+        Dict with its trip count and dataset version
+    """
+    problems = []
+    session = sessionmaker(bind=engine)()
+    try:
+        if engine.dialect.name == 'sqlite':
+            check = session.execute(text('PRAGMA quick_check')).scalar()
+            if check != 'ok':
+                problems.append(f'integrity check: {check}')
+        problems += layout_problems(engine)
+
+        trips = session.query(func.count(Trip.trip_id)).scalar()
+        if not trips:
+            problems.append('no trips')
+        if not session.query(func.count(Zone.zone_id)).scalar():
+            problems.append('no zones')
+
+        version = dataset_version(session)
+        if version != expected_version:
+            problems.append(f'dataset version {version}, expected {expected_version}')
+        stats = catalog.load_catalog(session, version)
+        if stats is None or stats.trip_count != trips:
+            problems.append('statistics catalog does not count every trip')
+        if bitmaps.get_bitmap_index(session) is None:
+            problems.append(f'no bitmap index at version {version}')
+        snapshot = snapshots.get_snapshot(session)
+        if snapshot is None or snapshot.rows != trips:
+            problems.append(f'no snapshot of all trips at version {version}')
+    finally:
+        session.close()
+
+    if problems:
+        raise InvalidGeneration('; '.join(problems))
+    return {'trips': trips, 'version': version}
+
+
+def reload(source=None):
+    """
+    Build a new generation from `source` (a SQLite file or PostgreSQL
+    schema; default: the active generation), validate it and switch to it.
+
+    Returns:
+        Dict with the new generation's number, trip count and version
+    """
+    generations = get_generations()
+    active = generations.active()
+    number = max(generations.numbers()) + 1
+
+    engine = create_db_engine(generations.url(active))
+    session = sessionmaker(bind=engine)()
+    try:
+        active_version = dataset_version(session)
+    finally:
+        session.close()
+        engine.dispose()
+
+    started = time.perf_counter()
+    generations.create(number, source if source is not None else generations.source(active))
+    engine = create_db_engine(generations.url(number))
+    try:
+        # Derived structures are built for the configured layout only
+        problems = layout_problems(engine)
+        if problems:
+            raise InvalidGeneration('; '.join(problems))
+        report = validate(engine, prepare(engine, active_version))
+    except Exception:
+        generations.drop(number)
+        raise
+    finally:
+        engine.dispose()
+
+    generations.switch(number)
+    logger.info(
+        f"Switched to generation {number} ({report['trips']:,} trips, version {report['version']}) "
+        f"built in {time.perf_counter() - started:.1f}s"
+    )
+    retire(generations, number)
+    return dict(report, generation=number)
+
+
+def retire(generations, active):
+    """Remove generations older than the KEEP_GENERATIONS before `active`."""
+    older = [n for n in generations.numbers() if 0 < n < active]
+    for number in older[:max(len(older) - KEEP_GENERATIONS, 0)]:
+        generations.drop(number)
+        logger.info(f"Removed generation {number}")
+
+
+def rollback():
+    """Switch back to the newest generation before the active one."""
+    generations = get_generations()
+    active = generations.active()
+    older = [n for n in generations.numbers() if n < active]
+    if not older:
+        raise InvalidGeneration('no earlier generation to return to')
+    generations.switch(older[-1])
+    logger.info(f"Switched back to generation {older[-1]}")
+    return older[-1]
+
+
+def status():
+    """Generations of the configured database and which one is active."""
+    generations = get_generations()
+    active = generations.active()
+    return {
+        'active': active,
+        'generations': [
+            {'generation': n, 'url': generations.url(n) if n else 'base', 'active': n == active}
+            for n in generations.numbers()
+        ],
+    }
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Build, validate and switch dataset generations')
+    parser.add_argument('--db', help='SQLite database (default: configured database)')
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument('--load', metavar='SOURCE',
+                        help='Serve a copy of this SQLite file (or PostgreSQL schema) as the next generation')
+    action.add_argument('--refresh', action='store_true',
+                        help='Recompute derived structures on a copy of the active generation and switch to it')
+    action.add_argument('--rollback', action='store_true', help='Switch back to the previous generation')
+    action.add_argument('--status', action='store_true', help='List generations')
+    args = parser.parse_args()
+
+    if args.db:
+        os.environ['USE_SQLITE'] = 'true'
+        os.environ['SQLITE_DB_PATH'] = os.path.abspath(args.db)
+
+    try:
+        if args.load:
+            is_sqlite = configured_database_url().startswith('sqlite')
+            print(json.dumps(reload(os.path.abspath(args.load) if is_sqlite else args.load), indent=2))
+        elif args.refresh:
+            print(json.dumps(reload(), indent=2))
+        elif args.rollback:
+            rollback()
+        print(json.dumps(status(), indent=2))
+    except InvalidGeneration as e:
+        logger.error(f"Not switched: {e}")
+        raise SystemExit(1)
@@ -0,0 +1,163 @@
+"""
+In-process cache of the zone, payment type and rate code dimensions.
+
+The lookup tables are tiny and change only when a dataset is (re)loaded,
+so they are read once into immutable ID-indexed structures and reused by
+every request instead of being joined or lazy-loaded per trip. The cache
+is keyed by the `dataset_meta` version, which ingest bumps; the version is
+re-checked at most every DIMENSION_CHECK_INTERVAL seconds.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+from sqlalchemy import inspect
+
+from models import DatasetMeta, Zone, PaymentType, RateCode, on_dataset_switch
+
+DIMENSION_CHECK_INTERVAL = float(os.getenv('DIMENSION_CHECK_INTERVAL', '5'))
+VERSION_KEY = 'version'
+
+ZoneInfo = namedtuple('ZoneInfo', ['zone_id', 'zone_name', 'borough', 'service_zone'])
+
+
+def encode_json(content):
+    """Encode a response body exactly like Flask's jsonify (compact, sorted keys)."""
+    return (json.dumps(content, sort_keys=True, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def _indexed(pairs):
+    """Tuple indexed by ID (None for unused IDs) from (id, value) pairs."""
+    pairs = [(i, v) for i, v in pairs if i is not None and i >= 0]
+    values = [None] * (max((i for i, _ in pairs), default=-1) + 1)
+    for i, value in pairs:
+        values[i] = value
+    return tuple(values)
+
+
+class Dimensions:
+    """
+    Immutable snapshot of the lookup tables for one dataset version.
+
+    Attributes:
+        version: Dataset version the snapshot was loaded for
+        zones: Read-only dict zone_id -> ZoneInfo
+        zone_list: ZoneInfo tuple ordered by borough, zone name
+        zone_names / zone_boroughs: Tuples indexed by zone_id
+        payment_names / rate_names: Tuples indexed by ID
+        zones_json: Pre-encoded /api/zones response body
+    """
+
+    def __init__(self, version, zones, payment_types, rate_codes):
+        self.version = version
+        self.zone_list = tuple(zones)
+        self.zones = MappingProxyType({z.zone_id: z for z in self.zone_list})
+        self.zone_names = _indexed((z.zone_id, z.zone_name) for z in self.zone_list)
+        self.zone_boroughs = _indexed((z.zone_id, z.borough) for z in self.zone_list)
+        self.payment_names = _indexed(payment_types)
+        self.rate_names = _indexed(rate_codes)
+        self.zones_json = encode_json(self.zones_body())
+
+    @staticmethod
+    def _lookup(values, key):
+        if key is None or key < 0 or key >= len(values):
+            return None
+        return values[key]
+
+    def zone_name(self, zone_id):
+        return self._lookup(self.zone_names, zone_id)
+
+    def zone_borough(self, zone_id):
+        return self._lookup(self.zone_boroughs, zone_id)
+
+    def payment_name(self, payment_type_id):
+        return self._lookup(self.payment_names, payment_type_id)
+
+    def rate_name(self, rate_code_id):
+        return self._lookup(self.rate_names, rate_code_id)
+
+    def zones_body(self):
+        """/api/zones response body."""
+        return {'zones': [z._asdict() for z in self.zone_list]}
+
+
+def dataset_version(session):
+    """Current dataset version, '0' for databases that never recorded one."""
+    if not inspect(session.get_bind()).has_table(DatasetMeta.__tablename__):
+        return '0'
+    version = session.query(DatasetMeta.value).filter(DatasetMeta.key == VERSION_KEY).scalar()
+    return version or '0'
+
+
+def bump_dataset_version(session):
+    """
+    Mark the dataset as changed so every process reloads its caches.
+
+    Returns:
+        The new version
+    """
+    DatasetMeta.__table__.create(session.get_bind(), checkfirst=True)
+    meta = session.get(DatasetMeta, VERSION_KEY)
+    if meta is None:
+        meta = DatasetMeta(key=VERSION_KEY, value='0')
+        session.add(meta)
+    meta.value = str(int(meta.value) + 1)
+    session.commit()
+    invalidate()
+    return meta.value
+
+
+def load_dimensions(session, version=None):
+    """Read the lookup tables into a new Dimensions snapshot."""
+    zones = [
+        ZoneInfo(*row) for row in session.query(
+            Zone.zone_id, Zone.zone_name, Zone.borough, Zone.service_zone
+        ).order_by(Zone.borough, Zone.zone_name)
+    ]
+    payment_types = session.query(PaymentType.payment_type_id, PaymentType.payment_name).all()
+    rate_codes = session.query(RateCode.rate_code_id, RateCode.rate_name).all()
+    return Dimensions(
+        version if version is not None else dataset_version(session),
+        zones, payment_types, rate_codes
+    )
+
+
+# database URL -> (Dimensions, monotonic time of the last version check)
+_cache = {}
+_lock = threading.Lock()
+
+
+def get_dimensions(session):
+    """
+    Cached Dimensions for the session's database.
+
+    Reloads when the dataset version changed since the snapshot was taken.
+    """
+    key = str(session.get_bind().url)
+    cached = _cache.get(key)
+    now = time.monotonic()
+    if cached and now - cached[1] < DIMENSION_CHECK_INTERVAL:
+        return cached[0]
+
+    with _lock:
+        cached = _cache.get(key)
+        if cached and now - cached[1] < DIMENSION_CHECK_INTERVAL:
+            return cached[0]
+        version = dataset_version(session)
+        if cached and cached[0].version == version:
+            dimensions = cached[0]
+        else:
+            dimensions = load_dimensions(session, version)
+        _cache[key] = (dimensions, now)
+        return dimensions
+
+
+@on_dataset_switch
+def invalidate():
+    """Drop cached snapshots so the next request reloads them."""
+    with _lock:
+        _cache.clear()
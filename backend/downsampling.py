@@ -0,0 +1,92 @@
+"""
+Largest-Triangle-Three-Buckets downsampling of time series.
+
+Steinarsson's LTTB keeps the first and last point and splits the rest into
+equal buckets. From each bucket it keeps the point forming the largest
+triangle with the point kept from the previous bucket and the mean of the
+next bucket, so peaks and troughs survive where striding or averaging
+would flatten them.
+
+Each bucket's choice depends on the previous one, so the buckets are
+visited in order, but every bucket is one vectorized NumPy step: the
+points are laid out as a (buckets, bucket size) matrix and the next-bucket
+means come from cumulative sums, leaving O(max_points) Python iterations
+whatever the length of the series.
+"""
+
+import numpy as np
+
+# Fewer points than this cannot keep both ends and a bucket
+MIN_POINTS = 3
+
+
+def lttb(x, y, max_points):
+    """
+    Indices of the points LTTB keeps.
+
+    Args:
+        x: Increasing x coordinates
+        y: Values (NaN counts as 0)
+        max_points: Points to keep, at least MIN_POINTS
+
+    Returns:
+        Sorted integer array of at most max_points indices, every index
+        when the series is no longer than max_points
+    """
+    n = len(x)
+    if n <= max_points:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.nan_to_num(np.asarray(y, dtype=np.float64))
+
+    # The n - 2 interior points in max_points - 2 buckets of near-equal size
+    edges = np.linspace(1, n - 1, max_points - 1).astype(np.int64)
+    starts, ends = edges[:-1], edges[1:]
+    sizes = ends - starts
+
+    cum_x = np.concatenate(([0.0], np.cumsum(x)))
+    cum_y = np.concatenate(([0.0], np.cumsum(y)))
+    # Third corner of bucket i: the mean of bucket i + 1, or the last point
+    next_x = np.append(((cum_x[ends] - cum_x[starts]) / sizes)[1:], x[-1])
+    next_y = np.append(((cum_y[ends] - cum_y[starts]) / sizes)[1:], y[-1])
+
+    # Row i holds bucket i; short rows repeat their first point, which
+    # argmax never prefers to the original
+    offsets = np.arange(sizes.max())
+    columns = starts[:, None] + offsets
+    columns = np.where(offsets < sizes[:, None], columns, starts[:, None])
+    bucket_x, bucket_y = x[columns], y[columns]
+
+    keep = np.empty(max_points, dtype=np.int64)
+    keep[0], keep[-1] = 0, n - 1
+    previous = 0
+    for i in range(len(starts)):
+        ax, ay = x[previous], y[previous]
+        # Twice the triangle area (previous kept point, candidate, next mean)
+        area = np.abs((ax - next_x[i]) * (bucket_y[i] - ay) - (ax - bucket_x[i]) * (next_y[i] - ay))
+        previous = columns[i, int(np.argmax(area))]
+        keep[i + 1] = previous
+    return keep
+
+
+def downsample_series(series, interval, max_points, metric):
+    """
+    At most max_points buckets of a time series, chosen by LTTB on `metric`.
+
+    Args:
+        series: Time-series points in order, keyed by 'hour' or 'date'
+        interval: 'hour' or 'day'
+        max_points: Points to keep
+        metric: Field whose shape is preserved
+
+    Returns:
+        The kept points (the same dicts), in order
+    """
+    if len(series) <= max_points:
+        return series
+    if interval == 'hour':
+        x = np.array([point['hour'] for point in series], dtype=np.float64)
+    else:
+        x = np.array([point['date'] for point in series], dtype='datetime64[D]').astype(np.float64)
+    y = np.array([point.get(metric) or 0 for point in series], dtype=np.float64)
+    return [series[i] for i in lttb(x, y, max_points)]
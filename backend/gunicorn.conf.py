@@ -0,0 +1,9 @@
+"""
+gunicorn settings, read from the working directory by `gunicorn app:app`.
+"""
+
+
+def post_worker_init(worker):
+    """Warm the shared result cache once the worker has loaded the app."""
+    import app
+    app.start_result_cache_warmup()
@@ -0,0 +1,242 @@
+"""
+Binned 2D histograms of two trip columns (/api/histogram2d).
+
+The response is a bins x bins matrix of trip counts, so its size depends on
+the bins requested, not on the number of trips. The counts are computed
+where the trips are:
+
+- from the columnar snapshot (snapshots.py) when it is current and every
+  filter can be evaluated on it, with one NumPy bincount per block of
+  matching positions
+- otherwise in SQL, where each trip's bin is integer arithmetic on the two
+  values and only the non-empty bins are grouped and returned
+
+x_min/x_max and y_min/y_max are applied as filters on the stored columns,
+so a fare range is a range scan of idx_fare_distance (fare_amount,
+trip_distance); that index also covers a fare vs distance histogram
+without reading the table. An axis without a bound spans the filtered
+trips' values on that side.
+"""
+
+import math
+
+import numpy as np
+from sqlalchemy import and_, func, literal_column, select
+
+from models import Trip
+from queries import InvalidQuery
+import catalog
+import snapshots
+import storage
+
+# Numeric trip columns an axis may use
+HISTOGRAM_COLUMNS = (
+    'trip_distance', 'trip_duration', 'fare_amount', 'tip_amount',
+    'total_amount', 'trip_speed', 'fare_per_km', 'fare_per_minute',
+)
+DEFAULT_X = 'trip_distance'
+DEFAULT_Y = 'fare_amount'
+DEFAULT_BINS = 50
+MAX_BINS = 200
+FETCH_BATCH_SIZE = 100000
+
+
+def _bound(args, name):
+    value = args.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise InvalidQuery(f'{name} must be a number')
+    if not math.isfinite(value):
+        raise InvalidQuery(f'{name} must be a number')
+    return value
+
+
+def histogram_params(args):
+    """
+    Axes and bin count of a /api/histogram2d request.
+
+    Returns:
+        (axes, bins) where axes is [(column name, lower, upper)] for x and
+        y, with None for a bound that was not given
+
+    Raises:
+        InvalidQuery: For an unknown column, bins outside 1..MAX_BINS or a
+            lower bound above its upper bound
+    """
+    axes = []
+    for axis, default in (('x', DEFAULT_X), ('y', DEFAULT_Y)):
+        name = args.get(axis) or default
+        if name not in HISTOGRAM_COLUMNS:
+            raise InvalidQuery(f"{axis} must be one of: {', '.join(HISTOGRAM_COLUMNS)}")
+        lower, upper = _bound(args, f'{axis}_min'), _bound(args, f'{axis}_max')
+        if lower is not None and upper is not None and lower > upper:
+            raise InvalidQuery(f'{axis}_min must not be greater than {axis}_max')
+        axes.append((name, lower, upper))
+
+    bins = args.get('bins')
+    if bins in (None, ''):
+        bins = DEFAULT_BINS
+    else:
+        try:
+            bins = int(bins)
+        except (TypeError, ValueError):
+            raise InvalidQuery('bins must be an integer')
+        if not 1 <= bins <= MAX_BINS:
+            raise InvalidQuery(f'bins must be between 1 and {MAX_BINS}')
+    return axes, bins
+
+
+def range_filters(axes):
+    """Filters on the stored columns for the bounds that were given."""
+    filters = []
+    for name, lower, upper in axes:
+        column = getattr(Trip, name)
+        if lower is not None:
+            filters.append(column >= lower)
+        if upper is not None:
+            filters.append(column <= upper)
+    return filters
+
+
+def _edges(lower, upper, bins):
+    """(lower, upper, bin width); an empty range is widened to one unit."""
+    if upper <= lower:
+        upper = lower + 1.0
+    return lower, upper, (upper - lower) / bins
+
+
+def _bin_index(values, lower, upper, width, bins):
+    # The upper bound (and any rounding past it) falls in the last bin
+    return np.minimum(((values - lower) / width).astype(np.int64), bins - 1)
+
+
+class _SnapshotSource:
+    """The filtered trips' two columns from the snapshot, in blocks."""
+
+    name = 'snapshot'
+
+    def __init__(self, snapshot, positions, names):
+        self.snapshot = snapshot
+        self.positions = positions
+        self.names = names
+
+    def blocks(self):
+        x, y = (self.snapshot.columns[name] for name in self.names)
+        for start in range(0, self.positions.size, FETCH_BATCH_SIZE):
+            rows = self.positions[start:start + FETCH_BATCH_SIZE]
+            xs, ys = x[rows], y[rows]
+            known = ~(np.isnan(xs) | np.isnan(ys))
+            yield xs[known], ys[known]
+
+    def value_range(self):
+        lows, highs = [], []
+        for xs, ys in self.blocks():
+            if xs.size:
+                lows.append((xs.min(), ys.min()))
+                highs.append((xs.max(), ys.max()))
+        if not lows:
+            return None
+        return [(float(low), float(high)) for low, high in zip(np.min(lows, axis=0), np.max(highs, axis=0))]
+
+    def counts(self, edges, bins):
+        counts = np.zeros(bins * bins, dtype=np.int64)
+        for xs, ys in self.blocks():
+            cells = _bin_index(xs, *edges[0], bins) * bins + _bin_index(ys, *edges[1], bins)
+            counts += np.bincount(cells, minlength=bins * bins)
+        return counts.reshape(bins, bins)
+
+
+class _SQLSource:
+    """The filtered trips' two columns in SQL."""
+
+    name = 'sql'
+
+    def __init__(self, session, filters, names):
+        self.session = session
+        self.columns = [getattr(Trip, name) for name in names]
+        self.filters = list(filters) + [column.isnot(None) for column in self.columns]
+
+    def value_range(self):
+        row = self.session.execute(
+            select(*[f(column) for column in self.columns for f in (func.min, func.max)])
+            .where(and_(*self.filters))
+        ).one()
+        if row[0] is None:
+            return None
+        return [(float(row[0]), float(row[1])), (float(row[2]), float(row[3]))]
+
+    def counts(self, edges, bins):
+        x_bin, y_bin = (
+            storage.floor_divide(self.session, storage.value_of(column) - lower, width).label(label)
+            for column, (lower, _, width), label in zip(self.columns, edges, ('x_bin', 'y_bin'))
+        )
+        rows = self.session.execute(
+            select(x_bin, y_bin, func.count().label('trips'))
+            .where(and_(*self.filters))
+            .group_by(literal_column('x_bin'), literal_column('y_bin'))
+        ).all()
+        counts = np.zeros((bins, bins), dtype=np.int64)
+        for x, y, trips in rows:
+            # The upper bound (and any rounding past it) falls in the last bin
+            counts[min(x, bins - 1), min(y, bins - 1)] += trips
+        return counts
+
+
+def _source(session, filters, names):
+    snapshot = snapshots.get_snapshot(session)
+    if snapshot is not None:
+        stats = catalog.get_catalog(session, snapshot.version)
+        positions = snapshot.positions(filters, stats.selectivity if stats is not None else None)
+        if positions is not None:
+            return _SnapshotSource(snapshot, positions, names)
+    return _SQLSource(session, filters, names)
+
+
+def query_histogram2d(session, args, filters):
+    """
+    Body of /api/histogram2d.
+
+    Returns:
+        'x' and 'y' (column, min, max and bin_width; min and max are None
+        when no trip matches an axis left open), 'bins', 'counts' where
+        counts[i][j] is the trips in x bin i and y bin j (bin i spans
+        [min + i * bin_width, min + (i + 1) * bin_width), the last bin
+        includes max), 'trip_count' and 'source' ('snapshot' or 'sql')
+    """
+    axes, bins = histogram_params(args)
+    names = [name for name, _, _ in axes]
+    source = _source(session, list(filters) + range_filters(axes), names)
+
+    edges = [(lower, upper) for _, lower, upper in axes]
+    if any(bound is None for pair in edges for bound in pair):
+        observed = source.value_range()
+        if observed is None:
+            edges = None
+        else:
+            edges = [
+                (observed[i][0] if lower is None else lower, observed[i][1] if upper is None else upper)
+                for i, (lower, upper) in enumerate(edges)
+            ]
+
+    if edges is None:
+        counts = np.zeros((bins, bins), dtype=np.int64)
+        axis_info = [{'column': name, 'min': None, 'max': None, 'bin_width': None} for name in names]
+    else:
+        edges = [_edges(lower, upper, bins) for lower, upper in edges]
+        counts = source.counts(edges, bins)
+        axis_info = [
+            {'column': name, 'min': lower, 'max': upper, 'bin_width': width}
+            for name, (lower, upper, width) in zip(names, edges)
+        ]
+
+    return {
+        'x': axis_info[0],
+        'y': axis_info[1],
+        'bins': bins,
+        'counts': counts.tolist(),
+        'trip_count': int(counts.sum()),
+        'source': source.name,
+    }
@@ -0,0 +1,685 @@
+"""
+Workload-driven index advisor for the trips table.
+
+Replays a captured request log (see WORKLOAD_LOG_PATH in app.py) or the
+benchmark workload through the Flask test client, records every statement
+that reads `trips` together with its filter / group / sort shape, its time
+and its plan (EXPLAIN QUERY PLAN on SQLite, EXPLAIN on PostgreSQL), and
+recommends covering or partial indexes for the shapes that scan the table.
+Each recommendation carries an estimated size and the write amplification
+it adds to ingest; --apply creates them and re-plans the workload.
+
+Usage:
+    WORKLOAD_LOG_PATH=workload.jsonl python app.py      # capture requests
+    python index_advisor.py --db bench_1m.db --log workload.jsonl
+    python index_advisor.py --db bench_1m.db --benchmark --output advice.json
+    python index_advisor.py --db bench_1m.db --benchmark --apply
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import namedtuple, defaultdict
+
+from sqlalchemy import event, inspect, text, Index, Integer, Float, DateTime
+from sqlalchemy.engine import Engine
+
+from models import Trip
+
+MAX_INDEX_COLUMNS = 6
+MAX_RECOMMENDATIONS = 5
+# Candidates must account for this share of the replayed trips time
+MIN_BENEFIT_SHARE = 0.01
+
+# Approximate bytes per index key column and per entry (row pointer, cell
+# header), calibrated against dbstat / pg_relation_size on generated data
+COLUMN_BYTES = {
+    'sqlite': {Integer: 2, Float: 9, DateTime: 27},
+    'postgresql': {Integer: 4, Float: 8, DateTime: 8},
+}
+ENTRY_OVERHEAD = {'sqlite': 8, 'postgresql': 16}
+FILL_FACTOR = {'sqlite': 1.0, 'postgresql': 0.9}
+DEFAULT_COLUMN_BYTES = 16
+
+QueryShape = namedtuple('QueryShape', ['equality', 'ranges', 'not_null', 'group_by', 'order_by', 'reads'])
+IndexCandidate = namedtuple('IndexCandidate', ['columns', 'include', 'where'])
+
+_log_lock = threading.Lock()
+
+
+def record_request(path, method, route, args, body, status, elapsed_ms):
+    """Append one request to the workload log at `path` (JSON lines)."""
+    entry = {
+        'method': method,
+        'path': route,
+        'args': dict(args),
+        'body': body,
+        'status': status,
+        'ms': round(elapsed_ms, 3),
+    }
+    with _log_lock:
+        with open(path, 'a') as f:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+
+
+def load_log(path):
+    """
+    Distinct requests of a workload log with their occurrence counts.
+
+    Returns:
+        List of ((method, path, args, body), count), most frequent first
+    """
+    counts = defaultdict(int)
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            key = json.dumps(
+                [entry.get('method', 'GET'), entry['path'], entry.get('args') or {}, entry.get('body')],
+                sort_keys=True
+            )
+            counts[key] += 1
+    return sorted(
+        ((tuple(json.loads(key)), count) for key, count in counts.items()),
+        key=lambda item: -item[1]
+    )
+
+
+def benchmark_workload():
+    """The requests benchmark.py times, each counted once."""
+    import benchmark
+
+    requests = [('GET', path, params, None) for _, path, params in benchmark.BENCHMARK_CASES]
+    for _, filters in benchmark.SUMMARY_FILTERS:
+        requests.extend(('GET', path, {**params, **filters}, None) for _, path, params in benchmark.DASHBOARD_REQUESTS)
+        requests.append(('GET', '/api/summary', filters, None))
+    return [(request, 1) for request in requests]
+
+
+def _split_top_level(clause):
+    """Split a comma-separated SQL list, ignoring commas inside parentheses."""
+    parts, depth, current = [], 0, []
+    for char in clause:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        if char == ',' and depth == 0:
+            parts.append(''.join(current).strip())
+            current = []
+        else:
+            current.append(char)
+    if current:
+        parts.append(''.join(current).strip())
+    return parts
+
+
+def _columns(fragment):
+    """trips columns referenced in a SQL fragment, in order of appearance."""
+    return list(dict.fromkeys(re.findall(r'\btrips\.(\w+)', fragment)))
+
+
+def _clause(sql, keyword, stops):
+    match = re.search(rf'\b{keyword}\b(.*?)(?=\b(?:{"|".join(stops)})\b|$)', sql)
+    return match.group(1) if match else ''
+
+
+PARAM = r'(?:\?|%\(\w+\)s|\$\d+)'
+AGGREGATE = re.compile(r'^(count|sum|avg|min|max)\(', re.IGNORECASE)
+
+
+def statement_shape(sql):
+    """
+    Filter / group / sort shape of a SELECT on trips, or None.
+
+    Statements are the ones SQLAlchemy renders for queries.py, so a light
+    parse of the clauses is enough.
+    """
+    sql = ' '.join(sql.split())
+    # Query.count() wraps the filtered query; only its WHERE columns are read
+    counted = re.match(r'^SELECT count\(\*\) AS \w+ FROM \((.*)\) AS anon_1$', sql)
+    if counted:
+        sql = counted.group(1)
+    if not sql.startswith('SELECT') or not re.search(r'\bFROM trips\b', sql):
+        return None
+
+    select_list = _clause(sql, 'SELECT', ['FROM'])
+    from_clause = _clause(sql, 'FROM', ['WHERE', 'GROUP BY', 'ORDER BY', 'LIMIT'])
+    where = _clause(sql, 'WHERE', ['GROUP BY', 'ORDER BY', 'LIMIT'])
+    group = _clause(sql, 'GROUP BY', ['ORDER BY', 'LIMIT'])
+    order = _clause(sql, 'ORDER BY', ['LIMIT', 'OFFSET'])
+
+    equality = re.findall(rf'\btrips\.(\w+) (?:= {PARAM}|IN \()', where)
+    ranges = re.findall(rf'\btrips\.(\w+) (?:[<>]=?) {PARAM}', where)
+    not_null = re.findall(r'\btrips\.(\w+) IS NOT NULL', where)
+
+    # GROUP BY / ORDER BY may name select-list labels
+    labels = {}
+    for item in _split_top_level(select_list):
+        labelled = re.match(r'^(.*) AS (\w+)$', item)
+        if labelled:
+            labels[labelled.group(2)] = labelled.group(1)
+
+    def resolve(clause):
+        """(plain columns, columns inside expressions) of a GROUP/ORDER BY list."""
+        plain, derived = [], []
+        for item in _split_top_level(clause):
+            item = re.sub(r' (ASC|DESC)$', '', item)
+            expression = labels.get(item, item)
+            if AGGREGATE.match(expression):
+                continue
+            if re.fullmatch(r'trips\.\w+', expression):
+                plain.append(expression[len('trips.'):])
+            else:
+                derived.extend(_columns(expression))
+        return list(dict.fromkeys(plain)), derived
+
+    group_by, group_derived = resolve(group)
+    order_by, order_derived = resolve(order)
+    join_columns = _columns(from_clause)
+    if group and not group_by and not group_derived:
+        # Grouped by a joined table's columns: the join key is the group
+        group_by = join_columns
+
+    # Grouping or sorting on an expression cannot use index order, but a
+    # covering index still saves reading the table
+    reads = [] if counted else _columns(select_list) + join_columns + group_derived + order_derived
+    return QueryShape(
+        tuple(dict.fromkeys(equality)), tuple(dict.fromkeys(ranges)), tuple(dict.fromkeys(not_null)),
+        tuple(group_by), tuple(order_by), tuple(dict.fromkeys(reads))
+    )
+
+
+def candidate_for(shape):
+    """
+    Index that serves `shape`: equality columns, then the group or sort
+    columns, then one range column, then the columns the query reads
+    (covering) when they fit in MAX_INDEX_COLUMNS. NOT NULL predicates
+    become the partial-index condition.
+    """
+    key = list(shape.equality)
+    if shape.order_by and not shape.ranges:
+        key += [c for c in shape.order_by if c not in key]
+    elif shape.group_by:
+        key += [c for c in shape.group_by if c not in key]
+    key += [c for c in shape.ranges[:1] if c not in key]
+    if not key:
+        # Nothing to seek on: only a narrower covering scan can help
+        # (trip_id is the row pointer every index already carries)
+        reads = [c for c in shape.reads if c != 'trip_id']
+        if not reads or len(reads) > MAX_INDEX_COLUMNS:
+            return None
+        key = [reads[0]]
+
+    extra = [
+        c for c in list(shape.ranges[1:]) + list(shape.reads)
+        if c not in key and c != 'trip_id'
+    ]
+    extra = list(dict.fromkeys(extra))
+    include = tuple(extra) if len(key) + len(extra) <= MAX_INDEX_COLUMNS else ()
+    where = tuple(sorted(c for c in shape.not_null if c not in key))
+    return IndexCandidate(tuple(key[:MAX_INDEX_COLUMNS]), include, where)
+
+
+def _where_sql(where):
+    return ' AND '.join(f'{c} IS NOT NULL' for c in where)
+
+
+def index_name(candidate):
+    """Stable name for a candidate index."""
+    digest = hashlib.sha1(repr(candidate).encode()).hexdigest()[:8]
+    return f"idx_adv_{'_'.join(c.split('_')[0] for c in candidate.columns)}_{digest}"
+
+
+def index_ddl(candidate, dialect):
+    """CREATE INDEX statement for a candidate (includes become key columns on SQLite)."""
+    columns = list(candidate.columns)
+    suffix = ''
+    if candidate.include:
+        if dialect == 'postgresql':
+            suffix = f" INCLUDE ({', '.join(candidate.include)})"
+        else:
+            columns += list(candidate.include)
+    ddl = f"CREATE INDEX {index_name(candidate)} ON trips ({', '.join(columns)}){suffix}"
+    if candidate.where:
+        ddl += f' WHERE {_where_sql(candidate.where)}'
+    return ddl
+
+
+def _serves(candidate, existing):
+    """True if an existing index (column list) already leads with the candidate."""
+    wanted = list(candidate.columns) + list(candidate.include)
+    return any(columns[:len(wanted)] == wanted for columns in existing)
+
+
+class StatementRecorder:
+    """Collects SQL text, parameters and time of every statement executed."""
+
+    def __init__(self):
+        self.statements = []
+        self.active = False
+        event.listen(Engine, 'before_cursor_execute', self._before)
+        event.listen(Engine, 'after_cursor_execute', self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info['advisor_started'] = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        if self.active and not executemany:
+            elapsed = (time.perf_counter() - conn.info.pop('advisor_started', time.perf_counter())) * 1000
+            self.statements.append((statement, parameters, elapsed))
+
+    def close(self):
+        event.remove(Engine, 'before_cursor_execute', self._before)
+        event.remove(Engine, 'after_cursor_execute', self._after)
+
+
+def replay(client, recorder, workload):
+    """
+    Replay `workload` once per distinct request.
+
+    Returns:
+        Dict SQL text -> {'parameters', 'count', 'total_ms', 'endpoints'},
+        statement counts weighted by how often each request occurred
+    """
+    statements = {}
+    for (method, path, args, body), weight in workload:
+        recorder.statements = []
+        recorder.active = True
+        if method == 'POST':
+            client.post(path, query_string=args, json=body)
+        else:
+            client.get(path, query_string=args)
+        recorder.active = False
+
+        for sql, parameters, elapsed in recorder.statements:
+            entry = statements.setdefault(sql, {
+                'parameters': parameters, 'count': 0, 'total_ms': 0.0, 'endpoints': set()
+            })
+            entry['count'] += weight
+            entry['total_ms'] += elapsed * weight
+            entry['endpoints'].add(path)
+    return statements
+
+
+def explain(connection, sql, parameters):
+    """
+    Plan of one statement.
+
+    Returns:
+        Tuple of (plan lines, kind) where kind is 'scan' for a full pass
+        over trips or one of its indexes, 'search' for an index lookup,
+        with a 'covering-' prefix when the table itself is not read
+    """
+    if connection.dialect.name == 'sqlite':
+        rows = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {sql}', parameters).fetchall()
+        lines = [row[-1] for row in rows]
+        trips = [line for line in lines if re.match(r'^(SCAN|SEARCH) trips\b', line)]
+        covering = trips and all('COVERING INDEX' in line for line in trips)
+        scanned = any(line.startswith('SCAN trips') for line in trips)
+    else:
+        plan = connection.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {sql}', parameters).scalar()
+        nodes = []
+
+        def walk(node):
+            nodes.append(node)
+            for child in node.get('Plans', []):
+                walk(child)
+
+        walk((plan[0] if isinstance(plan, list) else json.loads(plan)[0])['Plan'])
+        trips = [n for n in nodes if n.get('Relation Name') == 'trips']
+        lines = [
+            f"{n['Node Type']} {n.get('Relation Name', '')} {n.get('Index Name', '')}".strip()
+            for n in nodes
+        ]
+        covering = trips and all(n['Node Type'] == 'Index Only Scan' for n in trips)
+        scanned = any(n['Node Type'] == 'Seq Scan' for n in trips)
+    kind = 'scan' if scanned else 'search'
+    return lines, f'covering-{kind}' if covering else kind
+
+
+def _relation_sizes(connection):
+    """Bytes on disk per table / index name, where the database reports it."""
+    try:
+        if connection.dialect.name == 'sqlite':
+            rows = connection.exec_driver_sql('SELECT name, SUM(pgsize) FROM dbstat GROUP BY name')
+        else:
+            rows = connection.exec_driver_sql(
+                "SELECT c.relname, pg_relation_size(c.oid) FROM pg_class c "
+                "JOIN pg_namespace n ON n.oid = c.relnamespace WHERE n.nspname = current_schema()"
+            )
+        return {name: int(size) for name, size in rows}
+    except Exception:
+        return {}
+
+
+def entry_bytes(columns, dialect):
+    """Estimated bytes per index entry over `columns`."""
+    widths = COLUMN_BYTES.get(dialect, COLUMN_BYTES['postgresql'])
+    total = ENTRY_OVERHEAD.get(dialect, 16)
+    for name in columns:
+        column_type = Trip.__table__.c[name].type
+        # Compact-layout decorators are sized by the type they store
+        column_type = type(getattr(column_type, 'impl', column_type))
+        total += next((w for t, w in widths.items() if issubclass(column_type, t)), DEFAULT_COLUMN_BYTES)
+    return total / FILL_FACTOR.get(dialect, 0.9)
+
+
+def write_costs(connection, existing, candidates, trip_count):
+    """
+    Size of each candidate and the write amplification of ingest.
+
+    Write amplification is counted per inserted trip as the B-tree entries
+    (table row plus one per index) and estimated bytes written, before and
+    after adding the candidates.
+    """
+    dialect = connection.dialect.name
+    sizes = _relation_sizes(connection)
+    rows = max(trip_count, 1)
+
+    row_bytes = sizes.get('trips', 0) / rows or entry_bytes(
+        [c.name for c in Trip.__table__.columns], dialect
+    )
+    index_bytes = sum(
+        sizes.get(name, 0) / rows or entry_bytes(columns, dialect)
+        for name, columns in existing.items()
+    )
+
+    added_entries = 0.0
+    added_bytes = 0.0
+    costs = []
+    for candidate in candidates:
+        fraction = 1.0
+        if candidate.where:
+            matching = connection.exec_driver_sql(
+                f'SELECT COUNT(*) FROM trips WHERE {_where_sql(candidate.where)}'
+            ).scalar()
+            fraction = matching / rows
+        per_entry = entry_bytes(candidate.columns + candidate.include, dialect)
+        added_entries += fraction
+        added_bytes += per_entry * fraction
+        costs.append({
+            'estimated_size_mb': round(per_entry * fraction * trip_count / 2 ** 20, 1),
+            'bytes_per_insert': round(per_entry * fraction, 1),
+            'indexed_fraction': round(fraction, 3),
+        })
+
+    before_entries = 1 + len(existing)
+    before_bytes = row_bytes + index_bytes
+    amplification = {
+        'btree_entries_per_insert': [before_entries, round(before_entries + added_entries, 2)],
+        'bytes_per_insert': [round(before_bytes, 1), round(before_bytes + added_bytes, 1)],
+        'write_increase': round(added_bytes / before_bytes, 3) if before_bytes else None,
+        'current_index_mb': round(sum(sizes.get(n, 0) for n in existing) / 2 ** 20, 1) if sizes else None,
+    }
+    return costs, amplification
+
+
+def advise(client, engine, workload, apply=False, max_indexes=MAX_RECOMMENDATIONS):
+    """
+    Replay `workload`, plan every trips statement and recommend indexes.
+
+    Returns:
+        Dict with the observed 'shapes' (occurrences, time, plans),
+        'recommendations' (DDL, served shapes, benefit, size) and the
+        'write_amplification' estimate; with apply=True, 'applied' reports
+        which created indexes were kept (see apply_indexes)
+    """
+    recorder = StatementRecorder()
+    try:
+        statements = replay(client, recorder, workload)
+    finally:
+        recorder.close()
+
+    with engine.connect() as connection:
+        existing = {
+            index['name']: index['column_names']
+            for index in inspect(connection).get_indexes('trips')
+        }
+        trip_count = connection.exec_driver_sql('SELECT COUNT(*) FROM trips').scalar()
+
+        shapes = {}
+        for sql, entry in statements.items():
+            shape = statement_shape(sql)
+            if shape is None:
+                continue
+            lines, kind = explain(connection, sql, entry['parameters'])
+            summary = shapes.setdefault(shape, {
+                'count': 0, 'total_ms': 0.0, 'plans': set(), 'kinds': set(),
+                'endpoints': set(), 'statements': [],
+            })
+            summary['count'] += entry['count']
+            summary['total_ms'] += entry['total_ms']
+            summary['plans'].update(lines)
+            summary['kinds'].add(kind)
+            summary['endpoints'] |= entry['endpoints']
+            summary['statements'].append((sql, entry['parameters'], kind))
+
+        # Shapes that read the table (or a whole index) are what a new index can fix
+        benefit = defaultdict(float)
+        served = defaultdict(list)
+        for shape, summary in shapes.items():
+            if summary['kinds'] <= {'covering-search'}:
+                continue
+            candidate = candidate_for(shape)
+            if candidate is None or _serves(candidate, existing.values()):
+                continue
+            benefit[candidate] += summary['total_ms']
+            served[candidate].append(shape)
+
+        # A candidate whose columns lead another with the same condition is redundant
+        for candidate in list(benefit):
+            for other in list(benefit):
+                longer = other.columns + other.include
+                if other is not candidate and other.where == candidate.where \
+                        and longer[:len(candidate.columns)] == candidate.columns \
+                        and set(candidate.include) <= set(longer) and candidate in benefit:
+                    benefit[other] += benefit.pop(candidate)
+                    served[other].extend(served.pop(candidate))
+                    break
+
+        observed = sum(summary['total_ms'] for summary in shapes.values())
+        chosen = sorted(
+            (c for c in benefit if benefit[c] >= observed * MIN_BENEFIT_SHARE),
+            key=lambda c: -benefit[c]
+        )[:max_indexes]
+        costs, amplification = write_costs(connection, existing, chosen, trip_count)
+
+        recommendations = [{
+            'name': index_name(candidate),
+            'ddl': index_ddl(candidate, connection.dialect.name),
+            'columns': list(candidate.columns),
+            'include': list(candidate.include),
+            'where': _where_sql(candidate.where) or None,
+            'observed_ms': round(benefit[candidate], 1),
+            'shapes_served': len(served[candidate]),
+            'endpoints': sorted(set().union(*(shapes[s]['endpoints'] for s in served[candidate]))),
+            **cost,
+        } for candidate, cost in zip(chosen, costs)]
+
+    report = {
+        'trip_count': trip_count,
+        'statements_replayed': sum(e['count'] for e in statements.values()),
+        'shapes': sorted([{
+            'equality': list(shape.equality),
+            'ranges': list(shape.ranges),
+            'not_null': list(shape.not_null),
+            'group_by': list(shape.group_by),
+            'order_by': list(shape.order_by),
+            'reads': list(shape.reads),
+            'count': summary['count'],
+            'total_ms': round(summary['total_ms'], 1),
+            'plan': sorted(summary['plans']),
+            'plan_kind': sorted(summary['kinds']),
+            'endpoints': sorted(summary['endpoints']),
+        } for shape, summary in shapes.items()], key=lambda s: -s['total_ms']),
+        'recommendations': recommendations,
+        'write_amplification': amplification,
+    }
+
+    if apply and chosen:
+        report['applied'] = apply_indexes(engine, chosen, shapes)
+    return report
+
+
+def _timed(connection, sql, parameters):
+    """Milliseconds to run a statement and fetch its rows."""
+    started = time.perf_counter()
+    connection.exec_driver_sql(sql, parameters).fetchall()
+    return (time.perf_counter() - started) * 1000
+
+
+def apply_indexes(engine, candidates, shapes):
+    """
+    Create the candidate indexes and keep those that measurably help.
+
+    Every recorded statement is timed before and after the indexes exist.
+    A statement's change is credited to the new index its plan uses;
+    indexes whose net effect is not a speedup are dropped again, since the
+    planner may pick a new index over a better ordered scan.
+
+    Returns:
+        Dict with 'kept' and 'dropped' index names and their net ms saved,
+        and 'replanned' statements with plan kinds and timings
+    """
+    table = Trip.__table__
+    recorded = [
+        (sql, parameters, kind)
+        for summary in shapes.values()
+        for sql, parameters, kind in summary['statements']
+    ]
+    with engine.connect() as connection:
+        before = {sql: _timed(connection, sql, parameters) for sql, parameters, _ in recorded}
+
+    indexes = {}
+    for candidate in candidates:
+        columns = [table.c[c] for c in candidate.columns]
+        options = {}
+        if engine.dialect.name == 'postgresql':
+            options['postgresql_include'] = list(candidate.include)
+            if candidate.where:
+                options['postgresql_where'] = text(_where_sql(candidate.where))
+        else:
+            columns += [table.c[c] for c in candidate.include]
+            if candidate.where:
+                options['sqlite_where'] = text(_where_sql(candidate.where))
+        index = Index(index_name(candidate), *columns, **options)
+        index.create(engine, checkfirst=True)
+        indexes[index.name] = index
+
+    saved = dict.fromkeys(indexes, 0.0)
+    replanned = []
+    with engine.connect() as connection:
+        for sql, parameters, kind in recorded:
+            lines, new_kind = explain(connection, sql, parameters)
+            after = _timed(connection, sql, parameters)
+            used = [name for name in indexes if any(name in line for line in lines)]
+            for name in used:
+                saved[name] += (before[sql] - after) / len(used)
+            if new_kind != kind or used:
+                replanned.append({
+                    'statement': ' '.join(sql.split())[:200],
+                    'before': kind,
+                    'after': new_kind,
+                    'before_ms': round(before[sql], 1),
+                    'after_ms': round(after, 1),
+                    'indexes': used,
+                })
+
+    dropped = [name for name, ms in saved.items() if ms <= 0]
+    for name in dropped:
+        indexes[name].drop(engine)
+    return {
+        'kept': {name: round(ms, 1) for name, ms in saved.items() if name not in dropped},
+        'dropped': {name: round(saved[name], 1) for name in dropped},
+        'replanned': replanned,
+    }
+
+
+def print_report(report, stream=sys.stderr):
+    """Human-readable summary of an advise() report."""
+    print(f"{report['statements_replayed']} statements over {report['trip_count']:,} trips", file=stream)
+    print('\nQuery shapes by time:', file=stream)
+    for shape in report['shapes']:
+        described = ', '.join(
+            f"{part}={'+'.join(shape[part])}"
+            for part in ('equality', 'ranges', 'not_null', 'group_by', 'order_by') if shape[part]
+        ) or 'unfiltered'
+        print(
+            f"  {shape['total_ms']:10.1f}ms x{shape['count']:<4} {'/'.join(shape['plan_kind']):16s} {described}",
+            file=stream
+        )
+    print('\nRecommended indexes:', file=stream)
+    for rec in report['recommendations']:
+        print(
+            f"  {rec['ddl']}\n    serves {rec['shapes_served']} shape(s), {rec['observed_ms']}ms observed; "
+            f"~{rec['estimated_size_mb']} MB, +{rec['bytes_per_insert']} bytes per inserted trip",
+            file=stream
+        )
+    if not report['recommendations']:
+        print('  none', file=stream)
+    amplification = report['write_amplification']
+    print(
+        f"\nWrite amplification per inserted trip: B-tree entries "
+        f"{amplification['btree_entries_per_insert'][0]} -> {amplification['btree_entries_per_insert'][1]}, "
+        f"bytes {amplification['bytes_per_insert'][0]} -> {amplification['bytes_per_insert'][1]}",
+        file=stream
+    )
+    applied = report.get('applied')
+    if applied:
+        print('\nApplied:', file=stream)
+        for change in applied['replanned']:
+            print(
+                f"  {change['before_ms']:9.1f}ms -> {change['after_ms']:9.1f}ms "
+                f"{change['before']} -> {change['after']}: {change['statement'][:80]}",
+                file=stream
+            )
+        for name, ms in applied['kept'].items():
+            print(f"  kept {name} ({ms}ms saved per workload pass)", file=stream)
+        for name, ms in applied['dropped'].items():
+            print(f"  dropped {name} (net {ms}ms)", file=stream)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recommend trips indexes from a replayed workload')
+    parser.add_argument('--db', help='SQLite database to replay against (default: configured database)')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--log', help='Workload log captured with WORKLOAD_LOG_PATH')
+    source.add_argument('--benchmark', action='store_true', help="Replay benchmark.py's workload")
+    parser.add_argument('--limit', type=int, help='Replay at most this many distinct requests')
+    parser.add_argument('--max-indexes', type=int, default=MAX_RECOMMENDATIONS,
+                        help='Maximum number of recommendations')
+    parser.add_argument('--apply', action='store_true', help='Create the recommended indexes')
+    parser.add_argument('--output', help='Write the JSON report to this file (default: stdout)')
+    args = parser.parse_args()
+
+    if args.db:
+        os.environ['USE_SQLITE'] = 'true'
+        os.environ['SQLITE_DB_PATH'] = os.path.abspath(args.db)
+    # Replaying must not append to the log being replayed, nor be answered
+    # from the result cache instead of the queries being measured
+    os.environ.pop('WORKLOAD_LOG_PATH', None)
+    os.environ['RESULT_CACHE'] = 'false'
+
+    from app import app
+    from models import get_engine
+
+    workload = load_log(args.log) if args.log else benchmark_workload()
+    if args.limit:
+        workload = workload[:args.limit]
+
+    report = advise(app.test_client(), get_engine(), workload, apply=args.apply, max_indexes=args.max_indexes)
+    print_report(report)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
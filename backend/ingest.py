@@ -0,0 +1,120 @@
+"""
+Trip ingestion and refresh of derived structures.
+
+Every load path (bulk loaders, the synthetic generator) goes through
+`after_ingest` once its rows are committed, so derived structures stay in
+step with `trips` without rescanning the whole table, and the dataset
+version is bumped so that in-process caches reload. The bitmap index and
+the columnar snapshot are rebuilt last, stamped with the new version; until
+they are written, queries see a version mismatch and fall back to SQL.
+
+Usage:
+    python ingest.py --refresh     # rebuild derived structures from scratch
+"""
+
+import argparse
+import logging
+
+from sqlalchemy import func, insert
+
+from models import get_session, Trip
+from dimensions import bump_dataset_version
+import bitmaps
+import catalog
+import sampling
+import sketches
+import snapshots
+import storage
+
+logger = logging.getLogger(__name__)
+
+
+def next_trip_id(session):
+    """First trip_id that is not yet used."""
+    return (session.query(func.max(Trip.trip_id)).scalar() or 0) + 1
+
+
+def ingest_trips(session, records):
+    """
+    Bulk insert trip records and refresh derived structures.
+
+    Args:
+        session: Database session
+        records: List of dicts keyed by Trip column name; trip_id is
+            assigned when missing
+
+    Returns:
+        Number of trips inserted
+    """
+    if not records:
+        return 0
+
+    first_trip_id = next_trip_id(session)
+    for offset, record in enumerate(records):
+        record.setdefault('trip_id', first_trip_id + offset)
+
+    session.execute(insert(Trip), storage.stored_records(records, Trip.__table__))
+    session.commit()
+
+    after_ingest(session, since_trip_id=min(r['trip_id'] for r in records))
+    return len(records)
+
+
+def after_ingest(session, since_trip_id):
+    """
+    Bring derived structures up to date with trips whose
+    trip_id >= since_trip_id.
+    """
+    sampled = sampling.refresh_sample(session, since_trip_id)
+    logger.info(f"Added {sampled:,} trips to the approximate-query sample")
+
+    written = sketches.refresh_sketches(session, since_trip_id)
+    logger.info(f"Updated {written:,} quantile sketches")
+
+    counted = catalog.refresh_catalog(session, since_trip_id)
+    logger.info(f"Counted {counted:,} trips in the statistics catalog")
+
+    version = bump_dataset_version(session)
+    logger.info(f"Dataset version is now {version}")
+
+    scanned = bitmaps.build_index(session, version, since_trip_id)
+    logger.info(f"Indexed {scanned:,} trips in the bitmap index")
+
+    exported = snapshots.export_snapshot(session, version, since_trip_id)
+    logger.info(f"Exported {exported:,} trips to the columnar snapshot")
+
+
+def refresh_all(session):
+    """Rebuild every derived structure from the full trips table."""
+    sampled = sampling.rebuild_sample(session)
+    logger.info(f"Rebuilt approximate-query sample with {sampled:,} trips")
+
+    written = sketches.rebuild_sketches(session)
+    logger.info(f"Rebuilt {written:,} quantile sketches")
+
+    counted = catalog.rebuild_catalog(session)
+    logger.info(f"Rebuilt the statistics catalog over {counted:,} trips")
+
+    version = bump_dataset_version(session)
+    logger.info(f"Dataset version is now {version}")
+
+    scanned = bitmaps.build_index(session, version)
+    logger.info(f"Rebuilt the bitmap index over {scanned:,} trips")
+
+    exported = snapshots.export_snapshot(session, version)
+    logger.info(f"Exported {exported:,} trips to the columnar snapshot")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Refresh structures derived from the trips table')
+    parser.add_argument('--refresh', action='store_true', help='Rebuild all derived structures')
+    args = parser.parse_args()
+
+    if args.refresh:
+        session = get_session()
+        refresh_all(session)
+        session.close()
+    else:
+        parser.print_help()
@@ -0,0 +1,241 @@
+"""
+Concurrent load test for the WSGI (gunicorn + Flask) and ASGI (uvicorn +
+Starlette) serving paths.
+
+Each virtual client replays the dashboard's request mix (the five requests
+fired per filter change) over a keep-alive HTTP/1.1 connection for a fixed
+duration. The client is a minimal asyncio HTTP implementation so that it
+can hold hundreds of connections from one process without adding a
+dependency.
+
+Usage:
+    python loadtest.py --db bench_1m.db --concurrency 200 --duration 30
+    python loadtest.py --url http://localhost:8000 --concurrency 200
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from urllib.parse import urlencode, urlsplit
+
+from benchmark import git_commit, percentile_summary
+
+# Requests fired by the dashboard on every filter change
+DASHBOARD_MIX = [
+    ('/api/time-series', {'interval': 'day'}),
+    ('/api/heatmap', {}),
+    ('/api/top-routes', {'limit': 10}),
+    ('/api/time-series', {'interval': 'hour'}),
+    ('/api/statistics', {}),
+]
+
+SERVERS = {
+    'wsgi': [
+        sys.executable, '-m', 'gunicorn', 'app:app',
+        '--worker-class', 'gthread', '--workers', '{workers}', '--threads', '{threads}',
+        '--bind', '127.0.0.1:{port}', '--log-level', 'warning',
+    ],
+    'asgi': [
+        sys.executable, '-m', 'uvicorn', 'asgi:app',
+        '--workers', '{workers}', '--host', '127.0.0.1', '--port', '{port}',
+        '--log-level', 'warning', '--no-access-log',
+    ],
+}
+
+
+async def fetch(reader, writer, host, target):
+    """
+    Send one GET on an open connection and read the full response.
+
+    Returns:
+        Tuple of (status code, keep-alive flag)
+    """
+    writer.write(f'GET {target} HTTP/1.1\r\nHost: {host}\r\n\r\n'.encode('ascii'))
+    await writer.drain()
+
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split(' ')[1])
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
+    if 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    elif headers.get('transfer-encoding') == 'chunked':
+        while True:
+            size = int((await reader.readline()).strip(), 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+
+    return status, headers.get('connection', '').lower() != 'close'
+
+
+async def client(url, deadline, latencies, errors):
+    """One virtual user cycling through DASHBOARD_MIX until `deadline`."""
+    parts = urlsplit(url)
+    host = parts.hostname
+    port = parts.port or 80
+    targets = [path + ('?' + urlencode(params) if params else '') for path, params in DASHBOARD_MIX]
+
+    connection = None
+    step = 0
+    while time.perf_counter() < deadline:
+        target = targets[step % len(targets)]
+        step += 1
+        started = time.perf_counter()
+        try:
+            if connection is None:
+                connection = await asyncio.open_connection(host, port)
+            status, keep_alive = await fetch(*connection, parts.netloc, target)
+            if status != 200:
+                errors[str(status)] = errors.get(str(status), 0) + 1
+            else:
+                latencies.append((time.perf_counter() - started) * 1000)
+        except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+            errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            keep_alive = False
+        if not keep_alive and connection is not None:
+            connection[1].close()
+            connection = None
+
+    if connection is not None:
+        connection[1].close()
+
+
+async def run_load(url, concurrency, duration):
+    """
+    Drive `concurrency` clients against `url` for `duration` seconds.
+
+    Returns:
+        Dict with requests/second, latency percentiles and error counts
+    """
+    latencies = []
+    errors = {}
+    started = time.perf_counter()
+    deadline = started + duration
+    await asyncio.gather(*[
+        client(url, deadline, latencies, errors) for _ in range(concurrency)
+    ])
+    elapsed = time.perf_counter() - started
+
+    result = percentile_summary(latencies) if latencies else {}
+    result.update({
+        'requests': len(latencies),
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'errors': errors,
+        'concurrency': concurrency,
+        'duration_s': round(elapsed, 1),
+    })
+    return result
+
+
+def wait_for_server(url, timeout=30):
+    """Poll /health until the server answers or `timeout` expires."""
+    async def probe():
+        parts = urlsplit(url)
+        reader, writer = await asyncio.open_connection(parts.hostname, parts.port)
+        try:
+            status, _ = await fetch(reader, writer, parts.netloc, '/health')
+            return status == 200
+        finally:
+            writer.close()
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if asyncio.run(probe()):
+                return True
+        except OSError:
+            pass
+        time.sleep(0.25)
+    return False
+
+
+def start_server(kind, db_path, port, workers, threads):
+    """Spawn gunicorn ('wsgi') or uvicorn ('asgi') against `db_path`."""
+    env = dict(os.environ, USE_SQLITE='true', SQLITE_DB_PATH=os.path.abspath(db_path))
+    # Compare the servers, not hits of the shared result cache
+    env.setdefault('RESULT_CACHE', 'false')
+    command = [
+        part.format(workers=workers, threads=threads, port=port)
+        for part in SERVERS[kind]
+    ]
+    return subprocess.Popen(
+        command,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def compare_servers(db_path, concurrency, duration, workers, threads, port=8765):
+    """Run the same load against the WSGI and ASGI servers in turn."""
+    report = {}
+    for kind in SERVERS:
+        server = start_server(kind, db_path, port, workers, threads)
+        url = f'http://127.0.0.1:{port}'
+        try:
+            if not wait_for_server(url):
+                raise RuntimeError(f'{kind} server did not start on {url}')
+            asyncio.run(run_load(url, min(concurrency, 10), 2))  # warm-up
+            report[kind] = asyncio.run(run_load(url, concurrency, duration))
+        finally:
+            server.terminate()
+            server.wait()
+        print(
+            f"{kind}: {report[kind]['requests_per_second']:8.1f} req/s "
+            f"p50={report[kind].get('p50_ms', 0):8.1f}ms p99={report[kind].get('p99_ms', 0):8.1f}ms "
+            f"errors={report[kind]['errors']}",
+            file=sys.stderr,
+        )
+
+    if report['wsgi']['requests_per_second']:
+        report['asgi_speedup'] = round(
+            report['asgi']['requests_per_second'] / report['wsgi']['requests_per_second'], 2
+        )
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the WSGI and ASGI serving paths')
+    parser.add_argument('--db', help='SQLite database; starts gunicorn and uvicorn in turn against it')
+    parser.add_argument('--url', help='Load an already running server instead')
+    parser.add_argument('--concurrency', type=int, default=200, help='Concurrent clients')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds of load per server')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Server worker processes')
+    parser.add_argument('--threads', type=int, default=8, help='Threads per gunicorn worker')
+    parser.add_argument('--output', help='Write the JSON report to this file (default: stdout)')
+    args = parser.parse_args()
+
+    if args.url:
+        results = {'server': asyncio.run(run_load(args.url, args.concurrency, args.duration))}
+    elif args.db:
+        results = compare_servers(args.db, args.concurrency, args.duration, args.workers, args.threads)
+    else:
+        parser.error('one of --db or --url is required')
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'database': os.path.abspath(args.db) if args.db else None,
+            'url': args.url,
+            'workers': args.workers,
+            'threads': args.threads,
+        },
+        **results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
@@ -0,0 +1,77 @@
+"""
+In-process metrics, served at /metrics in the Prometheus text format.
+
+Counters live in the process that increments them, so under gunicorn or
+uvicorn with several workers each worker reports its own values and the
+scraper sums them. Gauges are computed when /metrics is read.
+"""
+
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_registry = []
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for key, value in labels
+    )
+    return '{' + pairs + '}'
+
+
+class Counter:
+    """Monotonic count per label set."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return list(self._values.items())
+
+
+class Gauge:
+    """
+    Value read at scrape time.
+
+    Args:
+        collect: Callable returning a dict of label dict items (a tuple of
+            (name, value) pairs) -> value
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, collect):
+        self.name = name
+        self.help = help_text
+        self.collect = collect
+        _registry.append(self)
+
+    def samples(self):
+        return list(self.collect().items())
+
+
+def render():
+    """Every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for labels, value in sorted(metric.samples()):
+            lines.append(f'{metric.name}{_label_text(labels)} {value:g}')
+    return '\n'.join(lines) + '\n'
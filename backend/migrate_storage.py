@@ -0,0 +1,332 @@
+"""
+Convert the trips table between the standard and compact storage layouts.
+
+The table is copied in trip_id batches into the target layout (see
+storage.py), the secondary indexes are rebuilt on the new table and every
+derived structure (sample, sketches, bitmap index, snapshot) is rebuilt
+from it. The copy runs in one transaction: if the target layout cannot
+represent a value exactly (sub-cent money, sub-second pickups, stored ratios
+that differ from the computed ones) the migration stops and leaves the
+database untouched, unless --allow-lossy is given.
+
+On-disk size, full-scan time and the time to build one index are measured
+before and after, and reported on stderr and as JSON.
+
+Usage:
+    python migrate_storage.py --db bench_1m.db --report
+    python migrate_storage.py --db bench_1m.db --to compact --output migration.json
+    COMPACT_STORAGE=true python app.py
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+from sqlalchemy import inspect, select, func, Column, Integer, MetaData, Table
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateTable
+
+import storage
+
+DEFAULT_BATCH_SIZE = 50000
+SCAN_REPEATS = 3
+# Index built and dropped again to time index builds in each layout
+PROBE_INDEX_COLUMNS = ('pickup_datetime', 'fare_amount')
+REPORT_KEYS = (
+    'file_bytes', 'table_bytes', 'index_bytes', 'bytes_per_row',
+    'stored_scan_ms', 'full_scan_ms', 'probe_index_build_ms',
+)
+
+
+class LossyMigration(Exception):
+    """The target layout cannot represent some stored values exactly."""
+
+    def __init__(self, lossy):
+        super().__init__(
+            'values not representable in the target layout: ' +
+            ', '.join(f"{name} ({count:,} rows)" for name, count in sorted(lossy.items()))
+        )
+        self.lossy = lossy
+
+
+def trips_table(metadata, compact, name='trips'):
+    """Table of the stored trip columns in one layout (for reading and measuring)."""
+    columns = [Column('trip_id', Integer, primary_key=True)]
+    for column_name in storage.TRIP_ENCODINGS:
+        column_type = storage.trip_type(column_name, compact)
+        if column_type is not None:
+            columns.append(Column(column_name, column_type))
+    return Table(name, metadata, *columns)
+
+
+def value_columns(table, compact):
+    """Labelled expressions of every Trip attribute in API values."""
+    derived = storage.derived_expressions(table.c) if compact else {}
+    return [table.c.trip_id] + [
+        derived[name].label(name) if name in derived else table.c[name]
+        for name in storage.TRIP_ENCODINGS
+    ]
+
+
+def _table_bytes(connection):
+    """Bytes of the trips table and of its indexes, where the database reports them."""
+    try:
+        if connection.dialect.name == 'sqlite':
+            index_names = [i['name'] for i in inspect(connection).get_indexes('trips')]
+            sizes = dict(connection.exec_driver_sql('SELECT name, SUM(pgsize) FROM dbstat GROUP BY name').all())
+            return sizes.get('trips', 0), sum(sizes.get(name, 0) for name in index_names)
+        table = connection.exec_driver_sql("SELECT pg_table_size('trips')").scalar()
+        indexes = connection.exec_driver_sql("SELECT pg_indexes_size('trips')").scalar()
+        return int(table), int(indexes)
+    except Exception:
+        return None, None
+
+
+def measure(engine, compact):
+    """
+    Size and scan cost of the trips table in its current layout.
+
+    The stored scan aggregates every stored column; the full scan every
+    Trip attribute, so in the compact layout it includes computing the
+    derived ones. Times are the best of SCAN_REPEATS warm runs.
+    """
+    table = trips_table(MetaData(), compact)
+
+    def scan(columns):
+        return select(func.count(), *[
+            func.max(c) if c.name.endswith('_datetime') else func.sum(c) for c in columns
+        ])
+    scans = {
+        'stored_scan_ms': scan([c for c in table.columns if c.name != 'trip_id']),
+        'full_scan_ms': scan(value_columns(table, compact)[1:]),
+    }
+
+    with engine.connect() as conn:
+        file_bytes = None
+        if conn.dialect.name == 'sqlite':
+            file_bytes = os.path.getsize(engine.url.database)
+        table_bytes, index_bytes = _table_bytes(conn)
+        rows = conn.execute(select(func.count()).select_from(table)).scalar()
+
+        scan_ms = {}
+        for name, statement in scans.items():
+            times = []
+            # The first run warms the cache
+            for _ in range(SCAN_REPEATS + 1):
+                started = time.perf_counter()
+                conn.execute(statement).one()
+                times.append(time.perf_counter() - started)
+            scan_ms[name] = round(min(times[1:]) * 1000, 1)
+
+        started = time.perf_counter()
+        conn.exec_driver_sql(
+            f"CREATE INDEX idx_storage_probe ON trips ({', '.join(PROBE_INDEX_COLUMNS)})"
+        )
+        index_seconds = time.perf_counter() - started
+        conn.exec_driver_sql('DROP INDEX idx_storage_probe')
+        conn.commit()
+
+    return {
+        'layout': 'compact' if compact else 'standard',
+        'rows': rows,
+        'file_bytes': file_bytes,
+        'table_bytes': table_bytes,
+        'index_bytes': index_bytes,
+        'bytes_per_row': round(table_bytes / rows, 1) if table_bytes and rows else None,
+        **scan_ms,
+        'probe_index_build_ms': round(index_seconds * 1000, 1),
+    }
+
+
+def _lossy_columns(record, target_columns, dialect):
+    """Names of the columns whose value does not survive the compact encoding."""
+    lossy = []
+    for name, column_type in target_columns:
+        value = record[name]
+        if value is None:
+            continue
+        stored = column_type.process_bind_param(value, dialect)
+        if isinstance(stored, float) or column_type.process_result_value(stored, dialect) != value:
+            lossy.append(name)
+    for name, value in storage.derived_values(record).items():
+        if value != record[name]:
+            lossy.append(name)
+    return lossy
+
+
+def copy_trips(connection, source, source_compact, target, target_compact, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Copy every trip from `source` into `target`, converting the layout.
+
+    Returns:
+        (rows copied, Counter of column name -> rows whose value would
+        change in the target layout)
+    """
+    columns = value_columns(source, source_compact)
+    checked = [
+        (c.name, c.type) for c in target.columns
+        if isinstance(c.type, (storage.FixedPoint, storage.EpochSeconds))
+    ]
+    dialect = connection.dialect
+    lossy = Counter()
+    copied = 0
+    last_trip_id = None
+
+    while True:
+        query = select(*columns).order_by(source.c.trip_id).limit(batch_size)
+        if last_trip_id is not None:
+            query = query.where(source.c.trip_id > last_trip_id)
+        records = [dict(row._mapping) for row in connection.execute(query)]
+        if not records:
+            break
+        if target_compact:
+            for record in records:
+                lossy.update(_lossy_columns(record, checked, dialect))
+        connection.execute(target.insert(), storage.stored_records(records, target))
+        copied += len(records)
+        last_trip_id = records[-1]['trip_id']
+        print(f"  copied {copied:,} trips", file=sys.stderr)
+    return copied, lossy
+
+
+def migrate(engine, target_compact, batch_size=DEFAULT_BATCH_SIZE, allow_lossy=False):
+    """
+    Rewrite trips in the target layout and rebuild what is derived from it.
+
+    COMPACT_STORAGE must select the target layout before models is
+    imported (the command line does this), since the Trip mapping follows it.
+
+    Returns:
+        Report dict with 'before' and 'after' measurements
+    """
+    import models
+    import ingest
+
+    if models.COMPACT_STORAGE != target_compact:
+        raise RuntimeError('COMPACT_STORAGE does not select the target layout')
+
+    source_compact = storage.layout(engine) == 'compact'
+    if source_compact == target_compact:
+        return {'before': measure(engine, source_compact), 'after': None}
+
+    before = measure(engine, source_compact)
+    started = time.perf_counter()
+
+    # Copies of the lookup tables let the new trips table keep its foreign keys
+    metadata = MetaData()
+    for table in (models.Zone.__table__, models.PaymentType.__table__, models.RateCode.__table__):
+        table.to_metadata(metadata)
+    target = models.Trip.__table__.to_metadata(metadata, name='trips_migrated')
+
+    try:
+        with engine.begin() as conn:
+            conn.execute(CreateTable(target))
+            source = trips_table(MetaData(), source_compact)
+            copied, lossy = copy_trips(conn, source, source_compact, target, target_compact, batch_size)
+            if lossy and not allow_lossy:
+                raise LossyMigration(dict(lossy))
+
+            conn.exec_driver_sql('DROP TABLE trips')
+            conn.exec_driver_sql('ALTER TABLE trips_migrated RENAME TO trips')
+            index_started = time.perf_counter()
+            for index in models.Trip.__table__.indexes:
+                index.create(conn)
+            index_seconds = time.perf_counter() - index_started
+
+            # The sample copies trip columns, so it is recreated in the new layout
+            models.TripSample.__table__.drop(conn, checkfirst=True)
+    except Exception:
+        # pysqlite runs DDL issued before the first INSERT outside the
+        # transaction, so the new table can outlive the rollback
+        with engine.begin() as conn:
+            target.drop(conn, checkfirst=True)
+        raise
+    copy_seconds = time.perf_counter() - started
+
+    session = sessionmaker(bind=engine)()
+    ingest.refresh_all(session)
+    session.close()
+
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.exec_driver_sql('VACUUM')
+
+    return {
+        'before': before,
+        'after': measure(engine, target_compact),
+        'copied': copied,
+        'lossy': dict(lossy),
+        'copy_seconds': round(copy_seconds, 1),
+        'index_build_seconds': round(index_seconds, 1),
+    }
+
+
+def _ratio(before, after):
+    return f"{after / before:.2f}x" if before and after else '-'
+
+
+def print_report(report, stream=sys.stderr):
+    """Human-readable before/after comparison of a migrate() report."""
+    before, after = report['before'], report['after']
+    if after is None:
+        print(f"trips uses the {before['layout']} layout", file=stream)
+        for key in REPORT_KEYS:
+            print(f"  {key:22s}{before[key] if before[key] is not None else '-':>14}", file=stream)
+        return
+
+    print(
+        f"Copied {report['copied']:,} trips in {report['copy_seconds']}s "
+        f"(indexes {report['index_build_seconds']}s)", file=stream
+    )
+    for name, count in sorted(report['lossy'].items()):
+        print(f"  lossy: {name} changed in {count:,} rows", file=stream)
+
+    print(f"\n{'':22s}{before['layout']:>14s}{after['layout']:>14s}{'ratio':>9s}", file=stream)
+    for key in REPORT_KEYS:
+        b, a = before[key], after[key]
+        print(
+            f"{key:22s}{b if b is not None else '-':>14}{a if a is not None else '-':>14}"
+            f"{_ratio(b, a):>9s}", file=stream
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert trips between storage layouts')
+    parser.add_argument('--db', help='SQLite database to convert (default: configured database)')
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument('--to', choices=['compact', 'standard'], help='Target layout')
+    action.add_argument('--report', action='store_true', help='Only measure the current layout')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Trips copied per batch')
+    parser.add_argument('--allow-lossy', action='store_true',
+                        help='Convert even if some values change (they are counted in the report)')
+    parser.add_argument('--output', help='Write the JSON report to this file (default: stdout)')
+    args = parser.parse_args()
+
+    if args.db:
+        os.environ['USE_SQLITE'] = 'true'
+        os.environ['SQLITE_DB_PATH'] = os.path.abspath(args.db)
+    if args.to:
+        os.environ['COMPACT_STORAGE'] = 'true' if args.to == 'compact' else 'false'
+
+    # Not get_engine(): its layout check would flag the table being converted
+    from models import create_db_engine
+
+    engine = create_db_engine()
+    if args.report:
+        report = {'before': measure(engine, storage.layout(engine) == 'compact'), 'after': None}
+    else:
+        try:
+            report = migrate(engine, args.to == 'compact', args.batch_size, args.allow_lossy)
+        except LossyMigration as e:
+            print(f"Not migrated: {e}. Re-run with --allow-lossy to convert anyway.", file=sys.stderr)
+            sys.exit(1)
+    print_report(report)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
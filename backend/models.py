@@ -3,15 +3,39 @@ Database models for NYC Taxi Trip application.
 Fully normalized schema with proper relationships and indexing.
 """
 
-from sqlalchemy import create_engine, Column, Integer, Float, DateTime, String, ForeignKey, Index
+from sqlalchemy import create_engine, event, text, Column, Integer, Float, DateTime, String, ForeignKey, Index, LargeBinary
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import column_property, relationship, sessionmaker
 from datetime import datetime
 import os
+import threading
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
 
+import storage
+
+# Trip columns use the compact encodings of storage.py
+COMPACT_STORAGE = os.getenv('COMPACT_STORAGE', 'false').lower() == 'true'
+
+# Blue/green dataset generations (see datasets.py): a SQLite database is
+# served from the file named in <SQLITE_DB_PATH>.current, a PostgreSQL one
+# from the schema named in GENERATION_TABLE, when they exist
+GENERATION_POINTER_SUFFIX = '.current'
+GENERATION_TABLE = 'dataset_generation'
+# Seconds between reads of the PostgreSQL generation pointer
+DATASET_CHECK_INTERVAL = float(os.getenv('DATASET_CHECK_INTERVAL', '5'))
+# Compiled statements kept per engine: up to 2^9 filter shapes of each
+# statement in statements.py, beyond SQLAlchemy's default of 500
+SQL_COMPILED_CACHE_SIZE = int(os.getenv('SQL_COMPILED_CACHE_SIZE', '2000'))
+
+
+def trip_type(name):
+    """Column type of trip column `name` in the configured storage layout."""
+    return storage.trip_type(name, COMPACT_STORAGE)
+
 Base = declarative_base()
 
 
@@ -59,33 +83,43 @@ class Trip(Base):
     trip_id = Column(Integer, primary_key=True, autoincrement=True)
     
     # Timestamps
-    pickup_datetime = Column(DateTime, nullable=False, index=True)
-    dropoff_datetime = Column(DateTime, nullable=False)
+    pickup_datetime = Column(trip_type('pickup_datetime'), nullable=False, index=True)
+    if not COMPACT_STORAGE:
+        dropoff_datetime = Column(DateTime, nullable=False)
     
     # Foreign keys
-    pickup_zone_id = Column(Integer, ForeignKey('zones.zone_id'), index=True)
-    dropoff_zone_id = Column(Integer, ForeignKey('zones.zone_id'), index=True)
-    payment_type_id = Column(Integer, ForeignKey('payment_types.payment_type_id'))
-    rate_code_id = Column(Integer, ForeignKey('rate_codes.rate_code_id'))
+    pickup_zone_id = Column(trip_type('pickup_zone_id'), ForeignKey('zones.zone_id'), index=True)
+    dropoff_zone_id = Column(trip_type('dropoff_zone_id'), ForeignKey('zones.zone_id'), index=True)
+    payment_type_id = Column(trip_type('payment_type_id'), ForeignKey('payment_types.payment_type_id'))
+    rate_code_id = Column(trip_type('rate_code_id'), ForeignKey('rate_codes.rate_code_id'))
     
     # Trip metrics
-    passenger_count = Column(Integer)
-    trip_distance = Column(Float, index=True)
-    trip_duration = Column(Float)  # in seconds
+    passenger_count = Column(trip_type('passenger_count'))
+    trip_distance = Column(trip_type('trip_distance'), index=True)
+    trip_duration = Column(trip_type('trip_duration'))  # in seconds
     
     # Fare information
-    fare_amount = Column(Float, index=True)
-    extra = Column(Float)
-    mta_tax = Column(Float)
-    tip_amount = Column(Float)
-    tolls_amount = Column(Float)
-    improvement_surcharge = Column(Float)
-    total_amount = Column(Float)
-    
-    # Derived features (engineered)
-    trip_speed = Column(Float)  # km/h or mph
-    fare_per_km = Column(Float)
-    fare_per_minute = Column(Float)
+    fare_amount = Column(trip_type('fare_amount'), index=True)
+    extra = Column(trip_type('extra'))
+    mta_tax = Column(trip_type('mta_tax'))
+    tip_amount = Column(trip_type('tip_amount'))
+    tolls_amount = Column(trip_type('tolls_amount'))
+    improvement_surcharge = Column(trip_type('improvement_surcharge'))
+    total_amount = Column(trip_type('total_amount'))
+    
+    if COMPACT_STORAGE:
+        # Computed from the stored columns (see storage.py)
+        _derived = storage.derived_expressions(locals())
+        dropoff_datetime = column_property(_derived['dropoff_datetime'])
+        trip_speed = column_property(_derived['trip_speed'])
+        fare_per_km = column_property(_derived['fare_per_km'])
+        fare_per_minute = column_property(_derived['fare_per_minute'])
+        del _derived
+    else:
+        # Derived features (engineered)
+        trip_speed = Column(Float)  # mph
+        fare_per_km = Column(Float)
+        fare_per_minute = Column(Float)
     
     # Relationships
     pickup_zone = relationship('Zone', foreign_keys=[pickup_zone_id], back_populates='pickup_trips')
@@ -97,17 +131,32 @@ class Trip(Base):
     __table_args__ = (
         Index('idx_pickup_datetime_zone', 'pickup_datetime', 'pickup_zone_id'),
         Index('idx_fare_distance', 'fare_amount', 'trip_distance'),
+    ) + (() if COMPACT_STORAGE else (
         Index('idx_datetime_range', 'pickup_datetime', 'dropoff_datetime'),
-    )
+    ))
     
-    def to_dict(self):
-        """Convert trip to dictionary for API responses."""
+    def to_dict(self, dimensions=None):
+        """
+        Convert trip to dictionary for API responses.
+
+        With `dimensions` (see dimensions.py) zone and payment names are
+        looked up in memory instead of loading the related rows.
+        """
+        if dimensions is not None:
+            pickup_zone = dimensions.zone_name(self.pickup_zone_id)
+            dropoff_zone = dimensions.zone_name(self.dropoff_zone_id)
+            payment_type = dimensions.payment_name(self.payment_type_id)
+        else:
+            pickup_zone = self.pickup_zone.zone_name if self.pickup_zone else None
+            dropoff_zone = self.dropoff_zone.zone_name if self.dropoff_zone else None
+            payment_type = self.payment_type.payment_name if self.payment_type else None
+
         return {
             'trip_id': self.trip_id,
             'pickup_datetime': self.pickup_datetime.isoformat() if self.pickup_datetime else None,
             'dropoff_datetime': self.dropoff_datetime.isoformat() if self.dropoff_datetime else None,
-            'pickup_zone': self.pickup_zone.zone_name if self.pickup_zone else None,
-            'dropoff_zone': self.dropoff_zone.zone_name if self.dropoff_zone else None,
+            'pickup_zone': pickup_zone,
+            'dropoff_zone': dropoff_zone,
             'passenger_count': self.passenger_count,
             'trip_distance': self.trip_distance,
             'trip_duration': self.trip_duration,
@@ -116,11 +165,101 @@ class Trip(Base):
             'trip_speed': self.trip_speed,
             'fare_per_km': self.fare_per_km,
             'fare_per_minute': self.fare_per_minute,
-            'payment_type': self.payment_type.payment_name if self.payment_type else None,
+            'payment_type': payment_type,
         }
 
 
-def get_database_url():
+class TripSample(Base):
+    """
+    Stratified Bernoulli sample of trips for approximate queries.
+    Strata are (pickup date, pickup borough); see sampling.py.
+    """
+    __tablename__ = 'trip_samples'
+    
+    trip_id = Column(Integer, primary_key=True)
+    sample_date = Column(String(10), nullable=False)
+    borough = Column(String(50), nullable=False)
+    
+    pickup_datetime = Column(trip_type('pickup_datetime'), nullable=False)
+    pickup_zone_id = Column(trip_type('pickup_zone_id'))
+    dropoff_zone_id = Column(trip_type('dropoff_zone_id'))
+    payment_type_id = Column(trip_type('payment_type_id'))
+    passenger_count = Column(trip_type('passenger_count'))
+    trip_distance = Column(trip_type('trip_distance'))
+    trip_duration = Column(trip_type('trip_duration'))
+    fare_amount = Column(trip_type('fare_amount'))
+    trip_speed = Column(Float)
+    total_amount = Column(trip_type('total_amount'))
+    
+    __table_args__ = (
+        Index('idx_sample_stratum', 'sample_date', 'borough'),
+    )
+
+
+class SampleStratum(Base):
+    """Population and sample sizes per stratum of the trip sample."""
+    __tablename__ = 'sample_strata'
+    
+    sample_date = Column(String(10), primary_key=True)
+    borough = Column(String(50), primary_key=True)
+    population_count = Column(Integer, nullable=False, default=0)
+    sample_count = Column(Integer, nullable=False, default=0)
+
+
+class TripSketch(Base):
+    """t-digest of one trip metric per (pickup date, pickup zone); see sketches.py."""
+    __tablename__ = 'trip_sketches'
+    
+    sketch_date = Column(String(10), primary_key=True)
+    pickup_zone_id = Column(Integer, primary_key=True)
+    metric = Column(String(20), primary_key=True)
+    count = Column(Integer, nullable=False)
+    min_value = Column(Float)
+    max_value = Column(Float)
+    centroids = Column(LargeBinary, nullable=False)
+
+
+class TripCountStat(Base):
+    """Trip count per (pickup date, pickup zone); see catalog.py."""
+    __tablename__ = 'trip_count_stats'
+    
+    stat_date = Column(String(10), primary_key=True)
+    pickup_zone_id = Column(Integer, primary_key=True)
+    trip_count = Column(Integer, nullable=False)
+
+
+class ColumnStat(Base):
+    """Value range, NULL count and equi-depth histogram of one trip column; see catalog.py."""
+    __tablename__ = 'column_stats'
+    
+    column_name = Column(String(50), primary_key=True)
+    row_count = Column(Integer, nullable=False)
+    null_count = Column(Integer, nullable=False)
+    min_value = Column(Float)
+    max_value = Column(Float)
+    histogram = Column(LargeBinary)
+
+
+class BackfillCheckpoint(Base):
+    """Progress of a backfill job over trips; see backfill.py."""
+    __tablename__ = 'backfill_checkpoints'
+    
+    job = Column(String(50), primary_key=True)
+    next_trip_id = Column(Integer, nullable=False)  # every trip below it is done
+    rows_updated = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False)
+    completed_at = Column(DateTime)
+
+
+class DatasetMeta(Base):
+    """Key/value metadata about the loaded dataset, e.g. its version."""
+    __tablename__ = 'dataset_meta'
+    
+    key = Column(String(50), primary_key=True)
+    value = Column(String(200), nullable=False)
+
+
+def configured_database_url():
     """
     Construct database URL from environment variables.
     Falls back to SQLite if PostgreSQL credentials not available.
@@ -146,9 +285,81 @@ def get_database_url():
     return f"postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
 
 
-def create_db_engine():
-    """Create SQLAlchemy engine with appropriate settings."""
-    db_url = get_database_url()
+def active_sqlite_path(db_path):
+    """The file of the active generation of a SQLite database (db_path itself without one)."""
+    try:
+        with open(db_path + GENERATION_POINTER_SUFFIX) as f:
+            target = f.read().strip()
+    except FileNotFoundError:
+        return db_path
+    return os.path.join(os.path.dirname(db_path), target) if target else db_path
+
+
+# PostgreSQL URL -> (active schema or None, time read), and the engine reading it
+_active_schemas = {}
+_pointer_engines = {}
+
+
+def active_schema(db_url):
+    """The schema of the active generation of a PostgreSQL database, or None; re-read every DATASET_CHECK_INTERVAL."""
+    cached = _active_schemas.get(db_url)
+    now = time.monotonic()
+    if cached and now - cached[1] < DATASET_CHECK_INTERVAL:
+        return cached[0]
+    engine = _pointer_engines.get(db_url)
+    if engine is None:
+        engine = _pointer_engines[db_url] = create_db_engine(db_url)
+    with engine.connect() as conn:
+        if engine.dialect.has_table(conn, GENERATION_TABLE, schema='public'):
+            schema = conn.execute(text(
+                f"SELECT target FROM public.{GENERATION_TABLE} WHERE name = 'active'"
+            )).scalar()
+        else:
+            schema = None
+    _active_schemas[db_url] = (schema, now)
+    return schema
+
+
+def schema_url(db_url, schema):
+    """`db_url` with `schema` first on the search path of its connections."""
+    return make_url(db_url).update_query_dict(
+        {'options': f'-csearch_path={schema},public'}
+    ).render_as_string(hide_password=False)
+
+
+def generation_schema(url):
+    """Generation schema a PostgreSQL URL (see schema_url) selects, or None."""
+    options = make_url(str(url)).query.get('options', '')
+    if not options.startswith('-csearch_path='):
+        return None
+    return options[len('-csearch_path='):].split(',')[0]
+
+
+def generation_name(name, url):
+    """`name` of a file derived from the database at `url`, suffixed with its generation schema if any."""
+    schema = generation_schema(url)
+    return f'{name}.{schema}' if schema else name
+
+
+def active_database_url(db_url):
+    """URL of the active generation of the database at `db_url`."""
+    if db_url.startswith('sqlite'):
+        db_path = make_url(db_url).database
+        if db_path in (None, '', ':memory:'):
+            return db_url
+        return f"sqlite:///{active_sqlite_path(db_path)}"
+    schema = active_schema(db_url)
+    return schema_url(db_url, schema) if schema else db_url
+
+
+def get_database_url():
+    """URL of the configured database, at its active generation."""
+    return active_database_url(configured_database_url())
+
+
+def create_db_engine(db_url=None):
+    """Create SQLAlchemy engine with appropriate settings (default: the configured database)."""
+    db_url = db_url or get_database_url()
     
     # Different settings for SQLite vs PostgreSQL
     if db_url.startswith('sqlite'):
@@ -156,7 +367,8 @@ def create_db_engine():
         return create_engine(
             db_url,
             echo=False,
-            connect_args={'check_same_thread': False}  # Allow multi-threading
+            connect_args={'check_same_thread': False},  # Allow multi-threading
+            query_cache_size=SQL_COMPILED_CACHE_SIZE
         )
     else:
         # PostgreSQL settings
@@ -164,14 +376,121 @@ def create_db_engine():
             db_url,
             echo=False,
             pool_size=10,
-            max_overflow=20
+            max_overflow=20,
+            query_cache_size=SQL_COMPILED_CACHE_SIZE
         )
 
 
+def create_async_db_engine(db_url=None):
+    """
+    Create an async SQLAlchemy engine for the ASGI app (default: the configured database).
+
+    Uses aiosqlite for SQLite and asyncpg for PostgreSQL; the driver is only
+    imported when this is called, so the WSGI app does not need either.
+    """
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    db_url = db_url or get_database_url()
+
+    # Requests queue for a pooled connection rather than holding a thread,
+    # so the pool timeout bounds how long a request may wait under load
+    pool_settings = {
+        'pool_size': int(os.getenv('ASYNC_POOL_SIZE', 20)),
+        'max_overflow': int(os.getenv('ASYNC_MAX_OVERFLOW', 40)),
+        'pool_timeout': float(os.getenv('ASYNC_POOL_TIMEOUT', 120)),
+        'query_cache_size': SQL_COMPILED_CACHE_SIZE,
+    }
+
+    if db_url.startswith('sqlite'):
+        return create_async_engine(
+            db_url.replace('sqlite://', 'sqlite+aiosqlite://', 1),
+            echo=False,
+            **pool_settings
+        )
+    else:
+        engine = create_async_engine(
+            db_url.replace('postgresql://', 'postgresql+asyncpg://', 1),
+            echo=False,
+            **pool_settings
+        )
+
+        # asyncpg takes the search path of a generation schema (see
+        # schema_url) as a server setting rather than libpq options
+        @event.listens_for(engine.sync_engine, 'do_connect')
+        def search_path(dialect, conn_rec, cargs, cparams):
+            options = cparams.pop('options', '')
+            if options.startswith('-csearch_path='):
+                cparams['server_settings'] = {'search_path': options[len('-csearch_path='):]}
+
+        return engine
+
+
+def set_read_only(engine):
+    """Make every connection of `engine` refuse writes."""
+    dialect = engine.dialect.name
+
+    @event.listens_for(engine, 'connect')
+    def read_only(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if dialect == 'sqlite':
+            cursor.execute('PRAGMA query_only = ON')
+        else:
+            cursor.execute('SET SESSION CHARACTERISTICS AS TRANSACTION READ ONLY')
+        cursor.close()
+    return engine
+
+
+_engines = {}
+# Configured URL -> URL of the generation its engine serves
+_active_urls = {}
+_switch_lock = threading.Lock()
+_switch_listeners = []
+
+
+def on_dataset_switch(callback):
+    """Call `callback()` whenever this process moves to another dataset generation."""
+    _switch_listeners.append(callback)
+    return callback
+
+
+def dataset_switched():
+    """Run the dataset switch callbacks, e.g. to drop in-process caches."""
+    for callback in _switch_listeners:
+        callback()
+
+
+def get_engine():
+    """
+    Shared engine for the configured database URL.
+
+    Engines own the connection pool, so creating one per request would
+    open a fresh connection every time; one engine per URL is kept for the
+    life of the process. When the active dataset generation changes, the
+    previous generation's engine is disposed: idle connections close now,
+    connections of requests still running close when they are returned.
+    """
+    configured = configured_database_url()
+    db_url = active_database_url(configured)
+    engine = _engines.get(db_url)
+    if engine is None:
+        engine = _engines[db_url] = create_db_engine(db_url)
+        storage.check_layout(engine, COMPACT_STORAGE)
+    if _active_urls.get(configured, db_url) != db_url:
+        with _switch_lock:
+            previous = _active_urls.get(configured)
+            if previous != db_url:
+                _active_urls[configured] = db_url
+                retired = _engines.pop(previous, None)
+                if retired is not None:
+                    retired.dispose()
+                dataset_switched()
+    _active_urls.setdefault(configured, db_url)
+    return engine
+
+
 def get_session():
     """Get database session."""
-    engine = create_db_engine()
-    Session = sessionmaker(bind=engine)
+    Session = sessionmaker(bind=get_engine())
     return Session()
 
 
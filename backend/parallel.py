@@ -0,0 +1,384 @@
+"""
+Process-pool aggregation over date shards.
+
+With parallel=true, /api/statistics and /api/time-series (hour and day
+intervals) split the start_date..end_date range (or the range of the data
+when a bound is missing) into contiguous whole-day shards. Each shard runs
+its partial aggregate - per group a trip count and, per metric, the sum and
+count of non-NULL values - in a process pool whose workers hold their own
+read-only connection. The parent merges the partials and shapes the same
+JSON as the serial queries in queries.py.
+
+Merging is exact for counts and for fixed-point columns (integer sums in
+the compact layout, see storage.py). Float sums are added with math.fsum,
+but each shard sums its rows in a different order than the serial scan, so
+an average can differ from the serial one in about the 15th significant
+digit; after rounding to 2 decimals the output only differs when a value
+lies that close to a rounding boundary. Zones with equal trip counts in
+the top 20 are ordered by name, where the serial query leaves them in
+database order.
+
+Workers are spawned (not forked) once per pool size and reused, so the
+first parallel request pays their start-up.
+"""
+
+import math
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, func, and_, type_coerce, Integer
+from sqlalchemy.orm import sessionmaker
+
+from models import Trip, create_db_engine, get_database_url, set_read_only
+from dimensions import get_dimensions
+import admission
+import queries
+import storage
+
+PARALLEL_WORKERS = int(os.getenv('PARALLEL_WORKERS', os.cpu_count() or 1))
+
+# Metric name -> trip column; each gets a sum and a non-NULL count per group
+METRICS = {
+    'fare': Trip.fare_amount,
+    'distance': Trip.trip_distance,
+    'duration': Trip.trip_duration,
+    'speed': Trip.trip_speed,
+    'revenue': Trip.total_amount,
+}
+
+# Grouping name -> metrics it aggregates; the keys are built by _group_key
+GROUPINGS = {
+    'overall': ('fare', 'distance', 'duration', 'speed', 'revenue'),
+    'hour': ('fare', 'speed', 'revenue'),
+    'day': ('fare', 'speed', 'revenue'),
+    'zone': ('fare',),
+    'payment_type': ('fare',),
+}
+
+
+def supports(endpoint, args):
+    """True if the request can run on date shards."""
+    if endpoint == 'statistics':
+        return args.get('group_by') in (None, 'hour', 'zone', 'payment_type')
+    if endpoint == 'time-series':
+        return args.get('interval', 'hour') in ('hour', 'day')
+    return False
+
+
+def _groupings(endpoint, args):
+    if endpoint == 'statistics':
+        group_by = args.get('group_by')
+        return ['overall'] + ([group_by] if group_by else [])
+    return [args.get('interval', 'hour')]
+
+
+def _group_key(session, grouping):
+    """SQL expression of the group key, or None for a single group."""
+    if grouping == 'hour':
+        return storage.hour_of(session, Trip.pickup_datetime)
+    if grouping == 'day':
+        return storage.date_of(session, Trip.pickup_datetime)
+    if grouping == 'zone':
+        return Trip.pickup_zone_id
+    if grouping == 'payment_type':
+        return Trip.payment_type_id
+    return None
+
+
+def _stored_sum(column):
+    """SUM of the stored values: integers for fixed-point columns, so shards add exactly."""
+    if storage.column_scale(column) != 1:
+        return func.sum(type_coerce(column, Integer))
+    return func.sum(column)
+
+
+# Per worker process: sessionmaker bound to a read-only engine of the
+# active dataset generation, with the API statement timeout
+_Session = None
+_engine = None
+
+
+def _init_worker():
+    _worker_session()
+
+
+def _worker_session():
+    """A session of the worker, on a new engine once the dataset generation changed."""
+    global _Session, _engine
+    db_url = get_database_url()
+    if _engine is None or _engine.url.render_as_string(hide_password=False) != db_url:
+        if _engine is not None:
+            # Shards run one at a time per worker, so no connection is in use
+            _engine.dispose()
+        _engine = admission.install_statement_timeouts(set_read_only(create_db_engine(db_url)))
+        _Session = sessionmaker(bind=_engine.execution_options(**admission.read_options()))
+    return _Session()
+
+
+def run_shard(groupings, filter_args, lower, upper):
+    """
+    Partial aggregates of the trips picked up in [lower, upper).
+
+    Runs in a pool worker.
+
+    Returns:
+        Dict grouping -> list of (key, count, sum, n, sum, n, ...) rows,
+        one sum/n pair per metric of the grouping
+    """
+    session = _worker_session()
+    try:
+        filters = queries.build_trip_filters(filter_args) + [
+            Trip.pickup_datetime >= lower, Trip.pickup_datetime < upper,
+        ]
+        partials = {}
+        for grouping in groupings:
+            key = _group_key(session, grouping)
+            columns = [func.count(Trip.trip_id)]
+            for metric in GROUPINGS[grouping]:
+                columns += [_stored_sum(METRICS[metric]), func.count(METRICS[metric])]
+            if key is None:
+                stmt = select(*columns).where(and_(*filters))
+                partials[grouping] = [(None,) + tuple(row) for row in session.execute(stmt)]
+            else:
+                stmt = select(key, *columns).where(and_(*filters)).group_by(key)
+                partials[grouping] = [tuple(row) for row in session.execute(stmt)]
+        return partials
+    finally:
+        session.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(workers):
+    """The process pool with `workers` processes, started on first use."""
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+            )
+            _pools[workers] = pool
+        return pool
+
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d') if value else None
+    except ValueError:
+        return None
+
+
+def shard_bounds(start, end, shards):
+    """
+    Split the days start..end (inclusive) into at most `shards` contiguous
+    ranges.
+
+    Returns:
+        List of (lower, upper) datetimes, upper exclusive
+    """
+    first = datetime(start.year, start.month, start.day)
+    days = (end.date() - first.date()).days + 1
+    shards = max(1, min(shards, days))
+    edges = [first + timedelta(days=days * i // shards) for i in range(shards + 1)]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+class Plan:
+    """
+    A sharded request: what each worker runs and what the parent needs to
+    shape the merged result.
+    """
+
+    def __init__(self, endpoint, args, shards, workers, dimensions):
+        self.endpoint = endpoint
+        self.args = args
+        self.groupings = _groupings(endpoint, args)
+        self.filter_args = {
+            name: args.get(name) for name in queries.TRIP_FILTER_PARAMS
+            if args.get(name) is not None
+        }
+        self.shards = shards
+        self.workers = workers
+        self.dimensions = dimensions
+
+
+def plan(session, endpoint, args, workers=None):
+    """
+    Shard a statistics or time-series request by pickup date.
+
+    Args:
+        session: Session used to find the date range when the request
+            leaves it open, and for the dimension cache
+        endpoint: 'statistics' or 'time-series'
+        args: Request arguments
+        workers: Pool size (default PARALLEL_WORKERS); also the shard count
+
+    Returns:
+        Plan for submit() and finish()
+    """
+    workers = workers or PARALLEL_WORKERS
+    start, end = _parse_date(args.get('start_date')), _parse_date(args.get('end_date'))
+    if start is None or end is None:
+        low, high = session.query(
+            func.min(Trip.pickup_datetime), func.max(Trip.pickup_datetime)
+        ).one()
+        start, end = start or low, end or high
+
+    shards = shard_bounds(start, end, workers) if start and end and start <= end else []
+    return Plan(endpoint, args, shards, workers, get_dimensions(session))
+
+
+def submit(request_plan):
+    """Start every shard of a plan on the pool; returns their futures in shard order."""
+    pool = get_pool(request_plan.workers)
+    return [
+        pool.submit(run_shard, request_plan.groupings, request_plan.filter_args, lower, upper)
+        for lower, upper in request_plan.shards
+    ]
+
+
+def merge(partials, grouping):
+    """
+    Combine shard partials of one grouping.
+
+    Returns:
+        Dict key -> {'count': int, '<metric>': (sum, n)}, sums in stored units
+    """
+    metrics = GROUPINGS[grouping]
+    counts, sums, ns = {}, {}, {}
+    for partial in partials:
+        for key, count, *pairs in partial[grouping]:
+            counts[key] = counts.get(key, 0) + count
+            key_sums = sums.setdefault(key, [[] for _ in metrics])
+            key_ns = ns.setdefault(key, [0] * len(metrics))
+            for i, (total, n) in enumerate(zip(pairs[::2], pairs[1::2])):
+                if total is not None:
+                    key_sums[i].append(total)
+                key_ns[i] += n
+    return {
+        key: dict(
+            {'count': counts[key]},
+            **{metric: (math.fsum(sums[key][i]), ns[key][i]) for i, metric in enumerate(metrics)}
+        )
+        for key in counts
+    }
+
+
+def _avg(group, metric):
+    """Rounded average in API units, computed as the serial AVG is."""
+    total, n = group[metric]
+    if not n:
+        return 0.0
+    return round(total / n / storage.column_scale(METRICS[metric]), 2)
+
+
+def _total(group, metric):
+    total, n = group[metric]
+    return round(total / storage.column_scale(METRICS[metric]), 2) if n else 0.0
+
+
+def _series_sums(group):
+    """Unrounded sums in API units behind a time-series point (queries.SERIES_SUMS)."""
+    sums = {'revenue_sum': group['revenue'][0] / storage.column_scale(METRICS['revenue'])}
+    for metric in ('fare', 'speed'):
+        total, n = group[metric]
+        sums[f'{metric}_sum'] = total / storage.column_scale(METRICS[metric])
+        sums[f'{metric}_n'] = n
+    return sums
+
+
+def _combine(groups, label):
+    """Re-key merged groups by label(key), summing groups with the same label; None labels drop."""
+    combined = {}
+    for key, group in groups.items():
+        name = label(key)
+        if name is None:
+            continue
+        if name not in combined:
+            combined[name] = dict(group)
+            continue
+        target = combined[name]
+        target['count'] += group['count']
+        for metric, (total, n) in group.items():
+            if metric != 'count':
+                target[metric] = (math.fsum((target[metric][0], total)), target[metric][1] + n)
+    return combined
+
+
+def finish(request_plan, partials):
+    """Merge the shard results of a plan into the endpoint's response body."""
+    dimensions = request_plan.dimensions
+    merged = {grouping: merge(partials, grouping) for grouping in request_plan.groupings}
+
+    if request_plan.endpoint == 'time-series':
+        grouping = request_plan.groupings[0]
+        label = 'hour' if grouping == 'hour' else 'date'
+        return {'time_series': [{
+            label: int(key) if grouping == 'hour' else str(key),
+            'trip_count': group['count'],
+            'avg_fare': _avg(group, 'fare'),
+            'avg_speed': _avg(group, 'speed'),
+            'total_revenue': _total(group, 'revenue'),
+            **_series_sums(group),
+        } for key, group in sorted(merged[grouping].items())]}
+
+    overall = merged['overall'].get(None)
+    if overall is None or not overall['count']:
+        overall = dict({'count': 0}, **{metric: (0.0, 0) for metric in GROUPINGS['overall']})
+    body = {
+        'overall': {
+            'total_trips': overall['count'],
+            'avg_fare': _avg(overall, 'fare'),
+            'avg_distance': _avg(overall, 'distance'),
+            'avg_duration': _avg(overall, 'duration'),
+            'avg_speed': _avg(overall, 'speed'),
+            'total_revenue': _total(overall, 'revenue'),
+        },
+        'grouped': [],
+    }
+
+    group_by = request_plan.args.get('group_by')
+    if group_by == 'hour':
+        body['grouped'] = [{
+            'hour': int(hour),
+            'trip_count': group['count'],
+            'avg_fare': _avg(group, 'fare'),
+            'avg_speed': _avg(group, 'speed'),
+        } for hour, group in sorted(merged['hour'].items())]
+
+    elif group_by == 'zone':
+        # Zones sharing a name and borough form one group, as in the serial query
+        def zone_label(zone_id):
+            zone = dimensions.zones.get(zone_id)
+            return (zone.zone_name, zone.borough) if zone else None
+        zones = _combine(merged['zone'], zone_label)
+        top = sorted(zones.items(), key=lambda item: (-item[1]['count'], item[0]))[:20]
+        body['grouped'] = [{
+            'zone_name': name,
+            'borough': borough,
+            'trip_count': group['count'],
+            'avg_fare': _avg(group, 'fare'),
+        } for (name, borough), group in top]
+
+    elif group_by == 'payment_type':
+        payments = _combine(merged['payment_type'], dimensions.payment_name)
+        body['grouped'] = [{
+            'payment_type': name,
+            'trip_count': group['count'],
+            'avg_fare': _avg(group, 'fare'),
+        } for name, group in sorted(payments.items())]
+
+    return body
+
+
+def run(session, endpoint, args, workers=None):
+    """Plan, run and merge a sharded request, waiting for the pool."""
+    request_plan = plan(session, endpoint, args, workers)
+    return finish(request_plan, [future.result() for future in submit(request_plan)])
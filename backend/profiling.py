@@ -0,0 +1,297 @@
+"""
+On-demand profiles of single requests, served at /debug/profiles.
+
+A request is profiled when it carries the header `X-Profile: <PROFILE_SECRET>`
+or, for /api requests, with probability PROFILE_SAMPLE_RATE. Two profilers
+are available (PROFILE_MODE, or `X-Profile-Mode` on a header-triggered
+request):
+
+- sample: a thread records the handler thread's stack every
+  PROFILE_INTERVAL_MS. Whole stacks, little overhead, but a request of a
+  few milliseconds gets few samples
+- cprofile: cProfile times every call, at a cost of roughly doubling the
+  CPU of Python-heavy requests. cProfile keeps caller/callee pairs rather
+  than stacks, so a function's time is split over its callers in
+  proportion to the time of each call edge. Flask only: under asgi.py the
+  queries run in greenlets (AsyncSession.run_sync), whose switches cProfile
+  takes for calls, so the ASGI app always samples
+
+Either way the profile is stored as collapsed stacks ("a;b;c weight" per
+line), the input of flamegraph.pl and speedscope, along with the method,
+path, status and duration. Each worker keeps its last PROFILE_RETENTION
+profiles, runs at most one profile at a time (a request arriving while one
+runs is not profiled) and returns the profile id in `X-Profile-Id`.
+
+Reading /debug/profiles always requires the same header, so sampling is
+off unless PROFILE_SECRET is set too. Without a secret app.py and asgi.py
+register no hooks and no /debug routes, so requests pay nothing.
+
+Usage:
+    curl -i -H "X-Profile: $PROFILE_SECRET" 'localhost:5000/api/statistics?group_by=zone'
+    curl -H "X-Profile: $PROFILE_SECRET" localhost:5000/debug/profiles
+    curl -H "X-Profile: $PROFILE_SECRET" localhost:5000/debug/profiles/<id> | flamegraph.pl > profile.svg
+"""
+
+import cProfile
+import functools
+import hmac
+import itertools
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime, timezone
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+PROFILE_SECRET = os.getenv('PROFILE_SECRET', '')
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_MODE = os.getenv('PROFILE_MODE', 'sample')
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', '1'))
+PROFILE_RETENTION = int(os.getenv('PROFILE_RETENTION', '50'))
+
+HEADER = 'X-Profile'
+MODE_HEADER = 'X-Profile-Mode'
+ID_HEADER = 'X-Profile-Id'
+MODES = ('sample', 'cprofile')
+
+# Call paths of a cProfile run shorter than this are dropped
+MIN_MICROSECONDS = 1
+
+PROFILES = metrics.Counter('request_profiles_total', 'Requests profiled, by trigger and mode')
+
+# Newest last; older profiles fall off beyond PROFILE_RETENTION
+_profiles = deque(maxlen=PROFILE_RETENTION)
+_ids = itertools.count(1)
+# Held while a request is profiled
+_running = threading.Lock()
+
+if PROFILE_MODE not in MODES:
+    logger.warning(f"Unknown PROFILE_MODE {PROFILE_MODE!r}; using 'sample'")
+    PROFILE_MODE = 'sample'
+if PROFILE_SAMPLE_RATE > 0 and not PROFILE_SECRET:
+    # Sampled profiles hold request paths and query strings, readable only with the secret
+    logger.warning("PROFILE_SAMPLE_RATE is set without PROFILE_SECRET; request sampling is off")
+    PROFILE_SAMPLE_RATE = 0.0
+
+PROFILE_ENABLED = bool(PROFILE_SECRET)
+
+
+def _secret_matches(value):
+    return bool(PROFILE_SECRET) and hmac.compare_digest((value or '').encode(), PROFILE_SECRET.encode())
+
+
+def can_read(secret):
+    """Whether a request with `X-Profile: secret` may read /debug/profiles."""
+    return _secret_matches(secret)
+
+
+# Longest first, so a frame is named relative to its innermost sys.path entry
+_PATH_PREFIXES = sorted({os.path.join(os.path.abspath(p), '') for p in sys.path}, key=len, reverse=True)
+
+
+@functools.lru_cache(maxsize=None)
+def _label(filename, lineno, name):
+    """Frame name in a collapsed stack: 'function (module path:line)'."""
+    if filename == '~':
+        # A C function in cProfile stats
+        label = name
+    else:
+        for prefix in _PATH_PREFIXES:
+            if filename.startswith(prefix):
+                filename = filename[len(prefix):]
+                break
+        label = f'{name} ({filename}:{lineno})'
+    return label.replace(';', ':')
+
+
+class _Sampler:
+    """Stacks of one thread, sampled from another."""
+
+    unit = 'samples'
+
+    def __init__(self, thread_id):
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, args=(thread_id, PROFILE_INTERVAL_MS / 1000), name='profile-sampler', daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self, thread_id, interval):
+        while not self._stopped.wait(interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(_label(code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        return self.stacks
+
+
+class _CallProfiler:
+    """cProfile on the calling thread, as collapsed stacks in microseconds."""
+
+    unit = 'microseconds'
+
+    def __init__(self, thread_id):
+        self._profiler = cProfile.Profile()
+
+    def start(self):
+        self._profiler.enable()
+
+    def stop(self):
+        self._profiler.disable()
+        self._profiler.create_stats()
+        return collapse_calls(self._profiler.stats)
+
+
+def collapse_calls(stats):
+    """
+    Collapsed stacks of cProfile stats.
+
+    Args:
+        stats: cProfile's {function: (calls, primitive calls, own time,
+            total time, {caller: (.., .., own time, total time)})}
+
+    Returns:
+        Counter of 'root;...;function' -> microseconds spent in the
+        function itself on that path
+    """
+    callees = {}
+    for function, (_, _, _, _, callers) in stats.items():
+        for caller in callers:
+            callees.setdefault(caller, []).append(function)
+
+    stacks = Counter()
+
+    def visit(function, path, functions, share):
+        # share: fraction of the function's time spent on this path
+        _, _, own, _, _ = stats[function]
+        path = path + (_label(*function),)
+        functions = functions | {function}
+        if own * share * 1e6 >= MIN_MICROSECONDS:
+            stacks[';'.join(path)] += own * share * 1e6
+        for callee in callees.get(function, ()):
+            # Recursive calls are already inside the outer call's time
+            if callee in functions:
+                continue
+            edge_time = stats[callee][4][function][3] * share
+            if edge_time * 1e6 >= MIN_MICROSECONDS:
+                visit(callee, path, functions, edge_time / stats[callee][3])
+
+    for function, (_, _, _, total, callers) in stats.items():
+        if not callers and total:
+            visit(function, (), frozenset(), 1.0)
+    return stacks
+
+
+PROFILERS = {'sample': _Sampler, 'cprofile': _CallProfiler}
+
+
+class RequestProfile:
+    """A running profile of one request; finish() stores it."""
+
+    def __init__(self, trigger, mode, method, path, query):
+        self.id = f'{os.getpid()}-{next(_ids)}'
+        self.trigger = trigger
+        self.mode = mode
+        self.method = method
+        self.path = path
+        self.query = query
+        self.started_at = datetime.now(timezone.utc)
+        self._started = time.perf_counter()
+        self._profiler = PROFILERS[mode](threading.get_ident())
+        self._profiler.start()
+
+    def finish(self, status):
+        """Stop profiling and keep the profile; `status` is None when the request failed."""
+        try:
+            duration_ms = (time.perf_counter() - self._started) * 1000
+            stacks = self._profiler.stop()
+            lines = [f'{stack} {round(weight)}' for stack, weight in sorted(stacks.items()) if round(weight)]
+            _profiles.append({
+                'id': self.id,
+                'method': self.method,
+                'path': self.path,
+                'query': self.query,
+                'status': status,
+                'trigger': self.trigger,
+                'mode': self.mode,
+                'unit': self._profiler.unit,
+                'started_at': self.started_at.isoformat(),
+                'duration_ms': round(duration_ms, 3),
+                'total': round(sum(stacks.values())),
+                'stacks': '\n'.join(lines) + '\n' if lines else '',
+            })
+            PROFILES.inc(trigger=self.trigger, mode=self.mode)
+        except Exception as e:
+            logger.warning(f"Profile {self.id} of {self.path} not stored: {e}")
+        finally:
+            _running.release()
+
+
+def begin(method, path, query='', secret=None, mode=None, modes=MODES):
+    """
+    Start profiling the current request if it asks for it or is sampled.
+
+    Args:
+        method: HTTP method
+        path: Request path
+        query: Query string, kept with the profile
+        secret: Value of the X-Profile header
+        mode: Value of the X-Profile-Mode header (honoured with the secret)
+        modes: Profilers the server supports, the first being its fallback
+
+    Returns:
+        The RequestProfile to finish when the response is ready, or None
+    """
+    if path.startswith('/debug/'):
+        return None
+    if _secret_matches(secret):
+        trigger = 'header'
+    elif PROFILE_SAMPLE_RATE > 0 and path.startswith('/api/') and random.random() < PROFILE_SAMPLE_RATE:
+        trigger = 'sample'
+        mode = None
+    else:
+        return None
+    if mode not in modes:
+        mode = PROFILE_MODE if PROFILE_MODE in modes else modes[0]
+    # One profile at a time: cProfile allows one profiler per thread, and a
+    # sampled burst must not profile every request at once
+    if not _running.acquire(blocking=False):
+        return None
+    try:
+        return RequestProfile(trigger, mode, method, path, query)
+    except Exception:
+        _running.release()
+        raise
+
+
+def list_profiles():
+    """Retained profiles without their stacks, newest first."""
+    return [
+        {key: value for key, value in profile.items() if key != 'stacks'}
+        for profile in reversed(list(_profiles))
+    ]
+
+
+def get_profile(profile_id):
+    """The retained profile `profile_id`, or None."""
+    for profile in list(_profiles):
+        if profile['id'] == profile_id:
+            return profile
+    return None
@@ -0,0 +1,784 @@
+"""
+Query logic shared by the WSGI (app.py) and ASGI (asgi.py) entry points.
+
+Each query function takes a synchronous SQLAlchemy session, the request
+arguments (any mapping with .get) and, where relevant, the filters already
+built by build_trip_filters, and returns the JSON-ready response body.
+Under ASGI the same functions run through AsyncSession.run_sync.
+"""
+
+import math
+import os
+from sqlalchemy import Integer, bindparam, func, and_, desc, select
+from datetime import datetime, timedelta
+from models import Trip, Zone, PaymentType, TripSample
+from algorithms import AnomalyDetector, TripGrouper
+from dimensions import get_dimensions, dataset_version
+import bitmaps
+import catalog
+import downsampling
+import parallel
+import sampling
+import sketches
+import statements
+import storage
+
+
+TRIP_FILTER_PARAMS = (
+    'start_date', 'end_date', 'min_fare', 'max_fare', 'min_distance',
+    'max_distance', 'pickup_zone_id', 'dropoff_zone_id', 'passenger_count',
+)
+
+
+# Trip filters that are also bitmap index dimensions
+TRIP_BITMAP_PARAMS = ('pickup_zone_id', 'dropoff_zone_id', 'passenger_count')
+
+# Trip filters the statistics catalog counts exactly (trip_count_stats); it
+# would estimate the others as independent, which correlated columns are not
+TRIP_CATALOG_PARAMS = ('start_date', 'end_date', 'pickup_zone_id')
+
+# Trip filters that select whole strata of the approx=true sample, whose
+# trips it counts exactly
+TRIP_STRATUM_PARAMS = ('start_date', 'end_date')
+
+# Largest limit of /api/trips, /api/anomalies, /api/top-routes and /api/summary
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', '1000'))
+# Largest /api/trips offset; deeper pages make the database skip that many rows
+MAX_OFFSET = int(os.getenv('MAX_OFFSET', '1000000'))
+# Take /api/trips total_count from the statistics catalog when the bitmap
+# index cannot count it and only date and zone filters are set, instead of
+# counting the filtered trips
+ESTIMATE_TRIP_COUNTS = os.getenv('ESTIMATE_TRIP_COUNTS', 'true').lower() == 'true'
+
+
+# /api/time-series metrics rolling= may name: sums get a rolling sum and
+# per-bucket mean, averages the mean of the trips in the window
+ROLLING_SUMS = ('trip_count', 'total_revenue')
+ROLLING_MEANS = ('avg_fare', 'avg_speed')
+# Unrounded fields of a time-series point that its rolling metrics are
+# computed from: a sum, or an average's (sum, non-NULL count). Every source
+# of a series adds them; finish_time_series drops them
+ROLLING_SOURCES = {'trip_count': 'trip_count', 'total_revenue': 'revenue_sum'}
+ROLLING_RATIOS = {'avg_fare': ('fare_sum', 'fare_n'), 'avg_speed': ('speed_sum', 'speed_n')}
+SERIES_SUMS = ('revenue_sum', 'fare_sum', 'fare_n', 'speed_sum', 'speed_n')
+MAX_ROLLING_WINDOW = 366
+
+
+class InvalidQuery(ValueError):
+    """Raised for request parameters that should produce a 400 response."""
+
+
+def page_param(args, name, default, maximum):
+    """
+    Integer paging parameter `name` between 0 and `maximum`.
+
+    Raises:
+        InvalidQuery: When the value is not an integer or is out of range
+    """
+    value = args.get(name)
+    if value in (None, ''):
+        return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise InvalidQuery(f'{name} must be an integer')
+    if not 0 <= value <= maximum:
+        raise InvalidQuery(f'{name} must be between 0 and {maximum}')
+    return value
+
+
+def build_trip_filters(args, model=Trip):
+    filters = []
+
+    value = args.get('start_date')
+    if value:
+        try:
+            start_date = datetime.strptime(value, '%Y-%m-%d')
+            filters.append(model.pickup_datetime >= start_date)
+        except ValueError:
+            pass
+
+    value = args.get('end_date')
+    if value:
+        try:
+            end_date = datetime.strptime(value, '%Y-%m-%d')
+            end_date = end_date.replace(hour=23, minute=59, second=59)
+            filters.append(model.pickup_datetime <= end_date)
+        except ValueError:
+            pass
+
+    value = args.get('min_fare')
+    if value not in (None, ''):
+        try:
+            filters.append(model.fare_amount >= float(value))
+        except ValueError:
+            pass
+
+    value = args.get('max_fare')
+    if value not in (None, ''):
+        try:
+            filters.append(model.fare_amount <= float(value))
+        except ValueError:
+            pass
+
+    value = args.get('min_distance')
+    if value not in (None, ''):
+        try:
+            filters.append(model.trip_distance >= float(value))
+        except ValueError:
+            pass
+
+    value = args.get('max_distance')
+    if value not in (None, ''):
+        try:
+            filters.append(model.trip_distance <= float(value))
+        except ValueError:
+            pass
+
+    value = args.get('pickup_zone_id')
+    if value not in (None, ''):
+        try:
+            filters.append(model.pickup_zone_id == int(value))
+        except ValueError:
+            pass
+
+    value = args.get('dropoff_zone_id')
+    if value not in (None, ''):
+        try:
+            filters.append(model.dropoff_zone_id == int(value))
+        except ValueError:
+            pass
+
+    value = args.get('passenger_count')
+    if value not in (None, ''):
+        try:
+            filters.append(model.passenger_count == int(value))
+        except ValueError:
+            pass
+
+    return filters
+
+
+def filter_dates(args):
+    """
+    Pickup dates the start_date/end_date filters select, as build_trip_filters reads them.
+
+    Returns:
+        (first, last) 'YYYY-MM-DD' dates, either None when unset or invalid
+    """
+    dates = []
+    for name in TRIP_STRATUM_PARAMS:
+        try:
+            dates.append(datetime.strptime(args.get(name) or '', '%Y-%m-%d').strftime('%Y-%m-%d'))
+        except ValueError:
+            dates.append(None)
+    return tuple(dates)
+
+
+def is_approx(args):
+    """True if the request asked for an approximate answer."""
+    return args.get('approx', 'false').lower() == 'true'
+
+
+def is_parallel(args, endpoint):
+    """True if the request asked for date-sharded execution and `endpoint` supports it."""
+    return args.get('parallel', 'false').lower() == 'true' and parallel.supports(endpoint, args)
+
+
+def api_index():
+    """Body of the API information endpoint."""
+    return {
+        'name': 'NYC Taxi Mobility Analytics API',
+        'version': '1.0.0',
+        'endpoints': {
+            'trips': '/api/trips',
+            'statistics': '/api/statistics',
+            'zones': '/api/zones',
+            'time_series': '/api/time-series',
+            'heatmap': '/api/heatmap',
+            'anomalies': '/api/anomalies',
+            'top_routes': '/api/top-routes',
+            'percentiles': '/api/percentiles',
+            'histogram2d': '/api/histogram2d',
+            'batch': '/api/batch',
+            'summary': '/api/summary',
+            'counts': '/api/counts'
+        }
+    }
+
+
+def query_trips(session, args, filters):
+    """Filtered, sorted and paginated trip records."""
+    # Zone IDs are foreign keys, so non-null IDs select the same trips an
+    # inner join on both zones would; names come from the dimension cache
+    def trips_with_zones(select_from, conditions):
+        return select_from.where(
+            Trip.pickup_zone_id.isnot(None),
+            Trip.dropoff_zone_id.isnot(None),
+            *conditions
+        )
+
+    # Get total count, from the bitmap index when it covers the filters,
+    # else from the statistics catalog when it counts them by date and zone
+    total_count = None
+    exact = True
+    if bitmaps.covers(args, TRIP_FILTER_PARAMS):
+        index = bitmaps.get_bitmap_index(session)
+        if index is not None:
+            total_count = index.count(
+                bitmaps.parse_predicates(args, TRIP_BITMAP_PARAMS),
+                not_null=('pickup_zone_id', 'dropoff_zone_id')
+            )
+    if total_count is None and ESTIMATE_TRIP_COUNTS and bitmaps.covers(args, TRIP_FILTER_PARAMS, TRIP_CATALOG_PARAMS):
+        stats = catalog.get_catalog(session)
+        if stats is not None:
+            total_count = stats.estimate_count(list(filters) + [
+                Trip.pickup_zone_id.isnot(None), Trip.dropoff_zone_id.isnot(None)
+            ])
+            exact = total_count is None
+    if total_count is None:
+        statement, params = statements.cached(
+            'trips_count', session, filters,
+            lambda conditions: trips_with_zones(select(func.count()).select_from(Trip), conditions)
+        )
+        total_count = session.execute(statement, params).scalar()
+
+    # Sorting
+    sort_by = args.get('sort_by', 'pickup_datetime')
+    sort_order = 'desc' if args.get('sort_order', 'desc') == 'desc' else 'asc'
+    if not hasattr(Trip, sort_by):
+        sort_by = sort_order = ''
+
+    def page(conditions):
+        query = trips_with_zones(select(Trip), conditions)
+        if sort_by:
+            order_column = getattr(Trip, sort_by)
+            query = query.order_by(desc(order_column) if sort_order == 'desc' else order_column)
+        # Bound, so that every page shares the statement
+        return query.limit(bindparam('limit', type_=Integer)).offset(bindparam('offset', type_=Integer))
+
+    # Pagination
+    limit = page_param(args, 'limit', 100, MAX_PAGE_SIZE)
+    offset = page_param(args, 'offset', 0, MAX_OFFSET)
+
+    statement, params = statements.cached(f'trips_page:{sort_by}:{sort_order}', session, filters, page)
+    trips = session.execute(statement, dict(params, limit=limit, offset=offset)).scalars().all()
+    dimensions = get_dimensions(session)
+
+    return {
+        'trips': [trip.to_dict(dimensions) for trip in trips],
+        'total_count': total_count,
+        'total_count_exact': exact,
+        'limit': limit,
+        'offset': offset
+    }
+
+
+def query_overall_statistics(session, filters):
+    """Overall aggregates for /api/statistics."""
+    statement, params = statements.cached('statistics', session, filters, lambda conditions: select(
+        func.count(Trip.trip_id).label('total_trips'),
+        func.avg(Trip.fare_amount).label('avg_fare'),
+        func.avg(Trip.trip_distance).label('avg_distance'),
+        func.avg(Trip.trip_duration).label('avg_duration'),
+        func.avg(Trip.trip_speed).label('avg_speed'),
+        func.sum(Trip.total_amount).label('total_revenue')
+    ).where(*conditions))
+
+    overall_stats = session.execute(statement, params).first()
+
+    return {
+        'total_trips': overall_stats.total_trips or 0,
+        'avg_fare': round(float(overall_stats.avg_fare or 0), 2),
+        'avg_distance': round(float(overall_stats.avg_distance or 0), 2),
+        'avg_duration': round(float(overall_stats.avg_duration or 0), 2),
+        'avg_speed': round(float(overall_stats.avg_speed or 0), 2),
+        'total_revenue': round(float(overall_stats.total_revenue or 0), 2)
+    }
+
+
+def query_grouped_statistics(session, filters, group_by):
+    """Grouped aggregates for /api/statistics ('hour', 'zone' or 'payment_type')."""
+    grouped_stats = []
+
+    if group_by == 'hour':
+        statement, params = statements.cached('statistics_hour', session, filters, lambda conditions: select(
+            storage.hour_of(session, Trip.pickup_datetime).label('hour'),
+            func.count(Trip.trip_id).label('trip_count'),
+            func.avg(Trip.fare_amount).label('avg_fare'),
+            func.avg(Trip.trip_speed).label('avg_speed')
+        ).where(*conditions).group_by('hour').order_by('hour'))
+
+        results = session.execute(statement, params).all()
+
+        grouped_stats = [{
+            'hour': int(r.hour),
+            'trip_count': r.trip_count,
+            'avg_fare': round(float(r.avg_fare or 0), 2),
+            'avg_speed': round(float(r.avg_speed or 0), 2)
+        } for r in results]
+
+    elif group_by == 'zone':
+        statement, params = statements.cached('statistics_zone', session, filters, lambda conditions: select(
+            Zone.zone_name,
+            Zone.borough,
+            func.count(Trip.trip_id).label('trip_count'),
+            func.avg(Trip.fare_amount).label('avg_fare')
+        ).select_from(Trip).join(Trip.pickup_zone).where(*conditions).group_by(
+            Zone.zone_name, Zone.borough
+        ).order_by(desc('trip_count')).limit(20))
+
+        results = session.execute(statement, params).all()
+
+        grouped_stats = [{
+            'zone_name': r.zone_name,
+            'borough': r.borough,
+            'trip_count': r.trip_count,
+            'avg_fare': round(float(r.avg_fare or 0), 2)
+        } for r in results]
+
+    elif group_by == 'payment_type':
+        statement, params = statements.cached('statistics_payment_type', session, filters, lambda conditions: select(
+            PaymentType.payment_name,
+            func.count(Trip.trip_id).label('trip_count'),
+            func.avg(Trip.fare_amount).label('avg_fare')
+        ).select_from(Trip).join(Trip.payment_type).where(*conditions).group_by(PaymentType.payment_name))
+
+        results = session.execute(statement, params).all()
+
+        grouped_stats = [{
+            'payment_type': r.payment_name,
+            'trip_count': r.trip_count,
+            'avg_fare': round(float(r.avg_fare or 0), 2)
+        } for r in results]
+
+    return grouped_stats
+
+
+def query_approximate_statistics(session, args):
+    """approx=true variant of /api/statistics; None without a sample of the filtered dates."""
+    return sampling.approximate_statistics(
+        session,
+        build_trip_filters(args, TripSample),
+        args.get('group_by'),
+        filter_dates(args),
+        bitmaps.covers(args, TRIP_FILTER_PARAMS, TRIP_STRATUM_PARAMS)
+    )
+
+
+def query_statistics(session, args, filters):
+    """Body of /api/statistics."""
+    if is_approx(args):
+        result = query_approximate_statistics(session, args)
+        if result is not None:
+            return result
+        # Without a sample of these dates the answer is exact, and says so
+        return dict(_exact_statistics(session, args, filters), approximate=None)
+    return _exact_statistics(session, args, filters)
+
+
+def _exact_statistics(session, args, filters):
+    if is_parallel(args, 'statistics'):
+        return parallel.run(session, 'statistics', args)
+
+    return {
+        'overall': query_overall_statistics(session, filters),
+        'grouped': query_grouped_statistics(session, filters, args.get('group_by'))
+    }
+
+
+def query_zones(session):
+    """Body of /api/zones, from the dimension cache."""
+    return get_dimensions(session).zones_body()
+
+
+def rolling_params(args):
+    """
+    (window, metrics) of a time-series request, or None without window=.
+
+    Raises:
+        InvalidQuery: For a window outside 1..MAX_ROLLING_WINDOW, an unknown
+            metric, or rolling= without window=
+    """
+    rolling = args.get('rolling')
+    if args.get('window') in (None, ''):
+        if rolling:
+            raise InvalidQuery('rolling requires window')
+        return None
+    try:
+        window = int(args['window'])
+    except (TypeError, ValueError):
+        raise InvalidQuery('window must be an integer')
+    if not 1 <= window <= MAX_ROLLING_WINDOW:
+        raise InvalidQuery(f'window must be between 1 and {MAX_ROLLING_WINDOW}')
+    metrics = [m.strip() for m in rolling.split(',') if m.strip()] if rolling else []
+    unknown = set(metrics) - set(ROLLING_SUMS + ROLLING_MEANS)
+    if unknown:
+        raise InvalidQuery(f"rolling must name: {', '.join(ROLLING_SUMS + ROLLING_MEANS)}")
+    return window, metrics or list(ROLLING_SUMS + ROLLING_MEANS)
+
+
+def fill_gaps(series, interval):
+    """
+    Time series with an empty bucket for every hour of the day, or every
+    date between the first and last, that had no trips.
+    """
+    label = 'hour' if interval == 'hour' else 'date'
+    present = {point[label]: point for point in series}
+    if interval == 'hour':
+        units = range(24)
+    elif series:
+        first = datetime.strptime(series[0]['date'], '%Y-%m-%d')
+        last = datetime.strptime(series[-1]['date'], '%Y-%m-%d')
+        units = [(first + timedelta(days=d)).strftime('%Y-%m-%d') for d in range((last - first).days + 1)]
+    else:
+        units = []
+    empty = {'trip_count': 0, 'avg_fare': 0.0, 'avg_speed': 0.0, 'total_revenue': 0.0}
+    empty.update({field: 0 for field in SERIES_SUMS})
+    return [present.get(unit) or {label: unit, **empty} for unit in units]
+
+
+def apply_rolling(body, interval, params):
+    """
+    Add rolling metrics (see rolling_params) to a time-series body, over
+    the gap-filled series so that windows span calendar buckets.
+    """
+    if params is None:
+        return body
+    window, metrics = params
+    series = TripGrouper.rolling_window(
+        fill_gaps(body['time_series'], interval), window,
+        {m: ROLLING_SOURCES[m] for m in metrics if m in ROLLING_SUMS},
+        {m: ROLLING_RATIOS[m] for m in metrics if m in ROLLING_MEANS}
+    )
+    for point in series:
+        for metric in metrics:
+            for key in (f'{metric}_rolling_sum', f'{metric}_rolling_mean'):
+                if key in point and key != 'trip_count_rolling_sum':
+                    # `or 0.0`: running totals can leave -0.0
+                    point[key] = round(float(point[key]), 2) or 0.0
+    return dict(body, time_series=series, rolling={'window': window, 'metrics': metrics})
+
+
+def downsample_params(args):
+    """
+    (max_points, metric) of a time-series request, or None without max_points=.
+
+    Raises:
+        InvalidQuery: For max_points below downsampling.MIN_POINTS or an
+            unknown downsample_by metric
+    """
+    if args.get('max_points') in (None, ''):
+        return None
+    try:
+        max_points = int(args['max_points'])
+    except (TypeError, ValueError):
+        raise InvalidQuery('max_points must be an integer')
+    if max_points < downsampling.MIN_POINTS:
+        raise InvalidQuery(f'max_points must be at least {downsampling.MIN_POINTS}')
+    metric = args.get('downsample_by') or 'trip_count'
+    if metric not in ROLLING_SUMS + ROLLING_MEANS:
+        raise InvalidQuery(f"downsample_by must be one of: {', '.join(ROLLING_SUMS + ROLLING_MEANS)}")
+    return max_points, metric
+
+
+def time_series_params(args):
+    """Post-processing of a time-series request: (rolling_params, downsample_params)."""
+    return rolling_params(args), downsample_params(args)
+
+
+def finish_time_series(body, interval, params):
+    """
+    Apply time_series_params to a time-series body: rolling metrics over the
+    full series first, then LTTB downsampling of the result. The points'
+    SERIES_SUMS are dropped either way.
+    """
+    rolling, downsample = params
+    body = apply_rolling(body, interval, rolling)
+    body = dict(body, time_series=[
+        {key: value for key, value in point.items() if key not in SERIES_SUMS}
+        for point in body['time_series']
+    ])
+    if downsample is None or len(body['time_series']) <= downsample[0]:
+        return body
+    max_points, metric = downsample
+    return dict(
+        body,
+        time_series=downsampling.downsample_series(body['time_series'], interval, max_points, metric),
+        downsampled={'points': len(body['time_series']), 'max_points': max_points, 'metric': metric}
+    )
+
+
+def query_time_series(session, args, filters):
+    """Body of /api/time-series, with rolling metrics and downsampling when requested."""
+    interval = args.get('interval', 'hour')
+    params = time_series_params(args)
+    return finish_time_series(_time_series(session, args, filters, interval), interval, params)
+
+
+def _time_series(session, args, filters, interval):
+    if is_approx(args):
+        result = sampling.approximate_time_series(
+            session,
+            build_trip_filters(args, TripSample),
+            interval,
+            filter_dates(args),
+            bitmaps.covers(args, TRIP_FILTER_PARAMS, TRIP_STRATUM_PARAMS)
+        )
+        if result is not None:
+            return result
+        # Without a sample of these dates the answer is exact, and says so
+        return dict(_exact_time_series(session, args, filters, interval), approximate=None)
+    return _exact_time_series(session, args, filters, interval)
+
+
+def _exact_time_series(session, args, filters, interval):
+    if is_parallel(args, 'time-series'):
+        return parallel.run(session, 'time-series', args)
+
+    time_series = []
+
+    # Build query based on interval
+    if interval == 'hour':
+        statement, params = statements.cached('time_series_hour', session, filters, lambda conditions: select(
+            storage.hour_of(session, Trip.pickup_datetime).label('time_unit'),
+            func.count(Trip.trip_id).label('trip_count'),
+            func.sum(Trip.fare_amount).label('fare_sum'),
+            func.count(Trip.fare_amount).label('fare_n'),
+            func.sum(Trip.trip_speed).label('speed_sum'),
+            func.count(Trip.trip_speed).label('speed_n'),
+            func.sum(Trip.total_amount).label('total_revenue')
+        ).where(*conditions).group_by('time_unit').order_by('time_unit'))
+
+        results = session.execute(statement, params).all()
+
+        time_series = [{'hour': int(r.time_unit), **_series_point(r)} for r in results]
+
+    elif interval == 'day':
+        statement, params = statements.cached('time_series_day', session, filters, lambda conditions: select(
+            storage.date_of(session, Trip.pickup_datetime).label('date'),
+            func.count(Trip.trip_id).label('trip_count'),
+            func.sum(Trip.fare_amount).label('fare_sum'),
+            func.count(Trip.fare_amount).label('fare_n'),
+            func.sum(Trip.trip_speed).label('speed_sum'),
+            func.count(Trip.trip_speed).label('speed_n'),
+            func.sum(Trip.total_amount).label('total_revenue')
+        ).where(*conditions).group_by('date').order_by('date'))
+
+        results = session.execute(statement, params).all()
+
+        time_series = [{'date': str(r.date), **_series_point(r)} for r in results]
+
+    return {'time_series': time_series}
+
+
+def _series_point(r):
+    """Metrics of a time-series row, with the SERIES_SUMS they come from."""
+    fare_sum, speed_sum = float(r.fare_sum or 0), float(r.speed_sum or 0)
+    revenue = float(r.total_revenue or 0)
+    return {
+        'trip_count': r.trip_count,
+        'avg_fare': round(fare_sum / r.fare_n, 2) if r.fare_n else 0.0,
+        'avg_speed': round(speed_sum / r.speed_n, 2) if r.speed_n else 0.0,
+        'total_revenue': round(revenue, 2),
+        'revenue_sum': revenue,
+        'fare_sum': fare_sum,
+        'fare_n': r.fare_n,
+        'speed_sum': speed_sum,
+        'speed_n': r.speed_n,
+    }
+
+
+def query_heatmap_side(session, filters, side, args=None):
+    """
+    One half of /api/heatmap: top 50 zones by 'pickup' or 'dropoff' count.
+
+    When `args` is given and its filters are all bitmap dimensions, the
+    counts come from the bitmap index instead of a scan.
+    """
+    zone_column = Trip.pickup_zone_id if side == 'pickup' else Trip.dropoff_zone_id
+
+    counts = None
+    if args is not None and bitmaps.covers(args, TRIP_FILTER_PARAMS):
+        index = bitmaps.get_bitmap_index(session)
+        if index is not None:
+            counts = index.group_counts(
+                zone_column.key, bitmaps.parse_predicates(args, TRIP_BITMAP_PARAMS)
+            ).items()
+
+    if counts is None:
+        statement, params = statements.cached(f'heatmap:{side}', session, filters, lambda conditions: select(
+            zone_column.label('zone_id'),
+            func.count(Trip.trip_id).label('count')
+        ).where(zone_column.isnot(None), *conditions).group_by(zone_column))
+
+        counts = session.execute(statement, params).all()
+
+    # Grouping on the trip column needs no join; names come from the cache
+    dimensions = get_dimensions(session)
+    ranked = sorted(
+        ((zone_id, count) for zone_id, count in counts if zone_id in dimensions.zones),
+        key=lambda item: (-item[1], item[0])
+    )
+    return [{
+        'zone_id': zone_id,
+        'zone_name': dimensions.zone_name(zone_id),
+        'borough': dimensions.zone_borough(zone_id),
+        'count': count
+    } for zone_id, count in ranked[:50]]
+
+
+def query_heatmap(session, args, filters):
+    """Body of /api/heatmap."""
+    return {
+        'pickup': query_heatmap_side(session, filters, 'pickup', args),
+        'dropoff': query_heatmap_side(session, filters, 'dropoff', args)
+    }
+
+
+def query_counts(session, args, filters):
+    """
+    Body of /api/counts: trip counts per value of one bitmap dimension.
+
+    Besides the usual trip filters, every dimension in bitmaps.DIMENSIONS
+    (including 'hour' and 'weekday', 0 = Sunday) can be filtered on, with
+    comma-separated values ORed. Answered from the bitmap index when the
+    filters are all dimensions, by a GROUP BY otherwise.
+    """
+    group_by = args.get('group_by', 'pickup_zone_id')
+    if group_by not in bitmaps.DIMENSIONS:
+        raise InvalidQuery(f"group_by must be one of: {', '.join(bitmaps.DIMENSIONS)}")
+    predicates = bitmaps.parse_predicates(args, multi=True)
+
+    index = None
+    if bitmaps.covers(args, TRIP_FILTER_PARAMS):
+        index = bitmaps.get_bitmap_index(session)
+
+    if index is not None:
+        source = 'bitmap'
+        counts = index.group_counts(group_by, predicates)
+        total_count = index.count(predicates)
+    else:
+        source = 'exact'
+        columns = bitmaps.dimension_columns(session)
+        # Dimension predicates replace the single-value filters built from args
+        conditions = list(filters)
+        if predicates:
+            conditions = build_trip_filters({k: v for k, v in args.items() if k not in predicates})
+            conditions += [columns[name].in_(values) for name, values in predicates.items()]
+
+        group_column = columns[group_by].label('value')
+        query = session.query(group_column, func.count(Trip.trip_id).label('count'))
+        total_query = session.query(func.count(Trip.trip_id))
+        if conditions:
+            query = query.filter(and_(*conditions))
+            total_query = total_query.filter(and_(*conditions))
+        counts = {
+            int(r.value): r.count
+            for r in query.filter(group_column.isnot(None)).group_by('value').all()
+        }
+        total_count = total_query.scalar()
+
+    return {
+        'group_by': group_by,
+        'counts': [{'value': value, 'count': count} for value, count in sorted(counts.items())],
+        'total_count': total_count,
+        'source': source
+    }
+
+
+def query_anomalies(session, args):
+    """Body of /api/anomalies."""
+    field = args.get('field', 'fare_amount')
+    threshold = float(args.get('threshold', 3.0))
+    limit = page_param(args, 'limit', 100, MAX_PAGE_SIZE)
+
+    # Fetch sample of trips
+    trips = session.query(Trip).limit(10000).all()
+    dimensions = get_dimensions(session)
+    trips_data = [trip.to_dict(dimensions) for trip in trips]
+
+    # Use custom anomaly detection algorithm
+    anomalies = AnomalyDetector.detect_outliers(trips_data, field, threshold)
+
+    return {
+        'anomalies': anomalies[:limit],
+        'total_anomalies': len(anomalies),
+        'field': field,
+        'threshold': threshold
+    }
+
+
+def query_top_routes(session, args):
+    """Body of /api/top-routes."""
+    limit = page_param(args, 'limit', 20, MAX_PAGE_SIZE)
+
+    statement, params = statements.cached('top_routes', session, (), lambda conditions: select(
+        Trip.pickup_zone_id,
+        func.count(Trip.trip_id).label('trip_count'),
+        func.avg(Trip.fare_amount).label('avg_fare'),
+        func.avg(Trip.trip_distance).label('avg_distance')
+    ).where(Trip.pickup_zone_id.isnot(None)).group_by(
+        Trip.pickup_zone_id
+    ).order_by(desc('trip_count')))
+    results = session.execute(statement, params).all()
+
+    dimensions = get_dimensions(session)
+    return {'routes': [{
+        'pickup_zone': dimensions.zone_name(r.pickup_zone_id),
+        'pickup_zone_id': r.pickup_zone_id,
+        'trip_count': r.trip_count,
+        'avg_fare': round(float(r.avg_fare or 0), 2),
+        'avg_distance': round(float(r.avg_distance or 0), 2)
+    } for r in results if r.pickup_zone_id in dimensions.zones][:limit]}
+
+
+def query_percentiles(session, args, filters):
+    """Body of /api/percentiles."""
+    metrics = [
+        m for m in args.get('metrics', ','.join(sketches.SKETCH_METRICS)).split(',')
+        if m in sketches.SKETCH_METRICS
+    ]
+    try:
+        percentiles = [
+            float(p) for p in args.get('percentiles', '50,90,99').split(',')
+            if p.strip()
+        ]
+    except ValueError:
+        raise InvalidQuery('percentiles must be numbers')
+    if not metrics or any(not math.isfinite(p) or p < 0 or p > 100 for p in percentiles):
+        raise InvalidQuery('Invalid metrics or percentiles')
+
+    result = None
+    sketches_merged = 0
+    if sketches.sketches_cover(args, TRIP_FILTER_PARAMS):
+        answer = sketches.sketch_percentiles(session, args, metrics, percentiles)
+        if answer is not None:
+            result, sketches_merged = answer
+
+    source = 'sketch'
+    if result is None:
+        source = 'exact'
+        result = sketches.exact_percentiles(session, filters, metrics, percentiles)
+
+    return {
+        'percentiles': result,
+        'source': source,
+        'sketches_merged': sketches_merged
+    }
+
+
+def query_health(session):
+    """Body of /health; the trip count comes from the statistics catalog when it is built."""
+    # Reading the version also checks the connection
+    stats = catalog.get_catalog(session, dataset_version(session))
+    if stats is not None:
+        trip_count = stats.trip_count
+    else:
+        trip_count = session.query(func.count(Trip.trip_id)).scalar()
+
+    return {
+        'status': 'healthy',
+        'database': 'connected',
+        'trip_count': trip_count
+    }
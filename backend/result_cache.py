@@ -0,0 +1,271 @@
+"""
+Result cache shared by every worker on a host, in a local SQLite file.
+
+Aggregate responses are stored as encoded JSON bodies (gzip-compressed with
+RESULT_CACHE_GZIP) under the endpoint, its normalized arguments (see
+coalesce.request_key) and the dataset version, so an ingest makes every
+earlier entry unreachable without a purge. Workers share one file instead
+of each warming a private in-memory cache; SQLite's WAL mode lets them read
+while one of them writes.
+
+Entries are evicted least recently used first once the stored bodies
+exceed RESULT_CACHE_MAX_BYTES. A hit refreshes its use time at most once
+per TOUCH_INTERVAL seconds, so hot entries do not turn every read into a
+write.
+
+At startup the responses the Dashboard, Drivers and Revenues pages request
+with their default filters (WARM_REQUESTS) are computed once, unless
+another worker already stored them for the current version.
+
+The file defaults to <SQLITE_DB_PATH>.results, or backend/result_cache.db
+for PostgreSQL.
+"""
+
+import fcntl
+import gzip
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+from models import generation_name, on_dataset_switch
+
+logger = logging.getLogger(__name__)
+
+RESULT_CACHE = os.getenv('RESULT_CACHE', 'true').lower() == 'true'
+RESULT_CACHE_PATH = os.getenv('RESULT_CACHE_PATH')
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+RESULT_CACHE_GZIP = os.getenv('RESULT_CACHE_GZIP', 'true').lower() == 'true'
+RESULT_CACHE_WARM = os.getenv('RESULT_CACHE_WARM', 'true').lower() == 'true'
+
+TOUCH_INTERVAL = 1.0
+GZIP_LEVEL = 6
+
+# (endpoint, path, args) requested by the frontend pages with default filters
+WARM_REQUESTS = (
+    ('summary', '/api/summary', {'limit': '10'}),        # Dashboard
+    ('statistics', '/api/statistics', {}),               # Drivers, Revenues
+    ('time-series', '/api/time-series', {'interval': 'day'}),  # Revenues
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT NOT NULL,
+    version TEXT NOT NULL,
+    content_type TEXT NOT NULL,
+    encoding TEXT,
+    body BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL,
+    PRIMARY KEY (key, version)
+);
+CREATE INDEX IF NOT EXISTS ix_results_used ON results (used);
+"""
+
+LOOKUPS = metrics.Counter('result_cache_lookups_total', 'Result cache lookups by endpoint and outcome')
+
+
+def cache_path(session):
+    """File holding the result cache of the session's database."""
+    if RESULT_CACHE_PATH:
+        return RESULT_CACHE_PATH
+    url = session.get_bind().url
+    if url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:'):
+        return os.path.abspath(url.database) + '.results'
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), generation_name('result_cache', url) + '.db')
+
+
+class Entry:
+    """
+    A cached response body.
+
+    Attributes:
+        body: Stored bytes, gzip-compressed when encoding is 'gzip'
+        encoding: 'gzip' or None
+        content_type: Content-Type of the response
+    """
+
+    def __init__(self, body, encoding, content_type):
+        self.body = body
+        self.encoding = encoding
+        self.content_type = content_type
+
+    def encoded(self, accept_gzip):
+        """
+        The body and headers to send to a client.
+
+        Args:
+            accept_gzip: Whether the request's Accept-Encoding allows gzip
+
+        Returns:
+            (body bytes, headers dict)
+        """
+        headers = {'Content-Type': self.content_type, 'Vary': 'Accept-Encoding'}
+        if self.encoding == 'gzip':
+            if accept_gzip:
+                headers['Content-Encoding'] = 'gzip'
+                return self.body, headers
+            return gzip.decompress(self.body), headers
+        return self.body, headers
+
+
+class ResultCache:
+    """
+    Size-bounded LRU cache of response bodies in a SQLite file.
+
+    Args:
+        path: Cache file, created on first use
+        max_bytes: Largest total size of the stored bodies
+        compress: Whether to store bodies gzip-compressed
+    """
+
+    def __init__(self, path, max_bytes=RESULT_CACHE_MAX_BYTES, compress=RESULT_CACHE_GZIP):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self._local = threading.local()
+
+    def _connection(self):
+        """This thread's connection to the cache file."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(SCHEMA)
+            self._local.connection = connection
+        return connection
+
+    def get(self, key, version):
+        """The Entry stored for key at `version`, or None."""
+        connection = self._connection()
+        row = connection.execute(
+            'SELECT content_type, encoding, body, used FROM results WHERE key = ? AND version = ?',
+            (key, version)
+        ).fetchone()
+        if row is None:
+            return None
+        content_type, encoding, body, used = row
+        now = time.time()
+        if now - used > TOUCH_INTERVAL:
+            try:
+                connection.execute(
+                    'UPDATE results SET used = ? WHERE key = ? AND version = ?', (now, key, version)
+                )
+            except sqlite3.OperationalError as e:
+                # Another worker holds the write lock; the use time can wait
+                logger.debug(f"Result cache touch skipped: {e}")
+        return Entry(body, encoding, content_type)
+
+    def put(self, key, version, body, content_type):
+        """Store a response body and evict the least recently used entries beyond max_bytes."""
+        encoding = None
+        if self.compress:
+            body, encoding = gzip.compress(body, GZIP_LEVEL), 'gzip'
+        if len(body) > self.max_bytes:
+            return
+        try:
+            connection = self._connection()
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, version, content_type, encoding, body, len(body), time.time())
+            )
+            self._evict(connection)
+            connection.execute('COMMIT')
+        except sqlite3.Error as e:
+            connection = getattr(self._local, 'connection', None)
+            if connection is not None and connection.in_transaction:
+                connection.execute('ROLLBACK')
+            logger.warning(f"Result not cached: {e}")
+
+    def _evict(self, connection):
+        total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        freed = 0
+        victims = []
+        for key, version, size in connection.execute(
+            'SELECT key, version, size FROM results ORDER BY used'
+        ):
+            victims.append((key, version))
+            freed += size
+            if freed >= excess:
+                break
+        connection.executemany('DELETE FROM results WHERE key = ? AND version = ?', victims)
+
+    def purge(self, keep_version):
+        """Delete the entries of every other dataset version."""
+        self._connection().execute('DELETE FROM results WHERE version != ?', (keep_version,))
+
+    def stats(self):
+        """Entry count and stored bytes."""
+        entries, size = self._connection().execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results'
+        ).fetchone()
+        return {'entries': entries, 'bytes': size}
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(session):
+    """The shared result cache of the session's database, or None when disabled."""
+    if not RESULT_CACHE:
+        return None
+    path = cache_path(session)
+    cache = _caches.get(path)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.setdefault(path, ResultCache(path))
+    return cache
+
+
+@on_dataset_switch
+def invalidate():
+    """Forget the caches opened so far; another dataset generation has its own file."""
+    with _caches_lock:
+        _caches.clear()
+
+
+def lookup(cache, endpoint, key, version):
+    """cache.get, counted in metrics as a hit or miss of `endpoint`; a cache error is a miss."""
+    try:
+        entry = cache.get(key, version)
+    except sqlite3.Error as e:
+        logger.warning(f"Result cache lookup failed: {e}")
+        entry = None
+    LOOKUPS.inc(endpoint=endpoint, outcome='hit' if entry is not None else 'miss')
+    return entry
+
+
+def warm(cache, version, fetch):
+    """
+    Compute the WARM_REQUESTS responses missing at `version`.
+
+    Workers warm one at a time under a file lock next to the cache, so the
+    first computes each response and the others find it stored.
+
+    Args:
+        cache: ResultCache
+        version: Current dataset version
+        fetch: Callable(path, args) issuing the request through the app's
+            cached route, which stores the response
+    """
+    started = time.perf_counter()
+    with open(cache.path + '.warm.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            cache.purge(version)
+            for endpoint, path, args in WARM_REQUESTS:
+                try:
+                    fetch(path, args)
+                except Exception as e:
+                    logger.warning(f"Could not warm {path}: {e}")
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    logger.info(f"Result cache warmed in {time.perf_counter() - started:.1f}s")
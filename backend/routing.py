@@ -0,0 +1,309 @@
+"""
+Read/write routing between the primary database and read replicas.
+
+Ingestion and every other write go to the primary (models.get_engine /
+get_session). API reads go through get_read_session, which picks one of the
+replicas listed in READ_REPLICA_URLS at random, weighted by
+READ_REPLICA_WEIGHTS, so a bulk load on the primary does not compete with
+dashboard queries.
+
+Replicas are checked at most every REPLICA_CHECK_INTERVAL seconds, from the
+request that finds the last check expired. A replica is used only if
+
+- it answers a query (otherwise it is unhealthy until the next check),
+- its dataset version (see dimensions.py) equals the primary's, so it
+  serves the data of the last ingest and not the one before, and
+- on PostgreSQL, its replay lag is at most REPLICA_MAX_LAG_SECONDS.
+
+When no replica qualifies, reads fall back to the primary. Replica
+connections are read-only, and read sessions carry the statement timeout
+of admission.py.
+
+Replicas can be SQLite copies of the primary, which makes the routing
+testable without a replication setup:
+
+    python routing.py --db bench_1m.db --sync bench_1m.replica1.db bench_1m.replica2.db
+    READ_REPLICA_URLS=sqlite:///bench_1m.replica1.db,sqlite:///bench_1m.replica2.db python app.py
+    python routing.py --db bench_1m.db --status
+
+--sync copies the database with SQLite's online backup, together with its
+bitmap index and snapshot directories; until a copy is synced again after
+an ingest, its version lags and reads stay on the primary.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import threading
+import time
+
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+
+from models import (
+    COMPACT_STORAGE, create_db_engine, get_database_url, get_engine, on_dataset_switch, set_read_only,
+)
+from dimensions import dataset_version
+import admission
+import storage
+
+logger = logging.getLogger(__name__)
+
+READ_REPLICA_URLS = os.getenv('READ_REPLICA_URLS', '')
+READ_REPLICA_WEIGHTS = os.getenv('READ_REPLICA_WEIGHTS', '')
+REPLICA_CHECK_INTERVAL = float(os.getenv('REPLICA_CHECK_INTERVAL', '5'))
+REPLICA_MAX_LAG_SECONDS = float(os.getenv('REPLICA_MAX_LAG_SECONDS', '30'))
+
+# Replay lag of a PostgreSQL standby; 0 when it has replayed all it
+# received, so an idle primary does not make its standbys look stale
+PG_LAG_SQL = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() "
+    "OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+# Directories derived from a SQLite database that --sync copies alongside it
+DERIVED_SUFFIXES = ('.bitmaps', '.snapshot')
+
+
+class Replica:
+    """
+    One read replica and the outcome of its last check.
+
+    Attributes:
+        engine: Read-only engine
+        weight: Relative share of reads
+        healthy: Whether the last check could query it
+        version: Dataset version seen by the last check
+        lag_seconds: Replay lag (PostgreSQL), None where not measured
+        usable: Whether reads may go to it
+        error: Reason it is not usable, if any
+    """
+
+    def __init__(self, engine, weight):
+        self.engine = engine
+        self.weight = weight
+        self.healthy = False
+        self.version = None
+        self.lag_seconds = None
+        self.usable = False
+        self.error = 'not checked yet'
+
+    def check(self, primary_version, max_lag):
+        """Query the replica and decide whether it may serve reads."""
+        session = sessionmaker(bind=self.engine)()
+        try:
+            self.version = dataset_version(session)
+            self.lag_seconds = None
+            if self.engine.dialect.name == 'postgresql':
+                self.lag_seconds = float(session.execute(PG_LAG_SQL).scalar() or 0)
+            self.healthy = True
+        except Exception as e:
+            self.healthy = False
+            self.usable = False
+            self.error = str(e)
+            return
+        finally:
+            session.close()
+
+        if self.version != primary_version:
+            self.usable = False
+            self.error = f'dataset version {self.version}, primary has {primary_version}'
+        elif self.lag_seconds is not None and self.lag_seconds > max_lag:
+            self.usable = False
+            self.error = f'replication lag {self.lag_seconds:.1f}s'
+        else:
+            self.usable = True
+            self.error = None
+
+    def status(self):
+        return {
+            'url': self.engine.url.render_as_string(hide_password=True),
+            'weight': self.weight,
+            'healthy': self.healthy,
+            'usable': self.usable,
+            'version': self.version,
+            'lag_seconds': self.lag_seconds,
+            'error': self.error,
+        }
+
+
+class EngineRouter:
+    """
+    Primary engine for writes and weighted read replicas with fallback.
+
+    Args:
+        primary: Engine of the primary database
+        replicas: List of Replica
+        check_interval: Seconds between replica checks
+        max_lag: Largest replay lag, in seconds, of a usable replica
+        read_options: Execution options of the engines reader() returns
+    """
+
+    def __init__(self, primary, replicas, check_interval=REPLICA_CHECK_INTERVAL,
+                 max_lag=REPLICA_MAX_LAG_SECONDS, read_options=None):
+        self.primary = primary
+        self.replicas = replicas
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self.checked_at = None
+        self._lock = threading.Lock()
+        self._readers = {
+            engine: engine.execution_options(**read_options) if read_options else engine
+            for engine in [primary] + [replica.engine for replica in replicas]
+        }
+
+    def writer(self):
+        """Engine for ingestion and other writes."""
+        return self.primary
+
+    def reader(self):
+        """Engine for one read: a usable replica chosen by weight, else the primary."""
+        if not self.replicas:
+            return self._readers[self.primary]
+        if self.checked_at is None or time.monotonic() - self.checked_at >= self.check_interval:
+            # One request runs the check; the others use the last result
+            if self._lock.acquire(blocking=self.checked_at is None):
+                try:
+                    self.check()
+                finally:
+                    self._lock.release()
+
+        usable = [replica for replica in self.replicas if replica.usable]
+        if not usable:
+            return self._readers[self.primary]
+        chosen = random.choices(usable, weights=[replica.weight for replica in usable])[0]
+        return self._readers[chosen.engine]
+
+    def check(self):
+        """Check every replica against the primary's dataset version now."""
+        session = sessionmaker(bind=self.primary)()
+        try:
+            primary_version = dataset_version(session)
+        finally:
+            session.close()
+
+        for replica in self.replicas:
+            was_usable = replica.usable
+            replica.check(primary_version, self.max_lag)
+            if was_usable and not replica.usable:
+                logger.warning(f"Read replica {replica.status()['url']} not used: {replica.error}")
+            elif replica.usable and not was_usable:
+                logger.info(f"Read replica {replica.status()['url']} in use")
+        self.checked_at = time.monotonic()
+
+    def status(self):
+        """Replica states for /health."""
+        return [replica.status() for replica in self.replicas]
+
+
+def parse_replicas(urls, weights):
+    """
+    (url, weight) pairs from the comma-separated READ_REPLICA_URLS and
+    READ_REPLICA_WEIGHTS values; missing weights default to 1.
+    """
+    urls = [url.strip() for url in urls.split(',') if url.strip()]
+    weights = [float(weight) for weight in weights.split(',') if weight.strip()]
+    if len(weights) > len(urls):
+        raise ValueError('READ_REPLICA_WEIGHTS has more entries than READ_REPLICA_URLS')
+    return list(zip(urls, weights + [1.0] * (len(urls) - len(weights))))
+
+
+_routers = {}
+_routers_lock = threading.Lock()
+
+
+def get_router():
+    """Shared router for the configured primary and replicas."""
+    db_url = get_database_url()
+    router = _routers.get(db_url)
+    if router is None:
+        # Outside the lock: moving to another dataset generation drops the routers
+        primary = get_engine()
+        with _routers_lock:
+            router = _routers.get(db_url)
+            if router is None:
+                replicas = []
+                for url, weight in parse_replicas(READ_REPLICA_URLS, READ_REPLICA_WEIGHTS):
+                    engine = set_read_only(create_db_engine(url))
+                    storage.check_layout(engine, COMPACT_STORAGE)
+                    admission.install_statement_timeouts(engine)
+                    replicas.append(Replica(engine, weight))
+                router = _routers[db_url] = EngineRouter(
+                    admission.install_statement_timeouts(primary), replicas,
+                    read_options=admission.read_options()
+                )
+    return router
+
+
+@on_dataset_switch
+def invalidate():
+    """Drop the routers of the previous dataset generation and close their replica pools."""
+    with _routers_lock:
+        routers = list(_routers.values())
+        _routers.clear()
+    for router in routers:
+        for replica in router.replicas:
+            replica.engine.dispose()
+
+
+def get_read_session():
+    """Session for API reads, on a replica when one is usable."""
+    Session = sessionmaker(bind=get_router().reader())
+    return Session()
+
+
+def sync_replica(primary_path, replica_path):
+    """
+    Copy a SQLite primary to `replica_path` with the online backup API, plus
+    its bitmap index and snapshot directories.
+    """
+    source = sqlite3.connect(primary_path)
+    target = sqlite3.connect(replica_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+    for suffix in DERIVED_SUFFIXES:
+        derived = primary_path + suffix
+        copy = replica_path + suffix
+        shutil.rmtree(copy, ignore_errors=True)
+        if os.path.isdir(derived):
+            shutil.copytree(derived, copy)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Manage and inspect read replicas')
+    parser.add_argument('--db', help='SQLite primary (default: configured database)')
+    parser.add_argument('--sync', nargs='+', metavar='REPLICA',
+                        help='Copy the SQLite primary to these replica files')
+    parser.add_argument('--status', action='store_true',
+                        help='Check the replicas in READ_REPLICA_URLS and print their state')
+    args = parser.parse_args()
+
+    if args.db:
+        os.environ['USE_SQLITE'] = 'true'
+        os.environ['SQLITE_DB_PATH'] = os.path.abspath(args.db)
+
+    if args.sync:
+        primary_path = get_engine().url.database
+        for replica_path in args.sync:
+            started = time.perf_counter()
+            sync_replica(primary_path, os.path.abspath(replica_path))
+            logger.info(f"Synced {replica_path} in {time.perf_counter() - started:.1f}s")
+
+    if args.status:
+        router = get_router()
+        router.check()
+        print(json.dumps(router.status(), indent=2))
+
+    if not args.sync and not args.status:
+        parser.print_help()
@@ -0,0 +1,632 @@
+"""
+Stratified sampling for approximate dashboard queries.
+
+A fixed-rate Bernoulli sample of trips is kept in `trip_samples`, stratified
+by (pickup date, pickup borough). Membership is decided by a multiplicative
+hash of trip_id, so the sample is deterministic and can be extended
+incrementally as trips are ingested. Per-stratum population and sample
+sizes live in `sample_strata`.
+
+Estimates use the standard stratified estimators: totals are
+sum_h N_h / n_h * y_h, averages are ratio estimators, and 95% confidence
+intervals come from the stratified variance with finite population
+correction (linearized for ratios). Strata with too few sampled trips keep
+their known population: their trips are predicted from the pooled sample
+of all such strata, so a day's count never loses them, and counts of whole
+strata (date filters only, overall or per day) are exact.
+"""
+
+import math
+import os
+from collections import namedtuple
+
+from sqlalchemy import func, and_, case, cast, inspect, insert, select, String
+
+from models import Trip, Zone, PaymentType, TripSample, SampleStratum
+import storage
+
+SAMPLE_RATE = float(os.getenv('APPROX_SAMPLE_RATE', '0.01'))
+MIN_STRATUM_SAMPLE = 2
+# Weight, in sampled trips, of the filtered sample's per-trip variance in
+# the variance of each stratum
+PRIOR_DF = 4
+Z_95 = 1.959964
+
+# Knuth multiplicative hash; trips whose hash falls below the threshold are sampled
+HASH_MULTIPLIER = 2654435761
+HASH_MODULUS = 2 ** 32
+
+Estimate = namedtuple('Estimate', ['value', 'low', 'high'])
+
+SAMPLE_COLUMNS = [
+    'trip_id', 'pickup_datetime', 'pickup_zone_id', 'dropoff_zone_id',
+    'payment_type_id', 'passenger_count', 'trip_distance', 'trip_duration',
+    'fare_amount', 'trip_speed', 'total_amount',
+]
+
+
+def sample_threshold(rate=SAMPLE_RATE):
+    """Hash threshold below which a trip is part of the sample."""
+    return int(rate * HASH_MODULUS)
+
+
+def refresh_sample(session, since_trip_id=0, rate=SAMPLE_RATE):
+    """
+    Extend the sample with trips whose trip_id >= since_trip_id.
+
+    Sampled rows are copied with a single INSERT ... SELECT and the stratum
+    population/sample sizes are incremented, so refreshing after an ingest
+    costs one pass over the new rows only.
+
+    Returns:
+        Number of trips added to the sample
+    """
+    bind = session.get_bind()
+    TripSample.__table__.create(bind, checkfirst=True)
+    SampleStratum.__table__.create(bind, checkfirst=True)
+
+    stratum_date = cast(storage.date_of(session, Trip.pickup_datetime), String)
+    stratum_borough = func.coalesce(Zone.borough, 'Unknown')
+    new_trips = Trip.trip_id >= since_trip_id
+    sampled = (Trip.trip_id * HASH_MULTIPLIER) % HASH_MODULUS < sample_threshold(rate)
+
+    sample_select = select(
+        *[getattr(Trip, c) for c in SAMPLE_COLUMNS],
+        stratum_date,
+        stratum_borough,
+    ).outerjoin(Zone, Trip.pickup_zone_id == Zone.zone_id).where(and_(new_trips, sampled))
+
+    session.execute(
+        insert(TripSample).from_select(SAMPLE_COLUMNS + ['sample_date', 'borough'], sample_select)
+    )
+
+    counts = session.query(
+        stratum_date.label('sample_date'),
+        stratum_borough.label('borough'),
+        func.count(Trip.trip_id).label('population'),
+        func.sum(case((sampled, 1), else_=0)).label('sampled'),
+    ).outerjoin(Zone, Trip.pickup_zone_id == Zone.zone_id).filter(new_trips).group_by(
+        stratum_date, stratum_borough
+    ).all()
+
+    added = 0
+    for row in counts:
+        stratum = session.get(SampleStratum, (row.sample_date, row.borough))
+        if stratum is None:
+            stratum = SampleStratum(sample_date=row.sample_date, borough=row.borough,
+                                    population_count=0, sample_count=0)
+            session.add(stratum)
+        stratum.population_count += row.population
+        stratum.sample_count += int(row.sampled or 0)
+        added += int(row.sampled or 0)
+
+    session.commit()
+    return added
+
+
+def rebuild_sample(session, rate=SAMPLE_RATE):
+    """Drop and rebuild the whole sample from `trips`."""
+    bind = session.get_bind()
+    TripSample.__table__.create(bind, checkfirst=True)
+    SampleStratum.__table__.create(bind, checkfirst=True)
+    session.query(TripSample).delete()
+    session.query(SampleStratum).delete()
+    session.commit()
+    return refresh_sample(session, since_trip_id=0, rate=rate)
+
+
+def load_strata(session):
+    """
+    Returns:
+        Dict mapping (sample_date, borough) to (population_count, sample_count),
+        or None if the sample has not been built
+    """
+    if not inspect(session.get_bind()).has_table(SampleStratum.__tablename__):
+        return None
+    strata = {
+        (s.sample_date, s.borough): (s.population_count, s.sample_count)
+        for s in session.query(SampleStratum).all()
+    }
+    return strata or None
+
+
+def sample_fraction(strata):
+    """Overall fraction of the population held in the sample."""
+    population = sum(n for n, _ in strata.values())
+    sampled = sum(m for _, m in strata.values())
+    return round(sampled / population, 6) if population else 0.0
+
+
+def strata_between(strata, dates=(None, None)):
+    """
+    The strata of pickup dates within `dates`.
+
+    Args:
+        strata: Result of load_strata()
+        dates: (first, last) 'YYYY-MM-DD' dates, either None when unbounded
+
+    Returns:
+        Dict like `strata`, restricted to those dates
+    """
+    first, last = dates
+    return {
+        key: sizes for key, sizes in strata.items()
+        if (first is None or key[0] >= first) and (last is None or key[0] <= last)
+    }
+
+
+def collapse_strata(strata):
+    """
+    Merge strata too small to estimate a variance from.
+
+    A (date, borough) stratum with fewer than MIN_STRATUM_SAMPLE sampled
+    trips is folded into a per-date remainder stratum (date, None). Because
+    the sample is Bernoulli at a uniform rate, the union is still a valid
+    simple random sample. A remainder that is still too small stays thin:
+    its population is known but its trips are predicted from the pooled
+    sample of every thin stratum (see estimate_groups), so the trips of a
+    date are never counted under another date.
+
+    Returns:
+        Tuple of (mapping from stratum key to effective key,
+        dict of effective key to (population_count, sample_count))
+    """
+    mapping = {}
+    for key, (population, sampled) in strata.items():
+        mapping[key] = key if sampled >= MIN_STRATUM_SAMPLE else (key[0], None)
+
+    sizes = {}
+    for key, target in mapping.items():
+        population, sampled = sizes.get(target, (0, 0))
+        sizes[target] = (population + strata[key][0], sampled + strata[key][1])
+
+    return mapping, sizes
+
+
+def _variance_term(total, total_sq, n):
+    """Sample variance of a stratum from its sum and sum of squares."""
+    if n <= 1:
+        return 0.0
+    return max(total_sq - total * total / n, 0.0) / (n - 1)
+
+
+def _share(hits, n):
+    """Share of `n` sampled trips that are hits, with half a trip added to each side so it is never 0 or 1."""
+    return (hits + 0.5) / (n + 1)
+
+
+def _moments(sums):
+    """Mean and sample variance of the values summed in `sums` ([count, sum, sum of squares])."""
+    count, total, total_sq = sums
+    return (total / count if count else 0.0), _variance_term(total, total_sq, count)
+
+
+def _shrunk(factor, variance, prior, n):
+    """
+    Variance part of a stratum: `factor` times the per-trip variance from
+    its `n` sampled trips, shrunk toward `prior` as if the prior came from
+    PRIOR_DF more trips. The few trips of a small stratum often all miss a
+    group, or all fall on one side of a skewed distribution, and understate
+    its spread.
+
+    Returns:
+        (variance, degrees of freedom)
+    """
+    df = n - 1
+    return factor * (df * variance + PRIOR_DF * prior) / (df + PRIOR_DF), df + PRIOR_DF
+
+
+def _t_95(df):
+    """Two-sided 95% quantile of Student's t with `df` degrees of freedom."""
+    if df < 1.5:
+        return 12.706205
+    if df < 2.5:
+        return 4.302653
+    # Cornish-Fisher expansion around the normal quantile
+    z = Z_95
+    return (
+        z
+        + (z ** 3 + z) / (4 * df)
+        + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * df ** 2)
+        + (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / (384 * df ** 3)
+    )
+
+
+def _interval(value, parts):
+    """
+    95% interval of an estimate from its per-stratum (variance, degrees of
+    freedom) parts, using Student's t with the Welch-Satterthwaite degrees
+    of freedom, as a stratum of a few sampled trips barely pins its variance.
+    """
+    variance = sum(v for v, _ in parts)
+    if variance <= 0:
+        return Estimate(value, value, value)
+    df = variance * variance / sum(v * v / df for v, df in parts if df > 0 and v > 0)
+    half_width = _t_95(df) * math.sqrt(variance)
+    return Estimate(value, value - half_width, value + half_width)
+
+
+def _new_sums(value_columns):
+    return {'n_rows': 0, **{k: [0, 0.0, 0.0] for k in value_columns}}
+
+
+def _add_sums(acc, other, value_columns):
+    acc['n_rows'] += other['n_rows']
+    for k in value_columns:
+        for i in range(3):
+            acc[k][i] += other[k][i]
+
+
+def estimate_groups(session, filters, group_columns, metrics, strata, joins=(),
+                    by_date=False, whole_strata=False):
+    """
+    Estimate counts, sums and averages per group from the sample.
+
+    Thin strata (see collapse_strata) are estimated together: their total
+    population, or with `by_date` that of the group's date, times the
+    pooled sample's per-trip statistics. Being predicted rather than
+    sampled, they add N^2 / n + N times the per-trip variance instead of
+    the N^2 (1 - n/N) / n of a sampled stratum. An interval has zero width
+    only when every contributing stratum is fully known: all its trips
+    sampled, or counted whole under `whole_strata`.
+
+    Args:
+        session: Database session
+        filters: Filter expressions built against TripSample
+        group_columns: List of labelled column expressions to group by
+        metrics: List of (output_name, kind, column) with kind in
+            'count', 'sum' or 'mean'
+        strata: Result of load_strata(), restricted to the filtered dates
+        joins: (target, onclause) pairs joined onto trip_samples
+        by_date: True when group_columns is [TripSample.sample_date]
+        whole_strata: True when `filters` only bound the pickup date, so
+            that each overall or per-day count is a sum of known stratum
+            populations
+
+    Returns:
+        Dict mapping group key tuples to {output_name: Estimate}
+    """
+    value_columns = {}
+    for _, kind, column in metrics:
+        if kind != 'count' and column.key not in value_columns:
+            value_columns[column.key] = column
+
+    selected = [TripSample.sample_date, TripSample.borough] + list(group_columns)
+    selected.append(func.count(TripSample.trip_id).label('n_rows'))
+    for key, column in value_columns.items():
+        column = storage.value_of(column)
+        selected += [
+            func.count(column).label(f'{key}__n'),
+            func.sum(column).label(f'{key}__sum'),
+            func.sum(column * column).label(f'{key}__sumsq'),
+        ]
+
+    query = session.query(*selected)
+    for target, onclause in joins:
+        query = query.join(target, onclause)
+    if filters:
+        query = query.filter(and_(*filters))
+
+    group_by = [TripSample.sample_date, TripSample.borough] + list(group_columns)
+    rows = query.group_by(*group_by).all()
+
+    mapping, sizes = collapse_strata(strata)
+    thin = {key for key, (_, sampled) in sizes.items() if sampled < MIN_STRATUM_SAMPLE}
+    exact_counts = whole_strata and (by_date or not group_columns)
+
+    # Strata a group may hold trips of: those of its date with `by_date`,
+    # otherwise every one, whether or not any of its sampled trips matched.
+    # One without a matching trip adds only its shrunk prior (see _shrunk):
+    # prior * c with c = factor * PRIOR_DF / df, on df = n - 1 + PRIOR_DF
+    # degrees of freedom. Sum c and c^2 / df once per list of candidates
+    candidates = {}
+    unmatched = {}
+    for key, (population, sampled) in sizes.items():
+        if key in thin:
+            continue
+        group_date = key[0] if by_date else None
+        df = sampled - 1 + PRIOR_DF
+        c = population * population * (1 - sampled / population) / sampled * PRIOR_DF / df
+        candidates.setdefault(group_date, set()).add(key)
+        c1, c2 = unmatched.get(group_date, (0.0, 0.0))
+        unmatched[group_date] = (c1 + c, c2 + c * c / df)
+
+    # Sum the sample statistics per (group, effective stratum)
+    groups = {}
+    for row in rows:
+        effective = mapping.get((row.sample_date, row.borough))
+        if effective is None or not sizes[effective][1]:
+            continue
+        key = tuple(getattr(row, c.key) for c in group_columns)
+        acc = groups.setdefault(key, {}).setdefault(effective, _new_sums(value_columns))
+        acc['n_rows'] += row.n_rows
+        for k in value_columns:
+            acc[k][0] += getattr(row, f'{k}__n') or 0
+            acc[k][1] += float(getattr(row, f'{k}__sum') or 0)
+            acc[k][2] += float(getattr(row, f'{k}__sumsq') or 0)
+
+    # Thin strata are predicted from their pooled sample, or from the whole
+    # sample when even the pool is too small to estimate a variance from
+    pool = thin if sum(sizes[key][1] for key in thin) >= MIN_STRATUM_SAMPLE else set(sizes)
+    pool_sampled = sum(sizes[key][1] for key in pool)
+    thin_population = sum(sizes[key][0] for key in thin)
+
+    # Each group's sums over the whole sample (with `by_date`, over every
+    # date), and those of every filtered sampled trip: the variance of each
+    # stratum is shrunk toward the group's share and mean with the spread of
+    # all filtered trips, which a group of a few trips would understate
+    sampled_total = sum(sampled for _, sampled in sizes.values())
+    pooled = {}
+    whole = {}
+    everything = _new_sums(value_columns)
+    for key, by_stratum in groups.items():
+        key = () if by_date else key
+        for effective, sums in by_stratum.items():
+            _add_sums(whole.setdefault(key, _new_sums(value_columns)), sums, value_columns)
+            _add_sums(everything, sums, value_columns)
+            if effective in pool:
+                _add_sums(pooled.setdefault(key, _new_sums(value_columns)), sums, value_columns)
+
+    keys = set(groups)
+    if not group_columns:
+        keys.add(())
+    if by_date:
+        keys.update((key[0],) for key in thin if sizes[key][0])
+
+    results = {}
+    for key in keys:
+        # (weight N/n, variance factor, n, accumulated sums)
+        terms = []
+        group_date = key[0] if by_date else None
+        c1, c2 = unmatched.get(group_date, (0.0, 0.0))
+        for effective, acc in groups.get(key, {}).items():
+            if effective not in candidates.get(group_date, ()):
+                continue
+            population, sampled = sizes[effective]
+            weight = population / sampled
+            factor = population * population * (1 - sampled / population) / sampled
+            terms.append((weight, factor, sampled, acc))
+            df = sampled - 1 + PRIOR_DF
+            c1 -= factor * PRIOR_DF / df
+            c2 -= (factor * PRIOR_DF / df) ** 2 / df
+        # The candidates without a matching trip, as one part of c1 * prior
+        # on the Welch-Satterthwaite degrees of freedom of their sum
+        unmatched_df = c1 * c1 / c2 if c1 > 0 and c2 > 0 else 0
+
+        if by_date:
+            population = sizes[(key[0], None)][0] if (key[0], None) in thin else 0
+        else:
+            population = thin_population
+        if population and pool_sampled:
+            terms.append((
+                population / pool_sampled,
+                population * population / pool_sampled + population,
+                pool_sampled,
+                pooled.get(() if by_date else key) or _new_sums(value_columns),
+            ))
+
+        group = whole.get(() if by_date else key) or _new_sums(value_columns)
+        estimates = {}
+        for name, kind, column in metrics:
+            if kind == 'count':
+                total = sum(w * acc['n_rows'] for w, _, _, acc in terms)
+                if exact_counts:
+                    parts = [(f * _variance_term(acc['n_rows'], acc['n_rows'], n), n - 1) for _, f, n, acc in terms]
+                else:
+                    share = _share(group['n_rows'], sampled_total)
+                    prior = share * (1 - share)
+                    parts = [
+                        _shrunk(f, _variance_term(acc['n_rows'], acc['n_rows'], n), prior, n)
+                        for _, f, n, acc in terms
+                    ]
+                    parts.append((c1 * prior, unmatched_df))
+                estimates[name] = _interval(total, parts)
+                continue
+
+            k = column.key
+            y_total = sum(w * acc[k][1] for w, _, _, acc in terms)
+            share = _share(group[k][0], sampled_total)
+            mean = _moments(group[k] if group[k][0] else everything[k])[0]
+            spread = _moments(everything[k])[1]
+
+            if kind == 'sum':
+                prior = share * spread + share * (1 - share) * mean * mean
+                parts = [
+                    _shrunk(f, _variance_term(acc[k][1], acc[k][2], n), prior, n)
+                    for _, f, n, acc in terms
+                ]
+                parts.append((c1 * prior, unmatched_df))
+                estimates[name] = _interval(y_total, parts)
+                continue
+
+            x_total = sum(w * acc[k][0] for w, _, _, acc in terms)
+            if not x_total:
+                estimates[name] = Estimate(0.0, 0.0, 0.0)
+                continue
+            ratio = y_total / x_total
+            # Linearized variance of the ratio estimator: z = y - R * x
+            prior = share * spread + share * (1 - share) * (mean - ratio) ** 2
+            parts = [
+                _shrunk(f / (x_total * x_total), _variance_term(
+                    acc[k][1] - ratio * acc[k][0],
+                    acc[k][2] - 2 * ratio * acc[k][1] + ratio * ratio * acc[k][0],
+                    n,
+                ), prior, n)
+                for _, f, n, acc in terms
+            ]
+            parts.append((c1 * prior / (x_total * x_total), unmatched_df))
+            estimates[name] = _interval(ratio, parts)
+
+        results[key] = estimates
+
+    return results
+
+
+def _format_row(estimates, names, counts=('trip_count', 'total_trips')):
+    """Round estimates like the exact endpoints and attach their intervals."""
+    row = {}
+    ci = {}
+    for name in names:
+        estimate = estimates[name]
+        if name in counts:
+            row[name] = int(round(estimate.value))
+            ci[name] = [int(math.floor(max(estimate.low, 0))), int(math.ceil(estimate.high))]
+        else:
+            row[name] = round(float(estimate.value), 2)
+            ci[name] = [round(float(estimate.low), 2), round(float(estimate.high), 2)]
+    row['ci'] = ci
+    return row
+
+
+def _series_sums(estimates):
+    """
+    Unrounded sums behind an estimated time-series point (queries.SERIES_SUMS);
+    the non-NULL counts are sum / mean, so that they give back the means.
+    """
+    sums = {'revenue_sum': float(estimates['total_revenue'].value)}
+    for metric in ('fare', 'speed'):
+        total, mean = float(estimates[f'{metric}_sum'].value), float(estimates[f'avg_{metric}'].value)
+        sums[f'{metric}_sum'] = total
+        sums[f'{metric}_n'] = total / mean if mean else 0.0
+    return sums
+
+
+def approximation_info(strata):
+    """Metadata attached to every approximate response."""
+    return {
+        'sample_fraction': sample_fraction(strata),
+        'sample_rate': SAMPLE_RATE,
+        'confidence': 0.95,
+    }
+
+
+def _selected_strata(session, dates):
+    """The strata within `dates`, or None if they hold too few sampled trips to estimate from."""
+    strata = load_strata(session)
+    if strata is None:
+        return None
+    selected = strata_between(strata, dates)
+    if sum(sampled for _, sampled in selected.values()) < MIN_STRATUM_SAMPLE:
+        return None
+    return selected
+
+
+def approximate_statistics(session, filters, group_by=None, dates=(None, None), whole_strata=False):
+    """
+    Approximate counterpart of /api/statistics.
+
+    Args:
+        session: Database session
+        filters: Filter expressions built against TripSample
+        group_by: None, 'hour', 'zone' or 'payment_type'
+        dates: (first, last) pickup dates the filters select, see strata_between()
+        whole_strata: True when the filters only bound the pickup date
+
+    Returns:
+        Dict with 'overall', 'grouped' and 'approximate' keys, or None if
+        the sample has not been built or holds too few trips of `dates`
+    """
+    strata = _selected_strata(session, dates)
+    if strata is None:
+        return None
+
+    overall_names = ['total_trips', 'avg_fare', 'avg_distance', 'avg_duration', 'avg_speed', 'total_revenue']
+    overall = estimate_groups(session, filters, [], [
+        ('total_trips', 'count', None),
+        ('avg_fare', 'mean', TripSample.fare_amount),
+        ('avg_distance', 'mean', TripSample.trip_distance),
+        ('avg_duration', 'mean', TripSample.trip_duration),
+        ('avg_speed', 'mean', TripSample.trip_speed),
+        ('total_revenue', 'sum', TripSample.total_amount),
+    ], strata, whole_strata=whole_strata)
+
+    if overall:
+        stats = _format_row(overall[()], overall_names)
+    else:
+        stats = {name: 0 for name in overall_names}
+        stats['ci'] = {}
+
+    grouped_stats = []
+
+    if group_by == 'hour':
+        hour = storage.hour_of(session, TripSample.pickup_datetime).label('hour')
+        groups = estimate_groups(session, filters, [hour], [
+            ('trip_count', 'count', None),
+            ('avg_fare', 'mean', TripSample.fare_amount),
+            ('avg_speed', 'mean', TripSample.trip_speed),
+        ], strata)
+        grouped_stats = [
+            dict({'hour': int(key[0])}, **_format_row(est, ['trip_count', 'avg_fare', 'avg_speed']))
+            for key, est in sorted(groups.items())
+        ]
+
+    elif group_by == 'zone':
+        groups = estimate_groups(session, filters, [Zone.zone_name, Zone.borough.label('zone_borough')], [
+            ('trip_count', 'count', None),
+            ('avg_fare', 'mean', TripSample.fare_amount),
+        ], strata, joins=[(Zone, TripSample.pickup_zone_id == Zone.zone_id)])
+        ranked = sorted(groups.items(), key=lambda item: item[1]['trip_count'].value, reverse=True)[:20]
+        grouped_stats = [
+            dict({'zone_name': key[0], 'borough': key[1]}, **_format_row(est, ['trip_count', 'avg_fare']))
+            for key, est in ranked
+        ]
+
+    elif group_by == 'payment_type':
+        groups = estimate_groups(session, filters, [PaymentType.payment_name], [
+            ('trip_count', 'count', None),
+            ('avg_fare', 'mean', TripSample.fare_amount),
+        ], strata, joins=[(PaymentType, TripSample.payment_type_id == PaymentType.payment_type_id)])
+        grouped_stats = [
+            dict({'payment_type': key[0]}, **_format_row(est, ['trip_count', 'avg_fare']))
+            for key, est in groups.items()
+        ]
+
+    return {
+        'overall': stats,
+        'grouped': grouped_stats,
+        'approximate': approximation_info(strata),
+    }
+
+
+def approximate_time_series(session, filters, interval='hour', dates=(None, None), whole_strata=False):
+    """
+    Approximate counterpart of /api/time-series.
+
+    Returns:
+        Dict with 'time_series' and 'approximate' keys, or None if the
+        sample has not been built or holds too few trips of `dates`
+    """
+    strata = _selected_strata(session, dates)
+    if strata is None:
+        return None
+    names = ['trip_count', 'avg_fare', 'avg_speed', 'total_revenue']
+    metrics = [
+        ('trip_count', 'count', None),
+        ('avg_fare', 'mean', TripSample.fare_amount),
+        ('avg_speed', 'mean', TripSample.trip_speed),
+        ('total_revenue', 'sum', TripSample.total_amount),
+        ('fare_sum', 'sum', TripSample.fare_amount),
+        ('speed_sum', 'sum', TripSample.trip_speed),
+    ]
+
+    time_series = []
+    if interval == 'hour':
+        hour = storage.hour_of(session, TripSample.pickup_datetime).label('time_unit')
+        groups = estimate_groups(session, filters, [hour], metrics, strata)
+        time_series = [
+            dict({'hour': int(key[0])}, **_format_row(est, names), **_series_sums(est))
+            for key, est in sorted(groups.items())
+        ]
+    elif interval == 'day':
+        groups = estimate_groups(
+            session, filters, [TripSample.sample_date], metrics, strata, by_date=True, whole_strata=whole_strata
+        )
+        time_series = [
+            dict({'date': key[0]}, **_format_row(est, names), **_series_sums(est))
+            for key, est in sorted(groups.items())
+        ]
+
+    return {
+        'time_series': time_series,
+        'approximate': approximation_info(strata),
+    }
@@ -0,0 +1,376 @@
+"""
+Mergeable quantile sketches (t-digest) for trip metrics.
+
+One digest per (pickup date, pickup zone, metric) is kept in
+`trip_sketches`, plus a per-day rollup over all zones. Percentiles over
+any date range / zone are answered by merging the stored digests, so a
+p99 over a year costs a merge of a few hundred small digests per metric
+instead of a sort of millions of rows.
+
+The digest follows Dunning's merging t-digest with the k1 scale function:
+centroids are small near the tails and large near the median, which keeps
+extreme quantiles accurate with ~`compression` centroids.
+"""
+
+import math
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import func, and_, cast, insert, inspect, update, String
+
+from models import Trip, TripSketch
+import storage
+
+SKETCH_METRICS = ['fare_amount', 'trip_duration', 'trip_speed', 'fare_per_km']
+DEFAULT_COMPRESSION = 200
+
+# Filters that map onto the sketch grid; any other filter needs raw rows
+SKETCH_FILTER_PARAMS = ('start_date', 'end_date', 'pickup_zone_id')
+
+UNKNOWN_ZONE = 0
+# Per-day rollup over every pickup zone
+ALL_ZONES = -1
+
+
+class TDigest:
+    """
+    Merging t-digest over float values.
+
+    Centroids are kept as two parallel NumPy arrays (means, weights)
+    sorted by mean, together with the exact min and max.
+    """
+
+    def __init__(self, means=None, weights=None, min_value=None, max_value=None,
+                 compression=DEFAULT_COMPRESSION):
+        self.means = np.asarray(means if means is not None else [], dtype=np.float64)
+        self.weights = np.asarray(weights if weights is not None else [], dtype=np.float64)
+        self.min_value = min_value
+        self.max_value = max_value
+        self.compression = compression
+
+    @property
+    def count(self):
+        return float(self.weights.sum())
+
+    @classmethod
+    def from_values(cls, values, compression=DEFAULT_COMPRESSION):
+        """
+        Build a digest from raw values.
+
+        Time Complexity: O(n log n) for the sort
+        """
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return cls(compression=compression)
+        values = np.sort(values)
+        digest = cls(values, np.ones(values.size), float(values[0]), float(values[-1]), compression)
+        digest._compress()
+        return digest
+
+    @classmethod
+    def merge_all(cls, digests, compression=DEFAULT_COMPRESSION):
+        """
+        Merge any number of digests into one.
+
+        Time Complexity: O(c log c) where c is the total number of centroids
+        """
+        digests = [d for d in digests if d.weights.size]
+        if not digests:
+            return cls(compression=compression)
+
+        means = np.concatenate([d.means for d in digests])
+        weights = np.concatenate([d.weights for d in digests])
+        order = np.argsort(means, kind='mergesort')
+        merged = cls(
+            means[order],
+            weights[order],
+            min(d.min_value for d in digests),
+            max(d.max_value for d in digests),
+            compression,
+        )
+        merged._compress()
+        return merged
+
+    def _scale(self, q):
+        """k1 scale function: k(q) = delta / (2 pi) * asin(2q - 1)."""
+        return self.compression / (2 * math.pi) * np.arcsin(2 * np.clip(q, 0.0, 1.0) - 1)
+
+    def _compress(self):
+        """
+        Fold sorted centroids into clusters spanning at most one unit of k.
+        """
+        total = self.weights.sum()
+        if self.means.size <= 1 or total == 0:
+            return
+
+        cumulative = np.cumsum(self.weights)
+        midpoints = (cumulative - self.weights / 2) / total
+        cluster = np.floor(self._scale(midpoints) - self._scale(0.0)).astype(np.int64)
+        # Clusters are monotone in the sorted order, so bincount keeps the order
+        cluster -= cluster[0]
+
+        weights = np.bincount(cluster, weights=self.weights)
+        sums = np.bincount(cluster, weights=self.weights * self.means)
+        keep = weights > 0
+        self.weights = weights[keep]
+        self.means = sums[keep] / self.weights
+
+    def quantile(self, q):
+        """
+        Estimate the q-th quantile (0 <= q <= 1).
+
+        Interpolates linearly between centroid centres, anchored at the
+        exact min and max for the tails.
+        """
+        if self.weights.size == 0:
+            return None
+        total = self.weights.sum()
+        centres = np.cumsum(self.weights) - self.weights / 2
+        positions = np.concatenate(([0.0], centres, [total]))
+        values = np.concatenate(([self.min_value], self.means, [self.max_value]))
+        return float(np.interp(q * total, positions, values))
+
+    def to_bytes(self):
+        """Serialize centroids as interleaved little-endian float64 pairs."""
+        return np.column_stack((self.means, self.weights)).astype('<f8').tobytes()
+
+    @classmethod
+    def from_bytes(cls, payload, min_value, max_value, compression=DEFAULT_COMPRESSION):
+        pairs = np.frombuffer(payload, dtype='<f8').reshape(-1, 2)
+        return cls(pairs[:, 0], pairs[:, 1], min_value, max_value, compression)
+
+
+def _sketch_column(metric):
+    return getattr(Trip, metric)
+
+
+def _day_sketches(day, zones, values):
+    """
+    Digests for one day: one per (zone, metric) plus an all-zones rollup.
+
+    Args:
+        day: Date string
+        zones: Array of pickup zone IDs, one per trip
+        values: 2-D array of metric values, one column per SKETCH_METRICS
+
+    Returns:
+        Dict mapping (day, zone_id, metric) to TDigest
+    """
+    digests = {}
+    for index, metric in enumerate(SKETCH_METRICS):
+        column = values[:, index]
+        present = ~np.isnan(column)
+        metric_zones = zones[present]
+        metric_values = column[present]
+        if metric_values.size == 0:
+            continue
+
+        digests[(day, ALL_ZONES, metric)] = TDigest.from_values(metric_values)
+
+        # Sort by (zone, value) once, then cut into per-zone runs
+        order = np.lexsort((metric_values, metric_zones))
+        metric_zones = metric_zones[order]
+        metric_values = metric_values[order]
+        cell_zones, starts = np.unique(metric_zones, return_index=True)
+        ends = np.append(starts[1:], metric_zones.size)
+        for zone_id, begin, end in zip(cell_zones, starts, ends):
+            run = metric_values[begin:end]
+            digest = TDigest(run, np.ones(run.size), float(run[0]), float(run[-1]))
+            digest._compress()
+            digests[(day, int(zone_id), metric)] = digest
+    return digests
+
+
+def _store_day(session, digests):
+    """Merge a day's digests into `trip_sketches` with bulk INSERT/UPDATE."""
+    days = {key[0] for key in digests}
+    existing = {
+        (s.sketch_date, s.pickup_zone_id, s.metric): s
+        for s in session.query(TripSketch).filter(TripSketch.sketch_date.in_(days))
+    }
+
+    inserts = []
+    updates = []
+    for key, digest in digests.items():
+        stored = existing.get(key)
+        if stored is not None:
+            digest = TDigest.merge_all([
+                TDigest.from_bytes(stored.centroids, stored.min_value, stored.max_value),
+                digest,
+            ])
+        row = {
+            'sketch_date': key[0],
+            'pickup_zone_id': key[1],
+            'metric': key[2],
+            'count': int(digest.count),
+            'min_value': digest.min_value,
+            'max_value': digest.max_value,
+            'centroids': digest.to_bytes(),
+        }
+        (updates if stored is not None else inserts).append(row)
+
+    session.expunge_all()
+    if inserts:
+        session.execute(insert(TripSketch), inserts)
+    if updates:
+        session.execute(update(TripSketch), updates)
+    return len(inserts) + len(updates)
+
+
+def refresh_sketches(session, since_trip_id=0, batch_size=50000):
+    """
+    Fold trips with trip_id >= since_trip_id into the stored digests.
+
+    New rows are streamed in pickup order and digested one day at a time,
+    then merged with whatever is already stored for each cell, so memory
+    stays bounded by a day of trips.
+
+    Returns:
+        Number of (date, zone, metric) sketches written
+    """
+    bind = session.get_bind()
+    TripSketch.__table__.create(bind, checkfirst=True)
+
+    sketch_date = cast(storage.date_of(session, Trip.pickup_datetime), String).label('sketch_date')
+    zone = func.coalesce(Trip.pickup_zone_id, UNKNOWN_ZONE).label('zone')
+    rows = session.query(
+        sketch_date, zone, *[_sketch_column(m) for m in SKETCH_METRICS]
+    ).filter(Trip.trip_id >= since_trip_id).order_by(Trip.pickup_datetime).yield_per(batch_size)
+
+    def flush(day, day_rows):
+        zones = np.array([r[1] for r in day_rows], dtype=np.int64)
+        values = np.array([r[2:] for r in day_rows], dtype=np.float64)
+        return _day_sketches(day, zones, values)
+
+    written = 0
+    pending = {}
+    current_day = None
+    day_rows = []
+    for row in rows:
+        if row.sketch_date != current_day:
+            if day_rows:
+                pending.update(flush(current_day, day_rows))
+            current_day = row.sketch_date
+            day_rows = []
+        day_rows.append(tuple(np.nan if v is None else v for v in row))
+        if len(pending) >= batch_size // 10:
+            written += _store_day(session, pending)
+            pending = {}
+    if day_rows:
+        pending.update(flush(current_day, day_rows))
+    if pending:
+        written += _store_day(session, pending)
+
+    session.commit()
+    return written
+
+
+def rebuild_sketches(session):
+    """Drop and rebuild every sketch from `trips`."""
+    bind = session.get_bind()
+    TripSketch.__table__.create(bind, checkfirst=True)
+    session.query(TripSketch).delete()
+    session.commit()
+    return refresh_sketches(session, since_trip_id=0)
+
+
+def sketches_cover(args, filter_params):
+    """True if every filter present in `args` can be answered from sketches."""
+    return all(
+        args.get(param) in (None, '')
+        for param in filter_params
+        if param not in SKETCH_FILTER_PARAMS
+    )
+
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+
+
+def summarize(digest, percentiles):
+    """Percentile summary dict for one digest."""
+    if digest.weights.size == 0:
+        return {'count': 0}
+    summary = {f'p{p:g}': round(digest.quantile(p / 100.0), 2) for p in percentiles}
+    summary.update({
+        'count': int(digest.count),
+        'min': round(digest.min_value, 2),
+        'max': round(digest.max_value, 2),
+    })
+    return summary
+
+
+def sketch_percentiles(session, args, metrics, percentiles):
+    """
+    Answer percentiles by merging stored digests.
+
+    Returns:
+        Tuple of ({metric: summary}, number of sketches merged), or None if
+        no sketches have been built
+    """
+    if not inspect(session.get_bind()).has_table(TripSketch.__tablename__):
+        return None
+    if session.query(TripSketch.metric).first() is None:
+        return None
+
+    query = session.query(TripSketch).filter(TripSketch.metric.in_(metrics))
+
+    start_date = _parse_date(args.get('start_date'))
+    if start_date:
+        query = query.filter(TripSketch.sketch_date >= start_date)
+    end_date = _parse_date(args.get('end_date'))
+    if end_date:
+        query = query.filter(TripSketch.sketch_date <= end_date)
+    zone_id = ALL_ZONES
+    zone = args.get('pickup_zone_id')
+    if zone not in (None, ''):
+        try:
+            zone_id = int(zone)
+        except ValueError:
+            pass
+    query = query.filter(TripSketch.pickup_zone_id == zone_id)
+
+    digests = {metric: [] for metric in metrics}
+    merged = 0
+    for sketch in query.all():
+        digests[sketch.metric].append(
+            TDigest.from_bytes(sketch.centroids, sketch.min_value, sketch.max_value)
+        )
+        merged += 1
+
+    return {
+        metric: summarize(TDigest.merge_all(parts), percentiles)
+        for metric, parts in digests.items()
+    }, merged
+
+
+def exact_percentiles(session, filters, metrics, percentiles):
+    """
+    Percentiles from raw rows, for filters the sketch grid cannot express.
+    """
+    result = {}
+    for metric in metrics:
+        column = _sketch_column(metric)
+        query = session.query(column).filter(column.isnot(None))
+        if filters:
+            query = query.filter(and_(*filters))
+        values = np.array([r[0] for r in query.all()], dtype=np.float64)
+
+        if values.size == 0:
+            result[metric] = {'count': 0}
+            continue
+        summary = {
+            f'p{p:g}': round(float(v), 2)
+            for p, v in zip(percentiles, np.percentile(values, percentiles))
+        }
+        summary.update({
+            'count': int(values.size),
+            'min': round(float(values.min()), 2),
+            'max': round(float(values.max()), 2),
+        })
+        result[metric] = summary
+    return result
@@ -0,0 +1,350 @@
+"""
+Memory-mapped columnar snapshots of the trips table.
+
+Every `Trip` column is exported to its own .npy file in trip_id order, in
+API units whatever the storage layout (datetimes as datetime64[ms], money
+and distances as float64, codes as int32 with NULL_VALUE for NULL). Readers
+open the files with np.load(mmap_mode='r'), so opening a snapshot costs a
+few header reads however large it is, and every gunicorn worker maps the
+same pages of the OS page cache instead of loading its own copy.
+
+A manifest records the dataset version the snapshot was exported at; a
+snapshot is only used while that version matches the database's, so
+readers fall back to SQL between an ingest and its export. Exports are
+written to a staging directory and swapped in with a rename, as the bitmap
+index is (see bitmaps.build_index): a worker still reading the previous
+snapshot keeps its mappings of the old files.
+
+Directory layout (<db>.snapshot/):
+    manifest.json   version, rows, max_trip_id, column -> file and dtype
+    <column>.npy    one array of `rows` values per Trip column
+"""
+
+import json
+import logging
+import operator
+import os
+import shutil
+import threading
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import select, func, Column, Float
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter
+
+from models import Trip, generation_name, on_dataset_switch
+from dimensions import get_dimensions
+import storage
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR')
+FETCH_BATCH_SIZE = 100000
+MANIFEST = 'manifest.json'
+
+# Stored for NULL codes; datetimes use NaT and floats NaN
+NULL_VALUE = -1
+
+# Comparison operators a filter may use on a snapshot column
+COMPARISONS = {
+    operators.eq: operator.eq,
+    operators.ge: operator.ge,
+    operators.gt: operator.gt,
+    operators.le: operator.le,
+    operators.lt: operator.lt,
+}
+
+COLUMNS = ('trip_id',) + tuple(storage.TRIP_ENCODINGS)
+
+
+def column_dtype(name):
+    """Snapshot dtype of trip column `name`."""
+    if name == 'trip_id':
+        return np.dtype('<i8')
+    if name.endswith('_datetime'):
+        return np.dtype('<M8[ms]')
+    if storage.trip_type(name, False) is Float:
+        return np.dtype('<f8')
+    return np.dtype('<i4')
+
+
+def snapshot_dir(session):
+    """Directory holding the snapshot of the session's database."""
+    if SNAPSHOT_DIR:
+        return SNAPSHOT_DIR
+    url = session.get_bind().url
+    if url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:'):
+        return os.path.abspath(url.database) + '.snapshot'
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), generation_name('snapshot', url))
+
+
+class Snapshot:
+    """
+    The trip columns of one dataset version.
+
+    Attributes:
+        version: Dataset version the snapshot was exported at
+        rows: Number of trips
+        max_trip_id: Highest trip_id exported
+        columns: Dict column name -> read-only memory-mapped array
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+        self.path = path
+        self.version = manifest['version']
+        self.rows = manifest['rows']
+        self.max_trip_id = manifest['max_trip_id']
+        self.columns = {}
+        for name, spec in manifest['columns'].items():
+            array = np.load(os.path.join(path, spec['file']), mmap_mode='r')
+            if array.dtype != np.dtype(spec['dtype']) or array.shape != (self.rows,):
+                raise ValueError(f"{spec['file']} does not match the manifest")
+            self.columns[name] = array
+
+    def positions(self, filters, selectivity=None):
+        """
+        Ascending positions of the trips matching `filters`, or None when
+        some filter is not a comparison of a trip column with a value.
+
+        Filters are evaluated one after the other on the trips that passed
+        the previous ones, so the first filter reads the whole column and
+        later ones only the survivors.
+
+        Args:
+            filters: SQLAlchemy expressions as built by build_trip_filters
+            selectivity: Optional callable(filter) -> estimated share of
+                trips it keeps, or None when unknown (see
+                catalog.Catalog.selectivity); the most selective filters
+                are then evaluated first
+        """
+        comparisons = []
+        for condition in filters:
+            if not isinstance(condition, BinaryExpression):
+                return None
+            column, value = condition.left, condition.right
+            compare = COMPARISONS.get(condition.operator)
+            if (
+                compare is None or not isinstance(column, Column)
+                or column.table is not Trip.__table__ or column.name not in self.columns
+                or not isinstance(value, BindParameter)
+            ):
+                return None
+            bound = value.effective_value
+            if bound is None:
+                return None
+            if isinstance(bound, datetime):
+                bound = np.datetime64(bound, 'ms')
+            share = selectivity(condition) if selectivity is not None else None
+            comparisons.append((1.0 if share is None else share, column.name, compare, bound))
+        if selectivity is not None:
+            comparisons.sort(key=lambda c: c[0])
+
+        positions = None
+        for _, name, compare, bound in comparisons:
+            values = self.columns[name]
+            if positions is not None:
+                values = values[positions]
+            keep = compare(values, bound)
+            if values.dtype == np.int32:
+                keep &= values != NULL_VALUE
+            positions = np.flatnonzero(keep) if positions is None else positions[keep]
+        return positions if positions is not None else np.arange(self.rows)
+
+    def scan(self, names, filters=(), batch_size=FETCH_BATCH_SIZE, selectivity=None):
+        """
+        Blocks of the trips matching `filters`, in trip_id order.
+
+        Every block but the last holds exactly batch_size matching trips,
+        like fetchmany over the equivalent query.
+
+        Args:
+            selectivity: Passed to positions() to order the filters
+
+        Returns:
+            Iterator of dicts column name -> array, or None when the filters
+            cannot be evaluated on the snapshot (see positions)
+        """
+        positions = None
+        if filters:
+            positions = self.positions(filters, selectivity)
+            if positions is None:
+                return None
+
+        def blocks():
+            total = self.rows if positions is None else positions.size
+            for start in range(0, total, batch_size):
+                if positions is None:
+                    rows = slice(start, start + batch_size)
+                else:
+                    rows = positions[start:start + batch_size]
+                yield {name: self.columns[name][rows] for name in names}
+        return blocks()
+
+
+def _select_columns(session):
+    """SELECT list of the export: one integer or float expression per column."""
+    columns = [Trip.trip_id]
+    for name in COLUMNS[1:]:
+        column = getattr(Trip, name)
+        dtype = column_dtype(name)
+        if dtype.kind == 'M':
+            columns.append(storage.epoch_millis(session, column))
+        elif dtype.kind == 'i':
+            columns.append(func.coalesce(column, NULL_VALUE))
+        else:
+            columns.append(column)
+    return columns
+
+
+def _scan(session, since_trip_id, batch_size):
+    """
+    Yield float64 blocks of the export columns in trip_id order.
+
+    Rows come straight from the DBAPI cursor; fixed-point columns are
+    scaled per block, as in summary.accumulate.
+    """
+    stmt = select(*_select_columns(session)).where(
+        Trip.trip_id >= since_trip_id
+    ).order_by(Trip.trip_id)
+    scales = np.array([storage.column_scale(getattr(Trip, name)) for name in COLUMNS], dtype=np.float64)
+
+    result = session.connection().execute(stmt)
+    cursor = result.cursor
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        # None becomes NaN; epoch milliseconds and ids are exact in float64
+        block = np.array(rows, dtype=np.float64)
+        yield block / scales
+    result.close()
+
+
+def _store(target, start, values):
+    """Write one float64 export column into a snapshot array."""
+    if target.dtype.kind == 'M':
+        missing = np.isnan(values)
+        values = np.where(missing, 0, values).astype(np.int64).view(target.dtype)
+        values[missing] = np.datetime64('NaT')
+    target[start:start + values.size] = values
+
+
+def export_snapshot(session, version, since_trip_id=0, batch_size=FETCH_BATCH_SIZE):
+    """
+    Export the trip columns and publish them for `version`.
+
+    With since_trip_id > 0 the trips before it are copied from the current
+    snapshot and only the rest is read from `trips`; without a usable
+    current snapshot everything is exported.
+
+    Returns:
+        Number of trips read from the database
+    """
+    path = snapshot_dir(session)
+    previous = _open(path)
+    kept = 0
+    if since_trip_id > 1 and previous is not None and previous.max_trip_id >= since_trip_id - 1:
+        kept = int(np.searchsorted(previous.columns['trip_id'], since_trip_id))
+    else:
+        since_trip_id = 0
+
+    new_rows = session.execute(
+        select(func.count()).select_from(Trip).where(Trip.trip_id >= since_trip_id)
+    ).scalar()
+    rows = kept + new_rows
+
+    staging = f'{path}.tmp-{os.getpid()}'
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    arrays = {
+        name: np.lib.format.open_memmap(
+            os.path.join(staging, f'{name}.npy'), mode='w+', dtype=column_dtype(name), shape=(rows,)
+        )
+        for name in COLUMNS
+    }
+    if kept:
+        for name in COLUMNS:
+            arrays[name][:kept] = previous.columns[name][:kept]
+    previous = None
+
+    written = kept
+    for block in _scan(session, since_trip_id, batch_size):
+        # Trips committed after the count are left for the next export
+        block = block[:rows - written]
+        for position, name in enumerate(COLUMNS):
+            _store(arrays[name], written, block[:, position])
+        written += block.shape[0]
+        if written == rows:
+            break
+    if written < rows:
+        raise RuntimeError(f'trips changed during the export ({written:,} of {rows:,} rows read)')
+
+    max_trip_id = int(arrays['trip_id'][-1]) if rows else 0
+    for array in arrays.values():
+        array.flush()
+    arrays = None
+
+    with open(os.path.join(staging, MANIFEST), 'w') as f:
+        json.dump({
+            'version': version,
+            'rows': rows,
+            'max_trip_id': max_trip_id,
+            'columns': {
+                name: {'file': f'{name}.npy', 'dtype': column_dtype(name).str}
+                for name in COLUMNS
+            },
+        }, f)
+
+    # Swap directories; readers keep their mappings of the old files
+    retired = f'{path}.old-{os.getpid()}'
+    if os.path.exists(path):
+        os.rename(path, retired)
+    os.rename(staging, path)
+    shutil.rmtree(retired, ignore_errors=True)
+    invalidate()
+    return new_rows
+
+
+def _open(path):
+    try:
+        return Snapshot(path)
+    except (OSError, ValueError, KeyError) as e:
+        logger.debug(f"No snapshot at {path}: {e}")
+        return None
+
+
+# snapshot directory -> (dataset version, Snapshot or None)
+_cache = {}
+_lock = threading.Lock()
+
+
+def get_snapshot(session):
+    """
+    The snapshot of the session's database, or None when it is missing or
+    was exported at another dataset version.
+    """
+    version = get_dimensions(session).version
+    path = snapshot_dir(session)
+    cached = _cache.get(path)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    with _lock:
+        cached = _cache.get(path)
+        if cached and cached[0] == version:
+            return cached[1]
+        snapshot = _open(path)
+        if snapshot is not None and snapshot.version != version:
+            snapshot = None
+        _cache[path] = (version, snapshot)
+        return snapshot
+
+
+@on_dataset_switch
+def invalidate():
+    """Drop opened snapshots so the next request maps the current files."""
+    with _lock:
+        _cache.clear()
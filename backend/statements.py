@@ -0,0 +1,133 @@
+"""
+SQL statements cached per filter shape.
+
+A request used to build its statement from scratch: fresh filter
+expressions, a fresh select around them, then a walk of the new tree for
+SQLAlchemy's cache key before the compiled SQL was found in the engine's
+compiled cache. Yet the SQL only depends on which filters are present -
+build_trip_filters has nine parameters, so a statement has at most 2^9
+shapes - and the filter values are bound parameters either way.
+
+cached() keeps one statement per (name, dialect, filter shape), built on
+first use with a placeholder bind parameter per filter, and returns it
+with the request's filter values as execution parameters. A reused
+statement also reuses its memoized cache key, so once warm a request
+costs a dict lookup and a compiled-cache hit. Filters that are not a
+comparison of a column with a value (IS NULL, IN) have no shape; the
+statement is then built for the one request, as before.
+
+Hit rates are exported at /metrics: sql_statement_cache_total for this
+cache and sql_compiled_cache_total for SQLAlchemy's compiled cache over
+every statement executed. `python benchmark.py --statement-report`
+measures the CPU time per request saved.
+"""
+
+import os
+
+from sqlalchemy import Column, bindparam, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.interfaces import CacheStats
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter
+
+import metrics
+
+STATEMENT_CACHE = os.getenv('STATEMENT_CACHE', 'true').lower() == 'true'
+
+# Operators of the comparisons a filter shape may hold
+COMPARISONS = frozenset((
+    operators.eq, operators.ne, operators.ge, operators.gt, operators.le, operators.lt,
+))
+
+COMPILED_CACHE_RESULTS = {
+    CacheStats.CACHE_HIT: 'hit',
+    CacheStats.CACHE_MISS: 'miss',
+}
+
+STATEMENT_LOOKUPS = metrics.Counter(
+    'sql_statement_cache_total',
+    'Statement lookups by filter shape (result: hit, miss, or uncacheable filters)'
+)
+COMPILED_CACHE = metrics.Counter(
+    'sql_compiled_cache_total',
+    "Statements executed, by outcome of SQLAlchemy's compiled cache lookup"
+)
+
+# (name, dialect, shape) -> statement. Entries are only ever added; two
+# requests racing on a new shape build equivalent statements and one wins
+_statements = {}
+
+metrics.Gauge(
+    'sql_statement_cache_size',
+    'Statements cached per filter shape',
+    lambda: {(): len(_statements)}
+)
+
+
+def filter_shape(filters):
+    """
+    Shape and values of filters that each compare a column with a value.
+
+    Returns:
+        (shape, values) where shape is a tuple of (table, column, operator)
+        in filter order, or None when some filter has another form
+    """
+    shape = []
+    values = []
+    for condition in filters:
+        if not isinstance(condition, BinaryExpression) or condition.operator not in COMPARISONS:
+            return None
+        column, value = condition.left, condition.right
+        if not isinstance(column, Column) or not isinstance(value, BindParameter):
+            return None
+        shape.append((column.table.name, column.name, condition.operator))
+        values.append(value.effective_value)
+    return tuple(shape), values
+
+
+def cached(name, session, filters, build):
+    """
+    The statement `name` over `filters`, and its execution parameters.
+
+    Args:
+        name: Identifies the statement and everything besides the filters
+            that changes its SQL (e.g. 'trips_page:fare_amount:desc')
+        session: Session the statement will run on; its dialect is part of
+            the key
+        filters: Filters as built by build_trip_filters
+        build: Callable(filters) -> statement
+
+    Returns:
+        (statement, parameters) for session.execute
+    """
+    shape = filter_shape(filters) if STATEMENT_CACHE else None
+    if shape is None:
+        if STATEMENT_CACHE:
+            STATEMENT_LOOKUPS.inc(statement=name.split(':')[0], result='uncacheable')
+        return build(list(filters)), {}
+
+    shape, values = shape
+    key = (name, session.get_bind().dialect.name, shape)
+    statement = _statements.get(key)
+    if statement is None:
+        placeholders = [
+            condition.operator(condition.left, bindparam(f'filter_{i}', type_=condition.right.type))
+            for i, condition in enumerate(filters)
+        ]
+        statement = _statements[key] = build(placeholders)
+        result = 'miss'
+    else:
+        result = 'hit'
+    STATEMENT_LOOKUPS.inc(statement=name.split(':')[0], result=result)
+    return statement, {f'filter_{i}': value for i, value in enumerate(values)}
+
+
+def clear():
+    """Drop every cached statement (benchmarks)."""
+    _statements.clear()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _count_compiled_cache(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        COMPILED_CACHE.inc(result=COMPILED_CACHE_RESULTS.get(context.cache_hit, 'uncached'))
@@ -0,0 +1,325 @@
+"""
+Physical encodings of trip columns.
+
+The standard layout stores money, distances and durations as 8-byte floats,
+datetimes as text (SQLite) and derives nothing. With COMPACT_STORAGE=true
+the same `Trip` attributes are mapped onto a narrower layout:
+
+- money, distance and duration as integer cents / hundredths / milliseconds
+  (FixedPoint), which SQLite packs into 1-4 byte varints
+- pickup time as integer seconds since 1970-01-01 (EpochSeconds)
+- zone, payment type, rate code and passenger count as SMALLINT
+- dropoff time, speed, fare per km and fare per minute computed in SQL from
+  the stored columns instead of stored
+
+The type decorators convert at the driver boundary, so ORM objects,
+filters and aggregates (AVG/SUM/MIN/MAX of a column keep its type) see the
+same values in either layout and the API output is unchanged. models.py
+reads COMPACT_STORAGE and maps `Trip` accordingly. Code that
+applies SQL functions to the pickup time goes through the helpers below,
+which pick the expression for the column's layout. A database is converted
+between layouts with migrate_storage.py.
+"""
+
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import (
+    inspect, case, cast, extract, func, literal, literal_column, type_coerce,
+    Integer, BigInteger, SmallInteger, Float, DateTime,
+)
+from sqlalchemy.sql.elements import ClauseElement, Grouping
+from sqlalchemy.sql.functions import ReturnTypeFromArgs
+from sqlalchemy.types import TypeDecorator
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+SECONDS_PER_DAY = 86400
+MILES_TO_KM = 1.60934
+
+
+def _scaled(value, scale):
+    """value * scale as an int when it is whole (to within rounding), else as-is."""
+    scaled = value * scale
+    whole = round(scaled)
+    return int(whole) if abs(scaled - whole) < 1e-6 else scaled
+
+
+class FixedPoint(TypeDecorator):
+    """
+    Decimal quantity stored as an integer number of 1/scale units
+    (scale=100 stores dollars as cents).
+
+    Values that are not whole units (e.g. a 12.345 filter bound) are bound
+    unrounded, so comparisons keep their meaning.
+    """
+    impl = Integer
+    cache_ok = True
+
+    def __init__(self, scale):
+        super().__init__()
+        self.scale = scale
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else _scaled(value, self.scale)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else float(value) / self.scale
+
+
+class EpochSeconds(TypeDecorator):
+    """Naive UTC datetime stored as integer seconds since 1970-01-01."""
+    impl = BigInteger
+    cache_ok = True
+    unit = 1
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        delta = value - EPOCH
+        seconds = delta.days * SECONDS_PER_DAY + delta.seconds
+        if delta.microseconds:
+            return (seconds + delta.microseconds / 1e6) * self.unit
+        return seconds * self.unit
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else EPOCH + timedelta(seconds=value / self.unit)
+
+
+class EpochMillis(EpochSeconds):
+    """Naive UTC datetime as integer milliseconds since 1970-01-01."""
+    cache_ok = True
+    unit = 1000
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else EPOCH + timedelta(milliseconds=value)
+
+
+class avg(ReturnTypeFromArgs):
+    """
+    func.avg typed like its argument, as func.sum already is, so that the
+    average of a FixedPoint column is scaled back to its API unit.
+    """
+    inherit_cache = True
+
+
+# Column name -> (standard type, compact type); derived columns have no
+# compact type because they are computed from the stored ones
+TRIP_ENCODINGS = {
+    'pickup_datetime': (DateTime, EpochSeconds()),
+    'dropoff_datetime': (DateTime, None),
+    'pickup_zone_id': (Integer, SmallInteger),
+    'dropoff_zone_id': (Integer, SmallInteger),
+    'payment_type_id': (Integer, SmallInteger),
+    'rate_code_id': (Integer, SmallInteger),
+    'passenger_count': (Integer, SmallInteger),
+    'trip_distance': (Float, FixedPoint(100)),
+    'trip_duration': (Float, FixedPoint(1000)),
+    'fare_amount': (Float, FixedPoint(100)),
+    'extra': (Float, FixedPoint(100)),
+    'mta_tax': (Float, FixedPoint(100)),
+    'tip_amount': (Float, FixedPoint(100)),
+    'tolls_amount': (Float, FixedPoint(100)),
+    'improvement_surcharge': (Float, FixedPoint(100)),
+    'total_amount': (Float, FixedPoint(100)),
+    'trip_speed': (Float, None),
+    'fare_per_km': (Float, None),
+    'fare_per_minute': (Float, None),
+}
+DERIVED_COLUMNS = tuple(name for name, (_, compact) in TRIP_ENCODINGS.items() if compact is None)
+
+
+def trip_type(name, compact):
+    """Column type of trip column `name` in the standard or compact layout."""
+    standard, compact_type = TRIP_ENCODINGS[name]
+    return compact_type if compact else standard
+
+
+def stored_records(records, table):
+    """Trip records without the derived keys that `table` computes instead of storing."""
+    if all(name in table.c for name in DERIVED_COLUMNS):
+        return records
+    return [{k: v for k, v in record.items() if k not in DERIVED_COLUMNS} for record in records]
+
+
+def is_compact(column):
+    """True if `column` uses one of the compact encodings."""
+    return isinstance(column.type, (FixedPoint, EpochSeconds))
+
+
+def column_scale(column):
+    """Stored units per value unit: the FixedPoint scale, else 1."""
+    return column.type.scale if isinstance(column.type, FixedPoint) else 1
+
+
+def _divide(numerator, denominator):
+    """
+    Float division rendered as a plain '/': the SQLite dialect otherwise
+    writes x / (y + 0.0), an extra addition per row and operand.
+    """
+    if not isinstance(denominator, ClauseElement):
+        denominator = literal(denominator, Float)
+    # Both sides grouped: a custom operator has no precedence relative to *
+    return Grouping(numerator).op('/', return_type=Float)(Grouping(denominator))
+
+
+def value_of(column):
+    """
+    SQL expression of a column's value in API units, as a plain float for
+    FixedPoint columns so that arithmetic on it (e.g. x * x) is not scaled
+    twice by the column type.
+    """
+    if isinstance(column.type, FixedPoint):
+        return _divide(type_coerce(column, Integer), float(column.type.scale))
+    return column
+
+
+def derived_expressions(columns):
+    """
+    SQL expressions of the derived trip columns over the compact columns.
+
+    They repeat synthetic.compute_derived_features operation by operation,
+    so the computed floats are bit-identical to the ones previously stored.
+    The CASE conditions test the stored integers, which are positive
+    exactly when the scaled values are.
+
+    Args:
+        columns: Mapping of column name to compact column (a Table's .c or
+            the Trip class body)
+
+    Returns:
+        Dict of column name -> SQL expression
+    """
+    stored = {name: type_coerce(columns[name], BigInteger) for name in (
+        'pickup_datetime', 'trip_distance', 'trip_duration', 'fare_amount'
+    )}
+    distance = value_of(columns['trip_distance'])
+    duration = value_of(columns['trip_duration'])
+    fare = value_of(columns['fare_amount'])
+    hours = _divide(duration, 3600.0)
+    km = distance * MILES_TO_KM
+    minutes = _divide(duration, 60.0)
+
+    return {
+        'dropoff_datetime': type_coerce(
+            stored['pickup_datetime'] * 1000 + stored['trip_duration'], EpochMillis()
+        ),
+        'trip_speed': case((stored['trip_duration'] > 0, _divide(distance, hours)), else_=0.0),
+        'fare_per_km': case((stored['trip_distance'] > 0, _divide(fare, km)), else_=0.0),
+        'fare_per_minute': case((stored['trip_duration'] > 0, _divide(fare, minutes)), else_=0.0),
+    }
+
+
+def derived_values(record):
+    """
+    Python counterpart of derived_expressions for one record of API values,
+    with SQL NULL semantics (a NULL condition takes the ELSE branch).
+    """
+    distance, duration, fare = record['trip_distance'], record['trip_duration'], record['fare_amount']
+
+    def ratio(numerator, denominator):
+        if denominator is None or not denominator > 0:
+            return 0.0
+        return None if numerator is None else numerator / denominator
+
+    hours = None if duration is None else duration / 3600.0
+    km = None if distance is None else distance * MILES_TO_KM
+    minutes = None if duration is None else duration / 60.0
+    dropoff = None
+    if record['pickup_datetime'] is not None and duration is not None:
+        dropoff = record['pickup_datetime'] + timedelta(milliseconds=round(duration * 1000))
+    return {
+        'dropoff_datetime': dropoff,
+        'trip_speed': ratio(distance, hours),
+        'fare_per_km': ratio(fare, km),
+        'fare_per_minute': ratio(fare, minutes),
+    }
+
+
+def _dialect(session):
+    return session.get_bind().dialect.name
+
+
+def epoch_seconds(session, column):
+    """Seconds since 1970-01-01 of a datetime column, as an integer SQL expression."""
+    if isinstance(column.type, EpochSeconds):
+        return type_coerce(column, BigInteger)
+    if _dialect(session) == 'sqlite':
+        # Inline format: SQLite re-parses a bound format string on every row
+        return cast(func.strftime(literal_column("'%s'"), column), Integer)
+    return cast(func.floor(extract('epoch', column)), BigInteger)
+
+
+def epoch_millis(session, column):
+    """Milliseconds since 1970-01-01 of a datetime column, as an integer SQL expression."""
+    if isinstance(column.type, EpochSeconds):
+        return type_coerce(column, BigInteger) * (1000 // column.type.unit)
+    if _dialect(session) == 'sqlite':
+        # '%f' is seconds with a fraction (SS.SSS); ROUND guards against 59.999...
+        fraction = cast(func.round(func.strftime(literal_column("'%f'"), column) * 1000), Integer) % 1000
+        return epoch_seconds(session, column) * 1000 + fraction
+    return cast(func.floor(extract('epoch', column) * 1000), BigInteger)
+
+
+def hour_of(session, column):
+    """Hour of day (0-23) of a datetime column."""
+    if isinstance(column.type, EpochSeconds):
+        return (type_coerce(column, BigInteger) % SECONDS_PER_DAY) // 3600
+    return extract('hour', column)
+
+
+def weekday_of(session, column):
+    """Day of week (0 = Sunday) of a datetime column."""
+    if isinstance(column.type, EpochSeconds):
+        # 1970-01-01 was a Thursday
+        return (type_coerce(column, BigInteger) // SECONDS_PER_DAY + 4) % 7
+    return extract('dow', column)
+
+
+def date_of(session, column):
+    """Calendar date of a datetime column ('YYYY-MM-DD' on SQLite)."""
+    if not isinstance(column.type, EpochSeconds):
+        return func.date(column)
+    seconds = type_coerce(column, BigInteger)
+    if _dialect(session) == 'sqlite':
+        return func.date(seconds, literal_column("'unixepoch'"))
+    return func.date(func.timezone('UTC', func.to_timestamp(seconds)))
+
+
+def floor_divide(session, numerator, denominator):
+    """Integer part of numerator / denominator, for a non-negative quotient."""
+    quotient = _divide(numerator, denominator)
+    if _dialect(session) == 'sqlite':
+        # CAST truncates toward zero, which is the floor for x >= 0
+        return cast(quotient, Integer)
+    # PostgreSQL's CAST rounds
+    return cast(func.floor(quotient), Integer)
+
+
+def layout(bind):
+    """'compact' or 'standard': the layout the trips table was created with."""
+    columns = {c['name']: c['type'] for c in inspect(bind).get_columns('trips')}
+    if 'dropoff_datetime' not in columns and 'pickup_datetime' in columns:
+        return 'compact'
+    return 'standard'
+
+
+def check_layout(bind, compact):
+    """Log an error when the configured layout does not match the database."""
+    try:
+        if not inspect(bind).has_table('trips'):
+            return
+        actual = layout(bind)
+    except Exception as e:
+        logger.warning(f"Could not inspect the trips layout: {e}")
+        return
+    expected = 'compact' if compact else 'standard'
+    if actual != expected:
+        logger.error(
+            f"trips uses the {actual} storage layout but COMPACT_STORAGE selects {expected}; "
+            f"set COMPACT_STORAGE={'true' if actual == 'compact' else 'false'} "
+            f"or run migrate_storage.py --to {expected}"
+        )
@@ -0,0 +1,320 @@
+"""
+Single-pass dashboard summary kernel.
+
+Overall statistics, hourly and daily series, payment mix, pickup/dropoff
+zone counts and top pickup zones are all projections of the same filtered
+trips. Instead of one GROUP BY scan per projection, the filtered rows are
+streamed once as a columnar slice of a few numeric columns and every
+aggregate is accumulated with NumPy bincounts. Memory is bounded by the
+fetch batch plus the (small) accumulator arrays, not by the row count.
+When the columnar snapshot (snapshots.py) is current the same blocks are
+sliced from its memory-mapped columns instead of fetched from SQL.
+
+Each section of the result has the same shape as the endpoint it replaces.
+"""
+
+import numpy as np
+from sqlalchemy import select, and_
+
+from models import Trip
+from dimensions import get_dimensions
+import catalog
+import queries
+import snapshots
+import storage
+
+FETCH_BATCH_SIZE = 100000
+HEATMAP_LIMIT = 50
+DEFAULT_ROUTES_LIMIT = 10
+MILLIS_PER_HOUR = 3600 * 1000
+
+# Column order of the streamed slice; the first column is the epoch hour
+SLICE_COLUMNS = [
+    'pickup_zone_id', 'dropoff_zone_id', 'payment_type_id', 'fare_amount',
+    'trip_distance', 'trip_duration', 'trip_speed', 'total_amount',
+]
+(HOUR, PICKUP, DROPOFF, PAYMENT, FARE, DISTANCE, DURATION, SPEED, REVENUE) = range(9)
+
+
+def epoch_hour(session):
+    """Hours since 1970-01-01 of the pickup time, as an integer SQL expression."""
+    return storage.epoch_seconds(session, Trip.pickup_datetime) // 3600
+
+
+class GroupAccumulator:
+    """
+    Running sums over integer group keys of unknown range.
+
+    Sums are kept in one (groups, fields) array addressed by key - offset;
+    the array grows in either direction as new keys appear.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.offset = None
+        self.sums = np.zeros((0, len(fields)))
+
+    def add(self, keys, values):
+        """
+        Add per-row `values` (rows, fields) into the groups named by `keys`.
+        """
+        if keys.size == 0:
+            return
+        low, high = int(keys.min()), int(keys.max())
+        if self.offset is None:
+            self.offset = low
+        if low < self.offset:
+            self.sums = np.vstack((np.zeros((self.offset - low, len(self.fields))), self.sums))
+            self.offset = low
+        size = high - self.offset + 1
+        if size > self.sums.shape[0]:
+            self.sums = np.vstack((self.sums, np.zeros((size - self.sums.shape[0], len(self.fields)))))
+
+        index = keys - self.offset
+        for column in range(len(self.fields)):
+            self.sums[:, column] += np.bincount(
+                index, weights=values[:, column], minlength=self.sums.shape[0]
+            )
+
+    def groups(self):
+        """Yield (key, {field: sum}) for every key that received rows."""
+        if self.offset is None:
+            return
+        count_column = self.fields.index('count')
+        for position in np.flatnonzero(self.sums[:, count_column]):
+            yield int(position) + self.offset, dict(zip(self.fields, self.sums[position]))
+
+
+def _sum_and_count(values):
+    """(value with NaN as 0, 1 where present) for NULL-aware averages."""
+    present = ~np.isnan(values)
+    return np.where(present, values, 0.0), present.astype(np.float64)
+
+
+def _avg(group, metric):
+    n = group[f'{metric}_n']
+    return round(float(group[f'{metric}_sum'] / n), 2) if n else 0.0
+
+
+HOUR_FIELDS = [
+    'count', 'fare_sum', 'fare_n', 'speed_sum', 'speed_n', 'distance_sum',
+    'distance_n', 'duration_sum', 'duration_n', 'revenue_sum',
+]
+PICKUP_FIELDS = ['count', 'fare_sum', 'fare_n', 'distance_sum', 'distance_n']
+DROPOFF_FIELDS = ['count']
+PAYMENT_FIELDS = ['count', 'fare_sum', 'fare_n']
+
+
+def _sql_blocks(session, filters, batch_size):
+    """Yield float64 blocks (rows, [HOUR] + SLICE_COLUMNS) of the filtered trips from SQL."""
+    stmt = select(
+        epoch_hour(session).label('epoch_hour'),
+        *[getattr(Trip, c) for c in SLICE_COLUMNS]
+    )
+    if filters:
+        stmt = stmt.where(and_(*filters))
+
+    # Every selected column is numeric, so rows are read straight from the
+    # DBAPI cursor as plain tuples without per-row result processing; values
+    # stored as fixed-point integers are scaled per block instead
+    scales = np.array([1] + [storage.column_scale(getattr(Trip, c)) for c in SLICE_COLUMNS], dtype=np.float64)
+    scaled = bool((scales != 1).any())
+
+    result = session.connection().execute(stmt)
+    cursor = result.cursor
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        # None becomes NaN in a float array
+        block = np.array(rows, dtype=np.float64)
+        if scaled:
+            block /= scales
+        yield block
+    result.close()
+
+
+def _snapshot_blocks(scan):
+    """The blocks of _sql_blocks, assembled from a snapshot scan."""
+    for columns in scan:
+        hours = columns['pickup_datetime'].astype(np.int64) // MILLIS_PER_HOUR
+        block = np.empty((hours.size, len(SLICE_COLUMNS) + 1))
+        block[:, HOUR] = hours
+        for position, name in enumerate(SLICE_COLUMNS, start=1):
+            values = columns[name]
+            block[:, position] = values
+            if values.dtype.kind == 'i':
+                block[values == snapshots.NULL_VALUE, position] = np.nan
+        yield block
+
+
+def accumulate(session, filters, batch_size=FETCH_BATCH_SIZE):
+    """
+    Stream the filtered trips once and accumulate every dashboard aggregate.
+
+    The trips are read from the columnar snapshot when it is current and
+    every filter can be evaluated on it, otherwise from SQL. The snapshot
+    yields the blocks of a trip_id-order scan; SQL may read the rows through
+    an index in another order, which can change the last rounded digit of
+    an average.
+
+    Returns:
+        Dict of GroupAccumulator keyed by 'hour' (epoch hour), 'pickup',
+        'dropoff' and 'payment'
+    """
+    accumulators = {
+        'hour': GroupAccumulator(HOUR_FIELDS),
+        'pickup': GroupAccumulator(PICKUP_FIELDS),
+        'dropoff': GroupAccumulator(DROPOFF_FIELDS),
+        'payment': GroupAccumulator(PAYMENT_FIELDS),
+    }
+
+    blocks = None
+    snapshot = snapshots.get_snapshot(session)
+    if snapshot is not None:
+        # The most selective filter (by the statistics catalog) is evaluated first
+        stats = catalog.get_catalog(session, snapshot.version)
+        scan = snapshot.scan(
+            ['pickup_datetime'] + SLICE_COLUMNS, filters, batch_size,
+            selectivity=stats.selectivity if stats is not None else None
+        )
+        if scan is not None:
+            blocks = _snapshot_blocks(scan)
+    if blocks is None:
+        blocks = _sql_blocks(session, filters, batch_size)
+
+    for block in blocks:
+        ones = np.ones(block.shape[0])
+
+        fare, fare_n = _sum_and_count(block[:, FARE])
+        speed, speed_n = _sum_and_count(block[:, SPEED])
+        distance, distance_n = _sum_and_count(block[:, DISTANCE])
+        duration, duration_n = _sum_and_count(block[:, DURATION])
+        revenue, _ = _sum_and_count(block[:, REVENUE])
+
+        accumulators['hour'].add(
+            block[:, HOUR].astype(np.int64),
+            np.column_stack((ones, fare, fare_n, speed, speed_n, distance,
+                             distance_n, duration, duration_n, revenue))
+        )
+
+        for name, column, values in (
+            ('pickup', PICKUP, np.column_stack((ones, fare, fare_n, distance, distance_n))),
+            ('dropoff', DROPOFF, ones[:, None]),
+            ('payment', PAYMENT, np.column_stack((ones, fare, fare_n))),
+        ):
+            # Trips without the dimension drop out, as in the joined queries
+            keys = block[:, column]
+            known = ~np.isnan(keys)
+            accumulators[name].add(keys[known].astype(np.int64), values[known])
+
+    return accumulators
+
+
+def _rollup(hour_groups, key):
+    """Sum epoch-hour groups by `key(epoch_hour)`."""
+    totals = {}
+    for hour, group in hour_groups:
+        target = totals.setdefault(key(hour), dict.fromkeys(HOUR_FIELDS, 0.0))
+        for field, value in group.items():
+            target[field] += value
+    return totals
+
+
+def _top_zones(groups, zones, limit):
+    """Zone groups known to `zones`, by count descending then zone_id."""
+    known = [(zone_id, group) for zone_id, group in groups if zone_id in zones]
+    known.sort(key=lambda item: (-item[1]['count'], item[0]))
+    return known[:limit]
+
+
+def build_summary(accumulators, zones, payment_names, routes_limit=DEFAULT_ROUTES_LIMIT):
+    """
+    Shape accumulated sums like the endpoints they replace.
+
+    Args:
+        accumulators: Result of accumulate()
+        zones: Dict zone_id -> (zone_name, borough)
+        payment_names: Dict payment_type_id -> payment_name
+        routes_limit: Number of top pickup zones
+
+    Returns:
+        Dict with 'overall' (/api/statistics), 'hourly' and 'daily'
+        (/api/time-series), 'payment_types' (/api/statistics grouped by
+        payment type), 'heatmap' (/api/heatmap) and 'top_routes'
+        (/api/top-routes, over the filtered trips)
+    """
+    hour_groups = list(accumulators['hour'].groups())
+    overall = _rollup(hour_groups, lambda hour: None).get(None, dict.fromkeys(HOUR_FIELDS, 0.0))
+    hourly = _rollup(hour_groups, lambda hour: hour % 24)
+    daily = _rollup(hour_groups, lambda hour: hour // 24)
+
+    def series_row(label, unit, group):
+        return {
+            label: unit,
+            'trip_count': int(group['count']),
+            'avg_fare': _avg(group, 'fare'),
+            'avg_speed': _avg(group, 'speed'),
+            'total_revenue': round(float(group['revenue_sum']), 2)
+        }
+
+    payment_mix = {}
+    for payment_id, group in accumulators['payment'].groups():
+        if payment_id not in payment_names:
+            continue
+        mix = payment_mix.setdefault(payment_names[payment_id], dict.fromkeys(PAYMENT_FIELDS, 0.0))
+        for field, value in group.items():
+            mix[field] += value
+
+    def heatmap_side(name):
+        return [{
+            'zone_id': zone_id,
+            'zone_name': zones[zone_id][0],
+            'borough': zones[zone_id][1],
+            'count': int(group['count'])
+        } for zone_id, group in _top_zones(accumulators[name].groups(), zones, HEATMAP_LIMIT)]
+
+    return {
+        'overall': {
+            'total_trips': int(overall['count']),
+            'avg_fare': _avg(overall, 'fare'),
+            'avg_distance': _avg(overall, 'distance'),
+            'avg_duration': _avg(overall, 'duration'),
+            'avg_speed': _avg(overall, 'speed'),
+            'total_revenue': round(float(overall['revenue_sum']), 2)
+        },
+        'hourly': [series_row('hour', hour, group) for hour, group in sorted(hourly.items())],
+        'daily': [
+            series_row('date', str(np.datetime64(day, 'D')), group)
+            for day, group in sorted(daily.items())
+        ],
+        'payment_types': [{
+            'payment_type': name,
+            'trip_count': int(group['count']),
+            'avg_fare': _avg(group, 'fare')
+        } for name, group in sorted(payment_mix.items())],
+        'heatmap': {
+            'pickup': heatmap_side('pickup'),
+            'dropoff': heatmap_side('dropoff'),
+        },
+        'top_routes': [{
+            'pickup_zone': zones[zone_id][0],
+            'pickup_zone_id': zone_id,
+            'trip_count': int(group['count']),
+            'avg_fare': _avg(group, 'fare'),
+            'avg_distance': _avg(group, 'distance')
+        } for zone_id, group in _top_zones(accumulators['pickup'].groups(), zones, routes_limit)],
+    }
+
+
+def query_summary(session, args, filters):
+    """Body of /api/summary."""
+    routes_limit = queries.page_param(args, 'limit', DEFAULT_ROUTES_LIMIT, queries.MAX_PAGE_SIZE)
+    dimensions = get_dimensions(session)
+    zones = {z.zone_id: (z.zone_name, z.borough) for z in dimensions.zone_list}
+    payment_names = {
+        payment_id: name for payment_id, name in enumerate(dimensions.payment_names)
+        if name is not None
+    }
+
+    return build_summary(accumulate(session, filters), zones, payment_names, routes_limit)
@@ -0,0 +1,315 @@
+"""
+Deterministic synthetic trip generator for scale testing.
+
+Produces SQLite databases with the same schema as nyc_taxi.db at arbitrary
+sizes (100k, 1M, 10M rows, ...). Zone, hour and fare distributions follow
+the shape of the real TLC data: Manhattan-heavy pickups, a morning and an
+evening rush, airport trips that are longer and mostly flat-rate, and
+fares computed from distance and duration with the usual surcharges.
+
+Usage:
+    python synthetic.py --rows 1000000 --output bench_1m.db
+"""
+
+import argparse
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.orm import sessionmaker
+
+from models import Base, Trip, Zone, PaymentType, RateCode
+from ingest import after_ingest
+from storage import MILES_TO_KM, stored_records
+
+logger = logging.getLogger(__name__)
+
+# Relative trip volume per hour of day (0-23), shaped like the TLC data
+HOURLY_PROFILE = np.array([
+    157, 71, 81, 83, 168, 308, 631, 773, 621, 471, 397, 397,
+    407, 433, 486, 556, 599, 777, 600, 488, 417, 301, 245, 149,
+], dtype=float)
+
+# Relative trip volume per weekday (Monday=0)
+WEEKDAY_PROFILE = np.array([0.92, 0.97, 1.0, 1.04, 1.1, 1.08, 0.89])
+
+# Mean traffic speed (mph) per hour of day
+HOURLY_SPEED = np.array([
+    21, 22, 23, 23, 22, 19, 15, 12, 11, 12, 13, 13,
+    13, 13, 12, 11, 11, 11, 12, 14, 16, 18, 19, 20,
+], dtype=float)
+
+PAYMENT_TYPE_WEIGHTS = {1: 0.71, 2: 0.245, 3: 0.03, 4: 0.015}
+PASSENGER_WEIGHTS = {1: 0.70, 2: 0.148, 3: 0.083, 4: 0.039, 5: 0.019, 6: 0.011}
+
+BOROUGH_WEIGHTS = {
+    'Manhattan': 10.0,
+    'Queens': 2.0,
+    'Brooklyn': 1.5,
+    'Bronx': 0.5,
+    'Staten Island': 0.1,
+    'EWR': 0.3,
+    'Unknown': 0.05,
+}
+
+AIRPORT_ZONES = {1: 3, 132: 2, 137: 2, 138: 1}  # zone_id -> rate_code_id
+
+DEFAULT_SOURCE_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nyc_taxi.db')
+
+
+def load_reference_data(source_db):
+    """
+    Load lookup tables from an existing database.
+
+    Returns:
+        Tuple of (zones, payment_types, rate_codes) as lists of dicts
+    """
+    engine = create_engine(f"sqlite:///{source_db}")
+    with engine.connect() as conn:
+        zones = [dict(r._mapping) for r in conn.execute(select(Zone.__table__).order_by(Zone.zone_id))]
+        payment_types = [dict(r._mapping) for r in conn.execute(select(PaymentType.__table__))]
+        rate_codes = [dict(r._mapping) for r in conn.execute(select(RateCode.__table__))]
+    engine.dispose()
+    return zones, payment_types, rate_codes
+
+
+def zone_weights(zones, rng):
+    """
+    Popularity weight per zone: borough weight times a Zipf-like rank factor.
+
+    The rank order is drawn from the seeded generator, so the same seed
+    always produces the same hot zones.
+    """
+    base = np.array([BOROUGH_WEIGHTS.get(z['borough'], 0.5) for z in zones])
+    ranks = rng.permutation(len(zones)) + 1
+    weights = base / np.sqrt(ranks)
+    return weights / weights.sum()
+
+
+def compute_derived_features(distance, duration, fare):
+    """
+    Vectorized derived features (speed in mph, fare per km, fare per minute).
+
+    Args:
+        distance: Trip distance in miles
+        duration: Trip duration in seconds
+        fare: Fare amount in dollars
+
+    Returns:
+        Tuple of (trip_speed, fare_per_km, fare_per_minute) arrays
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hours = duration / 3600.0
+        trip_speed = np.where(hours > 0, distance / hours, 0.0)
+        km = distance * MILES_TO_KM
+        fare_per_km = np.where(km > 0, fare / km, 0.0)
+        minutes = duration / 60.0
+        fare_per_minute = np.where(minutes > 0, fare / minutes, 0.0)
+    return trip_speed, fare_per_km, fare_per_minute
+
+
+class SyntheticTripGenerator:
+    """
+    Generates trips in fixed-size chunks from a seeded NumPy generator.
+
+    Every chunk is derived from (seed, chunk_index), so the output is
+    identical regardless of chunk scheduling and can be regenerated
+    partially.
+    """
+
+    def __init__(self, zones, seed=42, start_date='2024-01-01', days=365):
+        self.zones = zones
+        self.seed = seed
+        self.start = datetime.strptime(start_date, '%Y-%m-%d')
+        self.days = days
+
+        rng = np.random.default_rng(seed)
+        self.zone_ids = np.array([z['zone_id'] for z in zones])
+        self.zone_p = zone_weights(zones, rng)
+
+        # Day weights combine weekday seasonality with a mild annual cycle
+        start_weekday = self.start.weekday()
+        day_index = np.arange(days)
+        weekday = (start_weekday + day_index) % 7
+        seasonal = 1.0 + 0.08 * np.cos(2 * np.pi * (day_index - 140) / 365.0)
+        day_p = WEEKDAY_PROFILE[weekday] * seasonal
+        self.day_p = day_p / day_p.sum()
+        self.hour_p = HOURLY_PROFILE / HOURLY_PROFILE.sum()
+
+        self.payment_ids = np.array(list(PAYMENT_TYPE_WEIGHTS))
+        self.payment_p = np.array(list(PAYMENT_TYPE_WEIGHTS.values()))
+        self.payment_p /= self.payment_p.sum()
+        self.passenger_ids = np.array(list(PASSENGER_WEIGHTS))
+        self.passenger_p = np.array(list(PASSENGER_WEIGHTS.values()))
+        self.passenger_p /= self.passenger_p.sum()
+
+    def generate_chunk(self, chunk_index, size, first_trip_id):
+        """
+        Generate one chunk of trip records.
+
+        Returns:
+            List of dicts keyed by Trip column name
+        """
+        rng = np.random.default_rng([self.seed, chunk_index])
+
+        pickup_zone = rng.choice(self.zone_ids, size=size, p=self.zone_p)
+        # About 2% of trips start and end in the same zone
+        same_zone = rng.random(size) < 0.02
+        dropoff_zone = np.where(same_zone, pickup_zone, rng.choice(self.zone_ids, size=size, p=self.zone_p))
+
+        day = rng.choice(self.days, size=size, p=self.day_p)
+        hour = rng.choice(24, size=size, p=self.hour_p)
+        second_of_hour = rng.integers(0, 3600, size=size)
+        pickup_offset = day * 86400 + hour * 3600 + second_of_hour
+
+        # Distance: log-normal around ~2.5 miles, airports much longer
+        distance = rng.lognormal(mean=0.9, sigma=0.65, size=size)
+        airport = np.isin(pickup_zone, list(AIRPORT_ZONES)) | np.isin(dropoff_zone, list(AIRPORT_ZONES))
+        distance = np.where(airport, rng.normal(16.5, 3.0, size=size), distance)
+        distance = np.round(np.clip(distance, 0.3, 60.0), 2)
+
+        speed = HOURLY_SPEED[hour] * rng.lognormal(mean=0.0, sigma=0.25, size=size)
+        duration = np.round(distance / np.clip(speed, 2.0, 65.0) * 3600.0, 3)
+
+        rate_code = np.ones(size, dtype=int)
+        for zone_id, code in AIRPORT_ZONES.items():
+            rate_code = np.where((pickup_zone == zone_id) | (dropoff_zone == zone_id), code, rate_code)
+        negotiated = rng.random(size) < 0.005
+        rate_code = np.where(negotiated, 5, rate_code)
+
+        metered = 3.00 + 2.50 * distance + 0.35 * (duration / 60.0)
+        fare = np.where(rate_code == 2, 70.00, metered)
+        fare = np.where(rate_code == 3, metered + 20.00, fare)
+        fare = np.where(rate_code == 5, metered * rng.uniform(0.8, 1.2, size=size), fare)
+        fare = np.round(fare, 2)
+
+        extra = np.where((hour >= 16) & (hour < 20), 1.0, np.where((hour >= 20) | (hour < 6), 0.5, 0.0))
+        mta_tax = np.full(size, 0.5)
+        improvement_surcharge = np.full(size, 0.3)
+        tolls = np.where(airport & (rng.random(size) < 0.4), 6.94, 0.0)
+
+        payment_type = rng.choice(self.payment_ids, size=size, p=self.payment_p)
+        tip_rate = rng.choice([0.0, 0.15, 0.18, 0.2, 0.25], size=size, p=[0.1, 0.25, 0.25, 0.3, 0.1])
+        tip = np.where(payment_type == 1, np.round(fare * tip_rate, 2), 0.0)
+        # No-charge and disputed trips are recorded with a zero fare
+        charged = payment_type <= 2
+        total = np.where(charged, fare + extra + mta_tax + tip + tolls + improvement_surcharge, 0.0)
+        total = np.round(total, 2)
+
+        passengers = rng.choice(self.passenger_ids, size=size, p=self.passenger_p)
+        trip_speed, fare_per_km, fare_per_minute = compute_derived_features(distance, duration, fare)
+
+        records = []
+        for i in range(size):
+            pickup = self.start + timedelta(seconds=int(pickup_offset[i]))
+            dropoff = pickup + timedelta(seconds=float(duration[i]))
+            records.append({
+                'trip_id': first_trip_id + i,
+                'pickup_datetime': pickup,
+                'dropoff_datetime': dropoff,
+                'pickup_zone_id': int(pickup_zone[i]),
+                'dropoff_zone_id': int(dropoff_zone[i]),
+                'payment_type_id': int(payment_type[i]),
+                'rate_code_id': int(rate_code[i]),
+                'passenger_count': int(passengers[i]),
+                'trip_distance': float(distance[i]),
+                'trip_duration': float(duration[i]),
+                'fare_amount': float(fare[i]),
+                'extra': float(extra[i]),
+                'mta_tax': float(mta_tax[i]),
+                'tip_amount': float(tip[i]),
+                'tolls_amount': float(tolls[i]),
+                'improvement_surcharge': float(improvement_surcharge[i]),
+                'total_amount': float(total[i]),
+                'trip_speed': float(trip_speed[i]),
+                'fare_per_km': float(fare_per_km[i]),
+                'fare_per_minute': float(fare_per_minute[i]),
+            })
+        return records
+
+
+def build_database(output, rows, seed=42, source_db=DEFAULT_SOURCE_DB,
+                   start_date='2024-01-01', days=365, chunk_size=100000):
+    """
+    Create a SQLite database with `rows` synthetic trips.
+
+    Lookup tables are copied from `source_db`. Secondary indexes are
+    dropped during the load and rebuilt afterwards, which is much faster
+    than maintaining them row by row.
+    """
+    if os.path.exists(output):
+        os.remove(output)
+
+    zones, payment_types, rate_codes = load_reference_data(source_db)
+    generator = SyntheticTripGenerator(zones, seed=seed, start_date=start_date, days=days)
+
+    engine = create_engine(f"sqlite:///{output}")
+
+    @event.listens_for(engine, 'connect')
+    def _bulk_load_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=OFF')
+        cursor.execute('PRAGMA synchronous=OFF')
+        cursor.close()
+
+    Base.metadata.create_all(engine)
+    trip_indexes = list(Trip.__table__.indexes)
+
+    started = time.perf_counter()
+    with engine.begin() as conn:
+        for index in trip_indexes:
+            index.drop(conn)
+        conn.execute(Zone.__table__.insert(), zones)
+        conn.execute(PaymentType.__table__.insert(), payment_types)
+        conn.execute(RateCode.__table__.insert(), rate_codes)
+
+    written = 0
+    chunk_index = 0
+    while written < rows:
+        size = min(chunk_size, rows - written)
+        records = generator.generate_chunk(chunk_index, size, first_trip_id=written + 1)
+        with engine.begin() as conn:
+            conn.execute(Trip.__table__.insert(), stored_records(records, Trip.__table__))
+        written += size
+        chunk_index += 1
+        logger.info(f"Inserted {written:,}/{rows:,} trips")
+
+    with engine.begin() as conn:
+        for index in trip_indexes:
+            index.create(conn)
+
+    session = sessionmaker(bind=engine)()
+    after_ingest(session, since_trip_id=1)
+    session.close()
+    engine.dispose()
+
+    elapsed = time.perf_counter() - started
+    logger.info(f"Built {output} with {rows:,} trips in {elapsed:.1f}s")
+    return output
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Generate a synthetic NYC taxi trip database')
+    parser.add_argument('--rows', type=int, default=100000, help='Number of trips to generate')
+    parser.add_argument('--output', default='bench_trips.db', help='Output SQLite file')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed')
+    parser.add_argument('--source-db', default=DEFAULT_SOURCE_DB, help='Database to copy zone/lookup tables from')
+    parser.add_argument('--start-date', default='2024-01-01', help='First pickup date (YYYY-MM-DD)')
+    parser.add_argument('--days', type=int, default=365, help='Number of days covered')
+    parser.add_argument('--chunk-size', type=int, default=100000, help='Rows generated per insert batch')
+    args = parser.parse_args()
+
+    build_database(
+        args.output,
+        args.rows,
+        seed=args.seed,
+        source_db=args.source_db,
+        start_date=args.start_date,
+        days=args.days,
+        chunk_size=args.chunk_size,
+    )
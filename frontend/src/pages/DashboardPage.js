@@ -30,25 +30,13 @@ const DashboardPage = () => {
   const loadDashboardData = useCallback(async () => {
     try {
       setLoading(true);
-      const [
-        timeSeriesData,
-        heatmapData,
-        routesData,
-        hourlyData,
-        statsData
-      ] = await Promise.all([
-        apiService.getTimeSeries({ ...filters, interval: 'day' }),
-        apiService.getHeatmap(filters),
-        apiService.getTopRoutes({ ...filters, limit: 10 }),
-        apiService.getTimeSeries({ ...filters, interval: 'hour' }),
-        apiService.getStatistics(filters)
-      ]);
+      const summary = await apiService.getSummary({ ...filters, limit: 10 });
 
-      setTimeSeries(timeSeriesData.time_series || []);
-      setHeatmap(heatmapData);
-      setTopRoutes(routesData.routes || []);
-      setHourlyStats(hourlyData.time_series || []);
-      setStatistics(statsData.overall);
+      setTimeSeries(summary.daily || []);
+      setHeatmap(summary.heatmap);
+      setTopRoutes(summary.top_routes || []);
+      setHourlyStats(summary.hourly || []);
+      setStatistics(summary.overall);
     } catch (error) {
       console.error('Error loading dashboard data:', error);
     } finally {
@@ -66,6 +66,12 @@ export const apiService = {
     return response.data;
   },
 
+  // Every dashboard aggregate computed in one pass over the filtered trips
+  getSummary: async (params) => {
+    const response = await api.get('/api/summary', { params: cleanParams(params) });
+    return response.data;
+  },
+
   // Health check
   healthCheck: async () => {
     const response = await api.get('/health');